@@ -9767,13 +9767,23 @@ class ComputeManager(manager.Manager):
         number of virtual machines known by the database, we proceed in a lazy
         loop, one database record at a time, checking if the hypervisor has the
         same power state as is in the database.
+
+        If the driver can report the power states of all its instances in one
+        call, we compare them with the database in one pass instead and only
+        sync the instances not matching. The sync still queries the driver
+        under the instance lock, as the bulk states might be outdated by then.
         """
         db_instances = objects.InstanceList.get_by_host(context, self.host,
                                                         expected_attrs=[],
                                                         use_slave=True)
 
+        vm_power_states = None
         try:
-            num_vm_instances = self.driver.get_num_instances()
+            try:
+                vm_power_states = self.driver.get_power_states()
+                num_vm_instances = len(vm_power_states)
+            except NotImplementedError:
+                num_vm_instances = self.driver.get_num_instances()
         except exception.VirtDriverNotReady as e:
             # If the virt driver is not ready, like ironic-api not being up
             # yet in the case of ironic, just log it and exit.
@@ -9790,7 +9800,7 @@ class ComputeManager(manager.Manager):
                         {'num_db_instances': num_db_instances,
                          'num_vm_instances': num_vm_instances})
 
-        def _sync(db_instance):
+        def _sync(db_instance, delay=True):
             # NOTE(melwitt): This must be synchronized as we query state from
             #                two separate sources, the driver and the database.
             #                They are set (in stop_instance) and read, in sync.
@@ -9799,8 +9809,12 @@ class ComputeManager(manager.Manager):
                 self._query_driver_power_state_and_sync(context, db_instance)
 
             try:
-                greenthread.sleep(random.randint(
-                    1, CONF.sync_power_state_interval))
+                # NOTE: The random sleep spreads the load on the driver. We
+                # don't need that for the few instances the bulk query found
+                # out of sync.
+                if delay:
+                    greenthread.sleep(random.randint(
+                        1, CONF.sync_power_state_interval))
                 query_driver_power_state_and_sync()
             except Exception:
                 LOG.exception("Periodic sync_power_state task had an "
@@ -9810,6 +9824,14 @@ class ComputeManager(manager.Manager):
             self._syncs_in_progress.pop(db_instance.uuid)
 
         for db_instance in db_instances:
+            sync_args = (db_instance,)
+            if vm_power_states is not None:
+                vm_power_state = vm_power_states.get(db_instance.uuid,
+                                                     power_state.NOSTATE)
+                if self._is_power_state_in_sync(db_instance, vm_power_state):
+                    continue
+                sync_args = (db_instance, False)
+
             # process syncs asynchronously - don't want instance locking to
             # block entire periodic task thread
             uuid = db_instance.uuid
@@ -9820,7 +9842,29 @@ class ComputeManager(manager.Manager):
                 self._syncs_in_progress[uuid] = True
                 nova.utils.pass_context(self._sync_power_pool.spawn_n,
                                         _sync,
-                                        db_instance)
+                                        *sync_args)
+
+    @staticmethod
+    def _is_power_state_in_sync(db_instance, vm_power_state):
+        """Return True if syncing the instance's power state is a no-op
+
+        This only covers the common cases, where the power state in the
+        database matches the hypervisor and fits the vm_state, so
+        _sync_instance_power_state() would not change anything.
+        """
+        if db_instance.task_state is not None:
+            return False
+        if db_instance.power_state != vm_power_state:
+            return False
+
+        vm_state = db_instance.vm_state
+        if vm_state == vm_states.ACTIVE:
+            return vm_power_state == power_state.RUNNING
+        if vm_state == vm_states.STOPPED:
+            return vm_power_state in (power_state.NOSTATE,
+                                      power_state.SHUTDOWN,
+                                      power_state.CRASHED)
+        return False
 
     def _query_driver_power_state_and_sync(self, context, db_instance):
         if db_instance.task_state is not None:
@@ -242,6 +242,21 @@ datastore name. This setting must include a matched group of the name
                  help="""
 Time interval in seconds to poll remote tasks invoked on
 VMware VC server.
+"""),
+    cfg.BoolOpt('use_property_collector_for_tasks',
+                default=True,
+                help="""
+Wait for remote tasks through a single property collector
+
+Instead of polling each task every ``task_poll_interval`` seconds, the driver
+registers all tasks it waits for with one property collector and gets woken
+up by the vCenter as soon as a task finished. If that fails, the driver falls
+back to polling the task.
+
+Related options:
+
+* task_poll_interval
+* property_collector_max_wait_seconds
 """),
     cfg.IntOpt('api_retry_count',
                min=0,
@@ -315,7 +330,70 @@ This option sets the http connection pool size
 The connection pool size is the maximum number of connections from nova to
 vSphere.  It should only be increased if there are warnings indicating that
 the connection pool is full, otherwise, the default should suffice.
-""")
+
+Related options:
+
+* session_read_concurrency
+* session_reconfigure_concurrency
+* session_transfer_concurrency
+"""),
+    cfg.IntOpt('session_read_concurrency',
+               min=0,
+               default=0,
+               help="""
+Maximum number of concurrent API calls only reading from the vCenter
+
+API calls are sorted into lanes: "transfer" for operations moving data like
+clones, relocations and imports, "reconfigure" for all other tasks and "read"
+for everything else, e.g. reading properties. Each lane has its own limit, so
+a burst of heavy operations cannot use up all connections of the pool. Long
+polls waiting for property-collector updates are not limited and do not count
+against the "read" lane.
+
+Possible values:
+ * 0: no limit
+ * integer > 0: maximum number of concurrent calls
+
+Related options:
+
+* connection_pool_size
+"""),
+    cfg.IntOpt('session_reconfigure_concurrency',
+               min=0,
+               default=4,
+               help="""
+Maximum number of concurrent API calls starting a task in the vCenter
+
+This applies to all tasks not counted as transfer, e.g. reconfiguring or
+powering on a VM. See ``session_read_concurrency`` for the lanes.
+
+Possible values:
+ * 0: no limit
+ * integer > 0: maximum number of concurrent calls
+
+Related options:
+
+* connection_pool_size
+* session_read_concurrency
+"""),
+    cfg.IntOpt('session_transfer_concurrency',
+               min=0,
+               default=2,
+               help="""
+Maximum number of concurrent API calls moving data in the vCenter
+
+This applies to clones, relocations, migrations and imports or exports of
+VMs. See ``session_read_concurrency`` for the lanes.
+
+Possible values:
+ * 0: no limit
+ * integer > 0: maximum number of concurrent calls
+
+Related options:
+
+* connection_pool_size
+* session_read_concurrency
+"""),
 ]
 
 spbm_opts = [
@@ -407,6 +485,58 @@ instances as clone from template.
                 help="""
 Before fetching from Glance an image missing on the datastore first look
 for it on other datastores and clone it from there if available.
+"""),
+    cfg.IntOpt('image_template_prewarm_count',
+               min=0,
+               default=0,
+               help="""
+Number of the most booted images to keep image-template VMs for everywhere
+
+With ``image_as_template``, the first spawn of an image on a datastore has to
+wait for the image-template VM to be created there. The driver counts how
+often each image is booted and, when managing the image cache, clones the
+templates of the most booted images to the datastores a spawn would choose
+for them. That's one datastore matching the storage policy of the image's
+latest boot, or one per hagroup with ``datastore_hagroup_regex``.
+
+Possible values:
+ * 0: disable pre-warming
+ * integer > 0: number of images to pre-warm
+
+Related options:
+
+* image_as_template
+* fetch_image_from_other_datastores
+* image_template_prewarm_concurrency
+* [image_cache] manager_interval
+"""),
+    cfg.IntOpt('image_template_prewarm_concurrency',
+               min=1,
+               default=2,
+               help="""
+Number of image-template VMs cloned in parallel when pre-warming
+
+The clones run in a background thread started by the image cache management.
+A new run is only started after the previous one finished.
+
+Related options:
+
+* image_template_prewarm_count
+"""),
+    cfg.IntOpt('image_template_cleanup_concurrency',
+               min=1,
+               default=4,
+               help="""
+Number of expired image-template VMs destroyed in parallel
+
+When aging the image cache, image-template VMs not used within
+``[image_cache] remove_unused_original_minimum_age_seconds`` get destroyed.
+This limits how many of them are destroyed at the same time, so the cleanup
+doesn't take long on many templates without flooding the vCenter with tasks.
+
+Related options:
+
+* image_as_template
 """),
     cfg.BoolOpt('use_property_collector',
                 default=True,
@@ -414,6 +544,99 @@ for it on other datastores and clone it from there if available.
 Should the driver use a property collector to fetch essential properties
 and keep a local copy of the values. This should reduce the load on the
 vcenter api and be quicker, then polling each value individually
+
+This also applies to finding a free VNC port. Without a property collector,
+the VNC ports of all VMs in the vCenter are read for every new VM.
+"""),
+    cfg.IntOpt('property_collector_max_wait_seconds',
+               min=1,
+               default=30,
+               help="""
+Time in seconds the property-collector watcher blocks waiting for changes
+
+With ``use_property_collector`` enabled, a background thread waits for
+updates from the vCenter and applies them to the local cache as they arrive.
+This defines the ``maxWaitSeconds`` passed to each ``WaitForUpdatesEx`` call.
+It should be well below the timeout of the http connection to the vCenter.
+
+Related options:
+
+* use_property_collector
+* property_collector_max_cache_age
+"""),
+    cfg.IntOpt('property_collector_max_cache_age',
+               min=0,
+               default=120,
+               help="""
+Time in seconds after which the property-collector cache is considered stale
+
+The cache is considered fresh, if the vCenter confirmed it to be in sync
+within this amount of time. Callers not trusting a stale cache fall back to
+querying the vCenter directly.
+
+Possible values:
+ * integer > 0: maximum age of the cache in seconds
+ * integer = 0: never trust the cache
+
+Related options:
+
+* use_property_collector
+* property_collector_max_wait_seconds
+"""),
+    cfg.FloatOpt('datastore_inventory_max_age',
+                 default=1,
+                 help="""
+Time in seconds a cached datastore inventory is used without asking for changes
+
+With ``use_property_collector`` enabled, the datastores of a cluster are
+cached with their capacity, free space, accessibility and maintenance mode.
+A property collector tells the driver what changed since the last update, so
+selecting a datastore doesn't need to fetch all datastores every time. Within
+this amount of time after an update, the cache is used as is, so concurrent
+spawns don't all ask the vCenter for changes.
+
+Possible values:
+ * floating point value >= 0: maximum age of the cache in seconds
+ * floating point value < 0: disable the cache and always fetch all datastores
+
+Related options:
+
+* use_property_collector
+* datastore_policy_cache_ttl
+"""),
+    cfg.IntOpt('datastore_reservation_headroom_percent',
+               min=0,
+               max=100,
+               default=0,
+               help="""
+Percentage of a datastore's capacity to keep free when selecting a datastore
+
+When selecting a datastore, the space reserved for disks of instances being
+spawned is deducted from the free space reported by the vCenter, until the
+vCenter reports an updated free space. Additionally, this percentage of the
+capacity is deducted, so datastores close to being full get picked last.
+
+Possible values:
+ * integer between 0 and 100: percentage of the capacity to keep free
+"""),
+    cfg.IntOpt('datastore_policy_cache_ttl',
+               min=0,
+               default=300,
+               help="""
+Time in seconds to cache which datastores match a storage policy
+
+Filtering datastores by storage policy needs a call to the storage policy
+service. As the compatibility of datastores with a policy rarely changes, the
+result gets cached for the given datastores.
+
+Possible values:
+ * integer > 0: time in seconds to cache the result
+ * integer = 0: disable the cache
+
+Related options:
+
+* pbm_enabled
+* datastore_inventory_max_age
 """),
     cfg.IntOpt('min_disk_size_kb',
                default=1,
@@ -470,10 +693,12 @@ vmwareapi_driver_opts = [
                  help="""
 Amount of time in seconds between server-group sync via sync-loop
 
-The sync-loop for server-groups in the driver iterates over all applicable
-server-groups and calls "sync_server_group()" on them, sleeping a random time
-before calling the sync. The amount of time slept at max can be defined by this
-config value.
+The sync-loop for server-groups in the driver syncs the DRS rules of all
+applicable server-groups at once. If ``datastore_hagroup_regex`` is set, it
+then iterates over the server-groups to check their disk placement, sleeping a
+random time before each check. The amount of time slept at max can be defined
+by this config value. The relocations necessary to fix the disk placement run
+after all server-groups have been checked.
 
 Possible values:
  * floating point value of seconds passed to random.uniform(0.5, X)
@@ -485,10 +710,66 @@ Amount of time in seconds to wait between server-group sync-loop runs
 
 The sync-loop thread for server-groups runs continuously, sleeping after
 syncing all groups. This setting defines how long to sleep between runs.
+Changes to server-groups and their members are synced by the queue-based
+sync worker, so the sync-loop only serves as a consistency check.
 
 Possible values:
  * integer >= time in seconds to sleep between runs
  * intger < 0: disable the sync-loop
+
+Related options:
+
+* server_group_sync_queue_delay
+"""),
+    cfg.FloatOpt('server_group_sync_queue_delay',
+                 default=2,
+                 help="""
+Amount of time in seconds to collect server-group changes before syncing them
+
+Creating, deleting and migrating instances as well as changing the members of
+a server-group queues the affected server-group for a sync of its DRS rules. A
+worker thread waits this long after the first change, so all server-groups
+changed in the meantime get synced with a single reconfiguration of the
+cluster.
+
+Possible values:
+ * floating point value >= 0: time in seconds to collect changes
+ * floating point value < 0: disable the worker and sync every change right
+   away
+
+Related options:
+
+* server_group_sync_loop_spacing
+"""),
+    cfg.IntOpt('hagroup_relocation_concurrency',
+               min=1,
+               default=4,
+               help="""
+Number of relocations run in parallel to fix the hagroup disk placement
+
+When the root disks of a server-group's members are not placed on the
+datastores of their hagroup, all necessary relocations of the server-groups
+synced together are planned up front and run in parallel.
+
+Related options:
+
+* datastore_hagroup_regex
+* hagroup_relocation_concurrency_per_datastore
+"""),
+    cfg.IntOpt('hagroup_relocation_concurrency_per_datastore',
+               min=1,
+               default=2,
+               help="""
+Number of relocations fixing the hagroup disk placement targeting the same
+datastore in parallel
+
+The Storage vMotions to a datastore share its throughput and the vCenter
+limits how many of them can run per datastore anyways, so running more of them
+does not make the relocations finish any faster.
+
+Related options:
+
+* hagroup_relocation_concurrency
 """),
     cfg.StrOpt('allow_pulling_images_from_url',
                default=True,
@@ -497,6 +778,38 @@ Allow VMware to pull images directly from Swift. By enabling this, images
 that are stored in Swift will be downloaded by VMWare from the `direct_url`,
 instead of the nova-compute service having to proxy the image between glance
 and VMware.
+"""),
+    cfg.IntOpt('image_transfer_chunk_size_kb',
+               min=1,
+               default=64,
+               help="""
+Size in KiB of the chunks read and written when transferring images
+
+Larger chunks reduce the per-chunk overhead when transferring large images
+between Glance and the vCenter, but need more memory per buffer.
+
+Related options:
+
+* image_transfer_read_ahead_buffers
+"""),
+    cfg.IntOpt('image_transfer_read_ahead_buffers',
+               min=0,
+               default=16,
+               help="""
+Number of chunks the image transfer may read ahead of writing
+
+Reading from the source, e.g. Glance, happens in a separate green thread, so
+it overlaps with writing to the datastore or the HttpNfcLease. This sets the
+size of the bounded buffer pool in between. The memory used per transfer is
+at most this number times ``image_transfer_chunk_size_kb``.
+
+Possible values:
+ * integer > 0: number of chunks to buffer
+ * integer = 0: read and write sequentially in one green thread
+
+Related options:
+
+* image_transfer_chunk_size_kb
 """),
     cfg.IntOpt('resource_disk_gb_max_unit_limit',
                min=-1,
@@ -514,6 +827,20 @@ Possible values:
  * integer = 0: disable reporting DISK_GB resources i.e. disallow non-volume
                 root disks
  * integer = -1: no limit
+"""),
+    cfg.IntOpt('cluster_metrics_cache_ttl',
+               min=0,
+               default=30,
+               help="""
+Amount of time in seconds the driver caches the cluster metrics
+
+Collecting the cluster metrics requires reading the stats of all hosts and
+datastores of the cluster from the vCenter. Calls happening within this
+amount of time after the last collection return the cached values.
+
+Possible values:
+ * integer > 0: time in seconds to cache the metrics
+ * integer = 0: disable caching
 """),
     cfg.IntOpt('custom_traits_sync_loop_spacing',
                default=600,
@@ -526,6 +853,18 @@ syncing the traits. This setting defines how long to sleep between runs.
 Possible values:
  * integer >= time in seconds to sleep between runs
  * intger < 0: disable the sync-loop
+"""),
+    cfg.IntOpt('custom_traits_sync_concurrency',
+               min=1,
+               default=4,
+               help="""
+Number of custom attribute values the custom traits sync-loop sets in parallel
+
+Only the values which differ from the traits in Placement get written.
+
+Related options:
+
+* custom_traits_sync_loop_spacing
 """),
 ]
 
@@ -2329,6 +2329,65 @@ class ComputeManagerUnitTestCase(test.NoDBTestCase,
                                         use_slave=True)
             mock_spawn.assert_called_once_with(mock.ANY, instance)
 
+    @mock.patch.object(objects.InstanceList, 'get_by_host')
+    def test_sync_power_states_bulk(self, mock_get):
+        in_sync = self._get_sync_instance(power_state.RUNNING,
+                                          vm_states.ACTIVE)
+        in_sync.uuid = uuids.in_sync
+        changed = self._get_sync_instance(power_state.RUNNING,
+                                          vm_states.ACTIVE)
+        changed.uuid = uuids.changed
+        missing = self._get_sync_instance(power_state.SHUTDOWN,
+                                          vm_states.STOPPED)
+        missing.uuid = uuids.missing
+        busy = self._get_sync_instance(power_state.RUNNING,
+                                       vm_states.ACTIVE,
+                                       task_state=task_states.REBOOTING)
+        busy.uuid = uuids.busy
+        mock_get.return_value = [in_sync, changed, missing, busy]
+        vm_power_states = {uuids.in_sync: power_state.RUNNING,
+                           uuids.changed: power_state.SHUTDOWN,
+                           uuids.busy: power_state.RUNNING}
+
+        with test.nested(
+            mock.patch.object(self.compute.driver, 'get_power_states',
+                              return_value=vm_power_states),
+            mock.patch.object(self.compute.driver, 'get_num_instances',
+                              new_callable=mock.NonCallableMock),
+            mock.patch.object(self.compute._sync_power_pool, 'spawn_n')
+        ) as (mock_get_power_states, _, mock_spawn):
+            self.compute._sync_power_states(mock.sentinel.context)
+
+        mock_get_power_states.assert_called_once_with()
+        # the states found out of sync are queried again under the lock,
+        # only the random delay is skipped
+        mock_spawn.assert_has_calls([
+            mock.call(mock.ANY, changed, False),
+            mock.call(mock.ANY, missing, False),
+            mock.call(mock.ANY, busy, False)])
+        self.assertEqual(3, mock_spawn.call_count)
+
+    @mock.patch.object(manager.ComputeManager,
+                       '_query_driver_power_state_and_sync')
+    @mock.patch.object(manager.greenthread, 'sleep')
+    @mock.patch.object(objects.InstanceList, 'get_by_host')
+    def test_sync_power_states_bulk_queries_under_lock(self, mock_get,
+                                                       mock_sleep,
+                                                       mock_query_sync):
+        changed = self._get_sync_instance(power_state.RUNNING,
+                                          vm_states.ACTIVE)
+        mock_get.return_value = [changed]
+
+        with mock.patch.object(self.compute.driver, 'get_power_states',
+                               return_value={changed.uuid:
+                                             power_state.SHUTDOWN}):
+            self.compute._sync_power_states(mock.sentinel.context)
+            self.compute._sync_power_pool.waitall()
+
+        mock_sleep.assert_not_called()
+        mock_query_sync.assert_called_once_with(mock.sentinel.context,
+                                                changed)
+
     @mock.patch('nova.objects.InstanceList.get_by_host', new=mock.Mock())
     @mock.patch('nova.compute.manager.ComputeManager.'
                 '_query_driver_power_state_and_sync',
@@ -20,6 +20,7 @@ Test suite for VMwareAPI.
 """
 
 import collections
+import copy
 import datetime
 import fixtures
 
@@ -171,6 +172,7 @@ class VMwareAPIVMTestCase(test.TestCase,
         super(VMwareAPIVMTestCase, self).setUp()
         ds_util.dc_cache_reset()
         vm_util.vm_refs_cache_reset()
+        vm_util.vnc_port_allocator_reset()
         self.context = context.RequestContext('fake', 'fake', is_admin=False)
         self.flags(cluster_name='test_cluster',
                    host_ip=HOST,
@@ -683,11 +685,11 @@ class VMwareAPIVMTestCase(test.TestCase,
 
     @mock.patch.object(vmops.VMwareVMOps, 'update_cached_instances')
     @mock.patch.object(vmops.VMwareVMOps, 'power_off')
-    @mock.patch.object(volumeops.VMwareVolumeOps, 'detach_volume')
+    @mock.patch.object(volumeops.VMwareVolumeOps, 'detach_volumes')
     @mock.patch.object(vmops.VMwareVMOps, 'destroy')
     def test_destroy_with_attached_volumes(self,
                                            mock_destroy,
-                                           mock_detach_volume,
+                                           mock_detach_volumes,
                                            mock_power_off,
                                            mock_update_cached_instances):
         self._create_vm()
@@ -701,8 +703,8 @@ class VMwareAPIVMTestCase(test.TestCase,
         self.conn.destroy(self.context, self.instance, self.network_info,
                           block_device_info=bdi)
         mock_power_off.assert_called_once_with(self.instance)
-        mock_detach_volume.assert_called_once_with(
-            connection_info, self.instance)
+        mock_detach_volumes.assert_called_once_with(
+            [connection_info], self.instance)
         mock_destroy.assert_called_once_with(self.context, self.instance, True)
 
     @mock.patch.object(vmops.VMwareVMOps, 'update_cached_instances')
@@ -727,11 +729,11 @@ class VMwareAPIVMTestCase(test.TestCase,
                                              self.instance, True)
 
     @mock.patch.object(vmops.VMwareVMOps, 'update_cached_instances')
-    @mock.patch.object(volumeops.VMwareVolumeOps, 'detach_volume',
+    @mock.patch.object(volumeops.VMwareVolumeOps, 'detach_volumes',
                        side_effect=exception.NovaException())
     @mock.patch.object(vmops.VMwareVMOps, 'destroy')
     def test_destroy_with_attached_volumes_with_exception(
-        self, mock_destroy, mock_detach_volume, mock_update_cached_instances):
+        self, mock_destroy, mock_detach_volumes, mock_update_cached_instances):
         self._create_vm()
         connection_info = {'data': 'fake-data', 'serial': 'volume-fake-id'}
         bdm = [{'connection_info': connection_info,
@@ -742,8 +744,8 @@ class VMwareAPIVMTestCase(test.TestCase,
         self.assertRaises(exception.NovaException,
                           self.conn.destroy, self.context, self.instance,
                           self.network_info, block_device_info=bdi)
-        mock_detach_volume.assert_called_once_with(connection_info,
-                                                   self.instance)
+        mock_detach_volumes.assert_called_once_with([connection_info],
+                                                    self.instance)
         self.assertFalse(mock_destroy.called)
 
     @mock.patch.object(vmops.VMwareVMOps, 'update_cached_instances')
@@ -753,7 +755,8 @@ class VMwareAPIVMTestCase(test.TestCase,
     def test_destroy_with_attached_volumes_with_disk_not_found(
         self, mock_destroy, mock_detach_volume, mock_update_cached_instances):
         self._create_vm()
-        connection_info = {'data': 'fake-data', 'serial': 'volume-fake-id'}
+        connection_info = {'driver_volume_type': 'iscsi',
+                           'data': 'fake-data', 'serial': 'volume-fake-id'}
         bdm = [{'connection_info': connection_info,
                 'disk_bus': 'fake-bus',
                 'device_name': 'fake-name',
@@ -1643,9 +1646,9 @@ class VMwareAPIVMTestCase(test.TestCase,
 
     @mock.patch.object(vmops.VMwareVMOps, 'update_cached_instances')
     @mock.patch('nova.virt.driver.block_device_info_get_mapping')
-    @mock.patch.object(volumeops.VMwareVolumeOps, 'detach_volume')
+    @mock.patch.object(volumeops.VMwareVolumeOps, 'detach_volumes')
     def test_detach_instance_volumes(
-            self, detach_volume, block_device_info_get_mapping,
+            self, detach_volumes, block_device_info_get_mapping,
             mock_update_cached_instances):
         self._create_vm()
 
@@ -1657,8 +1660,6 @@ class VMwareAPIVMTestCase(test.TestCase,
         disk_2 = _mock_bdm(mock.sentinel.connection_info_2, 'dev2')
         block_device_info_get_mapping.return_value = [disk_1, disk_2]
 
-        detach_volume.side_effect = [None, exception.DiskNotFound("Error")]
-
         with mock.patch.object(self.conn, '_vmops') as vmops:
             block_device_info = mock.sentinel.block_device_info
             self.conn._detach_instance_volumes(self.instance,
@@ -1667,10 +1668,9 @@ class VMwareAPIVMTestCase(test.TestCase,
             block_device_info_get_mapping.assert_called_once_with(
                 block_device_info)
             vmops.power_off.assert_called_once_with(self.instance)
-            exp_detach_calls = [
-                mock.call(mock.sentinel.connection_info_1, self.instance),
-                mock.call(mock.sentinel.connection_info_2, self.instance)]
-            self.assertEqual(exp_detach_calls, detach_volume.call_args_list)
+            detach_volumes.assert_called_once_with(
+                [mock.sentinel.connection_info_1,
+                 mock.sentinel.connection_info_2], self.instance)
 
     def test_destroy(self):
         self._create_vm()
@@ -2454,6 +2454,87 @@ class VMwareAPIVMTestCase(test.TestCase,
         self.assertEqual(1, len(nodelist))
         self.assertIn(self.node_name, nodelist)
 
+    def _get_cluster_inventory_result(self):
+        result = vmwareapi_fake.FakeRetrieveResult()
+        result.add_object(vmwareapi_fake.ObjectContent(
+            self.conn._cluster_ref,
+            [vmwareapi_fake.Prop('summary', mock.Mock(
+                totalCpu=10000, totalMemory=16 * units.Gi))]))
+        for i in range(2):
+            result.add_object(vmwareapi_fake.ObjectContent(
+                vmwareapi_fake.ManagedObjectReference(
+                    name='HostSystem', value='host-%d' % i),
+                [vmwareapi_fake.Prop('summary.quickStats', mock.Mock(
+                    overallCpuUsage=1000, overallMemoryUsage=2048))]))
+            result.add_object(vmwareapi_fake.ObjectContent(
+                vmwareapi_fake.ManagedObjectReference(
+                    name='Datastore', value='ds-%d' % i),
+                [vmwareapi_fake.Prop('summary.freeSpace', 25 * units.Gi),
+                 vmwareapi_fake.Prop('summary.capacity', 100 * units.Gi)]))
+        return result
+
+    def test_get_cluster_metrics(self):
+        self.flags(cluster_metrics_cache_ttl=60, group='vmware')
+        with mock.patch.object(self.conn._session, '_call_method',
+                return_value=self._get_cluster_inventory_result()
+        ) as mock_call_method:
+            metrics = self.conn.get_cluster_metrics()
+            # cached
+            self.assertEqual(metrics, self.conn.get_cluster_metrics())
+
+        mock_call_method.assert_called_once_with(
+            vim_util, 'get_cluster_inventory', self.conn._cluster_ref,
+            ['summary'], ['summary.quickStats'],
+            ['summary.freeSpace', 'summary.capacity'])
+        self.assertEqual({'cpu_total': 10000,
+                          'cpu_used': 2000,
+                          'cpu_free': 8000,
+                          'cpu_percent': 20,
+                          'memory_total': 16384.0,
+                          'memory_used': 4096,
+                          'memory_free': 12288.0,
+                          'memory_percent': 25,
+                          'datastore_total': 200.0,
+                          'datastore_used': 150.0,
+                          'datastore_free': 50.0,
+                          'datastore_percent': 75},
+                         metrics)
+
+    def test_get_cluster_metrics_cache_disabled(self):
+        self.flags(cluster_metrics_cache_ttl=0, group='vmware')
+        with mock.patch.object(self.conn._session, '_call_method',
+                side_effect=lambda *a: self._get_cluster_inventory_result()
+        ) as mock_call_method:
+            self.conn.get_cluster_metrics()
+            self.conn.get_cluster_metrics()
+
+        self.assertEqual(2, mock_call_method.call_count)
+
+    def test_get_cluster_metrics_cluster_missing(self):
+        result = self._get_cluster_inventory_result()
+        missing = vmwareapi_fake.DataObject()
+        missing.path = 'summary'
+        missing.fault = vmwareapi_fake.DataObject()
+        missing.fault.localizedMessage = 'fake-fault'
+        result.objects[0] = vmwareapi_fake.ObjectContent(
+            self.conn._cluster_ref, missing_list=[missing])
+        with test.nested(
+                mock.patch.object(self.conn._session, '_call_method',
+                                  return_value=result),
+                mock.patch.object(driver.LOG, 'warning'),
+        ) as (_call_method, mock_warning):
+            self.assertRaises(exception.NotFound,
+                              self.conn.get_cluster_metrics)
+        mock_warning.assert_called_once_with(
+            mock.ANY, {'path': 'summary', 'reason': 'fake-fault'})
+
+        # without any cluster object, too
+        result.objects.pop(0)
+        with mock.patch.object(self.conn._session, '_call_method',
+                               return_value=result):
+            self.assertRaises(exception.NotFound,
+                              self.conn.get_cluster_metrics)
+
     @mock.patch.object(vmops.VMwareVMOps, 'update_cached_instances')
     @mock.patch.object(nova.virt.vmwareapi.images.VMwareImage,
                        'from_image')
@@ -2800,14 +2881,15 @@ class VMwareAPIVMTestCase(test.TestCase,
         with test.nested(
                 mock.patch.object(self.conn._volumeops, 'delete_shadow_vms'),
                 mock.patch.object(self.conn._vmops,
-                                  'sync_instance_server_group')
-            ) as (mock_delete_shadow_vms, mock_sync_instance_server_group):
+                                  'queue_instance_server_group_sync')
+            ) as (mock_delete_shadow_vms, mock_queue_sync):
 
             self.conn.post_live_migration(
                           self.context, self.instance, block_device_info,
                           migrate_data)
             mock_delete_shadow_vms.assert_called_once()
-            mock_sync_instance_server_group.assert_called_once()
+            mock_queue_sync.assert_called_once_with(self.context,
+                                                    self.instance)
 
     def test_get_instance_disk_info_is_implemented(self):
         # Ensure that the method has been implemented in the driver
@@ -2915,3 +2997,47 @@ class VMwareAPIVMTestCase(test.TestCase,
             self.assertEqual(2, mock_save.call_count)
             self.assertFalse(service.disabled)
             self.assertFalse(self.conn._vc_state._auto_service_disabled)
+
+    def test_host_state_get_per_host_stats(self):
+        vcstate = self.conn._vc_state
+        stats = self._mock_get_stats_from_cluster_per_host()
+        with mock.patch.object(vm_util, 'get_stats_from_cluster_per_host',
+                               return_value=stats) as mock_stats:
+            vcstate._per_host_stats = {}
+            self.assertEqual(stats, vcstate.get_per_host_stats())
+            self.assertEqual(stats, vcstate.get_per_host_stats())
+            self.assertEqual(1, mock_stats.call_count)
+
+            vcstate.get_per_host_stats(refresh=True)
+            self.assertEqual(2, mock_stats.call_count)
+
+    def test_host_state_update_status_changed_hosts_only(self):
+        vcstate = self.conn._vc_state
+        stats = self._mock_get_stats_from_cluster_per_host()
+        with test.nested(
+            mock.patch.object(vm_util, 'get_stats_from_cluster_per_host',
+                              side_effect=lambda *a, **kw: copy.deepcopy(
+                                  stats)),
+            mock.patch.object(vm_util, 'aggregate_stats_from_cluster',
+                              wraps=vm_util.aggregate_stats_from_cluster)
+        ) as (mock_stats, mock_aggregate):
+            first = vcstate.update_status()
+            mock_stats.assert_called_once_with(
+                vcstate._session, vcstate._cluster,
+                cpu_info_cache=vcstate._host_cpu_info_cache)
+            self.assertEqual(1, mock_aggregate.call_count)
+
+            # nothing changed, everything is reused
+            second = vcstate.update_status()
+            self.assertEqual(first, second)
+            self.assertEqual(1, mock_aggregate.call_count)
+            for name in ['host1', 'host2', self.node_name]:
+                self.assertIs(first[name], second[name])
+
+            # only the changed host gets merged again
+            stats['host-2']['memory_mb_used'] = 512
+            third = vcstate.update_status()
+            self.assertEqual(2, mock_aggregate.call_count)
+            self.assertIs(second['host1'], third['host1'])
+            self.assertEqual(512, third['host2']['memory_mb_used'])
+            self.assertEqual(512, third[self.node_name]['memory_mb_used'])
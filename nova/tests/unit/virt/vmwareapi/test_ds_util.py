@@ -30,8 +30,11 @@ class DsUtilTestCase(test.NoDBTestCase):
     def setUp(self):
         super(DsUtilTestCase, self).setUp()
         self.session = fake.FakeSession()
-        self.flags(api_retry_count=1, group='vmware')
+        # the datastore inventory gets tested separately
+        self.flags(api_retry_count=1, datastore_inventory_max_age=-1,
+                   group='vmware')
         fake.reset()
+        ds_util.ds_inventory_cache_reset()
 
     def tearDown(self):
         super(DsUtilTestCase, self).tearDown()
@@ -483,3 +486,227 @@ class DsUtilTestCase(test.NoDBTestCase):
             _call_method.assert_called_once_with(
                     mock.ANY, 'get_object_property',
                     'fake_datastore', 'host')
+
+
+class DatastoreInventoryTestCase(test.NoDBTestCase):
+    def setUp(self):
+        super(DatastoreInventoryTestCase, self).setUp()
+        self.session = mock.Mock()
+        self.cluster = fake.ManagedObjectReference(
+            name='ClusterComputeResource', value='domain-c1')
+        self.ds_ref = fake.ManagedObjectReference(name='Datastore',
+                                                  value='ds-1')
+        ds_util.ds_inventory_cache_reset()
+
+    def _make_update_set(self, version, *object_updates):
+        filter_update = fake.DataObject()
+        filter_update.objectSet = list(object_updates)
+        update_set = fake.DataObject()
+        update_set.version = version
+        update_set.filterSet = [filter_update]
+        return update_set
+
+    def _make_object_update(self, kind, ds_ref, **changes):
+        update = fake.DataObject()
+        update.kind = kind
+        update.obj = ds_ref
+        update.changeSet = []
+        for name, val in changes.items():
+            change = fake.DataObject()
+            change.name = 'summary.' + name
+            change.op = 'assign'
+            change.val = val
+            update.changeSet.append(change)
+        return update
+
+    def _mock_call_method(self, *update_sets):
+        update_sets = list(update_sets)
+
+        def fake_call_method(module, method, *args, **kwargs):
+            if method == 'CreatePropertyCollector':
+                return mock.sentinel.collector
+            if method == 'WaitForUpdatesEx':
+                self.assertEqual(mock.sentinel.collector, args[0])
+                return update_sets.pop(0) if update_sets else None
+            return None
+
+        self.session._call_method.side_effect = fake_call_method
+
+    def test_get_datastore_from_inventory(self):
+        self.flags(datastore_inventory_max_age=0, group='vmware')
+        ds_ref_2 = fake.ManagedObjectReference(name='Datastore',
+                                               value='ds-2')
+        self._mock_call_method(self._make_update_set(
+            '1',
+            self._make_object_update('enter', self.ds_ref,
+                type='VMFS', name='ds1', capacity=100, freeSpace=10,
+                accessible=True, maintenanceMode='normal'),
+            self._make_object_update('enter', ds_ref_2,
+                type='VMFS', name='ds2', capacity=100, freeSpace=20,
+                accessible=True, maintenanceMode='normal')))
+
+        result = ds_util.get_datastore(self.session, self.cluster)
+        self.assertEqual('ds2', result.name)
+        self.assertEqual(20, result.freespace)
+
+        # only the changes get applied
+        self._mock_call_method(self._make_update_set(
+            '2',
+            self._make_object_update('modify', self.ds_ref, freeSpace=50)))
+        result = ds_util.get_datastore(self.session, self.cluster)
+        self.assertEqual('ds1', result.name)
+        self.assertEqual(50, result.freespace)
+
+        self._mock_call_method(self._make_update_set(
+            '3', self._make_object_update('leave', self.ds_ref)))
+        result = ds_util.get_available_datastores(self.session,
+                                                  self.cluster)
+        self.assertEqual(['ds2'], [ds.name for ds in result])
+
+        # all updates went through the same property collector
+        create_calls = [c for c in self.session._call_method.call_args_list
+                        if c[0][1] == 'CreatePropertyCollector']
+        self.assertEqual(1, len(create_calls))
+
+    def test_get_datastores_uses_cache_within_max_age(self):
+        self.flags(datastore_inventory_max_age=60, group='vmware')
+        self._mock_call_method(self._make_update_set(
+            '1',
+            self._make_object_update('enter', self.ds_ref,
+                type='VMFS', name='ds1', capacity=100, freeSpace=10,
+                accessible=True, maintenanceMode='normal')))
+        inventory = ds_util.DatastoreInventory(self.cluster)
+
+        inventory.get_datastores(self.session)
+        call_count = self.session._call_method.call_count
+        datastores = inventory.get_datastores(self.session)
+
+        self.assertEqual(call_count, self.session._call_method.call_count)
+        self.assertEqual(1, len(datastores))
+        self.assertEqual(self.ds_ref, datastores[0].obj)
+
+    def test_get_datastore_falls_back_without_inventory(self):
+        self.session._call_method.side_effect = vexc.VimException('fake')
+        self.assertIsNone(ds_util._get_cached_datastores(self.session,
+                                                         self.cluster))
+
+        self.flags(datastore_inventory_max_age=-1, group='vmware')
+        self.session._call_method.reset_mock()
+        self.assertIsNone(ds_util._get_cached_datastores(self.session,
+                                                         self.cluster))
+        self.session._call_method.assert_not_called()
+
+    @mock.patch.object(ds_util.pbm, 'filter_hubs_by_profile')
+    @mock.patch.object(ds_util.pbm, 'convert_datastores_to_hubs')
+    @mock.patch.object(ds_util.pbm, 'get_profile_id_by_name',
+                       return_value='fake-profile')
+    def test_filter_datastores_matching_storage_policy_cached(
+            self, mock_get_profile, mock_convert, mock_filter):
+        hub = fake.DataObject()
+        hub.hubId = 'ds-1'
+        mock_filter.return_value = [hub]
+        datastores = [ds_util.CachedObjectContent(obj=self.ds_ref,
+                                                  propSet=[])]
+
+        for _ in range(2):
+            result = list(ds_util._filter_datastores_matching_storage_policy(
+                self.session, datastores, 'fake-policy'))
+            self.assertEqual(datastores, result)
+
+        mock_get_profile.assert_called_once_with(self.session, 'fake-policy')
+        mock_filter.assert_called_once()
+
+
+class DatastoreReservationTestCase(test.NoDBTestCase):
+    def setUp(self):
+        super(DatastoreReservationTestCase, self).setUp()
+        ds_util.ds_inventory_cache_reset()
+        self.ds_refs = [
+            fake.ManagedObjectReference(name='Datastore', value='ds-1'),
+            fake.ManagedObjectReference(name='Datastore', value='ds-2')]
+
+    def _make_datastores(self, capacities_and_freespaces):
+        datastores = []
+        for i, (capacity, freespace) in enumerate(capacities_and_freespaces):
+            props = {'summary.type': 'VMFS',
+                     'summary.name': 'ds%d' % (i + 1),
+                     'summary.capacity': capacity,
+                     'summary.freeSpace': freespace,
+                     'summary.accessible': True,
+                     'summary.maintenanceMode': 'normal'}
+            datastores.append(ds_util.CachedObjectContent(
+                obj=self.ds_refs[i],
+                propSet=[ds_util.CachedProperty(name=name, val=val)
+                         for name, val in props.items()]))
+        return datastores
+
+    def test_select_datastore_deducts_reservations(self):
+        datastores = self._make_datastores([(100, 50), (100, 40)])
+        ds_util.reserve_datastore_space(self.ds_refs[0], 'inst-1', 20)
+
+        best_match = ds_util._select_datastore(None, datastores, None)
+
+        self.assertEqual('ds2', best_match.name)
+        # the reported free space stays untouched
+        self.assertEqual(40, best_match.freespace)
+        self.assertEqual({'ds-1': 20}, ds_util.get_datastore_reservations())
+
+    def test_select_datastore_keeps_headroom(self):
+        self.flags(datastore_reservation_headroom_percent=10, group='vmware')
+        datastores = self._make_datastores([(1000, 150), (100, 120)])
+
+        best_match = ds_util._select_datastore(None, datastores, None)
+
+        self.assertEqual('ds2', best_match.name)
+
+    def test_release_datastore_space(self):
+        ds_util.reserve_datastore_space(self.ds_refs[0], 'inst-1', 20)
+        ds_util.reserve_datastore_space(self.ds_refs[0], 'inst-2', 30)
+
+        ds_util.release_datastore_space('inst-1')
+        # the space stays reserved until the vCenter reports a new free space
+        self.assertEqual(50, ds_util.get_reserved_datastore_space('ds-1'))
+
+        ds_util._datastore_space_updated('ds-1')
+        self.assertEqual(30, ds_util.get_reserved_datastore_space('ds-1'))
+
+    def test_released_reservations_expire(self):
+        ds_util.reserve_datastore_space(self.ds_refs[0], 'inst-1', 20)
+        ds_util.release_datastore_space('inst-1')
+
+        with mock.patch.object(
+                ds_util.time, 'monotonic',
+                return_value=(ds_util.time.monotonic() +
+                              ds_util._RELEASED_RESERVATION_MAX_AGE + 1)):
+            self.assertEqual(0, ds_util.get_reserved_datastore_space('ds-1'))
+        self.assertEqual({}, ds_util.get_datastore_reservations())
+
+    @mock.patch.object(ds_util.vutil, 'WithRetrieval')
+    @mock.patch.object(ds_util, '_get_cached_datastores', return_value=None)
+    def test_get_datastore_drops_released_reservations(self, mock_cached,
+                                                       mock_retrieval):
+        datastores = self._make_datastores([(100, 50), (100, 40)])
+        mock_retrieval.return_value.__enter__.return_value = datastores
+        session = mock.Mock()
+        ds_ret = fake.DataObject()
+        ds_ret.ManagedObjectReference = self.ds_refs
+        session._call_method.side_effect = [ds_ret, mock.sentinel.result]
+        ds_util.reserve_datastore_space(self.ds_refs[0], 'inst-1', 20)
+        ds_util.reserve_datastore_space(self.ds_refs[0], 'inst-2', 30)
+        ds_util.release_datastore_space('inst-1')
+        now = ds_util.time.monotonic()
+
+        with mock.patch.object(ds_util.time, 'monotonic',
+                               return_value=now + 1):
+            best_match = ds_util.get_datastore(session, 'fake-cluster')
+        with mock.patch.object(ds_util.time, 'monotonic',
+                               return_value=now + 2):
+            # released after the free space was read, so it's not reflected
+            ds_util.release_datastore_space('inst-2')
+
+        self.assertEqual('ds2', best_match.name)
+        # the released reservation is dropped with the new free space
+        self.assertEqual({'ds-1': 30}, ds_util.get_datastore_reservations())
+
+        ds_util._datastore_space_updated('ds-1', read_at=now + 1)
+        self.assertEqual({'ds-1': 30}, ds_util.get_datastore_reservations())
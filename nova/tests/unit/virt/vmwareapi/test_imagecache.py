@@ -232,6 +232,47 @@ class ImageCacheManagerTestCase(test.NoDBTestCase):
                     ds_obj.DatastorePath('fake-ds', 'fake-path'))
             self.assertEqual(3, self._get_timestamp_called)
 
+    def test_image_templates_index(self):
+        self.assertFalse(self._imagecache.image_templates_populated)
+        self.assertIsNone(self._imagecache.get_image_template('image-1',
+                                                              'ds1'))
+
+        self._imagecache.set_image_templates([('image-1', 'ds1', 'vm-1'),
+                                              ('image-1', 'ds2', 'vm-2'),
+                                              ('image-2', 'ds1', 'vm-3')])
+        self.assertTrue(self._imagecache.image_templates_populated)
+        self.assertEqual('vm-1',
+            self._imagecache.get_image_template('image-1', 'ds1'))
+        self.assertEqual({'ds1': 'vm-1', 'ds2': 'vm-2'},
+            self._imagecache.get_image_template_datastores('image-1'))
+
+        self._imagecache.add_image_template('image-2', 'ds2', 'vm-4')
+        self._imagecache.remove_image_template('image-1', 'ds1')
+        self._imagecache.remove_image_template('image-3', 'ds1')
+        self.assertEqual({'ds2': 'vm-2'},
+            self._imagecache.get_image_template_datastores('image-1'))
+        self.assertEqual({'ds1': 'vm-3', 'ds2': 'vm-4'},
+            self._imagecache.get_image_template_datastores('image-2'))
+        self.assertEqual({},
+            self._imagecache.get_image_template_datastores('image-3'))
+
+    def test_get_hot_images(self):
+        for _ in range(4):
+            self._imagecache.record_image_boot('image-1', 'vi-1')
+        for _ in range(2):
+            self._imagecache.record_image_boot('image-2', 'vi-2')
+        self._imagecache.record_image_boot('image-3', 'vi-3')
+
+        self.assertEqual(['vi-1', 'vi-2'], self._imagecache.get_hot_images(2))
+        # the counts decay, so images not booted anymore drop out
+        self._imagecache.record_image_boot('image-3', 'vi-3b')
+        self._imagecache.record_image_boot('image-3', 'vi-3b')
+        self.assertEqual(['vi-1', 'vi-3b', 'vi-2'],
+                         self._imagecache.get_hot_images(3))
+        self.assertEqual(['vi-1', 'vi-3b'],
+                         self._imagecache.get_hot_images(3))
+        self.assertEqual([], self._imagecache.get_hot_images(3))
+
     @mock.patch.object(objects.block_device.BlockDeviceMappingList,
                        'bdms_by_instance_uuid', return_value={})
     def test_update(self, mock_bdms_by_inst):
@@ -15,6 +15,7 @@
 Test suite for images.
 """
 
+import io
 import os
 import tarfile
 
@@ -86,10 +87,58 @@ class VMwareImagesTestCase(test.NoDBTestCase):
         http_write.assert_called_once_with(host, port, dc_name, ds_name, None,
                                            file_path, image_data['size'])
         image_transfer.assert_called_once_with(read_file_handle,
-                                               write_file_handle)
+                                               write_file_handle,
+                                               file_size=image_data['size'])
         image_download.assert_called_once_with(context, instance['image_ref'])
         image_show.assert_called_once_with(context, instance['image_ref'])
 
+    def _test_image_transfer(self, read_ahead_buffers):
+        self.flags(image_transfer_chunk_size_kb=1,
+                   image_transfer_read_ahead_buffers=read_ahead_buffers,
+                   group='vmware')
+        data = os.urandom(10 * units.Ki + 7)
+        read_handle = io.BytesIO(data)
+        write_handle = io.BytesIO()
+        with test.nested(
+            mock.patch.object(read_handle, 'close'),
+            mock.patch.object(write_handle, 'close'),
+        ) as (mock_read_close, mock_write_close):
+            images.image_transfer(read_handle, write_handle,
+                                  file_size=len(data))
+            mock_read_close.assert_called_once_with()
+            mock_write_close.assert_called_once_with()
+        self.assertEqual(data, write_handle.getvalue())
+
+    def test_image_transfer(self):
+        self._test_image_transfer(0)
+
+    def test_image_transfer_read_ahead(self):
+        self._test_image_transfer(2)
+
+    def test_image_transfer_read_ahead_read_error(self):
+        self.flags(image_transfer_read_ahead_buffers=2, group='vmware')
+        read_handle = mock.Mock()
+        read_handle.read.side_effect = [b'data', IOError('broken')]
+        write_handle = mock.Mock()
+
+        self.assertRaises(IOError, images.image_transfer,
+                          read_handle, write_handle)
+        write_handle.write.assert_called_once_with(b'data')
+        read_handle.close.assert_called_once_with()
+        write_handle.close.assert_called_once_with()
+
+    def test_image_transfer_read_ahead_write_error(self):
+        self.flags(image_transfer_read_ahead_buffers=1, group='vmware')
+        read_handle = mock.Mock()
+        read_handle.read.return_value = b'data'
+        write_handle = mock.Mock()
+        write_handle.write.side_effect = IOError('broken')
+
+        self.assertRaises(IOError, images.image_transfer,
+                          read_handle, write_handle)
+        read_handle.close.assert_called_once_with()
+        write_handle.close.assert_called_once_with()
+
     def _setup_mock_get_remote_image_service(self,
                                              mock_get_remote_image_service,
                                              metadata):
@@ -171,8 +220,9 @@ class VMwareImagesTestCase(test.NoDBTestCase):
 
             mock_tar_open.assert_called_once_with(mode='r|',
                                                   fileobj=mock_read_handle)
-            mock_image_transfer.assert_called_once_with(mock_read_handle,
-                                                        mock_write_handle)
+            mock_image_transfer.assert_called_once_with(
+                mock_read_handle, mock_write_handle,
+                file_size=mock_vmdk.size)
             mock_get_vmdk_info.assert_called_once_with(
                     session, mock.sentinel.vm_ref)
             mock_call_method.assert_called_once_with(
@@ -224,7 +274,8 @@ class VMwareImagesTestCase(test.NoDBTestCase):
                     vm_folder_ref, res_pool_ref)
 
             mock_image_transfer.assert_called_once_with(mock_read_handle,
-                                                        mock_write_handle)
+                                                        mock_write_handle,
+                                                        file_size=512)
             mock_call_method.assert_called_once_with(
                     session.vim, "MarkAsTemplate", mock.sentinel.vm_ref)
             mock_get_vmdk_info.assert_called_once_with(
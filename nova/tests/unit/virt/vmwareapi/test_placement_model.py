@@ -0,0 +1,149 @@
+# Copyright (c) 2026 SAP SE
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from nova import test
+from nova.tests.unit.virt.vmwareapi import fake
+from nova.virt.vmwareapi import cluster_util
+from nova.virt.vmwareapi import placement_model
+
+
+def _host_stats(memory_mb_used, available=True):
+    return {'name': 'name-%d' % memory_mb_used,
+            'available': available,
+            'memory_mb': 4096,
+            'memory_mb_used': memory_mb_used}
+
+
+def _rule(vm_group_name, affine=None, anti_affine=None, enabled=True,
+          mandatory=True):
+    return mock.Mock(vmGroupName=vm_group_name, enabled=enabled,
+                     mandatory=mandatory, affineHostGroupName=affine,
+                     antiAffineHostGroupName=anti_affine)
+
+
+class ClusterPlacementModelTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(ClusterPlacementModelTestCase, self).setUp()
+        self.host_stats = {
+            'host-1': _host_stats(1024),
+            'host-2': _host_stats(2048),
+            'host-3': _host_stats(3072, available=False),
+        }
+        self.host_groups = {
+            'hg-2': mock.Mock(host=[fake.ManagedObjectReference(
+                name='HostSystem', value='host-2')]),
+        }
+
+    def test_select_host(self):
+        model = placement_model.ClusterPlacementModel(self.host_stats)
+
+        self.assertEqual('host-1', model.select_host(1024))
+        self.assertEqual('host-2', model.select_host(1024, stack=True))
+        self.assertEqual('host-1', model.select_host(2560, stack=True))
+        self.assertIsNone(model.select_host(3584))
+
+    def test_select_host_equal_hosts(self):
+        model = placement_model.ClusterPlacementModel(
+            {'host-1': _host_stats(1024), 'host-2': _host_stats(1024)})
+
+        self.assertEqual('host-1', model.select_host(1024))
+        self.assertEqual('host-1', model.select_host(1024, stack=True))
+
+    def test_add_vm(self):
+        model = placement_model.ClusterPlacementModel(self.host_stats)
+
+        model.add_vm('host-1', 1536)
+
+        self.assertEqual(1536, model.get_memory_mb_free('host-1'))
+        self.assertEqual('host-2', model.select_host(1024))
+        self.assertFalse(model.fits('host-1', 2048))
+
+        # a host which went away in the meantime doesn't matter
+        model.add_vm('host-4', 1024)
+        self.assertEqual(1536, model.get_memory_mb_free('host-1'))
+
+    def test_fits_unknown_or_unavailable_host(self):
+        model = placement_model.ClusterPlacementModel(self.host_stats)
+
+        self.assertFalse(model.fits('host-3', 512))
+        self.assertFalse(model.fits('host-4', 512))
+
+    def test_mandatory_rules(self):
+        rules = {
+            'affine': _rule('vg-affine', affine='hg-2'),
+            'anti-affine': _rule('vg-anti-affine', anti_affine='hg-2'),
+            'optional': _rule('vg-optional', affine='hg-2', mandatory=False),
+            'disabled': _rule('vg-disabled', affine='hg-2', enabled=False),
+            'vm-vm': mock.Mock(vmGroupName=None),
+        }
+        model = placement_model.ClusterPlacementModel(
+            self.host_stats, host_groups=self.host_groups, rules=rules)
+
+        self.assertEqual(['host-2'], model.get_candidate_hosts(
+            512, vm_group_name='vg-affine'))
+        self.assertEqual(['host-1'], model.get_candidate_hosts(
+            512, vm_group_name='vg-anti-affine'))
+        for vm_group_name in (None, 'vg-optional', 'vg-disabled'):
+            self.assertEqual(['host-1', 'host-2'], model.get_candidate_hosts(
+                512, vm_group_name=vm_group_name))
+
+    @mock.patch.object(cluster_util, 'fetch_cluster_rules')
+    @mock.patch.object(cluster_util, 'fetch_cluster_groups')
+    def test_from_cluster_config(self, mock_fetch_groups, mock_fetch_rules):
+        session = mock.Mock()
+        config = mock.sentinel.cluster_config
+        mock_fetch_groups.return_value = self.host_groups
+        mock_fetch_rules.return_value = {
+            'affine': _rule('vg-affine', affine='hg-2')}
+
+        model = placement_model.ClusterPlacementModel.from_cluster_config(
+            session, self.host_stats, config)
+
+        session._call_method.assert_not_called()
+        mock_fetch_groups.assert_called_once_with(
+            session, cluster_config=config, group_type='host')
+        mock_fetch_rules.assert_called_once_with(
+            session, cluster_config=config)
+        self.assertEqual('host-2', model.select_host(
+            512, vm_group_name='vg-affine'))
+
+    def test_compare_with_recommendations(self):
+        # recorded from DRS on a cluster with the hosts of self.host_stats
+        recorded = [
+            {'memory_mb': 1024, 'host': 'host-1'},
+            {'memory_mb': 1024, 'host': 'host-2'},
+            {'memory_mb': 512, 'vm_group_name': 'vg-affine',
+             'host': 'host-2'},
+            {'memory_mb': 512, 'host': 'host-1'},
+            {'memory_mb': 4096, 'host': None},
+        ]
+        model = placement_model.ClusterPlacementModel(
+            self.host_stats, host_groups=self.host_groups,
+            rules={'affine': _rule('vg-affine', affine='hg-2')})
+
+        result = placement_model.compare_with_recommendations(model,
+                                                              recorded)
+
+        self.assertEqual(5, result['total'])
+        self.assertEqual(4, result['matched'])
+        # after the first VM, both hosts have 2048 MiB free and the model
+        # keeps their order, while DRS chose the other one
+        self.assertEqual([(recorded[1], 'host-1')], result['mismatches'])
+        # the recorded placements were applied to the model
+        self.assertEqual(1536, model.get_memory_mb_free('host-1'))
+        self.assertEqual(512, model.get_memory_mb_free('host-2'))
@@ -21,12 +21,16 @@
 Test suite for VMwareAPI Session
 """
 
+import eventlet
 import mock
 
+from oslo_vmware import api
+from oslo_vmware import exceptions as vexc
 from oslo_vmware.exceptions import ManagedObjectNotFoundException
 
 from nova import test
 from nova.tests.unit.virt.vmwareapi import fake as vmwareapi_fake
+from nova.virt.vmwareapi.session import SessionLane
 from nova.virt.vmwareapi.session import StableMoRefProxy
 from nova.virt.vmwareapi.session import VMwareAPISession
 
@@ -203,3 +207,201 @@ class VMwareSessionTestCase(test.NoDBTestCase):
             session._call_method(module, mock.sentinel.method_arg, ref=ref)
             fake_invoke.assert_called_with(
                 module, mock.sentinel.method_arg, ref=ref)
+
+
+class SessionLaneTestCase(test.NoDBTestCase):
+    def test_get_lane_name(self):
+        self.assertEqual('transfer',
+                         VMwareAPISession._get_lane_name('CloneVM_Task'))
+        self.assertEqual('transfer',
+                         VMwareAPISession._get_lane_name('ImportVApp'))
+        self.assertEqual('reconfigure',
+                         VMwareAPISession._get_lane_name('ReconfigVM_Task'))
+        get_lane_name = VMwareAPISession._get_lane_name
+        self.assertEqual('read', get_lane_name('get_object_property'))
+        self.assertEqual('read', get_lane_name('HttpNfcLeaseProgress'))
+        self.assertEqual('poll', get_lane_name('WaitForUpdatesEx'))
+
+    def test_acquire_unlimited(self):
+        lane = SessionLane('read', 0)
+        with lane.acquire('fira'):
+            with lane.acquire('fira'):
+                self.assertEqual(2, lane.active)
+        self.assertEqual({'concurrency': 0, 'active': 0, 'waiting': 0,
+                          'max_waiting': 0, 'calls': 2, 'wait_time': 0.0},
+                         lane.get_stats())
+
+    def test_acquire_limited(self):
+        lane = SessionLane('transfer', 1)
+        started = []
+
+        def _call(name):
+            with lane.acquire(name):
+                started.append(name)
+                eventlet.sleep(0)
+
+        with lane.acquire('first'):
+            threads = [eventlet.spawn(_call, n) for n in ('second', 'third')]
+            eventlet.sleep(0)
+            self.assertEqual([], started)
+            self.assertEqual(2, lane.waiting)
+        for t in threads:
+            t.wait()
+
+        self.assertEqual(['second', 'third'], started)
+        stats = lane.get_stats()
+        self.assertEqual(0, stats['waiting'])
+        self.assertEqual(2, stats['max_waiting'])
+        self.assertEqual(3, stats['calls'])
+
+    @mock.patch.object(VMwareAPISession, '_is_vim_object',
+                       return_value=True)
+    def test_call_method_uses_lane(self, mock_is_vim):
+        self.flags(session_reconfigure_concurrency=1, group='vmware')
+        with test.nested(
+                mock.patch.object(VMwareAPISession, '_create_session',
+                                  _fake_create_session),
+                mock.patch.object(VMwareAPISession, 'invoke_api'),
+        ) as (fake_create, fake_invoke):
+            session = VMwareAPISession()
+
+            def _invoke_api(module, method, *args, **kwargs):
+                if method == 'ReconfigVM_Task':
+                    # a nested call doesn't wait for a slot
+                    session._call_method(module, 'PowerOnVM_Task')
+                    self.assertEqual(
+                        1, session.get_lane_stats()['reconfigure']['active'])
+
+            fake_invoke.side_effect = _invoke_api
+            session._call_method(mock.sentinel.module, 'ReconfigVM_Task')
+
+            stats = session.get_lane_stats()
+            self.assertEqual(1, stats['reconfigure']['calls'])
+            self.assertEqual(0, stats['reconfigure']['active'])
+            self.assertEqual(0, stats['read']['calls'])
+            self.assertEqual(2, fake_invoke.call_count)
+
+    @mock.patch.object(VMwareAPISession, '_is_vim_object',
+                       return_value=True)
+    def test_call_method_long_poll_not_in_read_lane(self, mock_is_vim):
+        self.flags(session_read_concurrency=1, group='vmware')
+        with test.nested(
+                mock.patch.object(VMwareAPISession, '_create_session',
+                                  _fake_create_session),
+                mock.patch.object(VMwareAPISession, 'invoke_api'),
+        ) as (fake_create, fake_invoke):
+            session = VMwareAPISession()
+
+            def _invoke_api(module, method, *args, **kwargs):
+                stats = session.get_lane_stats()
+                # the long poll doesn't take the only read slot
+                self.assertEqual(0, stats['read']['active'])
+                self.assertEqual(1, stats['poll']['active'])
+
+            fake_invoke.side_effect = _invoke_api
+            session._call_method(mock.sentinel.module, 'WaitForUpdatesEx')
+
+            stats = session.get_lane_stats()
+            self.assertEqual(1, stats['poll']['calls'])
+            self.assertEqual(0, stats['read']['calls'])
+
+
+class TaskWaiterTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(TaskWaiterTestCase, self).setUp()
+        with mock.patch.object(VMwareAPISession, '_create_session',
+                               _fake_create_session):
+            self.session = VMwareAPISession()
+        self.session._vim = mock.Mock()
+        self.task = vmwareapi_fake.ManagedObjectReference(name='Task',
+                                                          value='task-1')
+        self.calls = []
+
+    def _make_update_set(self, state, error=None):
+        task_info = mock.Mock(state=state, error=error)
+        change = mock.Mock(val=task_info)
+        change.name = 'info'
+        object_update = mock.Mock(obj=self.task, changeSet=[change])
+        return mock.Mock(version='1',
+                         filterSet=[mock.Mock(objectSet=[object_update])])
+
+    def _fake_call_method(self, updates, create_filter_error=None):
+        updates = iter(updates)
+
+        def fake_call_method(module, method, *args, **kwargs):
+            self.calls.append(method)
+            if method == 'CreatePropertyCollector':
+                return 'fake-collector'
+            if method == 'CreateFilter':
+                if create_filter_error:
+                    raise create_filter_error
+                return 'fake-filter'
+            if method == 'WaitForUpdatesEx':
+                update = next(updates, None)
+                if isinstance(update, Exception):
+                    raise update
+                return update
+            if method == 'get_object_property':
+                return mock.Mock(state='success')
+        return fake_call_method
+
+    @mock.patch.object(api.VMwareAPISession, 'wait_for_task')
+    def test_wait_for_task(self, mock_poll):
+        update_set = self._make_update_set('success')
+        with mock.patch.object(self.session, '_call_method',
+                self._fake_call_method([update_set])):
+            task_info = self.session._wait_for_task(self.task)
+
+        self.assertEqual('success', task_info.state)
+        self.assertEqual(['CreatePropertyCollector', 'CreateFilter',
+                          'WaitForUpdatesEx', 'DestroyPropertyFilter'],
+                         self.calls)
+        mock_poll.assert_not_called()
+
+    @mock.patch.object(vexc, 'translate_fault',
+                       return_value=vexc.VimException('fake-fault'))
+    def test_wait_for_task_error(self, mock_translate):
+        update_set = self._make_update_set('error', error='fake-error')
+        with mock.patch.object(self.session, '_call_method',
+                self._fake_call_method([update_set])):
+            self.assertRaises(vexc.VimException,
+                              self.session._wait_for_task, self.task)
+
+        mock_translate.assert_called_once_with('fake-error')
+
+    @mock.patch.object(api.VMwareAPISession, 'wait_for_task',
+                       return_value='polled-info')
+    def test_wait_for_task_create_filter_fails(self, mock_poll):
+        with mock.patch.object(self.session, '_call_method',
+                self._fake_call_method(
+                    [], create_filter_error=vexc.VimException('fake'))):
+            self.assertEqual('polled-info',
+                             self.session._wait_for_task(self.task))
+
+        mock_poll.assert_called_once_with(self.task)
+        self.assertEqual({}, self.session._task_waiter._pending)
+
+    @mock.patch.object(api.VMwareAPISession, 'wait_for_task',
+                       return_value='polled-info')
+    def test_wait_for_task_collector_fails(self, mock_poll):
+        with mock.patch.object(self.session, '_call_method',
+                self._fake_call_method(
+                    [vexc.ManagedObjectNotFoundException()])):
+            self.assertEqual('polled-info',
+                             self.session._wait_for_task(self.task))
+
+        mock_poll.assert_called_once_with(self.task)
+        self.assertIn('DestroyPropertyCollector', self.calls)
+        self.assertIsNone(self.session._task_waiter._collector)
+
+    @mock.patch.object(api.VMwareAPISession, 'wait_for_task',
+                       return_value='polled-info')
+    def test_wait_for_task_disabled(self, mock_poll):
+        self.flags(use_property_collector_for_tasks=False, group='vmware')
+        with mock.patch.object(self.session, '_call_method') as mock_call:
+            self.assertEqual('polled-info',
+                             self.session._wait_for_task(self.task))
+
+        mock_call.assert_not_called()
+        mock_poll.assert_called_once_with(self.task)
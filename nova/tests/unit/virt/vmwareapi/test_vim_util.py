@@ -12,6 +12,9 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import mock
+from oslo_vmware import exceptions as vexc
+
 from nova import test
 from nova.tests.unit.virt.vmwareapi import fake
 from nova.virt.vmwareapi import vim_util
@@ -42,3 +45,102 @@ class VMwareVIMUtilTestCase(test.NoDBTestCase):
             self.vim, "Foo", [], ["bar", "baz"])
         self.assertTrue(hasattr(result, "objects"))
         self.assertTrue(hasattr(result.objects, "__iter__"))
+
+    def test_get_cluster_inventory(self):
+        vim = mock.Mock()
+        vim.client.factory.create.side_effect = lambda *a: mock.Mock()
+        cluster = fake.ManagedObjectReference(name='ClusterComputeResource',
+                                              value='domain-c1')
+        result = vim_util.get_cluster_inventory(
+            vim, cluster, ['summary'], ['summary.quickStats'],
+            ['summary.capacity'])
+
+        self.assertEqual(vim.RetrievePropertiesEx.return_value, result)
+        vim.RetrievePropertiesEx.assert_called_once_with(
+            vim.service_content.propertyCollector,
+            specSet=mock.ANY, options=mock.ANY)
+        spec_set = vim.RetrievePropertiesEx.call_args[1]['specSet']
+        self.assertEqual(1, len(spec_set))
+        self.assertEqual(
+            [('ClusterComputeResource', ['summary']),
+             ('HostSystem', ['summary.quickStats']),
+             ('Datastore', ['summary.capacity'])],
+            [(p.type, p.pathSet) for p in spec_set[0].propSet])
+        object_spec = spec_set[0].objectSet[0]
+        self.assertEqual(cluster, object_spec.obj)
+        self.assertEqual(
+            [('to_host', 'ClusterComputeResource', 'host'),
+             ('to_datastore', 'ClusterComputeResource', 'datastore')],
+            [(t.name, t.type, t.path) for t in object_spec.selectSet])
+
+
+class CustomFieldTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(CustomFieldTestCase, self).setUp()
+        self.session = mock.Mock()
+        self.field_a = mock.Mock(key=1, managedObjectType=None)
+        self.field_a.name = 'a'
+        self.fields = mock.Mock(CustomFieldDef=[self.field_a])
+
+    @mock.patch.object(vim_util, 'get_object_property')
+    def test_get_all_uncached(self, mock_get_prop):
+        mock_get_prop.return_value = self.fields
+        custom_field = vim_util.CustomField(self.session)
+
+        custom_field.get_all()
+        custom_field.get_all()
+
+        self.assertEqual(2, mock_get_prop.call_count)
+
+    @mock.patch.object(vim_util, 'get_object_property')
+    def test_get_all_cached(self, mock_get_prop):
+        mock_get_prop.return_value = self.fields
+        custom_field = vim_util.CustomField(self.session, cache_fields=True)
+
+        self.assertEqual([self.field_a], custom_field.get_all())
+        self.assertEqual([self.field_a], custom_field.get_all())
+        mock_get_prop.assert_called_once()
+
+        custom_field.invalidate()
+        custom_field.get_all()
+        self.assertEqual(2, mock_get_prop.call_count)
+
+    @mock.patch.object(vim_util, 'get_object_property')
+    def test_create_delete_update_cache(self, mock_get_prop):
+        mock_get_prop.return_value = self.fields
+        field_b = mock.Mock(key=2, managedObjectType='HostSystem')
+        field_b.name = 'b'
+        self.session._call_method.return_value = field_b
+        custom_field = vim_util.CustomField(self.session, cache_fields=True)
+        custom_field.get_all()
+
+        custom_field.create('b', obj_type='HostSystem')
+        self.assertEqual([self.field_a, field_b], custom_field.get_all())
+
+        custom_field.delete('a')
+        self.assertEqual([field_b], custom_field.get_all())
+        mock_get_prop.assert_called_once()
+
+    def test_set_values(self):
+        custom_field = vim_util.CustomField(self.session)
+        moref = mock.sentinel.moref
+
+        custom_field.set_values(moref, {1: 'true', 2: ''}, concurrency=2)
+
+        mgr = self.session.vim.service_content.customFieldsManager
+        self.session._call_method.assert_has_calls([
+            mock.call(self.session.vim, 'SetField', mgr, entity=moref,
+                      key=1, value='true'),
+            mock.call(self.session.vim, 'SetField', mgr, entity=moref,
+                      key=2, value='')], any_order=True)
+        self.assertEqual(2, self.session._call_method.call_count)
+
+    def test_set_values_raises_after_all_tried(self):
+        self.session._call_method.side_effect = [
+            vexc.VimException('fail'), None]
+        custom_field = vim_util.CustomField(self.session)
+
+        self.assertRaises(vexc.VimException, custom_field.set_values,
+                          mock.sentinel.moref, {1: 'true', 2: 'true'})
+        self.assertEqual(2, self.session._call_method.call_count)
@@ -16,7 +16,9 @@
 import builtins
 import collections
 import io
+import os
 
+import fixtures
 import mock
 from oslo_service import fixture as oslo_svc_fixture
 from oslo_utils import units
@@ -52,6 +54,7 @@ class VMwareVMUtilTestCase(test.NoDBTestCase):
         fake.reset()
         stubs.set_stubs(self)
         vm_util.vm_refs_cache_reset()
+        vm_util.vnc_port_allocator_reset()
         self._instance = fake_instance.fake_instance_obj(
             None,
             **{'id': 7, 'name': 'fake!',
@@ -398,6 +401,142 @@ class VMwareVMUtilTestCase(test.NoDBTestCase):
                               'memory_mb': 1024}}
         self.assertEqual(expected, vm_util._get_host_reservations_map(groups))
 
+    def test_get_host_reservations_map_cached_by_mtime(self):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            'reservations.json')
+        with open(path, 'w') as f:
+            f.write('{"__default__": {"vcpus": 2}}')
+        os.utime(path, ns=(0, 1000))
+        self.addCleanup(vm_util._HOST_RESERVATIONS_FILE_CACHE.clear)
+        CONF.set_override('hostgroup_reservations_json_file', path, 'vmware')
+
+        with mock.patch.object(builtins, 'open', side_effect=open) as m_open:
+            for _ in range(3):
+                self.assertEqual({'__default__': {'vcpus': 2}},
+                                 vm_util._get_host_reservations_map())
+            m_open.assert_called_once_with(path, 'rb')
+
+            with open(path, 'w') as f:
+                f.write('{"__default__": {"vcpus": 4}}')
+            os.utime(path, ns=(0, 2000))
+            self.assertEqual({'__default__': {'vcpus': 4}},
+                             vm_util._get_host_reservations_map())
+
+    def test_set_host_reservations_keeps_defaults(self):
+        host1 = fake.ManagedObjectReference('HostSystem', 'host1')
+        host2 = fake.ManagedObjectReference('HostSystem', 'host2')
+        mapping = {'__default__': {'vcpus': 2},
+                   'host1': {'vcpus': 5}}
+        stats = self._create_stats()
+        vm_util._set_host_reservations(stats, mapping, host1)
+        self.assertEqual(5, stats['vcpus_reserved'])
+        stats = self._create_stats()
+        vm_util._set_host_reservations(stats, mapping, host2)
+        self.assertEqual(2, stats['vcpus_reserved'])
+        self.assertEqual({'vcpus': 2}, mapping['__default__'])
+
+    def test_get_stats_from_cluster_per_host_cpu_info_cache(self):
+        host_refs = [fake.ManagedObjectReference("HostSystem", "host1"),
+                     fake.ManagedObjectReference("HostSystem", "host2")]
+        prop_dict = {'host': fake._convert_to_array_of_mor(host_refs)}
+        hardware = fake.HostSystem.create_summary_hardware()
+        runtimes = {}
+        props = {}
+        for host_ref in host_refs:
+            runtime = fake.DataObject()
+            runtime.connectionState = "connected"
+            runtime.inMaintenanceMode = False
+            runtime.bootTime = 1
+            runtimes[host_ref.value] = runtime
+            quickstats = fake.DataObject()
+            quickstats.overallMemoryUsage = 512
+            props[host_ref.value] = {
+                "name": host_ref.value,
+                "summary.hardware": hardware,
+                "summary.runtime": runtime,
+                "summary.quickStats": quickstats,
+                "hardware.cpuPkg": fake.HostSystem.create_cpu_pkgs(),
+                "hardware.cpuInfo":
+                    fake.HostSystem.create_hardware_cpu_info(),
+                "config.featureCapability":
+                    fake.HostSystem.create_config_feature_capability(),
+            }
+
+        retrieved = []
+
+        def fake_call_method(*args):
+            if "get_object_properties_dict" in args:
+                return prop_dict
+            if "get_properties_for_a_collection_of_objects" in args:
+                retrieved.append(([m.value for m in args[3]], args[4]))
+                objects = fake.FakeRetrieveResult()
+                for moref in args[3]:
+                    objects.add_object(fake.ObjectContent(
+                        moref, [fake.Prop(name=name, val=val)
+                                for name, val in props[moref.value].items()
+                                if name in args[4]]))
+                return objects
+            raise Exception('unexpected method call')
+
+        session = fake.FakeSession()
+        cache = {}
+        with mock.patch.object(session, '_call_method', fake_call_method):
+            expected = vm_util.get_stats_from_cluster_per_host(session,
+                                                               "cluster1")
+            del retrieved[:]
+
+            result = vm_util.get_stats_from_cluster_per_host(
+                session, "cluster1", cpu_info_cache=cache)
+            self.assertEqual(expected, result)
+            self.assertEqual(
+                [(['host1', 'host2'], vm_util._HOST_STATS_PROPERTIES),
+                 (['host1', 'host2'], vm_util._HOST_CPU_INFO_PROPERTIES)],
+                retrieved)
+            del retrieved[:]
+
+            result = vm_util.get_stats_from_cluster_per_host(
+                session, "cluster1", cpu_info_cache=cache)
+            self.assertEqual(expected, result)
+            self.assertEqual(
+                [(['host1', 'host2'], vm_util._HOST_STATS_PROPERTIES)],
+                retrieved)
+            del retrieved[:]
+
+            # a rebooted host gets its cpu_info refreshed
+            runtimes['host2'].bootTime = 2
+            result = vm_util.get_stats_from_cluster_per_host(
+                session, "cluster1", cpu_info_cache=cache)
+            self.assertEqual(expected, result)
+            self.assertEqual(
+                [(['host1', 'host2'], vm_util._HOST_STATS_PROPERTIES),
+                 (['host2'], vm_util._HOST_CPU_INFO_PROPERTIES)],
+                retrieved)
+
+            # an incomplete cpu_info isn't cached, but retrieved again
+            runtimes['host2'].bootTime = 3
+            feature_capability = props['host2'].pop(
+                'config.featureCapability')
+            vm_util.get_stats_from_cluster_per_host(
+                session, "cluster1", cpu_info_cache=cache)
+            self.assertEqual({'host1'}, set(cache))
+            del retrieved[:]
+
+            props['host2']['config.featureCapability'] = feature_capability
+            result = vm_util.get_stats_from_cluster_per_host(
+                session, "cluster1", cpu_info_cache=cache)
+            self.assertEqual(expected, result)
+            self.assertEqual(
+                [(['host1', 'host2'], vm_util._HOST_STATS_PROPERTIES),
+                 (['host2'], vm_util._HOST_CPU_INFO_PROPERTIES)],
+                retrieved)
+            self.assertEqual({'host1', 'host2'}, set(cache))
+
+            # hosts leaving the cluster are dropped from the cache
+            prop_dict['host'] = fake._convert_to_array_of_mor(host_refs[:1])
+            vm_util.get_stats_from_cluster_per_host(
+                session, "cluster1", cpu_info_cache=cache)
+            self.assertEqual({'host1'}, set(cache))
+
     def test_get_resize_spec(self):
         hw_version = 'vmx-10'
         self.flags(default_hw_version=hw_version, group='vmware')
@@ -760,6 +899,45 @@ class VMwareVMUtilTestCase(test.NoDBTestCase):
         self.assertEqual(0, unit_number)
         self.assertEqual(1, controller_spec.device.busNumber)
 
+    def test_allocate_controller_keys_and_unit_numbers_scsi(self):
+        # Test that slots allocated in the same call are not handed out twice
+        devices = [fake.VirtualLsiLogicController(1000, scsiCtlrUnitNumber=7)]
+        for unit_number in range(5):
+            disk = fake.VirtualDisk(1000, unit_number)
+            devices.append(disk)
+        factory = fake.FakeFactory()
+        slots, controller_specs = \
+            vm_util.allocate_controller_keys_and_unit_numbers(
+                factory, devices, [constants.DEFAULT_ADAPTER_TYPE] * 3)
+        self.assertEqual([(1000, 5), (1000, 6), (1000, 8)], slots)
+        self.assertEqual([], controller_specs)
+
+    def test_allocate_controller_keys_and_unit_numbers_new_controllers(self):
+        # Test that every new controller gets its own key and bus number and
+        # is used for the following disks
+        devices = [fake.VirtualLsiLogicController(1000, scsiCtlrUnitNumber=7)]
+        for unit_number in range(16):
+            if unit_number != 7:
+                devices.append(fake.VirtualDisk(1000, unit_number))
+        ide0 = fake.VirtualIDEController(200)
+        devices.append(ide0)
+        for unit_number in [0, 1]:
+            devices.append(fake.VirtualDisk(200, unit_number))
+        factory = fake.FakeFactory()
+        adapter_types = ([constants.DEFAULT_ADAPTER_TYPE] * 17 +
+                         [constants.ADAPTER_TYPE_IDE])
+        slots, controller_specs = \
+            vm_util.allocate_controller_keys_and_unit_numbers(
+                factory, devices, adapter_types)
+        expected = [(-101, unit_number) for unit_number in range(16)
+                    if unit_number != 7]
+        expected += [(-102, 0), (-102, 1), (-103, 0)]
+        self.assertEqual(expected, slots)
+        self.assertEqual([-101, -102, -103],
+                         [spec.device.key for spec in controller_specs])
+        self.assertEqual([1, 2, 0],
+                         [spec.device.busNumber for spec in controller_specs])
+
     def test_get_vnc_config_spec(self):
         self.flags(vnc_keymap='en-ie', group='vmware')
         fake_factory = fake.FakeFactory()
@@ -798,6 +976,7 @@ class VMwareVMUtilTestCase(test.NoDBTestCase):
         fake_vms = self._create_fake_vms()
         self.flags(vnc_port=5900, group='vmware')
         self.flags(vnc_port_total=10000, group='vmware')
+        self.flags(use_property_collector=False, group='vmware')
         actual = vm_util.get_vnc_port(
             fake.FakeObjectRetrievalSession(fake_vms))
         self.assertEqual(actual, 5910)
@@ -806,10 +985,173 @@ class VMwareVMUtilTestCase(test.NoDBTestCase):
         fake_vms = self._create_fake_vms()
         self.flags(vnc_port=5900, group='vmware')
         self.flags(vnc_port_total=10, group='vmware')
+        self.flags(use_property_collector=False, group='vmware')
         self.assertRaises(exception.ConsolePortRangeExhausted,
                           vm_util.get_vnc_port,
                           fake.FakeObjectRetrievalSession(fake_vms))
 
+    def _make_vnc_update_set(self, version, *object_updates):
+        filter_update = fake.DataObject()
+        filter_update.objectSet = list(object_updates)
+        update_set = fake.DataObject()
+        update_set.version = version
+        update_set.filterSet = [filter_update]
+        return update_set
+
+    def _make_vnc_object_update(self, kind, vm_value, port=None):
+        update = fake.DataObject()
+        update.kind = kind
+        update.obj = fake.ManagedObjectReference(name='VirtualMachine',
+                                                 value=vm_value)
+        update.changeSet = []
+        if kind != 'leave':
+            change = fake.DataObject()
+            change.name = vm_util.VNC_CONFIG_KEY
+            change.op = 'assign'
+            change.val = None
+            if port is not None:
+                change.val = fake.DataObject()
+                change.val.key = 'RemoteDisplay.vnc.port'
+                change.val.value = str(port)
+            update.changeSet.append(change)
+        return update
+
+    def _mock_vnc_session(self, *update_sets):
+        update_sets = list(update_sets)
+        session = mock.Mock()
+
+        def fake_call_method(module, method, *args, **kwargs):
+            if method == 'CreatePropertyCollector':
+                return mock.sentinel.collector
+            if method == 'WaitForUpdatesEx':
+                self.assertEqual(mock.sentinel.collector, args[0])
+                result = update_sets.pop(0) if update_sets else None
+                if isinstance(result, Exception):
+                    raise result
+                return result
+            return None
+
+        session._call_method.side_effect = fake_call_method
+        return session, update_sets
+
+    def _get_vnc_calls(self, session, method):
+        return [c for c in session._call_method.call_args_list
+                if c[0][1] == method]
+
+    @mock.patch.object(vm_util, '_get_vnc_ports_by_vm')
+    def test_get_vnc_port_property_collector(self, mock_get_ports):
+        self.flags(vnc_port=5900, vnc_port_total=10, group='vmware')
+        # vm-other belongs to another compute-node using the same vCenter
+        session, update_sets = self._mock_vnc_session(
+            self._make_vnc_update_set(
+                '1',
+                self._make_vnc_object_update('enter', 'vm-0', 5900),
+                self._make_vnc_object_update('enter', 'vm-other', 5901),
+                self._make_vnc_object_update('enter', 'vm-novnc')))
+
+        self.assertEqual(5902, vm_util.get_vnc_port(session))
+        self.assertEqual(1, len(self._get_vnc_calls(session,
+                                                    'CreateFilter')))
+
+        # a second allocation only asks for the changes
+        update_sets.append(self._make_vnc_update_set(
+            '2', self._make_vnc_object_update('enter', 'vm-3', 5903)))
+        self.assertEqual(5904, vm_util.get_vnc_port(session))
+
+        mock_get_ports.assert_not_called()
+        self.assertEqual(1, len(self._get_vnc_calls(
+            session, 'CreatePropertyCollector')))
+        versions = [c[1]['version'] for c in
+                    self._get_vnc_calls(session, 'WaitForUpdatesEx')]
+        self.assertEqual(['', '1', '1', '2'], versions)
+
+    @mock.patch.object(vm_util, '_get_vnc_ports_by_vm')
+    def test_get_vnc_port_property_collector_freed(self, mock_get_ports):
+        self.flags(vnc_port=5900, vnc_port_total=2, group='vmware')
+        session, update_sets = self._mock_vnc_session(
+            self._make_vnc_update_set(
+                '1', self._make_vnc_object_update('enter', 'vm-0', 5900)))
+
+        self.assertEqual(5901, vm_util.get_vnc_port(session))
+        # our own allocation is kept until a VM shows up with it
+        self.assertRaises(exception.ConsolePortRangeExhausted,
+                          vm_util.get_vnc_port, session)
+
+        update_sets.append(self._make_vnc_update_set(
+            '2',
+            self._make_vnc_object_update('enter', 'vm-1', 5901),
+            self._make_vnc_object_update('leave', 'vm-0')))
+        self.assertEqual(5900, vm_util.get_vnc_port(session))
+
+        # a deleted VNC port frees the port as well
+        update_sets.append(self._make_vnc_update_set(
+            '3',
+            self._make_vnc_object_update('enter', 'vm-2', 5900),
+            self._make_vnc_object_update('modify', 'vm-1')))
+        self.assertEqual(5901, vm_util.get_vnc_port(session))
+        mock_get_ports.assert_not_called()
+
+    @mock.patch.object(vm_util, '_get_vnc_ports_by_vm')
+    def test_get_vnc_port_reservation_expires(self, mock_get_ports):
+        self.flags(vnc_port=5900, vnc_port_total=1, group='vmware')
+        session, _ = self._mock_vnc_session()
+
+        with mock.patch('time.monotonic', return_value=100):
+            self.assertEqual(5900, vm_util.get_vnc_port(session))
+            self.assertRaises(exception.ConsolePortRangeExhausted,
+                              vm_util.get_vnc_port, session)
+
+        # the VM never got the port, e.g. because the spawn failed
+        with mock.patch('time.monotonic',
+                        return_value=100 +
+                        vm_util.VNC_PORT_RESERVATION_TIMEOUT):
+            self.assertEqual(5900, vm_util.get_vnc_port(session))
+        mock_get_ports.assert_not_called()
+
+    @mock.patch.object(vm_util, '_get_vnc_ports_by_vm')
+    def test_get_vnc_port_without_property_collector(self, mock_get_ports):
+        self.flags(vnc_port=5900, vnc_port_total=10, group='vmware')
+        self.flags(use_property_collector=False, group='vmware')
+        session = mock.Mock()
+        mock_get_ports.return_value = {'vm-0': 5900}
+
+        self.assertEqual(5901, vm_util.get_vnc_port(session))
+        mock_get_ports.return_value = {'vm-0': 5900, 'vm-2': 5902}
+        self.assertEqual(5903, vm_util.get_vnc_port(session))
+
+        # the ports of all VMs are read on every allocation
+        self.assertEqual(2, mock_get_ports.call_count)
+        session._call_method.assert_not_called()
+
+    @mock.patch.object(vm_util, '_get_vnc_ports_by_vm')
+    def test_get_vnc_port_property_collector_fails(self, mock_get_ports):
+        self.flags(vnc_port=5900, vnc_port_total=10, group='vmware')
+        session = mock.Mock()
+        session._call_method.side_effect = vexc.VimException('fake')
+        mock_get_ports.return_value = {'vm-0': 5900}
+
+        self.assertEqual(5901, vm_util.get_vnc_port(session))
+        mock_get_ports.assert_called_once_with(session)
+
+    @mock.patch.object(vm_util, '_get_vnc_ports_by_vm')
+    def test_get_vnc_port_property_collector_vanished(self, mock_get_ports):
+        self.flags(vnc_port=5900, vnc_port_total=10, group='vmware')
+        session, update_sets = self._mock_vnc_session(
+            self._make_vnc_update_set(
+                '1', self._make_vnc_object_update('enter', 'vm-0', 5900)))
+        self.assertEqual(5901, vm_util.get_vnc_port(session))
+
+        # after a re-login, the property collector is gone
+        update_sets.append(vexc.ManagedObjectNotFoundException())
+        update_sets.append(self._make_vnc_update_set(
+            '1',
+            self._make_vnc_object_update('enter', 'vm-0', 5900),
+            self._make_vnc_object_update('enter', 'vm-1', 5901)))
+        self.assertEqual(5902, vm_util.get_vnc_port(session))
+        self.assertEqual(2, len(self._get_vnc_calls(
+            session, 'CreatePropertyCollector')))
+        mock_get_ports.assert_not_called()
+
     def test_get_cluster_ref_by_name_none(self):
         fake_objects = fake.FakeRetrieveResult()
         ref = vm_util.get_cluster_ref_by_name(
@@ -2218,6 +2560,64 @@ class VMwareVMUtilTestCase(test.NoDBTestCase):
                 "get_object_property", vm_ref, "config.hardware.device")
             self.assertEqual(swap_disk, device)
 
+    def _get_snapshot_devices(self):
+        controller = fake.VirtualLsiLogicController()
+        controller.key = 1000
+        devices = [controller]
+        for key, file_name in ((2000, '[ds] uuid/uuid.vmdk'),
+                               (2001, '[ds] uuid/ephemeral_0.vmdk'),
+                               (2002, '[ds] uuid/swap.vmdk')):
+            disk = fake.VirtualDisk()
+            disk.key = key
+            disk.controllerKey = controller.key
+            disk.unitNumber = key - 2000
+            disk.capacityInBytes = units.Gi
+            disk.backing = fake.VirtualDiskFlatVer2BackingInfo()
+            disk.backing.fileName = file_name
+            disk.backing.uuid = 'UUID-%d' % key
+            devices.append(disk)
+        return devices
+
+    def test_device_snapshot(self):
+        vm_ref = fake.ManagedObjectReference(value='vm-1')
+        devices = self._get_snapshot_devices()
+        session = fake.FakeSession()
+        with test.nested(
+                mock.patch.object(session, '_call_method',
+                                  return_value=devices),
+                mock.patch.object(session, '_wait_for_task')
+        ) as (mock_call, _):
+            with vm_util.device_snapshot():
+                vmdk = vm_util.get_vmdk_info(session, vm_ref)
+                ephemerals = vm_util.get_ephemerals(session, vm_ref)
+                swap = vm_util.get_swap(session, vm_ref)
+                index = vm_util.get_hardware_device_index(session, vm_ref)
+                with vm_util.device_snapshot():
+                    vm_util.get_hardware_devices(session, vm_ref)
+
+                mock_call.assert_called_once_with(mock.ANY,
+                    "get_object_property", vm_ref, "config.hardware.device")
+                self.assertEqual('[ds] uuid/uuid.vmdk', vmdk.path)
+                self.assertEqual(constants.DEFAULT_ADAPTER_TYPE,
+                                 vmdk.adapter_type)
+                self.assertEqual([devices[2]], ephemerals)
+                self.assertEqual(devices[3], swap)
+                self.assertEqual(devices[2],
+                                 index.get_vmdk_backed_disk('UUID-2001'))
+                self.assertIsNone(index.get_vmdk_backed_disk('UUID-1000'))
+                self.assertEqual(constants.DEFAULT_ADAPTER_TYPE,
+                                 index.get_adapter_type(devices[3]))
+
+                # reconfiguring the VM invalidates the snapshot
+                vm_util.reconfigure_vm(session, vm_ref, 'fake-spec')
+                vm_util.get_hardware_devices(session, vm_ref)
+                self.assertEqual(3, mock_call.call_count)
+
+            # outside of the context, every lookup reads the devices
+            vm_util.get_swap(session, vm_ref)
+            vm_util.get_swap(session, vm_ref)
+            self.assertEqual(5, mock_call.call_count)
+
     def test_create_folder(self):
         """Test create_folder when the folder doesn't exist"""
         child_folder = mock.sentinel.child_folder
@@ -2356,6 +2756,69 @@ class VMwareVMUtilTestCase(test.NoDBTestCase):
             session.vim, "DetachDisk_Task", vm_ref, diskId=disk_id)
         session._wait_for_task.assert_called_once_with(task)
 
+    @mock.patch.object(vm_util, 'search_vm_ref_by_identifier')
+    def test_vm_ref_proxy_fetch_moref_bulk_refresh(self, mock_search):
+        stale_ref = fake.ManagedObjectReference(name='VirtualMachine',
+                                                value='vm-1')
+        new_ref = fake.ManagedObjectReference(name='VirtualMachine',
+                                              value='vm-2')
+        uuid = self._instance.uuid
+        vm_util.vm_ref_cache_update(uuid, stale_ref)
+
+        refresher = mock.Mock(
+            side_effect=lambda: vm_util.vm_ref_cache_update(uuid, new_ref))
+        vm_util.vm_refs_cache_set_refresher(refresher)
+
+        proxy = vm_util.VmMoRefProxy(stale_ref, uuid)
+        proxy.fetch_moref(mock.sentinel.session)
+
+        refresher.assert_called_once_with()
+        mock_search.assert_not_called()
+        self.assertEqual('vm-2', proxy.value)
+
+        # another proxy holding the stale ref takes the refreshed one from
+        # the cache without searching or refreshing again
+        other_proxy = vm_util.VmMoRefProxy(stale_ref, uuid)
+        other_proxy.fetch_moref(mock.sentinel.session)
+
+        refresher.assert_called_once_with()
+        mock_search.assert_not_called()
+        self.assertEqual('vm-2', other_proxy.value)
+
+    @mock.patch.object(vm_util, 'search_vm_ref_by_identifier')
+    def test_vm_ref_proxy_fetch_moref_refresh_too_recent(self, mock_search):
+        stale_ref = fake.ManagedObjectReference(name='VirtualMachine',
+                                                value='vm-1')
+        new_ref = fake.ManagedObjectReference(name='VirtualMachine',
+                                              value='vm-2')
+        mock_search.return_value = new_ref
+        uuid = self._instance.uuid
+        vm_util.vm_ref_cache_update(uuid, stale_ref)
+        refresher = mock.Mock()
+        vm_util.vm_refs_cache_set_refresher(refresher)
+
+        # the refresh doesn't find the VM, so we fall back to searching it
+        proxy = vm_util.VmMoRefProxy(stale_ref, uuid)
+        proxy.fetch_moref(mock.sentinel.session)
+
+        refresher.assert_called_once_with()
+        mock_search.assert_called_once_with(mock.sentinel.session, uuid)
+        self.assertEqual(new_ref, vm_util.vm_ref_cache_get(uuid))
+
+        # the next stale reference doesn't trigger another refresh so soon
+        self.assertFalse(vm_util.vm_refs_cache_refresh())
+        refresher.assert_called_once_with()
+
+    def test_vm_refs_cache_refresh_without_refresher(self):
+        self.assertFalse(vm_util.vm_refs_cache_refresh())
+
+    @mock.patch.object(vm_util, 'search_vm_ref_by_identifier',
+                       return_value=None)
+    def test_vm_ref_proxy_fetch_moref_not_found(self, mock_search):
+        proxy = vm_util.VmMoRefProxy(None, self._instance.uuid)
+        self.assertRaises(exception.InstanceNotFound,
+                          proxy.fetch_moref, mock.sentinel.session)
+
 
 @mock.patch.object(VMwareAPISession, 'vim', stubs.fake_vim_prop)
 class VMwareVMUtilGetHostRefTestCase(test.NoDBTestCase):
@@ -2394,3 +2857,64 @@ class VMwareVMUtilGetHostRefTestCase(test.NoDBTestCase):
 
         mock_get_vm_ref.assert_called_once_with(self.session, 'fake-instance')
         self.assertEqual(host.name, ret)
+
+
+class HistoryCollectorItemsTestCase(test.NoDBTestCase):
+    def setUp(self):
+        super(HistoryCollectorItemsTestCase, self).setUp()
+        self.session = mock.Mock()
+        self.pages = []
+        self.created = []
+
+        def _call_method(module, method, *args, **kwargs):
+            if method == 'CreateCollectorForTasks':
+                collector = fake.ManagedObjectReference(
+                    value='collector-%d' % len(self.created))
+                self.created.append(collector)
+                return collector
+            if method == 'ReadNextTasks':
+                return self.pages.pop(0) if self.pages else []
+        self.session._call_method.side_effect = _call_method
+        self.filter_spec = vm_util.create_task_filter_spec(
+            fake.FakeFactory(), entity='fake-folder', recursion='all')
+
+    def _task(self, value):
+        return mock.Mock(queueTime=value)
+
+    def _calls(self, method):
+        return [c for c in self.session._call_method.call_args_list
+                if c[0][1] == method]
+
+    def test_create_task_filter_spec(self):
+        spec = vm_util.create_task_filter_spec(
+            fake.FakeFactory(), entity='fake-folder', recursion='all',
+            begin_time='fake-begin')
+
+        self.assertEqual('fake-folder', spec.entity.entity)
+        self.assertEqual('all', spec.entity.recursion)
+        self.assertEqual('queuedTime', spec.time.timeType)
+        self.assertEqual('fake-begin', spec.time.beginTime)
+        self.assertFalse(hasattr(spec.time, 'endTime'))
+
+    def test_items_stop_early(self):
+        self.pages = [[self._task(2), self._task(1)], [self._task(3)]]
+
+        with vm_util.TaskHistoryCollectorItems(
+                self.session, self.filter_spec) as items:
+            result = [t.queueTime for t in items.items(
+                stop_when=lambda t: t.queueTime == 2)]
+
+        self.assertEqual([1, 2], result)
+        # the second page was never read
+        self.assertEqual(1, len(self._calls('ReadNextTasks')))
+        destroy_calls = self._calls('DestroyCollector')
+        self.assertEqual(1, len(destroy_calls))
+        self.assertEqual(self.created[0], destroy_calls[0][0][2])
+
+    def test_close_destroys_collector_once(self):
+        items = vm_util.TaskHistoryCollectorItems(self.session,
+                                                  self.filter_spec)
+        items.close()
+        items.close()
+
+        self.assertEqual(1, len(self._calls('DestroyCollector')))
@@ -13,12 +13,17 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import contextlib
+import copy
 import mock
 import re
 import time
 
 import ddt
+import eventlet
 from oslo_utils.fixture import uuidsentinel as uuids
+from oslo_utils import timeutils
 from oslo_utils import units
 from oslo_utils import uuidutils
 from oslo_vmware import exceptions as vexc
@@ -43,6 +48,7 @@ from nova.virt import hardware
 from nova.virt.vmwareapi import cluster_util
 from nova.virt.vmwareapi import constants
 from nova.virt.vmwareapi import ds_util
+from nova.virt.vmwareapi import imagecache
 from nova.virt.vmwareapi import images
 from nova.virt.vmwareapi.session import VMwareAPISession
 from nova.virt.vmwareapi import vif
@@ -208,6 +214,51 @@ class VMwareVMOpsTestCase(test.TestCase):
                                         self.pure_IPv6_network_info)
         self.assertEqual('DE:AD:BE:EF:00:00;;;;;#', result)
 
+    @mock.patch.object(vm_util, 'reconfigure_vm')
+    @mock.patch.object(vm_util, 'get_vnc_port', return_value=5901)
+    def test_set_machine_id_and_vnc_config(self, mock_get_vnc_port,
+                                           mock_reconfigure):
+        self.flags(enabled=True, group='vnc')
+        client_factory = self._session.vim.client.factory
+        self._vmops._set_machine_id_and_vnc_config(
+            client_factory, self._instance, 'fake_vm_ref', self.network_info)
+
+        mock_reconfigure.assert_called_once_with(self._session,
+                                                 'fake_vm_ref', mock.ANY)
+        config_spec = mock_reconfigure.call_args[0][2]
+        self.assertEqual(['machine.id', 'RemoteDisplay.vnc.enabled',
+                          'RemoteDisplay.vnc.port',
+                          'RemoteDisplay.vnc.keyMap'],
+                         [opt.key for opt in config_spec.extraConfig])
+
+    @mock.patch.object(vm_util, 'reconfigure_vm')
+    @mock.patch.object(vm_util, 'get_vnc_port')
+    def test_set_machine_id_and_vnc_config_vnc_disabled(self,
+                                                        mock_get_vnc_port,
+                                                        mock_reconfigure):
+        self.flags(enabled=False, group='vnc')
+        client_factory = self._session.vim.client.factory
+        self._vmops._set_machine_id_and_vnc_config(
+            client_factory, self._instance, 'fake_vm_ref', self.network_info)
+
+        mock_get_vnc_port.assert_not_called()
+        mock_reconfigure.assert_called_once_with(self._session,
+                                                 'fake_vm_ref', mock.ANY)
+        config_spec = mock_reconfigure.call_args[0][2]
+        self.assertEqual(['machine.id'],
+                         [opt.key for opt in config_spec.extraConfig])
+
+    @mock.patch.object(vm_util, 'reconfigure_vm')
+    def test_set_machine_id_and_vnc_config_nothing_to_do(self,
+                                                         mock_reconfigure):
+        self.flags(enabled=False, group='vnc')
+        self.flags(flat_injected=False)
+        client_factory = self._session.vim.client.factory
+        self._vmops._set_machine_id_and_vnc_config(
+            client_factory, self._instance, 'fake_vm_ref', self.network_info)
+
+        mock_reconfigure.assert_not_called()
+
     def _setup_create_folder_mocks(self):
         with mock.patch.object(vmops.VMwareVMOps, '_get_evc_modes',
                                return_value=self._evc_modes), \
@@ -398,7 +449,249 @@ class VMwareVMOpsTestCase(test.TestCase):
             self.assertRaises(exception.InstanceNotFound,
                               self._vmops.get_info,
                               self._instance)
-            mock_vm_ref_cache_get.assert_called_once_with(self._instance.uuid)
+            # once for the initial reference and once more when re-resolving
+            # the stale reference
+            self.assertEqual([mock.call(self._instance.uuid)] * 2,
+                             mock_vm_ref_cache_get.call_args_list)
+
+    @mock.patch.object(vm_util, 'get_vm_ref',
+        return_value=vmwareapi_fake.ManagedObjectReference(value='test_id'))
+    def test_get_info_fresh_cache(self, mock_get_vm_ref):
+        self._vmops._property_collector_last_sync = time.monotonic()
+        cache = {'test_id': {'runtime.powerState': 'poweredOff'}}
+        with test.nested(
+            mock.patch.object(vm_util, '_VM_VALUE_CACHE', cache),
+            mock.patch.object(self._session, '_call_method')
+        ) as (_, mock_call_method):
+            info = self._vmops.get_info(self._instance, use_cache=True)
+            self.assertEqual(hardware.InstanceInfo(state=power_state.SHUTDOWN),
+                             info)
+            mock_call_method.assert_not_called()
+
+    @mock.patch.object(vm_util, 'get_vm_ref',
+        return_value=vmwareapi_fake.ManagedObjectReference(value='test_id'))
+    def test_get_info_stale_cache(self, mock_get_vm_ref):
+        self.flags(property_collector_max_cache_age=10, group='vmware')
+        self._vmops._property_collector_last_sync = time.monotonic() - 20
+        cache = {'test_id': {'runtime.powerState': 'poweredOff'}}
+        with test.nested(
+            mock.patch.object(vm_util, '_VM_VALUE_CACHE', cache),
+            mock.patch.object(self._session, '_call_method',
+                              return_value={'runtime.powerState': 'poweredOn'})
+        ) as (_, mock_call_method):
+            info = self._vmops.get_info(self._instance, use_cache=True)
+            self.assertEqual(hardware.InstanceInfo(state=power_state.RUNNING),
+                             info)
+            mock_call_method.assert_called_once_with(
+                vutil, "get_object_properties_dict",
+                mock_get_vm_ref.return_value, ['runtime.powerState'])
+
+    @mock.patch.object(vmops.VMwareVMOps, '_list_instances_in_cluster')
+    @mock.patch.object(vmops.VMwareVMOps, 'update_cached_instances')
+    def test_get_power_states_from_cache(self, mock_update_cached_instances,
+                                         mock_list_instances):
+        self._vmops._property_collector_last_sync = time.monotonic()
+        cache = {
+            'vm-1': {'config.instanceUuid': uuids.vm1,
+                     'config.managedBy': True,
+                     'runtime.powerState': 'poweredOn'},
+            'vm-2': {'config.instanceUuid': uuids.vm2,
+                     'config.managedBy': True,
+                     'runtime.powerState': 'poweredOff'},
+            'vm-3': {'config.instanceUuid': uuids.vm3,
+                     'config.managedBy': False,
+                     'runtime.powerState': 'poweredOn'},
+        }
+        with mock.patch.object(vm_util, '_VM_VALUE_CACHE', cache):
+            power_states = self._vmops.get_power_states()
+
+        self.assertEqual({uuids.vm1: power_state.RUNNING,
+                          uuids.vm2: power_state.SHUTDOWN},
+                         power_states)
+        mock_update_cached_instances.assert_called_once_with()
+        mock_list_instances.assert_not_called()
+
+    @mock.patch.object(vmops.VMwareVMOps, '_list_instances_in_cluster')
+    def test_get_power_states_without_cache(self, mock_list_instances):
+        self.flags(use_property_collector=False, group='vmware')
+        mock_list_instances.return_value = [
+            (uuids.vm1, {'runtime.powerState': 'suspended'}),
+            (uuids.vm2, {'runtime.powerState': 'poweredOn'}),
+            (uuids.vm3, {})]
+
+        power_states = self._vmops.get_power_states()
+
+        self.assertEqual({uuids.vm1: power_state.SUSPENDED,
+                          uuids.vm2: power_state.RUNNING},
+                         power_states)
+        mock_list_instances.assert_called_once_with(['runtime.powerState'])
+
+    def test_get_vm_cache_age(self):
+        self.assertIsNone(self._vmops.get_vm_cache_age())
+        self.assertFalse(self._vmops.is_vm_cache_fresh())
+
+        self._vmops._property_collector_last_sync = time.monotonic() - 5
+        self.assertGreaterEqual(self._vmops.get_vm_cache_age(), 5)
+        self.assertTrue(self._vmops.is_vm_cache_fresh())
+        self.assertFalse(self._vmops.is_vm_cache_fresh(max_age=1))
+
+        self.flags(use_property_collector=False, group='vmware')
+        self.assertFalse(self._vmops.is_vm_cache_fresh())
+
+    @mock.patch.object(vmops.VMwareVMOps, '_list_instances_in_cluster',
+                       return_value=['fake-uuid-from-vcenter'])
+    def test_list_instances_from_cache(self, mock_list):
+        self.addCleanup(vm_util.vm_value_cache_reset)
+        vm_util.vm_value_cache_update('vm-1', 'config.instanceUuid', 'uuid-1')
+        vm_util.vm_value_cache_update('vm-1', 'config.managedBy', True)
+        vm_util.vm_value_cache_update('vm-2', 'config.instanceUuid', 'uuid-2')
+        self._vmops._property_collector_watcher_running = True
+        self._vmops._property_collector_version = '42'
+        self._vmops._property_collector_last_sync = time.monotonic()
+
+        self.assertEqual(['uuid-1'], self._vmops.list_instances())
+        mock_list.assert_not_called()
+
+        info = self._vmops.get_vm_cache_info()
+        self.assertEqual('42', info['version'])
+        self.assertTrue(info['fresh'])
+        self.assertEqual(len(vm_util._VM_VALUE_CACHE), info['vms'])
+
+    @mock.patch.object(vmops.VMwareVMOps, '_list_instances_in_cluster',
+                       return_value=['fake-uuid-from-vcenter'])
+    def test_list_instances_stale_cache(self, mock_list):
+        self.addCleanup(vm_util.vm_value_cache_reset)
+        vm_util.vm_value_cache_update('vm-1', 'config.instanceUuid', 'uuid-1')
+        vm_util.vm_value_cache_update('vm-1', 'config.managedBy', True)
+        self._vmops._property_collector_watcher_running = True
+        self._vmops._property_collector_last_sync = time.monotonic() - 3600
+
+        self.assertEqual(['fake-uuid-from-vcenter'],
+                         self._vmops.list_instances())
+        mock_list.assert_called_once_with()
+        self.assertFalse(self._vmops.get_vm_cache_info()['fresh'])
+
+    @mock.patch.object(vmops.VMwareVMOps,
+                       '_wait_for_property_collector_updates')
+    def test_update_cached_instances_with_watcher(self, mock_wait):
+        self._vmops._property_collector_watcher_running = True
+        self._vmops.update_cached_instances()
+        mock_wait.assert_not_called()
+
+        self._vmops._property_collector_watcher_running = False
+        self._vmops.update_cached_instances()
+        mock_wait.assert_called_once_with(0)
+
+    def _make_update_set(self, version, updates, truncated=False):
+        object_set = []
+        for kind, value, changes in updates:
+            vm_ref = vmwareapi_fake.ManagedObjectReference(
+                name='VirtualMachine', value=value)
+            change_set = [mock.Mock(op='assign', val=val)
+                          for val in changes.values()]
+            for change, name in zip(change_set, changes):
+                change.name = name
+            object_set.append(mock.Mock(obj=vm_ref, kind=kind,
+                                        changeSet=change_set))
+        return mock.Mock(version=version, truncated=truncated,
+                         filterSet=[mock.Mock(objectSet=object_set)])
+
+    def test_wait_for_property_collector_updates(self):
+        managed_by = mock.Mock(extensionKey=constants.EXTENSION_KEY)
+        update_sets = [
+            self._make_update_set('1', [
+                ('enter', 'vm-1', {'config.instanceUuid': uuids.vm1,
+                                   'config.managedBy': managed_by,
+                                   'runtime.powerState': 'poweredOn'}),
+                ('enter', 'vm-2', {'config.instanceUuid': uuids.vm2,
+                                   'config.managedBy': None})],
+                truncated=True),
+            self._make_update_set('2', [
+                ('modify', 'vm-1', {'runtime.powerState': 'poweredOff'})]),
+            None]
+        self._vmops._property_collector = mock.sentinel.pc
+        vm_util.vm_value_cache_reset()
+        vm_util.vm_refs_cache_reset()
+
+        with mock.patch.object(self._session, '_call_method',
+                               side_effect=update_sets) as mock_call_method:
+            self._vmops._wait_for_property_collector_updates(5)
+
+        self.assertEqual(3, mock_call_method.call_count)
+        self.assertEqual('2', self._vmops._property_collector_version)
+        self.assertIsNotNone(self._vmops.get_vm_cache_age())
+        self.assertEqual({'config.instanceUuid': uuids.vm1,
+                          'config.managedBy': True,
+                          'runtime.powerState': 'poweredOff'},
+                         vm_util.vm_value_cache_get('vm-1'))
+        self.assertEqual('vm-1',
+                         vm_util.vm_ref_cache_get(uuids.vm1).value)
+        self.assertIsNone(vm_util.vm_ref_cache_get(uuids.vm2))
+
+    def test_reset_property_collector(self):
+        pc = vmwareapi_fake.ManagedObjectReference(
+            name='PropertyCollector', value='session[1]pc')
+        self._vmops._property_collector = pc
+        self._vmops._property_collector_version = '42'
+        self._vmops._property_collector_last_sync = time.monotonic()
+        vm_util.vm_value_cache_update('vm-1', 'runtime.powerState',
+                                      'poweredOn')
+
+        with mock.patch.object(self._session, '_call_method',
+                side_effect=vexc.ManagedObjectNotFoundException) as mock_call:
+            self._vmops._reset_property_collector()
+            mock_call.assert_called_once_with(
+                self._session.vim, "DestroyPropertyCollector", pc)
+
+        self.assertIsNone(self._vmops._property_collector)
+        self.assertEqual('', self._vmops._property_collector_version)
+        self.assertIsNone(self._vmops.get_vm_cache_age())
+        self.assertIsNone(vm_util.vm_value_cache_get('vm-1'))
+
+    @mock.patch.object(vmops.VMwareVMOps, '_reset_property_collector')
+    @mock.patch.object(vmops.VMwareVMOps, '_drain_property_collector')
+    @mock.patch.object(vmops.VMwareVMOps,
+                       '_wait_for_property_collector_updates')
+    def test_property_collector_watcher_loop(self, mock_wait, mock_drain,
+                                             mock_reset):
+        side_effects = iter([
+            None,
+            vexc.VimFaultException(['InvalidCollectorVersion'], 'invalid'),
+            vexc.VimFaultException(['RequestCanceled'], 'canceled'),
+            vexc.ManagedObjectNotFoundException(),
+            None])
+
+        def _wait(max_wait_seconds):
+            if mock_wait.call_count == 5:
+                self._vmops.stop_property_collector_watcher()
+            result = next(side_effects)
+            if isinstance(result, Exception):
+                raise result
+
+        mock_wait.side_effect = _wait
+        self._vmops._property_collector_watcher_loop()
+
+        mock_drain.assert_called_once_with()
+        mock_wait.assert_called_with(
+            CONF.vmware.property_collector_max_wait_seconds)
+        self.assertEqual(5, mock_wait.call_count)
+        # version invalid, collector gone and once when stopping
+        self.assertEqual(3, mock_reset.call_count)
+        self.assertFalse(self._vmops._property_collector_watcher_running)
+        self.assertIsNone(self._vmops._property_collector_watcher)
+
+    @mock.patch.object(utils, 'spawn')
+    def test_start_property_collector_watcher(self, mock_spawn):
+        self._vmops.start_property_collector_watcher()
+        self._vmops.start_property_collector_watcher()
+        mock_spawn.assert_called_once_with(
+            self._vmops._property_collector_watcher_loop)
+
+    @mock.patch.object(utils, 'spawn')
+    def test_start_property_collector_watcher_disabled(self, mock_spawn):
+        self.flags(use_property_collector=False, group='vmware')
+        self._vmops.start_property_collector_watcher()
+        mock_spawn.assert_not_called()
 
     def _test_get_datacenter_ref_and_name(self, ds_ref_exists=False):
         instance_ds_ref = vmwareapi_fake.ManagedObjectReference(value='ds-1')
@@ -1264,8 +1557,8 @@ class VMwareVMOpsTestCase(test.TestCase):
         self.test_finish_revert_in_place_migration_another_cluster(
             relocate_fails=True)
 
-    @mock.patch.object(volumeops.VMwareVolumeOps, 'attach_volume')
-    def test_attach_volumes(self, fake_attach_volume):
+    @mock.patch.object(volumeops.VMwareVolumeOps, 'attach_volumes')
+    def test_attach_volumes(self, fake_attach_volumes):
         block_device_info = {
             'block_device_mapping': [
                 {'mount_device': '/dev/sda', 'connection_info': {'id': 'c'}},
@@ -1275,11 +1568,24 @@ class VMwareVMOpsTestCase(test.TestCase):
         }
         self._vmops._attach_volumes(self._instance, block_device_info,
                                     mock.sentinel.adapter_type)
-        fake_attach_volume.assert_has_calls([
-            mock.call({'id': 'c'}, self._instance, mock.sentinel.adapter_type),
-            mock.call({'id': 'b'}, self._instance, mock.sentinel.adapter_type),
-            mock.call({'id': 'a'}, self._instance, mock.sentinel.adapter_type),
-        ])
+        fake_attach_volumes.assert_called_once_with([
+            ({'id': 'c'}, mock.sentinel.adapter_type),
+            ({'id': 'b'}, mock.sentinel.adapter_type),
+            ({'id': 'a'}, mock.sentinel.adapter_type),
+        ], self._instance)
+
+    @mock.patch.object(volumeops.VMwareVolumeOps, 'detach_volumes')
+    def test_detach_volumes(self, fake_detach_volumes):
+        block_device_info = {
+            'block_device_mapping': [
+                {'mount_device': '/dev/sdb', 'connection_info': {'id': 'b'}},
+                {'mount_device': '/dev/sdc', 'connection_info': {'id': 'c'}},
+                {'mount_device': '/dev/sda', 'connection_info': {'id': 'a'}},
+            ]
+        }
+        self._vmops._detach_volumes(self._instance, block_device_info)
+        fake_detach_volumes.assert_called_once_with(
+            [{'id': 'c'}, {'id': 'b'}, {'id': 'a'}], self._instance)
 
     @mock.patch.object(vmops.VMwareVMOps, '_get_instance_metadata')
     @mock.patch.object(vmops.VMwareVMOps, '_get_extra_specs')
@@ -1477,6 +1783,46 @@ class VMwareVMOpsTestCase(test.TestCase):
                     '[fake] uuid/root.vmdk',
                     disk_io_limits=extra_specs.disk_io_limits)
 
+    @mock.patch.object(vmops.VMwareVMOps, '_extend_virtual_disk')
+    @mock.patch.object(vmops.VMwareVMOps, '_get_extra_specs',
+                       return_value=vm_util.ExtraSpecs())
+    @mock.patch.object(ds_util, 'disk_move')
+    @mock.patch.object(ds_util, 'disk_copy')
+    def test_resize_disk_invalidates_device_snapshot(
+            self, fake_disk_copy, fake_disk_move, fake_get_extra_specs,
+            fake_extend):
+        vm_ref = vmwareapi_fake.ManagedObjectReference(value='vm-1')
+        device = vmwareapi_fake.DataObject()
+        device.backing = vmwareapi_fake.DataObject()
+        device.backing.datastore = 'fake-ref'
+        vmdk = vm_util.VmdkInfo('[fake] uuid/root.vmdk', 'fake-adapter',
+                                'fake-disk',
+                                self._instance.flavor.root_gb * units.Gi,
+                                device)
+        dc_info = ds_util.DcInfo(ref='fake_ref', name='fake',
+                                 vmFolder='fake_folder')
+        instance = self._instance.obj_clone()
+        instance.old_flavor = instance.flavor.obj_clone()
+        flavor = fake_flavor.fake_flavor_obj(
+            self._context, root_gb=self._instance.flavor.root_gb + 1)
+        self._vmops._volumeops = mock.Mock()
+
+        with test.nested(
+                vm_util.device_snapshot(),
+                mock.patch.object(self._vmops, 'get_datacenter_ref_and_name',
+                                  return_value=dc_info),
+                mock.patch.object(self._session, '_call_method',
+                                  return_value=[device]),
+        ) as (_, _get_dc_info, _call_method):
+            vm_util.get_hardware_devices(self._session, vm_ref)
+
+            self._vmops._resize_disk(instance, vm_ref, vmdk, flavor)
+            fake_extend.assert_called_once()
+
+            # the devices get read again with the new capacity
+            vm_util.get_hardware_devices(self._session, vm_ref)
+            self.assertEqual(2, _call_method.call_count)
+
     @mock.patch.object(vm_util, 'detach_devices_from_vm')
     @mock.patch.object(vm_util, 'get_swap')
     @mock.patch.object(vm_util, 'get_ephemerals')
@@ -2081,17 +2427,21 @@ class VMwareVMOpsTestCase(test.TestCase):
              not EXPIRED)
         ]
 
-        mock_task_it.return_value = []
+        tasks = []
         mock_older_than_results = []
         for task, expired in tasks_and_expirations:
-            mock_task_it.return_value.append(task)
+            tasks.append(task)
             mock_older_than_results.append(expired)
+        mock_task_it.return_value.__enter__.return_value.items.return_value \
+            = tasks
         mock_older_than.side_effect = mock_older_than_results
 
         # any instance just to ensure calling _destroy_expired_image_templates
         fake_instances = [self._instance]
         with test.nested(
                 mock.patch.object(self._vmops, '_imagecache'),
+                mock.patch.object(self._vmops, 'get_datacenter_ref_and_name',
+                                  return_value=self._dc_info),
                 mock.patch.object(self._vmops, '_get_all_images_folders',
                                   return_value=['fake-folder']),
                 mock.patch.object(self._vmops, '_get_image_template_vms',
@@ -2104,6 +2454,87 @@ class VMwareVMOpsTestCase(test.TestCase):
                                                     None,
                                                     expired_templ_vm_ref)
 
+    def _destroy_expired_image_templates(self, folders_templ_vms,
+                                         folders_tasks=None,
+                                         destroy_side_effect=None):
+        def _mock_with_ret(vim, ret_res):
+            return mock.Mock(__enter__=mock.Mock(return_value=[]),
+                             __exit__=mock.Mock(return_value=None))
+
+        def _task_items(session, task_filter_spec, max_page_size):
+            folder_ref = task_filter_spec.entity.entity
+            task_items = mock.MagicMock()
+            task_items.__enter__.return_value.items.return_value = \
+                list((folders_tasks or {}).get(folder_ref, []))
+            return task_items
+
+        with test.nested(
+                mock.patch.object(vm_util, 'TaskHistoryCollectorItems',
+                                  side_effect=_task_items),
+                mock.patch.object(vm_util, 'destroy_vm',
+                                  side_effect=destroy_side_effect),
+                mock.patch.object(vutil, 'WithRetrieval',
+                                  side_effect=_mock_with_ret),
+                mock.patch.object(self._vmops, '_imagecache'),
+                mock.patch.object(self._session, '_call_method'),
+        ) as (mock_task_it, mock_destroy_vm, _, mock_imagecache, _):
+            self._vmops._destroy_expired_image_templates(folders_templ_vms)
+        return mock_task_it, mock_destroy_vm, mock_imagecache
+
+    def test_destroy_expired_image_templates_per_folder(self):
+        self.flags(remove_unused_original_minimum_age_seconds=3600,
+                   group='image_cache')
+        used_ref = vmwareapi_fake.ManagedObjectReference(value='vm-1')
+        expired_ref = vmwareapi_fake.ManagedObjectReference(value='vm-2')
+        folders_templ_vms = [
+            ('folder-1', [(used_ref, '%s (ds1)' % self._image_id)]),
+            ('folder-2', [(expired_ref, '%s (ds2)' % self._image_id)]),
+            ('folder-3', []),
+        ]
+        folders_tasks = {
+            'folder-1': [mock.Mock(descriptionId="VirtualMachine.clone",
+                                   entity=used_ref,
+                                   queueTime=timeutils.utcnow())],
+            # tasks not creating or cloning the template don't count
+            'folder-2': [mock.Mock(descriptionId="VirtualMachine.rename",
+                                   entity=expired_ref,
+                                   queueTime=timeutils.utcnow())],
+        }
+
+        mock_task_it, mock_destroy_vm, mock_imagecache = \
+            self._destroy_expired_image_templates(folders_templ_vms,
+                                                  folders_tasks)
+
+        # one query per folder having templates
+        self.assertEqual(2, mock_task_it.call_count)
+        filter_specs = sorted((c[0][1] for c in mock_task_it.call_args_list),
+                              key=lambda f: f.entity.entity)
+        self.assertEqual(['folder-1', 'folder-2'],
+                         [f.entity.entity for f in filter_specs])
+        for filter_spec in filter_specs:
+            self.assertEqual('children', filter_spec.entity.recursion)
+            self.assertEqual('queuedTime', filter_spec.time.timeType)
+            self.assertTrue(timeutils.is_older_than(
+                filter_spec.time.beginTime, 3599))
+        mock_destroy_vm.assert_called_once_with(self._session, None,
+                                                expired_ref)
+        mock_imagecache.remove_image_template.assert_called_once_with(
+            self._image_id, 'ds2')
+
+    def test_destroy_expired_image_templates_continues_on_failure(self):
+        templ_vms = [
+            (vmwareapi_fake.ManagedObjectReference(value='vm-%d' % i),
+             '%s (ds%d)' % (self._image_id, i))
+            for i in range(3)]
+
+        mock_task_it, mock_destroy_vm, mock_imagecache = \
+            self._destroy_expired_image_templates(
+                [('fake-folder', templ_vms)],
+                destroy_side_effect=[None, vexc.VimException('x'), None])
+
+        self.assertEqual(3, mock_destroy_vm.call_count)
+        self.assertEqual(2, mock_imagecache.remove_image_template.call_count)
+
     @mock.patch.object(vutil, 'WithRetrieval')
     @mock.patch.object(vim_util, 'get_inner_objects')
     def _get_image_template_vms(self, mock_get_inner, mock_with_ret,
@@ -2151,6 +2582,758 @@ class VMwareVMOpsTestCase(test.TestCase):
         self._get_image_template_vms(datastore_regex=re.compile('^ds-bb01-.*'),
                                      additional_fail_names=[fail_name])
 
+    def _get_image_template_vi(self, ds_name='ds1'):
+        vi = mock.Mock()
+        vi.ii.image_id = self._image_id
+        vi.datastore.name = ds_name
+        return vi
+
+    @mock.patch.object(vm_util, 'find_by_inventory_path')
+    def test_find_image_template_vm_from_index(self, mock_find):
+        vi = self._get_image_template_vi()
+        templ_vm_ref = vmwareapi_fake.ManagedObjectReference(
+            name='VirtualMachine', value='vm-1')
+        self._vmops._imagecache.add_image_template(self._image_id, 'ds1',
+                                                   templ_vm_ref)
+        with mock.patch.object(self._session, '_call_method',
+                return_value='%s (ds1)' % self._image_id) as mock_call:
+            result = self._vmops._find_image_template_vm(vi)
+
+        self.assertEqual(templ_vm_ref, result)
+        mock_call.assert_called_once_with(vutil, "get_object_property",
+                                          templ_vm_ref, "name")
+        mock_find.assert_not_called()
+
+    @mock.patch.object(vmops.VMwareVMOps, '_build_template_vm_inventory_path',
+                       return_value='fake-path')
+    @mock.patch.object(vm_util, 'find_by_inventory_path')
+    def test_find_image_template_vm_stale_index(self, mock_find,
+                                                mock_build_path):
+        vi = self._get_image_template_vi()
+        stale_vm_ref = vmwareapi_fake.ManagedObjectReference(
+            name='VirtualMachine', value='vm-1')
+        templ_vm_ref = vmwareapi_fake.ManagedObjectReference(
+            name='VirtualMachine', value='vm-2')
+        mock_find.return_value = templ_vm_ref
+        self._vmops._imagecache.add_image_template(self._image_id, 'ds1',
+                                                   stale_vm_ref)
+        with mock.patch.object(self._session, '_call_method',
+                side_effect=vexc.ManagedObjectNotFoundException):
+            result = self._vmops._find_image_template_vm(vi)
+
+        self.assertEqual(templ_vm_ref, result)
+        mock_find.assert_called_once_with(self._session, 'fake-path')
+        self.assertEqual(templ_vm_ref,
+            self._vmops._imagecache.get_image_template(self._image_id, 'ds1'))
+
+    @mock.patch.object(vmops.VMwareVMOps, '_find_image_template_vm')
+    @mock.patch.object(ds_util, 'get_available_datastores')
+    @mock.patch.object(vmops.VMwareVMOps, '_update_image_template_index')
+    def test_fetch_image_from_other_datastores_indexed_first(
+            self, mock_update, mock_get_ds, mock_find):
+        datastores = []
+        for name in ('ds1', 'ds2', 'ds3'):
+            ds = mock.Mock(ref={'value': 'ref-%s' % name})
+            ds.name = name
+            datastores.append(ds)
+        vi = self._get_image_template_vi()
+        vi.datastore = datastores[0]
+        mock_get_ds.return_value = datastores
+        self._vmops._imagecache.set_image_templates(
+            [(self._image_id, 'ds3', 'vm-3'), ('other-image', 'ds2', 'vm-2')])
+        searched = []
+        mock_find.side_effect = \
+            lambda tmp_vi: searched.append(tmp_vi.datastore.name)
+
+        self.assertIsNone(self._vmops._fetch_image_from_other_datastores(vi))
+
+        mock_update.assert_not_called()
+        # the index is only a hint, so datastores not in it are searched,
+        # too
+        self.assertEqual(['ds3', 'ds2'], searched)
+
+    @mock.patch.object(vmops.VMwareVMOps, '_find_image_template_vm')
+    @mock.patch.object(ds_util, 'get_available_datastores')
+    def test_fetch_image_from_other_datastores_not_indexed(self, mock_get_ds,
+                                                           mock_find):
+        vi = self._get_image_template_vi()
+        self._vmops._imagecache.set_image_templates(
+            [('other-image', 'ds2', 'vm-2')])
+
+        self.assertIsNone(self._vmops._fetch_image_from_other_datastores(vi))
+
+        # the loaded index knows all templates, so nothing gets searched
+        mock_get_ds.assert_not_called()
+        mock_find.assert_not_called()
+
+    @mock.patch.object(vmops.VMwareVMOps, '_update_image_template_index')
+    def test_ensure_image_template_index(self, mock_update):
+        mock_update.side_effect = \
+            lambda dc_info: self._vmops._imagecache.set_image_templates([])
+
+        self._vmops._ensure_image_template_index(mock.sentinel.dc_info)
+        self._vmops._ensure_image_template_index(mock.sentinel.dc_info)
+
+        mock_update.assert_called_once_with(mock.sentinel.dc_info)
+
+    @mock.patch.object(vmops.VMwareVMOps, '_create_image_template')
+    @mock.patch.object(vmops.VMwareVMOps, '_fetch_image_from_other_datastores',
+                       return_value=None)
+    @mock.patch.object(vmops.VMwareVMOps, '_find_image_template_vm',
+                       return_value=None)
+    @mock.patch.object(vmops.VMwareVMOps, '_fetch_image_if_missing')
+    @mock.patch.object(vmops.VMwareVMOps, '_get_vm_config_info')
+    @mock.patch.object(vmops.VMwareVMOps, '_ensure_image_template_index')
+    def test_get_vm_template_for_image_loads_index_unlocked(
+            self, mock_ensure, mock_get_vi, mock_fetch, mock_find,
+            mock_fetch_other, mock_create):
+        self.flags(fetch_image_from_other_datastores=True, group='vmware')
+        locked = []
+
+        @contextlib.contextmanager
+        def fake_lock(name, **kwargs):
+            locked.append(name)
+            yield
+            locked.remove(name)
+
+        mock_ensure.side_effect = \
+            lambda dc_info: self.assertEqual([], locked)
+        image_info = images.VMwareImage(image_id=self._image_id,
+                                        file_size=units.Gi)
+        with mock.patch.object(vmops.lockutils, 'lock', fake_lock):
+            result = self._vmops._get_vm_template_for_image(
+                self._context, self._instance, image_info,
+                vm_util.ExtraSpecs(), mock.sentinel.dc_info)
+
+        self.assertEqual(mock_create.return_value, result)
+        mock_ensure.assert_called_once_with(mock.sentinel.dc_info)
+
+    def _get_prewarm_datastores(self, *ds_names):
+        return [ds_obj.Datastore(
+                    vmwareapi_fake.ManagedObjectReference(
+                        name='Datastore', value='ref-%s' % name), name)
+                for name in ds_names]
+
+    def _get_image_boot_info(self, image_id=None):
+        return imagecache.ImageBootInfo(image_id=image_id or self._image_id,
+                                        owner='fake-owner', root_gb=1,
+                                        disk_type=constants.DEFAULT_DISK_TYPE,
+                                        storage_policy='fake-policy')
+
+    @mock.patch.object(utils, 'spawn')
+    def test_prewarm_image_templates_disabled(self, mock_spawn):
+        self._vmops._imagecache.record_image_boot(
+            self._image_id, self._get_image_boot_info())
+
+        for flags in ({'image_template_prewarm_count': 0},
+                      {'image_as_template': False},
+                      {'fetch_image_from_other_datastores': False}):
+            config = {'image_as_template': True,
+                      'image_template_prewarm_count': 1}
+            config.update(flags)
+            self.flags(group='vmware', **config)
+
+            self._vmops.prewarm_image_templates()
+
+        mock_spawn.assert_not_called()
+
+    @mock.patch.object(utils, 'spawn')
+    def test_prewarm_image_templates_in_background(self, mock_spawn):
+        self.flags(image_as_template=True, image_template_prewarm_count=1,
+                   group='vmware')
+        boot_info = self._get_image_boot_info()
+        self._vmops._imagecache.record_image_boot(self._image_id, boot_info)
+
+        self._vmops.prewarm_image_templates()
+
+        mock_spawn.assert_called_once_with(
+            self._vmops._prewarm_image_templates, [boot_info])
+
+        # a still running pre-warming isn't started a second time
+        mock_spawn.return_value.dead = False
+        self._vmops._imagecache.record_image_boot(self._image_id, boot_info)
+        self._vmops.prewarm_image_templates()
+        self.assertEqual(1, mock_spawn.call_count)
+
+        mock_spawn.return_value.dead = True
+        self._vmops.prewarm_image_templates()
+        self.assertEqual(2, mock_spawn.call_count)
+
+    @mock.patch.object(vmops.VMwareVMOps, 'get_datacenter_ref_and_name')
+    @mock.patch.object(vmops.VMwareVMOps, '_find_image_template_vm',
+                       return_value=None)
+    @mock.patch.object(vmops.VMwareVMOps, '_fetch_image_from_other_datastores')
+    @mock.patch.object(vmops.VMwareVMOps,
+                       '_get_image_template_prewarm_datastores')
+    def test_prewarm_image_templates_clones(self, mock_get_ds,
+                                            mock_fetch_other, mock_find,
+                                            mock_get_dc):
+        mock_get_dc.return_value = self._dc_info
+        mock_get_ds.return_value = self._get_prewarm_datastores('ds1', 'ds2',
+                                                                'ds3')
+        self._vmops._imagecache.add_image_template(self._image_id, 'ds1',
+                                                   'vm-1')
+        mock_fetch_other.side_effect = [Exception('fake'), 'vm-3']
+
+        self._vmops._prewarm_image_templates([self._get_image_boot_info()])
+
+        # the image on ds1 had a template already, the failure on ds2
+        # doesn't stop the pre-warming on ds3
+        vis = [c[0][0] for c in mock_fetch_other.call_args_list]
+        self.assertEqual(['ds2', 'ds3'],
+                         sorted(vi.datastore.name for vi in vis))
+        for vi in vis:
+            self.assertEqual(self._image_id, vi.ii.image_id)
+            self.assertEqual('fake-owner', vi.ii.owner)
+            self.assertEqual(1, vi.root_gb)
+            self.assertEqual(self._dc_info, vi.dc_info)
+        mock_get_ds.assert_called_once_with(self._get_image_boot_info())
+
+    @ddt.data(False, True)
+    @mock.patch.object(ds_util, 'get_datastore')
+    def test_get_image_template_prewarm_datastores(self, with_hagroups,
+                                                   mock_get_ds):
+        hagroup_re = re.compile(r'^(?P<hagroup>[ab])-')
+        self._vmops._datastore_hagroup_regex = \
+            hagroup_re if with_hagroups else None
+        datastores = {None: self._get_prewarm_datastores('a-ds1')[0],
+                      'A': self._get_prewarm_datastores('a-ds1')[0],
+                      'B': self._get_prewarm_datastores('b-ds2')[0]}
+        mock_get_ds.side_effect = \
+            lambda *a, **kw: datastores[kw['datastore_hagroup']]
+        boot_info = self._get_image_boot_info()
+
+        result = self._vmops._get_image_template_prewarm_datastores(
+            boot_info)
+
+        # only the datastores a spawn would choose, once each
+        expected = ['a-ds1', 'b-ds2'] if with_hagroups else ['a-ds1']
+        self.assertEqual(expected, [ds.name for ds in result])
+        allowed_ds_types = ds_util.get_allowed_datastore_types(
+            constants.DEFAULT_DISK_TYPE)
+        calls = [mock.call(self._session, self._cluster.obj,
+                           self._vmops._datastore_regex, 'fake-policy',
+                           allowed_ds_types, datastore_hagroup_regex=None,
+                           datastore_hagroup=None)]
+        if with_hagroups:
+            calls += [mock.call(self._session, self._cluster.obj,
+                                self._vmops._datastore_regex, 'fake-policy',
+                                allowed_ds_types,
+                                datastore_hagroup_regex=hagroup_re,
+                                datastore_hagroup=hagroup)
+                      for hagroup in ('A', 'B')]
+        self.assertEqual(calls, mock_get_ds.call_args_list)
+
+    @mock.patch.object(ds_util, 'get_datastore',
+                       side_effect=exception.DatastoreNotFound)
+    def test_get_image_template_prewarm_datastores_none(self, mock_get_ds):
+        self.assertEqual([],
+            self._vmops._get_image_template_prewarm_datastores(
+                self._get_image_boot_info()))
+
+    @mock.patch.object(vmops.VMwareVMOps, 'get_datacenter_ref_and_name')
+    @mock.patch.object(vmops.VMwareVMOps, '_fetch_image_from_other_datastores')
+    @mock.patch.object(vmops.VMwareVMOps, '_find_image_template_vm',
+                       return_value='vm-2')
+    def test_prewarm_image_template_created_meanwhile(self, mock_find,
+                                                      mock_fetch_other,
+                                                      mock_get_dc):
+        ds = self._get_prewarm_datastores('ds2')[0]
+
+        self._vmops._prewarm_image_template(self._get_image_boot_info(), ds)
+
+        mock_find.assert_called_once_with(mock.ANY)
+        self.assertEqual(ds, mock_find.call_args[0][0].datastore)
+        mock_fetch_other.assert_not_called()
+
+    @mock.patch.object(vmops.VMwareVMOps, '_destroy_expired_image_templates')
+    def test_age_cached_image_templates_updates_index(self, mock_destroy):
+        templ_vms = [('vm-1', '%s (ds1)' % self._image_id),
+                     ('vm-2', '%s (ds2)' % self._image_id)]
+        with test.nested(
+                mock.patch.object(self._vmops, '_get_all_images_folders',
+                                  return_value=['fake-folder']),
+                mock.patch.object(self._vmops, '_get_image_template_vms',
+                                  return_value=templ_vms)):
+            self._vmops._age_cached_image_templates(self._dc_info)
+
+        mock_destroy.assert_called_once_with([('fake-folder', templ_vms)])
+        self.assertTrue(self._vmops._imagecache.image_templates_populated)
+        self.assertEqual({'ds1': 'vm-1', 'ds2': 'vm-2'},
+            self._vmops._imagecache.get_image_template_datastores(
+                self._image_id))
+
+    def _make_drs_rule(self, name, vm_values, key=1, enabled=True):
+        rule = vmwareapi_fake.DataObject()
+        rule.name = name
+        rule.key = key
+        rule.enabled = enabled
+        rule.vm = [vmwareapi_fake.ManagedObjectReference(
+            name='VirtualMachine', value=v) for v in vm_values]
+        return rule
+
+    def _sync_server_groups(self, sg_uuids, rules, groups, vm_values,
+                            reconfigure_side_effect=None):
+        cluster_config = vmwareapi_fake.DataObject()
+        cluster_config.rule = rules
+
+        def fake_get_sg(context, sg_uuid):
+            if sg_uuid not in groups:
+                raise exception.InstanceGroupNotFound(group_uuid=sg_uuid)
+            return groups[sg_uuid]
+
+        def fake_get_instances(context, filters, expected_attrs):
+            return [objects.Instance(uuid=u, task_state=None)
+                    for u in filters['uuid']]
+
+        def fake_get_vm_ref(session, instance):
+            return vmwareapi_fake.ManagedObjectReference(
+                name='VirtualMachine', value=vm_values[instance.uuid])
+
+        with test.nested(
+                mock.patch.object(self._session, '_call_method',
+                                  side_effect=lambda *a: copy.deepcopy(
+                                      cluster_config)),
+                mock.patch.object(objects.InstanceGroup, 'get_by_uuid',
+                                  side_effect=fake_get_sg),
+                mock.patch.object(objects.MigrationList, 'get_by_filters',
+                                  return_value=[]),
+                mock.patch.object(objects.InstanceList, 'get_by_filters',
+                                  side_effect=fake_get_instances),
+                mock.patch.object(vm_util, 'get_vm_ref',
+                                  side_effect=fake_get_vm_ref),
+                mock.patch.object(cluster_util, 'reconfigure_cluster',
+                                  side_effect=reconfigure_side_effect),
+        ) as (mock_call, mock_get_sg, mock_get_migrations,
+              mock_get_instances, mock_get_vm_ref, mock_reconfigure):
+            self._vmops.sync_server_groups(self._context, sg_uuids)
+
+        # the rules are read again before changing them
+        self.assertEqual(
+            [mock.call(vutil, "get_object_property", self._vmops._cluster,
+                       "configurationEx")] *
+            (2 if mock_reconfigure.called else 1),
+            mock_call.call_args_list)
+        return mock_reconfigure
+
+    def test_sync_server_groups(self):
+        sg = objects.InstanceGroup(uuid=uuids.sg1, policy='anti-affinity',
+                                   members=[uuids.inst1, uuids.inst2])
+        orphan_rule = self._make_drs_rule(
+            '{}{}-affinity'.format(constants.DRS_PREFIX, uuids.orphan),
+            ['vm-3', 'vm-4'])
+        mock_reconfigure = self._sync_server_groups(
+            [uuids.sg1, uuids.orphan], [orphan_rule], {uuids.sg1: sg},
+            {uuids.inst1: 'vm-1', uuids.inst2: 'vm-2'})
+
+        mock_reconfigure.assert_called_once_with(
+            self._session, self._vmops._cluster, mock.ANY)
+        rules_spec = mock_reconfigure.call_args[0][2].rulesSpec
+        self.assertEqual(
+            [('add', '{}{}-anti-affinity'.format(constants.DRS_PREFIX,
+                                                 uuids.sg1)),
+             ('remove', orphan_rule.name)],
+            sorted((spec.operation, spec.info.name) for spec in rules_spec))
+
+    def test_sync_server_groups_nothing_to_do(self):
+        sg = objects.InstanceGroup(uuid=uuids.sg1, policy='anti-affinity',
+                                   members=[uuids.inst1, uuids.inst2])
+        rule = self._make_drs_rule(
+            '{}{}-anti-affinity'.format(constants.DRS_PREFIX, uuids.sg1),
+            ['vm-1', 'vm-2'])
+        mock_reconfigure = self._sync_server_groups(
+            [uuids.sg1], [rule], {uuids.sg1: sg},
+            {uuids.inst1: 'vm-1', uuids.inst2: 'vm-2'})
+
+        mock_reconfigure.assert_not_called()
+
+    def test_sync_server_groups_enable_and_update_rule(self):
+        sg = objects.InstanceGroup(uuid=uuids.sg1, policy='anti-affinity',
+                                   members=[uuids.inst1, uuids.inst2])
+        rule = self._make_drs_rule(
+            '{}{}-anti-affinity'.format(constants.DRS_PREFIX, uuids.sg1),
+            ['vm-1', 'vm-3'], enabled=False)
+        mock_reconfigure = self._sync_server_groups(
+            [uuids.sg1], [rule], {uuids.sg1: sg},
+            {uuids.inst1: 'vm-1', uuids.inst2: 'vm-2'})
+
+        mock_reconfigure.assert_called_once_with(
+            self._session, self._vmops._cluster, mock.ANY)
+        rules_spec = mock_reconfigure.call_args[0][2].rulesSpec
+        self.assertEqual(1, len(rules_spec))
+        self.assertEqual('edit', rules_spec[0].operation)
+        self.assertTrue(rules_spec[0].info.enabled)
+        self.assertEqual(['vm-1', 'vm-2'],
+                         [vutil.get_moref_value(m)
+                          for m in rules_spec[0].info.vm])
+
+    def test_sync_server_groups_falls_back_per_group(self):
+        orphan_rule_1 = self._make_drs_rule(
+            '{}{}-affinity'.format(constants.DRS_PREFIX, uuids.orphan1),
+            ['vm-1', 'vm-2'], key=1)
+        orphan_rule_2 = self._make_drs_rule(
+            '{}{}-affinity'.format(constants.DRS_PREFIX, uuids.orphan2),
+            ['vm-3', 'vm-4'], key=2)
+        mock_reconfigure = self._sync_server_groups(
+            [uuids.orphan1, uuids.orphan2], [orphan_rule_1, orphan_rule_2],
+            {}, {}, reconfigure_side_effect=[vexc.VimException('fake'),
+                                             vexc.VimException('fake'),
+                                             None])
+
+        self.assertEqual(3, mock_reconfigure.call_count)
+        self.assertEqual(
+            [2, 1, 1],
+            [len(c[0][2].rulesSpec) for c in mock_reconfigure.call_args_list])
+
+    def test_sync_server_groups_locks_per_group(self):
+        held_locks = set()
+        locked = []
+
+        @contextlib.contextmanager
+        def fake_lock(name, lock_file_prefix=None):
+            held_locks.add(name)
+            locked.append(name)
+            try:
+                yield
+            finally:
+                held_locks.remove(name)
+
+        def fake_reconfigure(session, cluster, config_spec):
+            # only the server-groups getting changed stay locked during the
+            # reconfiguration
+            self.assertEqual({orphan_lock}, held_locks)
+
+        orphan_rule = self._make_drs_rule(
+            '{}{}-affinity'.format(constants.DRS_PREFIX, uuids.orphan),
+            ['vm-1', 'vm-2'], key=1)
+        orphan_lock = self._vmops._get_server_group_lock_name(uuids.orphan)
+        sg = objects.InstanceGroup(uuid=uuids.sg1, policy='anti-affinity',
+                                   members=[uuids.inst1, uuids.inst2])
+        rule = self._make_drs_rule(
+            '{}{}-anti-affinity'.format(constants.DRS_PREFIX, uuids.sg1),
+            ['vm-1', 'vm-2'], key=2)
+        sg_lock = self._vmops._get_server_group_lock_name(uuids.sg1)
+        with mock.patch.object(vmops.lockutils, 'lock', new=fake_lock):
+            mock_reconfigure = self._sync_server_groups(
+                [uuids.orphan, uuids.sg1], [orphan_rule, rule],
+                {uuids.sg1: sg}, {uuids.inst1: 'vm-1', uuids.inst2: 'vm-2'},
+                reconfigure_side_effect=fake_reconfigure)
+
+        mock_reconfigure.assert_called_once()
+        # each server-group was locked on its own while reading its state
+        self.assertEqual(sorted([orphan_lock, sg_lock]), sorted(locked[:2]))
+        self.assertEqual([orphan_lock], locked[2:])
+
+    def test_sync_server_groups_interleaved_with_single_sync(self):
+        sgs = {
+            uuids.sg1: objects.InstanceGroup(
+                uuid=uuids.sg1, policy='anti-affinity',
+                members=[uuids.inst1, uuids.inst2]),
+            uuids.sg2: objects.InstanceGroup(
+                uuid=uuids.sg2, policy='anti-affinity',
+                members=[uuids.inst3, uuids.inst4]),
+        }
+        vm_values = {uuids.inst1: 'vm-1', uuids.inst2: 'vm-2',
+                     uuids.inst3: 'vm-3', uuids.inst4: 'vm-4'}
+        # the DRS rules in the vCenter
+        cluster_rules = []
+
+        def fake_get_cluster_config(*args):
+            cluster_config = vmwareapi_fake.DataObject()
+            cluster_config.rule = copy.deepcopy(cluster_rules)
+            return cluster_config
+
+        def fake_reconfigure(session, cluster, config_spec):
+            for spec in config_spec.rulesSpec:
+                self.assertEqual('add', spec.operation)
+                rule = copy.deepcopy(spec.info)
+                rule.key = len(cluster_rules) + 1
+                cluster_rules.append(rule)
+
+        batch_reading_sg2 = eventlet.event.Event()
+        single_sync_done = eventlet.event.Event()
+
+        def fake_get_instances(context, filters, expected_attrs):
+            if uuids.inst3 in filters['uuid']:
+                # the batch has computed the rules of sg1 and waits for the
+                # DB while a spawn syncs sg1
+                batch_reading_sg2.send()
+                single_sync_done.wait()
+            return [objects.Instance(uuid=u, task_state=None)
+                    for u in filters['uuid']]
+
+        def fake_get_vm_ref(session, instance):
+            return vmwareapi_fake.ManagedObjectReference(
+                name='VirtualMachine', value=vm_values[instance.uuid])
+
+        with test.nested(
+                mock.patch.object(self._session, '_call_method',
+                                  side_effect=fake_get_cluster_config),
+                mock.patch.object(objects.InstanceGroup, 'get_by_uuid',
+                                  side_effect=lambda c, u: sgs[u]),
+                mock.patch.object(objects.MigrationList, 'get_by_filters',
+                                  return_value=[]),
+                mock.patch.object(objects.InstanceList, 'get_by_filters',
+                                  side_effect=fake_get_instances),
+                mock.patch.object(vm_util, 'get_vm_ref',
+                                  side_effect=fake_get_vm_ref),
+                mock.patch.object(cluster_util, 'reconfigure_cluster',
+                                  side_effect=fake_reconfigure),
+        ) as (mock_call, mock_get_sg, mock_get_migrations,
+              mock_get_instances, mock_get_vm_ref, mock_reconfigure):
+            batch = eventlet.spawn(self._vmops.sync_server_groups,
+                                   self._context, [uuids.sg1, uuids.sg2])
+            batch_reading_sg2.wait()
+            self._vmops.sync_server_group(self._context, uuids.sg1)
+            single_sync_done.send()
+            batch.wait()
+
+        # the batch noticed the rule created by the single sync and didn't
+        # create it a second time
+        self.assertEqual(
+            sorted('{}{}-anti-affinity'.format(constants.DRS_PREFIX, sg_uuid)
+                   for sg_uuid in (uuids.sg1, uuids.sg2)),
+            sorted(rule.name for rule in cluster_rules))
+
+    @mock.patch.object(ds_util, 'release_datastore_space')
+    @mock.patch.object(vmops.VMwareVMOps, '_spawn',
+                       side_effect=test.TestingException)
+    def test_spawn_releases_datastore_space(self, mock_spawn, mock_release):
+        self.assertRaises(test.TestingException, self._vmops.spawn,
+                          self._context, self._instance, mock.sentinel.image,
+                          None, None, self.network_info)
+        mock_release.assert_called_once_with(self._instance.uuid)
+
+    def test_get_instance_disk_space(self):
+        self._instance.flavor.root_gb = 10
+        self._instance.flavor.ephemeral_gb = 2
+        self._instance.flavor.swap = 512
+        image_info = images.VMwareImage(image_id=self._image_id,
+                                        file_size=units.Gi)
+
+        self.assertEqual(
+            12 * units.Gi + 512 * units.Mi,
+            self._vmops._get_instance_disk_space(self._instance, image_info,
+                                                 False))
+        self.assertEqual(
+            2 * units.Gi + 512 * units.Mi,
+            self._vmops._get_instance_disk_space(self._instance, image_info,
+                                                 True))
+
+        self._instance.flavor.root_gb = 0
+        self.assertEqual(
+            3 * units.Gi + 512 * units.Mi,
+            self._vmops._get_instance_disk_space(self._instance, image_info,
+                                                 False))
+
+    def test_queue_server_group_sync_without_worker(self):
+        self.assertFalse(self._vmops.queue_server_group_sync(uuids.sg))
+        self.assertEqual(set(), self._vmops._server_group_sync_queue)
+
+    def test_queue_server_group_sync_deduplicates(self):
+        self._vmops._server_group_sync_worker = mock.sentinel.worker
+        self.assertTrue(self._vmops.queue_server_group_sync(uuids.sg1))
+        self.assertTrue(self._vmops.queue_server_group_sync(uuids.sg2))
+        self.assertTrue(self._vmops.queue_server_group_sync(uuids.sg1))
+
+        self.assertEqual({uuids.sg1, uuids.sg2},
+                         self._vmops._server_group_sync_queue)
+        self.assertTrue(self._vmops._server_group_sync_queued.is_set())
+
+    @mock.patch.object(vmops.VMwareVMOps, 'sync_server_group')
+    @mock.patch.object(objects.instance_group.InstanceGroup,
+                       'get_by_instance_uuid')
+    def test_queue_instance_server_group_sync(self, mock_get_group,
+                                              mock_sync):
+        mock_get_group.return_value = mock.Mock(uuid=uuids.sg)
+        self._vmops._server_group_sync_worker = mock.sentinel.worker
+
+        self._vmops.queue_instance_server_group_sync(self._context,
+                                                     self._instance)
+
+        mock_sync.assert_not_called()
+        self.assertEqual({uuids.sg}, self._vmops._server_group_sync_queue)
+
+    @mock.patch.object(vmops.VMwareVMOps, 'sync_server_group')
+    @mock.patch.object(objects.instance_group.InstanceGroup,
+                       'get_by_instance_uuid')
+    def test_queue_instance_server_group_sync_without_worker(self,
+                                                             mock_get_group,
+                                                             mock_sync):
+        mock_get_group.return_value = mock.Mock(uuid=uuids.sg)
+
+        self._vmops.queue_instance_server_group_sync(self._context,
+                                                     self._instance)
+
+        mock_sync.assert_called_once_with(self._context, uuids.sg)
+
+    @mock.patch.object(vmops.VMwareVMOps,
+                       'update_server_groups_hagroup_disk_placement')
+    @mock.patch.object(vmops.VMwareVMOps, 'sync_server_groups')
+    @mock.patch.object(time, 'sleep')
+    def test_server_group_sync_worker_loop(self, mock_sleep, mock_sync,
+                                           mock_placement):
+        self.flags(server_group_sync_queue_delay=3, group='vmware')
+        self._vmops._server_group_sync_worker = mock.sentinel.worker
+        self._vmops.queue_server_group_sync(uuids.sg1)
+        self._vmops.queue_server_group_sync(uuids.sg2)
+
+        def _sync_server_groups(context, sg_uuids):
+            # a change coming in during the sync is kept for the next round
+            self._vmops.queue_server_group_sync(uuids.sg3)
+            self._vmops.stop_server_group_sync_worker()
+
+        mock_sync.side_effect = _sync_server_groups
+
+        self._vmops._server_group_sync_worker_loop()
+
+        mock_sleep.assert_called_once_with(3)
+        mock_sync.assert_called_once_with(mock.ANY, {uuids.sg1, uuids.sg2})
+        mock_placement.assert_called_once_with(
+            mock.ANY, sorted([uuids.sg1, uuids.sg2]))
+        self.assertEqual({uuids.sg3}, self._vmops._server_group_sync_queue)
+        self.assertIsNone(self._vmops._server_group_sync_worker)
+
+    @mock.patch.object(vmops.VMwareVMOps, '_run_hagroup_relocations')
+    @mock.patch.object(vmops.VMwareVMOps, '_plan_hagroup_relocations')
+    @mock.patch.object(ds_util, 'get_available_datastores')
+    def test_update_server_groups_hagroup_disk_placement(self, mock_get_ds,
+                                                         mock_plan, mock_run):
+        self._vmops._datastore_hagroup_regex = re.compile(
+            r'^.*-(?P<hagroup>[ab])$')
+        ds = mock.Mock(ref=vmwareapi_fake.ManagedObjectReference(
+            name='Datastore', value='ds-1'))
+        mock_get_ds.return_value = [ds]
+        mock_plan.side_effect = [[mock.sentinel.relocation1],
+                                 test.TestingException(),
+                                 [mock.sentinel.relocation2]]
+
+        self._vmops.update_server_groups_hagroup_disk_placement(
+            self._context, [uuids.sg1, uuids.sg2, uuids.sg3])
+
+        # the datastores are only fetched once for all server-groups
+        mock_get_ds.assert_called_once_with(self._session, self._cluster.obj,
+                                            self._vmops._datastore_regex)
+        self.assertEqual(
+            [mock.call(self._context, sg_uuid, {'ds-1': ds})
+             for sg_uuid in (uuids.sg1, uuids.sg2, uuids.sg3)],
+            mock_plan.call_args_list)
+        # a failing server-group does not stop the others
+        mock_run.assert_called_once_with(
+            self._context,
+            [mock.sentinel.relocation1, mock.sentinel.relocation2])
+
+    @mock.patch.object(vmops.VMwareVMOps, '_plan_hagroup_relocations')
+    def test_update_server_groups_hagroup_disk_placement_disabled(
+            self, mock_plan):
+        self._vmops._datastore_hagroup_regex = None
+
+        self._vmops.update_server_groups_hagroup_disk_placement(
+            self._context, [uuids.sg1])
+
+        mock_plan.assert_not_called()
+
+    @mock.patch.object(ds_util, 'release_datastore_space')
+    @mock.patch.object(ds_util, 'get_datastore')
+    @mock.patch.object(vim_util, 'get_array_items')
+    @mock.patch.object(vm_util, 'get_vm_ref')
+    @mock.patch.object(vmops.VMwareVMOps, '_get_storage_policy')
+    @mock.patch.object(objects.instance.InstanceList, 'get_by_filters')
+    @mock.patch.object(vmops.VMwareVMOps,
+                       '_get_server_group_members_for_hagroup')
+    @mock.patch.object(objects.instance_group.InstanceGroup, 'get_by_uuid')
+    def test_plan_hagroup_relocations_releases_on_error(
+            self, mock_get_sg, mock_get_members, mock_get_instances,
+            mock_get_policy, mock_get_vm_ref, mock_get_array_items,
+            mock_get_datastore, mock_release):
+        self._vmops._datastore_hagroup_regex = re.compile(
+            r'^.*-(?P<hagroup>[ab])$')
+        mock_get_sg.return_value = mock.Mock(policy='anti-affinity')
+        mock_get_members.return_value = [uuids.inst1, uuids.inst2]
+        flavor = objects.Flavor(root_gb=1, ephemeral_gb=0, swap=0)
+        mock_get_instances.return_value = [
+            mock.Mock(uuid=uuid, flavor=flavor)
+            for uuid in (uuids.inst1, uuids.inst2)]
+        # the current datastore belongs to no hagroup, so both instances
+        # have to move
+        ds = mock.Mock(ref=vmwareapi_fake.ManagedObjectReference(
+            name='Datastore', value='ds-1'))
+        ds.name = 'ds-x'
+        mock_get_array_items.return_value = [ds.ref]
+        mock_get_datastore.side_effect = [mock.sentinel.datastore,
+                                          test.TestingException()]
+
+        with mock.patch.object(self._session, '_call_method',
+                               return_value={'datastore': mock.ANY}):
+            self.assertRaises(test.TestingException,
+                              self._vmops._plan_hagroup_relocations,
+                              self._context, uuids.sg, {'ds-1': ds})
+
+        self.assertEqual(2, mock_get_datastore.call_count)
+        self.assertEqual(
+            '%s-relocate' % uuids.inst1,
+            mock_get_datastore.call_args_list[0][1]['reservation_key'])
+        # only the reservation of the already planned relocation is left
+        mock_release.assert_called_once_with('%s-relocate' % uuids.inst1)
+
+    @mock.patch.object(ds_util, 'release_datastore_space')
+    def test_run_hagroup_relocations(self, mock_release):
+        self.flags(hagroup_relocation_concurrency=2,
+                   hagroup_relocation_concurrency_per_datastore=1,
+                   group='vmware')
+        datastores = [
+            mock.Mock(ref=vmwareapi_fake.ManagedObjectReference(
+                name='Datastore', value=value))
+            for value in ('ds-1', 'ds-1', 'ds-2')]
+        instances = [mock.Mock(uuid=uuid)
+                     for uuid in (uuids.inst1, uuids.inst2, uuids.inst3)]
+        relocations = [(uuids.sg, instance, 'a', datastore)
+                       for instance, datastore in zip(instances, datastores)]
+
+        running = collections.Counter()
+        max_running = collections.Counter()
+        max_total = []
+        finished = []
+        finished_before_ds2 = []
+
+        def _relocate(context, instance, ds_ref):
+            if ds_ref.value == 'ds-2':
+                finished_before_ds2.extend(finished)
+            running[ds_ref.value] += 1
+            max_running[ds_ref.value] = max(max_running[ds_ref.value],
+                                            running[ds_ref.value])
+            max_total.append(sum(running.values()))
+            eventlet.sleep(0)
+            running[ds_ref.value] -= 1
+            finished.append(instance.uuid)
+            if instance.uuid == uuids.inst1:
+                raise test.TestingException()
+
+        with mock.patch.object(self._vmops,
+                               'relocate_vm_config_and_ephemeral_disk',
+                               side_effect=_relocate) as mock_relocate:
+            self.assertRaises(test.TestingException,
+                              self._vmops._run_hagroup_relocations,
+                              self._context, relocations)
+
+        # all relocations were tried, even though the first one failed
+        self.assertEqual(3, mock_relocate.call_count)
+        self.assertEqual({'ds-1': 1, 'ds-2': 1}, dict(max_running))
+        # the second relocation to ds-1 waiting for its datastore did not
+        # keep the one to ds-2 from running in parallel
+        self.assertEqual([], finished_before_ds2)
+        self.assertEqual(2, max(max_total))
+        self.assertCountEqual(
+            [mock.call('%s-relocate' % uuid)
+             for uuid in (uuids.inst1, uuids.inst2, uuids.inst3)],
+            mock_release.call_args_list)
+
+    def test_start_server_group_sync_worker_disabled(self):
+        self.flags(server_group_sync_queue_delay=-1, group='vmware')
+        with mock.patch.object(utils, 'spawn') as mock_spawn:
+            self._vmops.start_server_group_sync_worker()
+        mock_spawn.assert_not_called()
+
     @mock.patch.object(vutil, 'get_inventory_path', return_value='fake_path')
     @mock.patch.object(vmops.VMwareVMOps, '_attach_cdrom_to_vm')
     @mock.patch.object(vmops.VMwareVMOps, '_create_config_drive')
@@ -2327,7 +3510,7 @@ class VMwareVMOpsTestCase(test.TestCase):
                                                self._instance.image_ref,
                                                self._image_meta)
             get_vm_config_info.assert_called_once_with(self._context,
-                self._instance, image_info, extra_specs)
+                self._instance, image_info, extra_specs, reserve_space=True)
             build_virtual_machine.assert_called_once_with(
                 self._instance, self._context, image_info, vi.datastore, [],
                 extra_specs, self._get_metadata(), 'fake_vm_folder',
@@ -2336,11 +3519,10 @@ class VMwareVMOpsTestCase(test.TestCase):
                                                  vi.datastore, vi.dc_info.ref)
             fetch_image.assert_called_once_with(self._context, vi)
             use_disk_image.assert_called_once_with('fake-vm-ref', vi)
-            volumeops.attach_volume.assert_any_call(
-                connection_info1, self._instance, constants.ADAPTER_TYPE_IDE)
-            volumeops.attach_volume.assert_any_call(
-                connection_info2, self._instance,
-                constants.DEFAULT_ADAPTER_TYPE)
+            volumeops.attach_volumes.assert_called_once_with(
+                [(connection_info1, constants.ADAPTER_TYPE_IDE),
+                 (connection_info2, constants.DEFAULT_ADAPTER_TYPE)],
+                self._instance)
 
     @mock.patch.object(vm_util, 'rename_vm')
     @mock.patch.object(vmops.VMwareVMOps, '_create_folders',
@@ -2394,7 +3576,7 @@ class VMwareVMOpsTestCase(test.TestCase):
                                                self._instance.image_ref,
                                                self._image_meta)
             get_vm_config_info.assert_called_once_with(self._context,
-                self._instance, image_info, extra_specs)
+                self._instance, image_info, extra_specs, reserve_space=True)
             build_virtual_machine.assert_called_once_with(
                 self._instance, self._context, image_info, vi.datastore, [],
                 extra_specs, self._get_metadata(is_image_used=False),
@@ -2402,12 +3584,10 @@ class VMwareVMOpsTestCase(test.TestCase):
             volumeops.attach_root_volume.assert_called_once_with(
                 connection_info1, self._instance, vi.datastore.ref,
                 constants.ADAPTER_TYPE_IDE)
-            volumeops.attach_volume.assert_any_call(
-                connection_info2, self._instance,
-                constants.DEFAULT_ADAPTER_TYPE)
-            volumeops.attach_volume.assert_any_call(
-                connection_info3, self._instance,
-                constants.ADAPTER_TYPE_LSILOGICSAS)
+            volumeops.attach_volumes.assert_called_once_with(
+                [(connection_info2, constants.DEFAULT_ADAPTER_TYPE),
+                 (connection_info3, constants.ADAPTER_TYPE_LSILOGICSAS)],
+                self._instance)
 
     @mock.patch.object(vmops.VMwareVMOps, '_create_folders',
                        return_value='fake_vm_folder')
@@ -2450,7 +3630,8 @@ class VMwareVMOpsTestCase(test.TestCase):
                                            self._instance.image_ref,
                                            self._image_meta)
         get_vm_config_info.assert_called_once_with(
-            self._context, self._instance, image_info, extra_specs)
+            self._context, self._instance, image_info, extra_specs,
+            reserve_space=True)
         build_virtual_machine.assert_called_once_with(
             self._instance, self._context, image_info, vi.datastore, [],
             extra_specs, self._get_metadata(is_image_used=False),
@@ -2667,10 +3848,9 @@ class VMwareVMOpsTestCase(test.TestCase):
     @mock.patch('nova.virt.vmwareapi.vm_util.create_vm',
                 return_value='fake_vm_ref')
     @mock.patch('nova.virt.vmwareapi.ds_util.mkdir')
-    @mock.patch('nova.virt.vmwareapi.vmops.VMwareVMOps._set_machine_id')
+    @mock.patch.object(vmops.VMwareVMOps, '_set_machine_id_and_vnc_config')
     @mock.patch(
         'nova.virt.vmwareapi.imagecache.ImageCacheManager.enlist_image')
-    @mock.patch.object(vmops.VMwareVMOps, '_get_and_set_vnc_config')
     @mock.patch('nova.virt.vmwareapi.vm_util.power_on_instance')
     @mock.patch('nova.virt.vmwareapi.vm_util.copy_virtual_disk')
     # TODO(dims): Need to add tests for create_virtual_disk after the
@@ -2678,9 +3858,8 @@ class VMwareVMOpsTestCase(test.TestCase):
     def _test_spawn(self,
                    mock_copy_virtual_disk,
                    mock_power_on_instance,
-                   mock_get_and_set_vnc_config,
                    mock_enlist_image,
-                   mock_set_machine_id,
+                   mock_set_machine_id_and_vnc_config,
                    mock_mkdir,
                    mock_create_vm,
                    mock_get_create_spec,
@@ -2775,15 +3954,11 @@ class VMwareVMOpsTestCase(test.TestCase):
                     'fake_create_spec',
                     self._cluster.resourcePool,
                     host_ref=None)
-            mock_get_and_set_vnc_config.assert_called_once_with(
-                self._session.vim.client.factory,
-                self._instance,
-                'fake_vm_ref')
-            mock_set_machine_id.assert_called_once_with(
+            mock_set_machine_id_and_vnc_config.assert_called_once_with(
                 self._session.vim.client.factory,
                 self._instance,
-                network_info,
-                vm_ref='fake_vm_ref')
+                'fake_vm_ref',
+                network_info)
             mock_power_on_instance.assert_called_once_with(
                 self._session, self._instance, vm_ref='fake_vm_ref')
 
@@ -2793,16 +3968,16 @@ class VMwareVMOpsTestCase(test.TestCase):
                 for bdm in bdms:
                     mock_attach_root = (
                         self._vmops._volumeops.attach_root_volume)
-                    mock_attach = self._vmops._volumeops.attach_volume
+                    mock_attach = self._vmops._volumeops.attach_volumes
                     adapter_type = bdm.get('disk_bus') or vi.ii.adapter_type
                     if bdm.get('boot_index') == 0:
                         mock_attach_root.assert_any_call(
                             bdm['connection_info'], self._instance,
                             self._ds.ref, adapter_type)
                     else:
-                        mock_attach.assert_any_call(
-                            bdm['connection_info'], self._instance,
-                            self._ds.ref, adapter_type)
+                        self.assertIn(
+                            (bdm['connection_info'], adapter_type),
+                            mock_attach.call_args[0][0])
 
             mock_enlist_image.assert_called_once_with(
                         self._image_id, self._ds, self._dc_info.ref)
@@ -3001,7 +4176,7 @@ class VMwareVMOpsTestCase(test.TestCase):
         from_image.assert_called_once_with(
             self._context, self._instance.image_ref, {})
         get_vm_config_info.assert_called_once_with(self._context,
-            self._instance, image_info, extra_specs)
+            self._instance, image_info, extra_specs, reserve_space=True)
         build_virtual_machine.assert_called_once_with(self._instance,
                                                       self._context,
             image_info, vi.datastore, [], extra_specs, metadata, 'fake-folder',
@@ -4140,12 +5315,18 @@ class VMwareVMOpsTestCase(test.TestCase):
     def _test_stack_vm_to_host_if_needed(self, instance_memory_mb,
                                          hosts, expected):
         with test.nested(
-                mock.patch.object(vm_util,
-                                  'get_stats_from_cluster_per_host',
+                mock.patch.object(self._vmops._vc_state,
+                                  'get_per_host_stats',
                                   return_value=hosts),
                 mock.patch.object(cluster_util, 'is_drs_enabled',
                                   return_value=False),
-        ) as (_get_stats_from_cluster_per_host, _is_drs_enabled):
+                mock.patch.object(self._session, '_call_method'),
+                mock.patch.object(cluster_util, 'fetch_cluster_groups',
+                                  return_value={}),
+                mock.patch.object(cluster_util, 'fetch_cluster_rules',
+                                  return_value={}),
+        ) as (_get_per_host_stats, _is_drs_enabled,
+              _call_method, _fetch_cluster_groups, _fetch_cluster_rules):
             instance = self._instance.obj_clone()
             instance.memory_mb = instance_memory_mb
 
@@ -4157,12 +5338,33 @@ class VMwareVMOpsTestCase(test.TestCase):
 
             host_ref = self._vmops._stack_vm_to_host_if_needed(instance)
 
-            _get_stats_from_cluster_per_host.assert_called_once_with(
-                self._session, self._cluster.obj)
+            _get_per_host_stats.assert_called_once_with()
+            _call_method.assert_called_once_with(
+                vutil, 'get_object_property', self._cluster.obj,
+                'configurationEx')
             _is_drs_enabled.assert_called_once_with(self._session,
                                                     self._cluster.obj)
             self.assertEqual(expected, host_ref.value if host_ref else None)
 
+    def test_get_cluster_config(self):
+        with mock.patch.object(self._session, '_call_method',
+                               side_effect=[mock.sentinel.config1,
+                                            mock.sentinel.config2]
+                               ) as _call_method:
+            self.assertEqual(mock.sentinel.config1,
+                             self._vmops._get_cluster_config())
+            self.assertEqual(mock.sentinel.config1,
+                             self._vmops._get_cluster_config())
+            _call_method.assert_called_once_with(
+                vutil, 'get_object_property', self._cluster.obj,
+                'configurationEx')
+
+            self.assertEqual(mock.sentinel.config2,
+                             self._vmops._get_cluster_config(refresh=True))
+            self.assertEqual(mock.sentinel.config2,
+                             self._vmops._get_cluster_config())
+            self.assertEqual(2, _call_method.call_count)
+
     @ddt.unpack
     @ddt.data(
         (512, 'host-2'),
@@ -4225,6 +5427,95 @@ class VMwareVMOpsTestCase(test.TestCase):
         self._test_stack_vm_to_host_if_needed(
             requested_mb, hosts, expected)
 
+    def _mock_stack_vm_to_host(self, hosts):
+        stack = contextlib.ExitStack()
+        self.addCleanup(stack.close)
+
+        def fake_get_per_host_stats():
+            # let other greenthreads run, as reading the stats might do
+            eventlet.sleep(0)
+            return hosts[0]
+
+        stack.enter_context(mock.patch.object(
+            self._vmops._vc_state, 'get_per_host_stats',
+            side_effect=fake_get_per_host_stats))
+        stack.enter_context(mock.patch.object(
+            cluster_util, 'is_drs_enabled', return_value=False))
+        stack.enter_context(mock.patch.object(self._session, '_call_method'))
+        stack.enter_context(mock.patch.object(
+            cluster_util, 'fetch_cluster_groups', return_value={}))
+        stack.enter_context(mock.patch.object(
+            cluster_util, 'fetch_cluster_rules', return_value={}))
+
+    def _make_stack_instance(self, memory_mb):
+        instance = self._instance.obj_clone()
+        instance.uuid = uuidutils.generate_uuid()
+        instance.memory_mb = memory_mb
+        return instance
+
+    def test_stack_vm_to_host_if_needed_concurrently(self):
+        hosts = [{
+            'host-1': {'name': 'host1', 'available': True,
+                       'memory_mb': 4096, 'memory_mb_used': 2048},
+            'host-2': {'name': 'host2', 'available': True,
+                       'memory_mb': 4096, 'memory_mb_used': 1536},
+        }]
+        self._mock_stack_vm_to_host(hosts)
+        instances = [self._make_stack_instance(1536) for _ in range(2)]
+
+        threads = [eventlet.spawn(self._vmops._stack_vm_to_host_if_needed,
+                                  instance)
+                   for instance in instances]
+        host_refs = [t.wait() for t in threads]
+
+        # host-1 only fits one of the VMs, so the other one goes to host-2
+        self.assertEqual(['host-1', 'host-2'],
+                         sorted(vutil.get_moref_value(h) for h in host_refs))
+
+    def test_stack_vm_to_host_if_needed_finished(self):
+        hosts = [{
+            'host-1': {'name': 'host1', 'available': True,
+                       'memory_mb': 4096, 'memory_mb_used': 2048},
+            'host-2': {'name': 'host2', 'available': True,
+                       'memory_mb': 4096, 'memory_mb_used': 1536},
+        }]
+        self._mock_stack_vm_to_host(hosts)
+        failed, spawned, other = [self._make_stack_instance(1536)
+                                  for _ in range(3)]
+
+        host_ref = self._vmops._stack_vm_to_host_if_needed(failed)
+        self.assertEqual('host-1', vutil.get_moref_value(host_ref))
+        # a VM failing to spawn frees its host again
+        self._vmops._finish_stacked_vm(failed, False)
+        host_ref = self._vmops._stack_vm_to_host_if_needed(spawned)
+        self.assertEqual('host-1', vutil.get_moref_value(host_ref))
+
+        # a spawned VM is accounted for until the stats contain it
+        self._vmops._finish_stacked_vm(spawned, True)
+        host_ref = self._vmops._stack_vm_to_host_if_needed(other)
+        self.assertEqual('host-2', vutil.get_moref_value(host_ref))
+        self._vmops._finish_stacked_vm(other, False)
+
+        hosts[0] = copy.deepcopy(hosts[0])
+        hosts[0]['host-1']['memory_mb_used'] += 1536
+        host_ref = self._vmops._stack_vm_to_host_if_needed(other)
+        self.assertEqual('host-2', vutil.get_moref_value(host_ref))
+        self.assertEqual({other.uuid}, set(self._vmops._stacked_vms))
+
+    @mock.patch.object(vmops.VMwareVMOps, '_finish_stacked_vm')
+    @mock.patch.object(vmops.VMwareVMOps, '_spawn')
+    def test_spawn_finishes_stacked_vm(self, mock_spawn, mock_finish):
+        self._vmops.spawn(self._context, self._instance, self._image_meta,
+                          None, None, None)
+        mock_finish.assert_called_once_with(self._instance, True)
+
+        mock_finish.reset_mock()
+        mock_spawn.side_effect = test.TestingException
+        self.assertRaises(test.TestingException, self._vmops.spawn,
+                          self._context, self._instance, self._image_meta,
+                          None, None, None)
+        mock_finish.assert_called_once_with(self._instance, False)
+
     @mock.patch.object(vm_util, 'apply_evc_mode')
     def test_spawn_with_evc_mode(self, mock_apply_evc_mode):
         """Check that we call the function for ApplyEvcModeVM_Task"""
@@ -171,49 +171,42 @@ class VMwareVolumeOpsTestCase(test.NoDBTestCase):
                 'data': {'volume': 'vm-10',
                          'volume_id': 'volume-fake-id'}}
 
+    def _get_vmdk_backed_disk(self, key, backing_uuid):
+        disk = vmwareapi_fake.VirtualDisk(1000, key - 2000)
+        disk.key = key
+        disk.backing = vmwareapi_fake.VirtualDiskFlatVer2BackingInfo()
+        disk.backing.uuid = backing_uuid
+        return disk
+
     @mock.patch.object(volumeops.VMwareVolumeOps, '_get_volume_uuid')
-    @mock.patch.object(vm_util, 'get_vmdk_backed_disk_device')
-    def test_get_vmdk_backed_disk_device(self, get_vmdk_backed_disk_device,
-                                         get_volume_uuid):
+    def test_get_vmdk_backed_disk_device(self, get_volume_uuid):
         session = mock.Mock()
         self._volumeops._session = session
-        hardware_devices = mock.sentinel.hardware_devices
-        session._call_method.return_value = hardware_devices
-
-        device = mock.sentinel.device
-        get_vmdk_backed_disk_device.return_value = device
-
-        vm_ref = mock.sentinel.vm_ref
         connection_info = self._fake_connection_info()
         volume_id = connection_info['data']['volume_id']
+        device = self._get_vmdk_backed_disk(2000, volume_id)
+        session._call_method.return_value = [
+            self._get_vmdk_backed_disk(2001, 'other-uuid'), device]
 
+        vm_ref = mock.sentinel.vm_ref
         ret = self._volumeops._get_vmdk_backed_disk_device(
             vm_ref, connection_info['data'])
 
         self.assertEqual(device, ret)
         session._call_method.assert_called_once_with(
             vutil, "get_object_property", vm_ref, "config.hardware.device")
-        get_vmdk_backed_disk_device.assert_called_once_with(hardware_devices,
-                                                            volume_id)
+        get_volume_uuid.assert_not_called()
 
     @mock.patch.object(volumeops.VMwareVolumeOps, '_get_volume_uuid')
-    @mock.patch.object(vm_util, 'get_vmdk_backed_disk_device')
-    def test_get_vmdk_backed_disk_device_indirect(self,
-            get_vmdk_backed_disk_device, get_volume_uuid):
+    def test_get_vmdk_backed_disk_device_indirect(self, get_volume_uuid):
         session = mock.Mock()
         self._volumeops._session = session
-        hardware_devices = mock.sentinel.hardware_devices
-        session._call_method.return_value = hardware_devices
-
-        disk_uuid = mock.sentinel.disk_uuid
-        get_volume_uuid.return_value = disk_uuid
-
-        device = mock.sentinel.device
-        get_vmdk_backed_disk_device.side_effect = [None, device]
+        device = self._get_vmdk_backed_disk(2000, 'disk-uuid')
+        session._call_method.return_value = [device]
+        get_volume_uuid.return_value = 'disk-uuid'
 
         vm_ref = mock.sentinel.vm_ref
         connection_info = self._fake_connection_info()
-        volume_id = connection_info['data']['volume_id']
 
         ret = self._volumeops._get_vmdk_backed_disk_device(
             vm_ref, connection_info['data'])
@@ -223,27 +216,18 @@ class VMwareVolumeOpsTestCase(test.NoDBTestCase):
             vutil, "get_object_property", vm_ref, "config.hardware.device")
         get_volume_uuid.assert_called_once_with(
             vm_ref, connection_info['data']['volume_id'])
-        get_vmdk_backed_disk_device.assert_has_calls([
-            mock.call(mock.sentinel.hardware_devices, volume_id),
-            mock.call(mock.sentinel.hardware_devices, disk_uuid)])
 
     @mock.patch.object(volumeops.VMwareVolumeOps, '_get_volume_uuid')
-    @mock.patch.object(vm_util, 'get_vmdk_backed_disk_device')
     def test_get_vmdk_backed_disk_device_with_missing_disk_device(
-            self, get_vmdk_backed_disk_device, get_volume_uuid):
+            self, get_volume_uuid):
         session = mock.Mock()
         self._volumeops._session = session
-        hardware_devices = mock.sentinel.hardware_devices
-        session._call_method.return_value = hardware_devices
-
-        disk_uuid = mock.sentinel.disk_uuid
-        get_volume_uuid.return_value = disk_uuid
-
-        get_vmdk_backed_disk_device.return_value = None
+        session._call_method.return_value = [
+            self._get_vmdk_backed_disk(2000, 'other-uuid')]
+        get_volume_uuid.return_value = 'disk-uuid'
 
         vm_ref = mock.sentinel.vm_ref
         connection_info = self._fake_connection_info()
-        volume_id = connection_info['data']['volume_id']
         self.assertRaises(exception.DiskNotFound,
                           self._volumeops._get_vmdk_backed_disk_device,
                           vm_ref, connection_info['data'])
@@ -251,9 +235,20 @@ class VMwareVolumeOpsTestCase(test.NoDBTestCase):
             vutil, "get_object_property", vm_ref, "config.hardware.device")
         get_volume_uuid.assert_called_once_with(
             vm_ref, connection_info['data']['volume_id'])
-        get_vmdk_backed_disk_device.assert_has_calls([
-            mock.call(mock.sentinel.hardware_devices, volume_id),
-            mock.call(mock.sentinel.hardware_devices, disk_uuid)])
+
+    def test_get_vmdk_backed_disk_device_from_index(self):
+        session = mock.Mock()
+        self._volumeops._session = session
+        connection_info = self._fake_connection_info()
+        device = self._get_vmdk_backed_disk(
+            2000, connection_info['data']['volume_id'])
+        index = vm_util.HardwareDeviceIndex([device])
+
+        ret = self._volumeops._get_vmdk_backed_disk_device(
+            mock.sentinel.vm_ref, connection_info['data'], index=index)
+
+        self.assertEqual(device, ret)
+        session._call_method.assert_not_called()
 
     def test_detach_volume_vmdk(self):
         client_factory = self._volumeops._session.vim.client.factory
@@ -298,7 +293,7 @@ class VMwareVolumeOpsTestCase(test.NoDBTestCase):
                                                instance)
             get_volume_ref.assert_called_once_with(data)
             get_vmdk_backed_disk_device.assert_called_once_with(
-                mock.sentinel.vm_ref, data)
+                mock.sentinel.vm_ref, data, index=mock.ANY)
             adapter_type = vm_util.CONTROLLER_TO_ADAPTER_TYPE.get(
                 virtual_controller.__class__.__name__)
             consolidate_vmdk_volume.assert_called_once_with(
@@ -345,7 +340,7 @@ class VMwareVolumeOpsTestCase(test.NoDBTestCase):
                                                instance)
             get_volume_ref.assert_called_once_with(connection_info['data'])
             get_vmdk_backed_disk_device.assert_called_once_with(
-                mock.sentinel.vm_ref, connection_info['data'])
+                mock.sentinel.vm_ref, connection_info['data'], index=mock.ANY)
             get_vm_state.assert_called_once_with(self._volumeops._session,
                                                  instance)
 
@@ -435,7 +430,8 @@ class VMwareVolumeOpsTestCase(test.NoDBTestCase):
 
     @mock.patch.object(vm_util, 'get_vm_ref')
     @mock.patch.object(vm_util, 'get_vm_state')
-    @mock.patch.object(vm_util, 'get_vmdk_backed_disk_device')
+    @mock.patch.object(volumeops.VMwareVolumeOps,
+                       '_get_vmdk_backed_disk_device')
     @mock.patch.object(vm_util, '_create_fcd_id_obj')
     @mock.patch.object(vm_util, 'detach_fcd')
     def _test__detach_volume_fcd(
@@ -945,3 +941,314 @@ class VMwareVolumeOpsTestCase(test.NoDBTestCase):
             self.assertEqual(host_ip, connector['host'])
             self.assertEqual(iqn, connector['initiator'])
             self.assertEqual(vm_id, connector['instance'])
+
+    @mock.patch.object(vm_util, 'reconfigure_vm')
+    @mock.patch.object(vm_util, 'get_hardware_devices')
+    def test_attach_disks_to_vm(self, get_hardware_devices, reconfigure_vm):
+        devices = [vmwareapi_fake.VirtualLsiLogicController(
+            1000, scsiCtlrUnitNumber=7)]
+        devices += [vmwareapi_fake.VirtualDisk(1000, unit_number)
+                    for unit_number in range(2)]
+        get_hardware_devices.return_value = devices
+        vm_ref = vmwareapi_fake.ManagedObjectReference()
+        disks = [{'adapter_type': constants.DEFAULT_ADAPTER_TYPE,
+                  'disk_type': constants.DEFAULT_DISK_TYPE,
+                  'vmdk_path': '[ds] volume-1/volume-1.vmdk',
+                  'volume_uuid': uuids.volume_1,
+                  'backing_uuid': uuids.backing_1},
+                 {'adapter_type': constants.DEFAULT_ADAPTER_TYPE,
+                  'disk_type': constants.DEFAULT_DISK_TYPE,
+                  'vmdk_path': '[ds] volume-2/volume-2.vmdk',
+                  'volume_uuid': uuids.volume_2,
+                  'backing_uuid': uuids.backing_2}]
+
+        self._volumeops.attach_disks_to_vm(vm_ref, self._instance, disks)
+
+        reconfigure_vm.assert_called_once_with(self._volumeops._session,
+                                               vm_ref, mock.ANY)
+        config_spec = reconfigure_vm.call_args[0][2]
+        self.assertEqual(['add', 'add'],
+                         [spec.operation for spec in config_spec.deviceChange])
+        new_disks = [spec.device for spec in config_spec.deviceChange]
+        self.assertEqual([-101, -102], [disk.key for disk in new_disks])
+        self.assertEqual([(1000, 2), (1000, 3)],
+                         [(disk.controllerKey, disk.unitNumber)
+                          for disk in new_disks])
+        self.assertEqual([disk['vmdk_path'] for disk in disks],
+                         [disk.backing.fileName for disk in new_disks])
+        self.assertEqual({'volume-%s' % uuids.volume_1: uuids.backing_1,
+                          'volume-%s' % uuids.volume_2: uuids.backing_2},
+                         {opt.key: opt.value
+                          for opt in config_spec.extraConfig})
+
+    @mock.patch.object(vm_util, 'reconfigure_vm')
+    @mock.patch.object(vm_util, 'get_hardware_devices')
+    def test_attach_disks_to_vm_create_controllers_first(
+            self, get_hardware_devices, reconfigure_vm):
+        controller = vmwareapi_fake.VirtualLsiLogicController(
+            1000, scsiCtlrUnitNumber=7)
+        get_hardware_devices.side_effect = [[], [controller]]
+        vm_ref = vmwareapi_fake.ManagedObjectReference()
+        disks = [{'adapter_type': constants.DEFAULT_ADAPTER_TYPE,
+                  'disk_type': constants.DEFAULT_DISK_TYPE,
+                  'vmdk_path': '[ds] fcd/fcd-%d.vmdk' % i}
+                 for i in range(2)]
+
+        self._volumeops.attach_disks_to_vm(vm_ref, self._instance, disks,
+                                           create_controllers_first=True)
+
+        self.assertEqual(2, reconfigure_vm.call_count)
+        # the controller gets created by a reconfigure of its own
+        controller_spec = reconfigure_vm.call_args_list[0][0][2]
+        self.assertEqual(['add'], [spec.operation
+                                   for spec in controller_spec.deviceChange])
+        self.assertFalse(hasattr(controller_spec.deviceChange[0].device,
+                                 'backing'))
+        # and the disks use the key of the created controller
+        config_spec = reconfigure_vm.call_args_list[1][0][2]
+        new_disks = [spec.device for spec in config_spec.deviceChange]
+        self.assertEqual([(1000, 0), (1000, 1)],
+                         [(disk.controllerKey, disk.unitNumber)
+                          for disk in new_disks])
+        self.assertEqual([disk['vmdk_path'] for disk in disks],
+                         [disk.backing.fileName for disk in new_disks])
+
+    @mock.patch.object(vm_util, 'reconfigure_vm')
+    def test_detach_disks_from_vm(self, reconfigure_vm):
+        device_1 = vmwareapi_fake.VirtualDisk(1000, 0)
+        device_2 = vmwareapi_fake.VirtualDisk(1000, 1)
+        vm_ref = vmwareapi_fake.ManagedObjectReference()
+
+        self._volumeops.detach_disks_from_vm(
+            vm_ref, self._instance,
+            [(device_1, uuids.volume_1), (device_2, None)])
+
+        config_spec = reconfigure_vm.call_args[0][2]
+        self.assertEqual(['remove', 'remove'],
+                         [spec.operation for spec in config_spec.deviceChange])
+        self.assertEqual([device_1, device_2],
+                         [spec.device for spec in config_spec.deviceChange])
+        self.assertEqual({'volume-%s' % uuids.volume_1: ''},
+                         {opt.key: opt.value
+                          for opt in config_spec.extraConfig})
+
+    def test_attach_volumes(self):
+        vmdk_connection_info = {
+            'driver_volume_type': constants.DISK_FORMAT_VMDK,
+            'serial': 'volume-fake-id',
+            'data': {'volume': 'vm-10',
+                     'volume_id': uuids.vmdk_volume,
+                     'profile_id': 'fake-profile-id'}}
+        fcd_connection_info = {
+            'driver_volume_type': constants.DISK_FORMAT_FCD,
+            'data': {'id': 'fake-fcd-id',
+                     'ds_ref_val': 'ds-1',
+                     'adapter_type': constants.ADAPTER_TYPE_LSILOGICSAS}}
+        iscsi_connection_info = {
+            'driver_volume_type': constants.DISK_FORMAT_ISCSI,
+            'data': {}}
+        backing = mock.Mock(uuid=uuids.vmdk_backing)
+        vmdk_info = vm_util.VmdkInfo('fake-path',
+                                     constants.DEFAULT_ADAPTER_TYPE,
+                                     constants.DEFAULT_DISK_TYPE, 1024,
+                                     mock.Mock(backing=backing))
+        fcd_info = {'disk_type': 'thin',
+                    'vmdk_path': 'fcd-path',
+                    'volume_uuid': uuids.fcd_volume,
+                    'backing_uuid': uuids.fcd_backing}
+        with test.nested(
+            mock.patch.object(vm_util, 'get_vm_ref',
+                              return_value=mock.sentinel.vm_ref),
+            mock.patch.object(self._volumeops, '_get_volume_ref'),
+            mock.patch.object(vm_util, 'get_vmdk_info',
+                              return_value=vmdk_info),
+            mock.patch.object(self._volumeops, '_get_fcd_disk_info',
+                              return_value=fcd_info),
+            mock.patch.object(self._volumeops, 'attach_disks_to_vm'),
+            mock.patch.object(self._volumeops, 'attach_volume'),
+            mock.patch.object(vm_util, 'get_vm_state')
+        ) as (get_vm_ref, get_volume_ref, get_vmdk_info, get_fcd_disk_info,
+              attach_disks_to_vm, attach_volume, get_vm_state):
+            self._volumeops.attach_volumes(
+                [(vmdk_connection_info, None),
+                 (iscsi_connection_info, mock.sentinel.adapter_type),
+                 (fcd_connection_info, None)],
+                self._instance)
+
+            get_vm_ref.assert_called_once_with(self._volumeops._session,
+                                               self._instance)
+            get_fcd_disk_info.assert_called_once_with('fake-fcd-id', 'ds-1')
+            attach_disks_to_vm.assert_called_once_with(
+                mock.sentinel.vm_ref, self._instance,
+                [{'adapter_type': constants.DEFAULT_ADAPTER_TYPE,
+                  'disk_type': constants.DEFAULT_DISK_TYPE,
+                  'vmdk_path': 'fake-path',
+                  'volume_uuid': uuids.vmdk_volume,
+                  'backing_uuid': uuids.vmdk_backing,
+                  'profile_id': 'fake-profile-id'},
+                 {'adapter_type': constants.ADAPTER_TYPE_LSILOGICSAS,
+                  'disk_type': 'thin',
+                  'vmdk_path': 'fcd-path',
+                  'volume_uuid': uuids.fcd_volume,
+                  'backing_uuid': uuids.fcd_backing,
+                  'profile_id': None}],
+                create_controllers_first=True)
+            attach_volume.assert_called_once_with(
+                iscsi_connection_info, self._instance,
+                mock.sentinel.adapter_type)
+            self.assertFalse(get_vm_state.called)
+
+    def test_attach_volumes_ide_powered_on(self):
+        connection_info = {
+            'driver_volume_type': constants.DISK_FORMAT_FCD,
+            'data': {'id': 'fake-fcd-id',
+                     'ds_ref_val': 'ds-1',
+                     'adapter_type': constants.ADAPTER_TYPE_IDE}}
+        with test.nested(
+            mock.patch.object(vm_util, 'get_vm_ref'),
+            mock.patch.object(vm_util, 'get_vm_state',
+                              return_value=power_state.RUNNING),
+            mock.patch.object(self._volumeops, 'attach_disks_to_vm')
+        ) as (get_vm_ref, get_vm_state, attach_disks_to_vm):
+            self.assertRaises(exception.Invalid,
+                              self._volumeops.attach_volumes,
+                              [(connection_info, None),
+                               (connection_info, None)],
+                              self._instance)
+            get_vm_state.assert_called_once_with(self._volumeops._session,
+                                                 self._instance)
+            self.assertFalse(attach_disks_to_vm.called)
+
+    def test_detach_volumes(self):
+        client_factory = self._volumeops._session.vim.client.factory
+        virtual_controller = client_factory.create(
+            'ns0:VirtualLsiLogicController')
+        virtual_controller.key = 100
+        vmdk_disk = client_factory.create('ns0:VirtualDisk')
+        vmdk_disk.controllerKey = virtual_controller.key
+        fcd_disk = client_factory.create('ns0:VirtualDisk')
+        fcd_disk.controllerKey = virtual_controller.key
+
+        vmdk_connection_info = {
+            'driver_volume_type': constants.DISK_FORMAT_VMDK,
+            'serial': 'volume-fake-id',
+            'data': {'volume': 'vm-10',
+                     'volume_id': uuids.vmdk_volume,
+                     'profile_id': 'fake-profile-id'}}
+        missing_connection_info = {
+            'driver_volume_type': constants.DISK_FORMAT_VMDK,
+            'serial': 'volume-missing-id',
+            'data': {'volume': 'vm-11',
+                     'volume_id': uuids.missing_volume}}
+        fcd_connection_info = {
+            'driver_volume_type': constants.DISK_FORMAT_FCD,
+            'serial': uuids.fcd_volume,
+            'data': {'id': 'fake-fcd-id',
+                     'adapter_type': constants.DEFAULT_ADAPTER_TYPE}}
+        iscsi_connection_info = {
+            'driver_volume_type': constants.DISK_FORMAT_ISCSI,
+            'data': {}}
+
+        with test.nested(
+            mock.patch.object(vm_util, 'get_vm_ref',
+                              return_value=mock.sentinel.vm_ref),
+            mock.patch.object(self._volumeops, '_get_volume_ref',
+                              return_value=mock.sentinel.volume_ref),
+            mock.patch.object(self._volumeops,
+                              '_get_vmdk_backed_disk_device',
+                              side_effect=[vmdk_disk,
+                                           exception.DiskNotFound('oh man'),
+                                           fcd_disk]),
+            mock.patch.object(vm_util, 'get_hardware_device_index',
+                              return_value=vm_util.HardwareDeviceIndex(
+                                  [virtual_controller])),
+            mock.patch.object(vm_util, '_get_device_disk_type',
+                              return_value='fake-disk-type'),
+            mock.patch.object(self._volumeops, '_consolidate_vmdk_volume'),
+            mock.patch.object(self._volumeops, 'detach_disks_from_vm'),
+            mock.patch.object(self._volumeops, 'detach_volume')
+        ) as (get_vm_ref, get_volume_ref, get_vmdk_backed_disk_device,
+              get_hardware_device_index, _get_device_disk_type,
+              consolidate_vmdk_volume, detach_disks_from_vm, detach_volume):
+            self._volumeops.detach_volumes(
+                [vmdk_connection_info, missing_connection_info,
+                 iscsi_connection_info, fcd_connection_info],
+                self._instance)
+
+            get_vm_ref.assert_called_once_with(self._volumeops._session,
+                                               self._instance)
+            consolidate_vmdk_volume.assert_called_once_with(
+                self._instance, mock.sentinel.vm_ref, vmdk_disk,
+                mock.sentinel.volume_ref,
+                adapter_type=constants.DEFAULT_ADAPTER_TYPE,
+                disk_type='fake-disk-type', profile_id='fake-profile-id')
+            detach_volume.assert_called_once_with(iscsi_connection_info,
+                                                  self._instance)
+            detach_disks_from_vm.assert_called_once_with(
+                mock.sentinel.vm_ref, self._instance,
+                [(vmdk_disk, uuids.vmdk_volume),
+                 (fcd_disk, uuids.fcd_volume)])
+
+    @mock.patch.object(vm_util, 'invalidate_device_snapshot')
+    @mock.patch.object(vm_util, 'get_vm_ref')
+    def test_fixup_shadow_vms(self, get_vm_ref, invalidate_device_snapshot):
+        def _disk(key, unit_number, file_name):
+            disk = vmwareapi_fake.VirtualDisk(1000, unit_number)
+            disk.key = key
+            disk.backing = vmwareapi_fake.DataObject()
+            disk.backing.fileName = file_name
+            disk.backing.thinProvisioned = True
+            return disk
+
+        controller = vmwareapi_fake.VirtualLsiLogicController(
+            1000, scsiCtlrUnitNumber=7)
+        instance_devices = [controller,
+                            _disk(2001, 1, '[ds] vm/volume-1.vmdk'),
+                            _disk(2002, 2, '[ds] vm/volume-2.vmdk'),
+                            _disk(2003, 3, '[ds] vm/volume-3.vmdk')]
+        shadow_vm_devices = {
+            'vm-1': [],
+            'vm-2': [controller, _disk(3000, 0, '[ds] vm-2/volume-2.vmdk')],
+            'vm-3': [controller, _disk(3000, 0, '[ds] vm/volume-3.vmdk')],
+        }
+        shadow_vms = {
+            2001: {'volume': 'vm-1', 'volume_id': uuids.volume_1},
+            2002: {'volume': 'vm-2', 'volume_id': uuids.volume_2},
+            2003: {'volume': 'vm-3', 'volume_id': uuids.volume_3},
+        }
+
+        def fake_get_hardware_devices(session, vm_ref):
+            if vm_ref is get_vm_ref.return_value:
+                return instance_devices
+            return shadow_vm_devices[vm_ref.value]
+
+        session = self._volumeops._session
+        with test.nested(
+            mock.patch.object(vm_util, 'get_hardware_devices',
+                              side_effect=fake_get_hardware_devices),
+            mock.patch.object(session, '_call_method',
+                              side_effect=lambda *args, **kwargs:
+                                  'task-%s' % args[2].value),
+            mock.patch.object(session, '_wait_for_task',
+                              side_effect=[None, test.TestingException])
+        ) as (get_hardware_devices, call_method, wait_for_task):
+            self._volumeops.fixup_shadow_vms(self._instance, shadow_vms)
+
+            self.assertEqual(['task-vm-1', 'task-vm-2'],
+                             [c[0][0] for c in wait_for_task.call_args_list])
+            self.assertEqual(2, invalidate_device_snapshot.call_count)
+
+            specs = {c[0][2].value: c[1]['spec']
+                     for c in call_method.call_args_list}
+            self.assertEqual({'vm-1', 'vm-2'}, set(specs))
+            # a new controller is created along with the disk
+            self.assertEqual(
+                ['add', 'add'],
+                [spec.operation for spec in specs['vm-1'].deviceChange])
+            # the stale disk gets replaced in the same reconfigure
+            change = specs['vm-2'].deviceChange
+            self.assertEqual(['remove', 'add'],
+                             [spec.operation for spec in change])
+            self.assertEqual('destroy', change[0].fileOperation)
+            self.assertEqual('[ds] vm/volume-2.vmdk',
+                             change[1].device.backing.fileName)
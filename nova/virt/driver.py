@@ -247,6 +247,17 @@ class ComputeDriver(object):
         # TODO(Vek): Need to pass context in for access to auth_token
         raise NotImplementedError()
 
+    def get_power_states(self):
+        """Return the power states of all instances on this node.
+
+        Drivers able to fetch the power states of all their instances at once
+        should implement this, so the compute manager doesn't have to call
+        get_info() for every single instance when syncing power states.
+
+        :returns: A dict mapping the instance uuid to its power state
+        """
+        raise NotImplementedError()
+
     def get_num_instances(self):
         """Return the total number of virtual machines.
 
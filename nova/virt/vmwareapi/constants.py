@@ -82,6 +82,9 @@ VCLS_EXTENSION_TYPE_AGENT = 'cluster-agent'
 # One adapter has 16 slots but one reserved for controller
 SCSI_MAX_CONNECT_NUMBER = 15
 
+# The slot a new SCSI controller reserves for itself on its bus
+SCSI_CONTROLLER_UNIT_NUMBER = 7
+
 # The max number of SCSI adaptors that could be created on one instance.
 SCSI_MAX_CONTROLLER_NUMBER = 4
 
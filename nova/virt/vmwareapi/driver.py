@@ -20,7 +20,6 @@ A connection to the VMware vCenter platform.
 """
 import contextlib
 import os
-import random
 import re
 import six
 from six.moves import urllib
@@ -156,6 +155,8 @@ class VMwareVCDriver(driver.ComputeDriver):
 
         self._validate_configuration()
         self._cluster_name = CONF.vmware.cluster_name
+        self.cluster_metrics = {}
+        self._cluster_metrics_timestamp = None
         self._cluster_ref = vm_util.get_cluster_ref_by_name(self._session,
                                                             self._cluster_name)
         if self._cluster_ref is None:
@@ -236,11 +237,15 @@ class VMwareVCDriver(driver.ComputeDriver):
             self._session._create_session()
 
         self._vmops.set_compute_host(host)
+        self._vmops.start_property_collector_watcher()
+        self._vmops.start_server_group_sync_worker()
         LOG.debug("Starting green server-group sync-loop thread")
         utils.spawn(self._server_group_sync_loop, host)
         utils.spawn(self._custom_traits_sync_loop, host)
 
     def cleanup_host(self, host):
+        self._vmops.stop_property_collector_watcher()
+        self._vmops.stop_server_group_sync_worker()
         self._session.logout()
 
     def _register_openstack_extension(self):
@@ -442,38 +447,47 @@ class VMwareVCDriver(driver.ComputeDriver):
         return stats_dict
 
     def get_cluster_metrics(self):
-        cluster_ref = vm_util.get_cluster_ref_by_name(
-            self._session, CONF.vmware.cluster_name)
+        if (self._cluster_metrics_timestamp is not None and
+                time.monotonic() - self._cluster_metrics_timestamp <
+                    CONF.vmware.cluster_metrics_cache_ttl):
+            return dict(self.cluster_metrics)
 
-        lst_properties = ["summary.quickStats"]
         self.cluster_metrics = {}
         self.cpu_usage = 0
         self.memory_usage = 0
         self.datastore_free_space = 0
         self.datastore_total = 0
 
-        cluster_data = self._session._call_method(vim_util,
-             'get_object_properties_dict', cluster_ref,
-             ['host', 'datastore', 'summary'])
-
-        for datastore in cluster_data['datastore'][0]:
-            datastore_capacity = self._session._call_method(
-                vim_util,
-                "get_object_properties_dict",
-                datastore,
-                ['summary.freeSpace', 'summary.capacity'])
-            self.datastore_free_space += (
-                datastore_capacity['summary.freeSpace'])
-            self.datastore_total += datastore_capacity['summary.capacity']
-
-        for cluster_host in cluster_data['host'][0]:
-            props = self._session._call_method(vim_util,
-                                               "get_object_properties_dict",
-                                               cluster_host,
-                                               lst_properties)
-
-            self.cpu_usage += props['summary.quickStats'].overallCpuUsage
-            self.memory_usage += props['summary.quickStats'].overallMemoryUsage
+        cluster_data = {}
+        result = self._session._call_method(nova_vim_util,
+            'get_cluster_inventory', self._cluster_ref,
+            ['summary'],
+            ['summary.quickStats'],
+            ['summary.freeSpace', 'summary.capacity'])
+        with vim_util.WithRetrieval(self._session.vim, result) as objects:
+            for obj in objects:
+                props = vm_util.propset_dict(getattr(obj, 'propSet', None))
+                for m in getattr(obj, 'missingSet', None) or []:
+                    LOG.warning("Unable to retrieve value for %(path)s "
+                                "Reason: %(reason)s",
+                                {'path': m.path,
+                                 'reason': m.fault.localizedMessage})
+                obj_type = vim_util.get_moref_type(obj.obj)
+                if obj_type == 'Datastore':
+                    self.datastore_free_space += props.get(
+                        'summary.freeSpace', 0)
+                    self.datastore_total += props.get('summary.capacity', 0)
+                elif obj_type == 'HostSystem':
+                    quick_stats = props['summary.quickStats']
+                    self.cpu_usage += quick_stats.overallCpuUsage
+                    self.memory_usage += quick_stats.overallMemoryUsage
+                else:
+                    cluster_data = props
+
+        if 'summary' not in cluster_data:
+            raise exception.NotFound(_("The specified cluster '%s' was not "
+                                       "found in vCenter")
+                                     % self._cluster_name)
 
         self.cluster_metrics['cpu_total'] = cluster_data['summary'].totalCpu
         self.cluster_metrics['cpu_used'] = self.cpu_usage
@@ -505,7 +519,8 @@ class VMwareVCDriver(driver.ComputeDriver):
             self.cluster_metrics['datastore_total'] / units.G)
         self.cluster_metrics['datastore_percent'] = int(perc * 100)
 
-        return self.cluster_metrics
+        self._cluster_metrics_timestamp = time.monotonic()
+        return dict(self.cluster_metrics)
 
     def get_available_nodes(self, refresh=False):
         """Returns nodenames of all nodes managed by the compute service.
@@ -635,6 +650,11 @@ class VMwareVCDriver(driver.ComputeDriver):
                         'step_size': 1,
             }
 
+        # NOTE: We rebuild and set the whole inventory even if none of its
+        # inputs changed. The resource tracker merges the inventories of the
+        # provider configs afterwards and rejects them if the provider already
+        # has them, so leaving the provider untouched would break the merge.
+        # Flushing an unchanged tree to placement doesn't cause any requests.
         provider_tree.update_inventory(nodename, result)
 
         # TODO(cdent): Here is where additional functionality would be added.
@@ -699,21 +719,19 @@ class VMwareVCDriver(driver.ComputeDriver):
             # plugging. Hence we need to power off the instance and update
             # the instance state.
             self._vmops.power_off(instance)
-            for disk in block_device_mapping:
-                connection_info = disk['connection_info']
-                try:
-                    self._volumeops.detach_volume(connection_info, instance)
-                except exception.DiskNotFound:
-                    LOG.warning('The volume %s does not exist!',
-                                disk.get('device_name'),
-                                instance=instance)
-                except Exception as e:
-                    with excutils.save_and_reraise_exception():
-                        LOG.error("Failed to detach %(device_name)s. "
-                                  "Exception: %(exc)s",
-                                  {'device_name': disk.get('device_name'),
-                                   'exc': e},
-                                  instance=instance)
+            connection_infos = [disk['connection_info']
+                                for disk in block_device_mapping]
+            try:
+                self._volumeops.detach_volumes(connection_infos, instance)
+            except Exception as e:
+                with excutils.save_and_reraise_exception():
+                    LOG.error("Failed to detach %(device_names)s. "
+                              "Exception: %(exc)s",
+                              {'device_names': [disk.get('device_name')
+                                                for disk in
+                                                block_device_mapping],
+                               'exc': e},
+                              instance=instance)
 
     def destroy(self, context, instance, network_info, block_device_info=None,
                 destroy_disks=True, destroy_secrets=True):
@@ -792,6 +810,10 @@ class VMwareVCDriver(driver.ComputeDriver):
         """Return info about the VM instance."""
         return self._vmops.get_info(instance, use_cache=use_cache)
 
+    def get_power_states(self):
+        """Return the power states of all VM instances in the cluster."""
+        return self._vmops.get_power_states()
+
     def get_diagnostics(self, instance):
         """Return data about VM diagnostics."""
         return self._vmops.get_diagnostics(instance)
@@ -836,6 +858,7 @@ class VMwareVCDriver(driver.ComputeDriver):
     def manage_image_cache(self, context, all_instances):
         """Manage the local cache of images."""
         self._vmops.manage_image_cache(context, all_instances)
+        self._vmops.prewarm_image_templates()
 
     def instance_exists(self, instance):
         """Efficient override of base instance_exists method."""
@@ -850,15 +873,23 @@ class VMwareVCDriver(driver.ComputeDriver):
         self._vmops.detach_interface(context, instance, vif)
 
     def sync_server_group(self, context, sg_uuid):
+        if self._vmops.queue_server_group_sync(sg_uuid):
+            return
+
         self._vmops.sync_server_group(context, sg_uuid)
         self._vmops.update_server_group_hagroup_disk_placement(context,
                                                                sg_uuid)
 
     def _server_group_sync_loop(self, compute_host):
-        """Retrieve all groups from the cluster and from the DB and call
-        self.sync_server_group() for them.
+        """Retrieve all groups from the cluster and from the DB and sync them.
+
+        The DRS rules of all groups get synced with a single reconfiguration
+        of the cluster. Before checking the disk placement of each group, we
+        always wait a little not not overwhelm the cluster.
 
-        We always wait a little not not overwhelm the cluster.
+        Changes to server-groups and their members get synced through the
+        server-group sync worker of the VMOps, so this loop is only a
+        consistency check catching what was missed.
         """
         context = nova_context.get_admin_context()
 
@@ -893,14 +924,14 @@ class VMwareVCDriver(driver.ComputeDriver):
 
                     sg_uuids.add(m.group(0))
 
-                for sg_uuid in sg_uuids:
+                self._vmops.sync_server_groups(context, sg_uuids)
+
+                # without hagroups, there's no disk placement to check
+                if self._datastore_hagroup_regex:
                     spacing = \
                         CONF.vmware.server_group_sync_loop_max_group_spacing
-                    sleep_time = random.uniform(0.5, spacing)
-                    time.sleep(sleep_time)
-                    self._vmops.sync_server_group(context, sg_uuid)
-                    self._vmops.update_server_group_hagroup_disk_placement(
-                        context, sg_uuid)
+                    self._vmops.update_server_groups_hagroup_disk_placement(
+                        context, sg_uuids, max_spacing=spacing)
             except Exception as e:
                 LOG.exception("Finished server-group sync-loop with error: %s",
                               e)
@@ -920,91 +951,18 @@ class VMwareVCDriver(driver.ComputeDriver):
         """
         context = nova_context.get_admin_context()
 
-        # in addition to all "CUSTOM_"-prefixed traits, we also sync these
-        # traits into the cluster
-        EXTRA_TRAITS = set(['COMPUTE_STATUS_DISABLED'])
-
-        PREFIX = constants.CUSTOM_ATTRIBUTES_TRAITS_PREFIX
+        # The CustomFieldDef are kept for the life of the loop and only
+        # fetched again after an error, as we might have missed changes done
+        # by others in that case.
+        custom_field = nova_vim_util.CustomField(self._session,
+                                                 cache_fields=True)
 
         while CONF.vmware.custom_traits_sync_loop_spacing >= 0:
             LOG.debug('Starting custom traits sync-loop')
             try:
-                placement_client = self.virtapi.reportclient
-                # NOTE(jkulik): We need to get all traits, because while our
-                # nova-compute might not need a trait, other nova-compute in
-                # the same vCenter might. To not delete CustomFieldDef that's
-                # actually in use by others, we keep all traits in the vCenter.
-                trait_fields_names = set(
-                    f"{PREFIX}{t}"
-                    for t in placement_client.get_traits(context)
-                    if t.startswith('CUSTOM_') or t in EXTRA_TRAITS)
-
-                custom_field = nova_vim_util.CustomField(self._session)
-                obj_type = 'ClusterComputeResource'
-                # Fetch the existing CustomFieldDef
-                vc_fields_names_by_key = {
-                    f.key: f.name
-                    for f in custom_field.get_by_obj_type(obj_type)
-                    if f.name.startswith(PREFIX)}
-                vc_fields_names = set(vc_fields_names_by_key.values())
-
-                # Create all CustomFieldDef that do not exist, yet
-                for name in trait_fields_names - vc_fields_names:
-                    field = custom_field.create(name, obj_type=obj_type)
-                    vc_fields_names_by_key[field.key] = field.name
-                    LOG.debug('Created CustomFieldDef %s for the '
-                              'corresponding trait in Placement.', name)
-
-                # Remove all CustomFieldDef that do not exist in Placement
-                # anymore
-                for name in vc_fields_names - trait_fields_names:
-                    # we do not update vc_fields here, because we only use it
-                    # for mapping values to names.
-                    custom_field.delete(name)
-                    LOG.debug('Deleted CustomFieldDef %s as it has no '
-                              'corresponding trait in Placement.', name)
-
-                # Fetch the traits our nova-compute has from Placement
-                cn = self.virtapi._compute._get_compute_info(context,
-                                                             CONF.host)
-                rp_uuid = cn.uuid
-                provider_traits = \
-                    placement_client.get_provider_traits(context, rp_uuid)
-                our_trait_field_names = set(
-                    f"{PREFIX}{t}"
-                    for t in provider_traits.traits
-                    if t.startswith('CUSTOM_') or t in EXTRA_TRAITS)
-
-                FIELD_VALUE = 'true'
-                # Fetch the custom field values for our cluster
-                # `vc_fields_names_by_key` contains the only fields we care
-                # about. There could be more values on our cluster, but we do
-                # not want to delete them or update them and thus ignore them.
-                vc_values = {
-                    vc_fields_names_by_key[v.key]: v.value
-                    for v in custom_field.get_values(self._cluster_ref)
-                    if v.key in vc_fields_names_by_key and
-                    v.value == FIELD_VALUE}
-                vc_values_names = set(vc_values)
-                vc_fields_keys_by_name = {v: k
-                                    for k, v in vc_fields_names_by_key.items()}
-
-                # Add custom field values we're missing
-                for name in our_trait_field_names - vc_values_names:
-                    key = vc_fields_keys_by_name[name]
-                    custom_field.set_value(self._cluster_ref, key,
-                                           FIELD_VALUE)
-                    LOG.debug('Set value for CustomFieldDef %s to %s',
-                              name, FIELD_VALUE)
-
-                # Remove custom field values we have no trait for anymore
-                for name in vc_values_names - our_trait_field_names:
-                    key = vc_fields_keys_by_name[name]
-                    # There is no remove. We can just set it to an empty
-                    # string. It will still be returned by
-                    # `custom_field.get_values()` as extra item.
-                    custom_field.set_value(self._cluster_ref, key, '')
+                self._sync_custom_traits(context, custom_field)
             except Exception as e:
+                custom_field.invalidate()
                 msg = "Finished custom traits sync-loop with error: %s"
                 LOG.exception(msg, e)
             else:
@@ -1012,6 +970,96 @@ class VMwareVCDriver(driver.ComputeDriver):
 
             time.sleep(CONF.vmware.custom_traits_sync_loop_spacing)
 
+    def _sync_custom_traits(self, context, custom_field):
+        """Run a single iteration of the custom traits sync-loop
+
+        Only the custom field values differing from the traits in Placement
+        are written.
+        """
+        # in addition to all "CUSTOM_"-prefixed traits, we also sync these
+        # traits into the cluster
+        EXTRA_TRAITS = set(['COMPUTE_STATUS_DISABLED'])
+
+        PREFIX = constants.CUSTOM_ATTRIBUTES_TRAITS_PREFIX
+
+        placement_client = self.virtapi.reportclient
+        # NOTE(jkulik): We need to get all traits, because while our
+        # nova-compute might not need a trait, other nova-compute in
+        # the same vCenter might. To not delete CustomFieldDef that's
+        # actually in use by others, we keep all traits in the vCenter.
+        trait_fields_names = set(
+            f"{PREFIX}{t}"
+            for t in placement_client.get_traits(context)
+            if t.startswith('CUSTOM_') or t in EXTRA_TRAITS)
+
+        obj_type = 'ClusterComputeResource'
+        # Fetch the existing CustomFieldDef
+        vc_fields_names_by_key = {
+            f.key: f.name
+            for f in custom_field.get_by_obj_type(obj_type)
+            if f.name.startswith(PREFIX)}
+        vc_fields_names = set(vc_fields_names_by_key.values())
+
+        # Create all CustomFieldDef that do not exist, yet
+        for name in trait_fields_names - vc_fields_names:
+            field = custom_field.create(name, obj_type=obj_type)
+            vc_fields_names_by_key[field.key] = field.name
+            LOG.debug('Created CustomFieldDef %s for the '
+                      'corresponding trait in Placement.', name)
+
+        # Remove all CustomFieldDef that do not exist in Placement
+        # anymore
+        for name in vc_fields_names - trait_fields_names:
+            # we do not update vc_fields here, because we only use it
+            # for mapping values to names.
+            custom_field.delete(name)
+            LOG.debug('Deleted CustomFieldDef %s as it has no '
+                      'corresponding trait in Placement.', name)
+
+        # Fetch the traits our nova-compute has from Placement
+        cn = self.virtapi._compute._get_compute_info(context, CONF.host)
+        rp_uuid = cn.uuid
+        provider_traits = \
+            placement_client.get_provider_traits(context, rp_uuid)
+        our_trait_field_names = set(
+            f"{PREFIX}{t}"
+            for t in provider_traits.traits
+            if t.startswith('CUSTOM_') or t in EXTRA_TRAITS)
+
+        FIELD_VALUE = 'true'
+        # Fetch the custom field values for our cluster
+        # `vc_fields_names_by_key` contains the only fields we care
+        # about. There could be more values on our cluster, but we do
+        # not want to delete them or update them and thus ignore them.
+        vc_values = {
+            vc_fields_names_by_key[v.key]: v.value
+            for v in custom_field.get_values(self._cluster_ref)
+            if v.key in vc_fields_names_by_key and
+            v.value == FIELD_VALUE}
+        vc_values_names = set(vc_values)
+        vc_fields_keys_by_name = {v: k
+                                  for k, v in vc_fields_names_by_key.items()}
+
+        values = {}
+        # Add custom field values we're missing
+        for name in our_trait_field_names - vc_values_names:
+            values[vc_fields_keys_by_name[name]] = FIELD_VALUE
+            LOG.debug('Setting value for CustomFieldDef %s to %s',
+                      name, FIELD_VALUE)
+
+        # Remove custom field values we have no trait for anymore
+        for name in vc_values_names - our_trait_field_names:
+            # There is no remove. We can just set it to an empty
+            # string. It will still be returned by
+            # `custom_field.get_values()` as extra item.
+            values[vc_fields_keys_by_name[name]] = ''
+            LOG.debug('Clearing value for CustomFieldDef %s', name)
+
+        if values:
+            custom_field.set_values(
+                self._cluster_ref, values,
+                concurrency=CONF.vmware.custom_traits_sync_concurrency)
+
     def check_can_live_migrate_destination(self, context, instance,
                                            src_compute_info, dst_compute_info,
                                            block_migration=False,
@@ -1259,7 +1307,7 @@ class VMwareVCDriver(driver.ComputeDriver):
 
         with self._error_out_instance_on_exception(instance,
                 "sync server groups"):
-            self._vmops.sync_instance_server_group(context, instance)
+            self._vmops.queue_instance_server_group_sync(context, instance)
 
     def post_live_migration_at_source(self, context, instance, network_info):
         # We have to clean up our VM-moref cache, so that when a VM with
@@ -1284,7 +1332,8 @@ class VMwareVCDriver(driver.ComputeDriver):
 
         with self._error_out_instance_on_exception(instance,
                 "update cluster placement"):
-            self._vmops.update_cluster_placement(context, instance)
+            self._vmops.update_cluster_placement(context, instance,
+                                                 defer_sync=True)
 
         with self._error_out_instance_on_exception(instance,
                 "fixup shadow vms"):
@@ -16,6 +16,8 @@
 Datastore utility functions
 """
 import collections
+import threading
+import time
 
 from oslo_log import log as logging
 from oslo_vmware import exceptions as vexc
@@ -23,12 +25,14 @@ from oslo_vmware.objects import datastore as ds_obj
 from oslo_vmware import pbm
 from oslo_vmware import vim_util as vutil
 
+import nova.conf
 from nova import exception
 from nova.i18n import _
 from nova.virt.vmwareapi import constants
 from nova.virt.vmwareapi import vim_util
 from nova.virt.vmwareapi import vm_util
 
+CONF = nova.conf.CONF
 LOG = logging.getLogger(__name__)
 ALL_SUPPORTED_DS_TYPES = frozenset([constants.DATASTORE_TYPE_VMFS,
                                     constants.DATASTORE_TYPE_NFS,
@@ -44,6 +48,297 @@ DcInfo = collections.namedtuple('DcInfo',
 # the datastore moref. The value will be the DcInfo object.
 _DS_DC_MAPPING = {}
 
+# The properties needed to select a datastore
+DATASTORE_PROPERTIES = ["summary.type", "summary.name", "summary.capacity",
+                        "summary.freeSpace", "summary.accessible",
+                        "summary.maintenanceMode"]
+
+# Cached datastore inventories. The key is the moref-value of the cluster or
+# datacenter the datastores belong to. The value is a DatastoreInventory.
+_DS_INVENTORIES = {}
+
+# A cache for the datastores matching a storage policy. The key is the name
+# of the policy and the moref-values of the datastores to filter. The value is
+# a tuple of the time of the lookup and the moref-values of the matches.
+_POLICY_MATCH_CACHE = {}
+
+# Space reserved on datastores for disks being created, which the free space
+# reported by the vCenter doesn't reflect, yet. The key is the moref-value of
+# the datastore. The value is a dict of reservation key to SpaceReservation.
+_DS_RESERVATIONS = collections.defaultdict(dict)
+# Released reservations are kept until we see a new free space reported by
+# the vCenter for their datastore, but at most this many seconds.
+_RELEASED_RESERVATION_MAX_AGE = 300
+
+# Stand-ins for the ObjectContent and DynamicProperty returned by the vCenter,
+# so cached datastores can be passed to the same functions
+CachedObjectContent = collections.namedtuple('CachedObjectContent',
+                                             ['obj', 'propSet'])
+CachedProperty = collections.namedtuple('CachedProperty', ['name', 'val'])
+
+
+class SpaceReservation(object):
+    """Disk space reserved on a datastore, e.g. for a spawning instance"""
+    def __init__(self, size):
+        self.size = size
+        self.released_at = None
+
+
+def reserve_datastore_space(ds_ref, key, size):
+    """Reserve `size` bytes on the datastore until released under `key`
+
+    Selecting a datastore deducts the reservations from its free space, so
+    concurrent spawns don't all pick the same datastore.
+    """
+    ds_value = vutil.get_moref_value(ds_ref)
+    _DS_RESERVATIONS[ds_value][key] = SpaceReservation(size)
+    LOG.debug("Reserved %(size)d bytes on datastore %(ds)s for %(key)s",
+              {'size': size, 'ds': ds_value, 'key': key})
+
+
+def release_datastore_space(key):
+    """Release the reservations made under `key`
+
+    The space stays reserved until the vCenter reports a new free space for
+    the datastore, because that's when the created disks are accounted for.
+    """
+    now = time.monotonic()
+    for reservations in _DS_RESERVATIONS.values():
+        reservation = reservations.get(key)
+        if reservation is not None and reservation.released_at is None:
+            reservation.released_at = now
+
+
+def _datastore_space_updated(ds_value, read_at=None):
+    """Drop the released reservations of a datastore with new free space
+
+    If `read_at` is given, only reservations released before the free space
+    was read are dropped, because the later ones might not be reflected, yet.
+    """
+    reservations = _DS_RESERVATIONS.get(ds_value)
+    if not reservations:
+        return
+
+    for key, reservation in list(reservations.items()):
+        if reservation.released_at is None:
+            continue
+        if read_at is None or reservation.released_at <= read_at:
+            del reservations[key]
+    if not reservations:
+        del _DS_RESERVATIONS[ds_value]
+
+
+def get_reserved_datastore_space(ds_value):
+    """Return the bytes currently reserved on the datastore"""
+    reservations = _DS_RESERVATIONS.get(ds_value)
+    if not reservations:
+        return 0
+
+    now = time.monotonic()
+    for key, reservation in list(reservations.items()):
+        if (reservation.released_at is not None and
+                now - reservation.released_at >
+                _RELEASED_RESERVATION_MAX_AGE):
+            del reservations[key]
+    return sum(r.size for r in reservations.values())
+
+
+def get_datastore_reservations():
+    """Return the bytes currently reserved per datastore moref-value"""
+    return {ds_value: reserved
+            for ds_value, reserved in (
+                (ds_value, get_reserved_datastore_space(ds_value))
+                for ds_value in list(_DS_RESERVATIONS))
+            if reserved}
+
+
+def _read_datastores_space(datastores, read_at):
+    """Yield the datastores freshly read from the vCenter
+
+    Without the inventory, nobody else tells us about a new free space, so
+    the released reservations are dropped as the datastores pass by.
+    """
+    for obj_content in datastores:
+        _datastore_space_updated(vutil.get_moref_value(obj_content.obj),
+                                 read_at)
+        yield obj_content
+
+
+def _get_effective_freespace(datastore):
+    """Return the free space of the datastore we can actually plan with
+
+    That's the reported free space minus the reservations and the headroom
+    to be kept free.
+    """
+    freespace = datastore.freespace
+    headroom_percent = CONF.vmware.datastore_reservation_headroom_percent
+    if headroom_percent:
+        freespace -= datastore.capacity * headroom_percent // 100
+    if _DS_RESERVATIONS:
+        freespace -= get_reserved_datastore_space(
+            vutil.get_moref_value(datastore.ref))
+    return freespace
+
+
+class DatastoreInventory(object):
+    """Cached properties of all datastores of a cluster or datacenter
+
+    A property collector with a filter on the datastores of the container
+    tells us what changed since the last update. Thus, keeping the cache
+    up-to-date only costs a single WaitForUpdatesEx call, which returns
+    nothing if nothing changed.
+    """
+    def __init__(self, container):
+        self._container = container
+        self._lock = threading.Lock()
+        self._collector = None
+        self._version = ''
+        self._datastores = {}
+        self._last_update = None
+
+    def get_datastores(self, session):
+        """Return the cached datastores as list of CachedObjectContent
+
+        Updates the cache first, if it's older than
+        CONF.vmware.datastore_inventory_max_age.
+        """
+        with self._lock:
+            if (self._last_update is None or
+                    time.monotonic() - self._last_update >=
+                    CONF.vmware.datastore_inventory_max_age):
+                try:
+                    self._update(session)
+                except vexc.ManagedObjectNotFoundException:
+                    # the property collector lives in the session, so it's
+                    # gone after a re-login
+                    LOG.debug("Datastore property collector vanished. Doing "
+                              "a full resync.")
+                    self.reset(session)
+                    self._update(session)
+
+            return [CachedObjectContent(
+                        obj=ref,
+                        propSet=[CachedProperty(name=name, val=val)
+                                 for name, val in props.items()])
+                    for ref, props in self._datastores.values()]
+
+    def reset(self, session):
+        """Forget everything, so the next update does a full resync"""
+        collector = self._collector
+        self._collector = None
+        self._version = ''
+        self._datastores = {}
+        self._last_update = None
+
+        if collector is None:
+            return
+
+        try:
+            session._call_method(session.vim, "DestroyPropertyCollector",
+                                 collector)
+        except Exception as e:
+            LOG.debug("Could not destroy datastore property collector %s: "
+                      "%s", vutil.get_moref_value(collector), e)
+
+    def _create_collector(self, session):
+        vim = session.vim
+        client_factory = vim.client.factory
+        self._collector = session._call_method(
+            vim, "CreatePropertyCollector",
+            vim.service_content.propertyCollector)
+        self._version = ''
+        self._datastores = {}
+
+        traversal_spec = vim_util.build_traversal_spec_from(
+            client_factory, self._container, "datastore")
+        object_spec = vutil.build_object_spec(client_factory,
+                                              self._container,
+                                              [traversal_spec])
+        object_spec.skip = True
+        property_spec = vutil.build_property_spec(client_factory,
+                                                  "Datastore",
+                                                  DATASTORE_PROPERTIES)
+        filter_spec = vutil.build_property_filter_spec(client_factory,
+                                                       [property_spec],
+                                                       [object_spec])
+        session._call_method(vim, "CreateFilter", self._collector,
+                             spec=filter_spec, partialUpdates=False)
+
+    def _update(self, session):
+        if self._collector is None:
+            self._create_collector(session)
+
+        vim = session.vim
+        options = vim.client.factory.create("ns0:WaitOptions")
+        options.maxWaitSeconds = 0
+        while True:
+            update_set = session._call_method(vim, "WaitForUpdatesEx",
+                                              self._collector,
+                                              version=self._version,
+                                              options=options)
+            if not update_set:
+                break
+
+            self._version = update_set.version
+            for filter_update in update_set.filterSet or []:
+                for update in filter_update.objectSet or []:
+                    self._apply_object_update(update)
+
+        self._last_update = time.monotonic()
+
+    def _apply_object_update(self, update):
+        ds_ref = update.obj
+        if vutil.get_moref_type(ds_ref) != "Datastore":
+            return
+
+        key = vutil.get_moref_value(ds_ref)
+        if update.kind == "leave":
+            self._datastores.pop(key, None)
+            return
+
+        _, props = self._datastores.setdefault(key, (ds_ref, {}))
+        for change in getattr(update, "changeSet", None) or []:
+            if change.op in ("remove", "indirectRemove"):
+                props.pop(change.name, None)
+            else:
+                props[change.name] = getattr(change, "val", None)
+            if change.name == "summary.freeSpace":
+                _datastore_space_updated(key)
+
+
+def _get_cached_datastores(session, container):
+    """Return the datastores of the container from the inventory cache
+
+    Returns None, if the cache is disabled or cannot be used, so the caller
+    has to fetch the datastores itself.
+    """
+    if (not CONF.vmware.use_property_collector or
+            CONF.vmware.datastore_inventory_max_age < 0):
+        return None
+
+    key = vutil.get_moref_value(container)
+    inventory = _DS_INVENTORIES.get(key)
+    if inventory is None:
+        inventory = _DS_INVENTORIES.setdefault(key,
+                                               DatastoreInventory(container))
+
+    try:
+        return inventory.get_datastores(session)
+    except Exception as e:
+        LOG.warning("Could not use the datastore inventory of %s: %s",
+                    key, e)
+        inventory.reset(session)
+        return None
+
+
+def ds_inventory_cache_reset():
+    global _DS_INVENTORIES
+    global _POLICY_MATCH_CACHE
+    global _DS_RESERVATIONS
+    _DS_INVENTORIES = {}
+    _POLICY_MATCH_CACHE = {}
+    _DS_RESERVATIONS = collections.defaultdict(dict)
+
 
 def _select_datastore(session, datastores, best_match, datastore_regex=None,
                       storage_policy=None,
@@ -86,9 +381,10 @@ def _select_datastore(session, datastores, best_match, datastore_regex=None,
                     name=propdict['summary.name'],
                     capacity=capacity,
                     freespace=min(freespace, capacity))
-            # favor datastores with more free space
+            # favor datastores with more free space not reserved, yet
             if (best_match is None or
-                    new_ds.freespace > best_match.freespace):
+                    _get_effective_freespace(new_ds) >
+                    _get_effective_freespace(best_match)):
                 best_match = new_ds
 
     return best_match
@@ -142,28 +438,22 @@ def get_datastore(session, cluster, datastore_regex=None,
                   storage_policy=None,
                   allowed_ds_types=ALL_SUPPORTED_DS_TYPES,
                   datastore_hagroup_regex=None,
-                  datastore_hagroup=None):
-    """Get the datastore list and choose the most preferable one."""
-    datastore_ret = session._call_method(vutil,
-                                         "get_object_property",
-                                         cluster,
-                                         "datastore")
-    # If there are no datastores in the cluster then an exception is
-    # raised
-    if not datastore_ret:
-        raise exception.DatastoreNotFound()
-
-    datastore_mors = datastore_ret.ManagedObjectReference
-    result = session._call_method(vim_util,
-                            "get_properties_for_a_collection_of_objects",
-                            "Datastore", datastore_mors,
-                            ["summary.type", "summary.name",
-                             "summary.capacity", "summary.freeSpace",
-                             "summary.accessible",
-                             "summary.maintenanceMode"])
+                  datastore_hagroup=None,
+                  reservation_key=None,
+                  reservation_size=0):
+    """Get the datastore list and choose the most preferable one.
 
+    If `reservation_key` is given, `reservation_size` bytes get reserved on
+    the chosen datastore until release_datastore_space() is called.
+    """
     best_match = None
-    with vutil.WithRetrieval(session.vim, result) as datastores:
+    datastores = _get_cached_datastores(session, cluster)
+    if datastores is not None:
+        # If there are no datastores in the cluster then an exception is
+        # raised
+        if not datastores:
+            raise exception.DatastoreNotFound()
+
         best_match = _select_datastore(session,
                                        datastores,
                                        best_match,
@@ -172,7 +462,37 @@ def get_datastore(session, cluster, datastore_regex=None,
                                        allowed_ds_types,
                                        datastore_hagroup_regex,
                                        datastore_hagroup)
+    else:
+        datastore_ret = session._call_method(vutil,
+                                             "get_object_property",
+                                             cluster,
+                                             "datastore")
+        # If there are no datastores in the cluster then an exception is
+        # raised
+        if not datastore_ret:
+            raise exception.DatastoreNotFound()
+
+        datastore_mors = datastore_ret.ManagedObjectReference
+        read_at = time.monotonic()
+        result = session._call_method(vim_util,
+                                "get_properties_for_a_collection_of_objects",
+                                "Datastore", datastore_mors,
+                                DATASTORE_PROPERTIES)
+
+        with vutil.WithRetrieval(session.vim, result) as datastores:
+            best_match = _select_datastore(session,
+                                           _read_datastores_space(datastores,
+                                                                  read_at),
+                                           best_match,
+                                           datastore_regex,
+                                           storage_policy,
+                                           allowed_ds_types,
+                                           datastore_hagroup_regex,
+                                           datastore_hagroup)
     if best_match:
+        if reservation_key is not None:
+            reserve_datastore_space(best_match.ref, reservation_key,
+                                    reservation_size)
         return best_match
 
     if storage_policy:
@@ -210,6 +530,12 @@ def _get_allowed_datastores(datastores, datastore_regex):
 def get_available_datastores(session, cluster=None,
                              datastore_regex=None, dc_ref=None):
     """Get the datastore list and choose the first local storage."""
+    container = cluster or dc_ref
+    if container:
+        datastores = _get_cached_datastores(session, container)
+        if datastores is not None:
+            return list(_get_allowed_datastores(datastores, datastore_regex))
+
     if cluster:
         ds = session._call_method(vutil,
                                   "get_object_property",
@@ -230,9 +556,7 @@ def get_available_datastores(session, cluster=None,
     result = session._call_method(vim_util,
             "get_properties_for_a_collection_of_objects",
             "Datastore", datastore_mors,
-            ["summary.type", "summary.name", "summary.accessible",
-             "summary.maintenanceMode", "summary.capacity",
-             "summary.freeSpace"])
+            DATASTORE_PROPERTIES)
 
     with vutil.WithRetrieval(session.vim, result) as datastores:
         return list(_get_allowed_datastores(datastores, datastore_regex))
@@ -477,28 +801,37 @@ def _filter_datastores_matching_storage_policy(session, datastores,
     :param storage_policy: the storage policy name
     :return: an iterator to datastores conforming to the given storage policy
     """
-    profile_id = pbm.get_profile_id_by_name(session, storage_policy)
-    if not profile_id:
-        LOG.error("Unable to retrieve storage policy with name %s",
-                  storage_policy)
-        return
-
-    factory = session.pbm.client.factory
-
     # The hub-id is the moref-value of the datastore
     ds_mors = []
     ref_to_oc = {}
     for oc in datastores:
         ds_mors.append(oc.obj)
-        ref_to_oc[vim_util.get_moref_value(oc.obj)] = oc
+        ref_to_oc[vutil.get_moref_value(oc.obj)] = oc
 
-    hubs = pbm.convert_datastores_to_hubs(factory, ds_mors)
-    matching_hubs = pbm.filter_hubs_by_profile(session, hubs,
-                                                profile_id)
+    cache_key = (storage_policy, frozenset(ref_to_oc))
+    cached = _POLICY_MATCH_CACHE.get(cache_key)
+    ttl = CONF.vmware.datastore_policy_cache_ttl
+    if cached is not None and time.monotonic() - cached[0] < ttl:
+        matching_hub_ids = cached[1]
+    else:
+        profile_id = pbm.get_profile_id_by_name(session, storage_policy)
+        if not profile_id:
+            LOG.error("Unable to retrieve storage policy with name %s",
+                      storage_policy)
+            return
+
+        factory = session.pbm.client.factory
+        hubs = pbm.convert_datastores_to_hubs(factory, ds_mors)
+        matching_hubs = pbm.filter_hubs_by_profile(session, hubs,
+                                                    profile_id)
+        matching_hub_ids = [hub.hubId for hub in matching_hubs]
+        if ttl:
+            _POLICY_MATCH_CACHE[cache_key] = (time.monotonic(),
+                                              matching_hub_ids)
 
     # Now we have to map back all the matching ones
-    for hub in matching_hubs:
-        yield ref_to_oc[hub.hubId]
+    for hub_id in matching_hub_ids:
+        yield ref_to_oc[hub_id]
 
 
 def _update_datacenter_cache_from_objects(session, dcs):
@@ -66,6 +66,14 @@ class VCState(object):
         self._cluster = cluster
         self._datastore_regex = datastore_regex
         self._stats = {}
+        # Keeps the cpu_info of the hosts between updates
+        self._host_cpu_info_cache = {}
+        # The per-host stats of the last update and the defaults they have
+        # been merged with, to only merge the stats of changed hosts
+        self._per_host_stats = {}
+        self._defaults = None
+        self._aggregate_config = None
+        self._cluster_stats = None
         ctx = context.get_admin_context()
         try:
             service = objects.Service.get_by_compute_host(ctx, CONF.host)
@@ -88,6 +96,14 @@ class VCState(object):
             self.update_status()
         return self._stats
 
+    def get_per_host_stats(self, refresh=False):
+        """Return the stats of the cluster's hosts by their mo-ref value as
+        of the last update. If 'refresh' is True, run the update first.
+        """
+        if refresh or not self._per_host_stats:
+            self.update_status()
+        return self._per_host_stats
+
     def update_status(self):
         """Update the current state of the cluster."""
         data = {}
@@ -97,7 +113,8 @@ class VCState(object):
 
             # Get cpu, memory stats from the cluster
             per_host_stats = vm_util.get_stats_from_cluster_per_host(
-                self._session, self._cluster)
+                self._session, self._cluster,
+                cpu_info_cache=self._host_cpu_info_cache)
         except (vexc.VimConnectionException, vexc.VimAttributeException) as ex:
             # VimAttributeException is thrown when vpxd service is down
             LOG.warning("Failed to connect with %(node)s. "
@@ -124,15 +141,46 @@ class VCState(object):
             "numa_topology": None,
         }
 
+        defaults_changed = defaults != self._defaults
+        changed_hosts = 0
         for host_ref_value, info in per_host_stats.items():
-            data[info["name"]] = self._merge_stats(info["name"], info,
-                                                   defaults)
-        cluster_stats = vm_util.aggregate_stats_from_cluster(per_host_stats)
-        cluster_stats["hypervisor_type"] = self._hypervisor_type
-        cluster_stats["hypervisor_version"] = self._hypervisor_version
-        data[self._cluster_node_name] = self._merge_stats(
-            self._cluster_node_name, cluster_stats, defaults)
-
+            name = info["name"]
+            if (not defaults_changed and name in self._stats and
+                    self._per_host_stats.get(host_ref_value) == info):
+                data[name] = self._stats[name]
+                continue
+            changed_hosts += 1
+            data[name] = self._merge_stats(name, info, defaults)
+
+        # The cluster stats only need to be aggregated again, if any host
+        # changed or went away or the config they depend on changed
+        aggregate_config = (
+            CONF.vmware.memory_reservation_cluster_hosts_max_fail,
+            CONF.vmware.memory_reservation_max_ratio_fallback)
+        cluster_stats = self._cluster_stats
+        if (changed_hosts or cluster_stats is None or
+                len(per_host_stats) != len(self._per_host_stats) or
+                aggregate_config != self._aggregate_config):
+            cluster_stats = vm_util.aggregate_stats_from_cluster(
+                per_host_stats)
+            cluster_stats["hypervisor_type"] = self._hypervisor_type
+            cluster_stats["hypervisor_version"] = self._hypervisor_version
+        if (cluster_stats is not self._cluster_stats or defaults_changed or
+                self._cluster_node_name not in self._stats):
+            data[self._cluster_node_name] = self._merge_stats(
+                self._cluster_node_name, cluster_stats, defaults)
+        else:
+            data[self._cluster_node_name] = \
+                self._stats[self._cluster_node_name]
+        LOG.debug("Updated the stats of %(changed)d out of %(total)d hosts "
+                  "of %(node)s",
+                  {'changed': changed_hosts, 'total': len(per_host_stats),
+                   'node': self._cluster_node_name})
+
+        self._per_host_stats = per_host_stats
+        self._defaults = defaults
+        self._aggregate_config = aggregate_config
+        self._cluster_stats = cluster_stats
         self._stats = data
         if self._auto_service_disabled:
             self._set_host_enabled(True)
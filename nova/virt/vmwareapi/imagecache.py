@@ -33,8 +33,15 @@ When accessing a timestamp we make use of locking. This ensure that aging
 will not delete an image during the spawn operation. When spawning
 the timestamp folder will be locked  and the timestamps will be purged.
 This will ensure that an image is not deleted during the spawn.
+
+Next to the datastore folders, the manager keeps an in-memory index of the
+image-template VMs. It is filled from the periodic template listing and
+updated whenever a template is created or aged, so spawn can look at the
+datastores known to hold a template of an image first.
 """
 
+import collections
+
 from oslo_concurrency import lockutils
 from oslo_config import cfg
 from oslo_log import log as logging
@@ -52,6 +59,12 @@ CONF = cfg.CONF
 TIMESTAMP_PREFIX = 'ts-'
 TIMESTAMP_FORMAT = '%Y-%m-%d-%H-%M-%S'
 
+# What's needed to choose a datastore for the image-template VM of a booted
+# image and to clone it there
+ImageBootInfo = collections.namedtuple('ImageBootInfo',
+                                       ['image_id', 'owner', 'root_gb',
+                                        'disk_type', 'storage_policy'])
+
 
 class ImageCacheManager(imagecache.ImageCacheManager):
     def __init__(self, session, base_folder):
@@ -59,6 +72,76 @@ class ImageCacheManager(imagecache.ImageCacheManager):
         self._session = session
         self._base_folder = base_folder
         self._ds_browser = {}
+        # image_id -> {datastore name: image-template VM moref}
+        self._image_templates = collections.defaultdict(dict)
+        self._image_templates_populated = False
+        # image_id -> number of recent boots from an image-template VM
+        self._image_boots = collections.Counter()
+        # image_id -> ImageBootInfo of the latest boot of the image
+        self._image_boot_infos = {}
+
+    def add_image_template(self, image_id, ds_name, templ_vm_ref):
+        """Record the image-template VM of the image on the datastore."""
+        self._image_templates[image_id][ds_name] = templ_vm_ref
+
+    def remove_image_template(self, image_id, ds_name):
+        """Record that the image has no image-template VM on the datastore."""
+        templates = self._image_templates.get(image_id)
+        if templates is None:
+            return
+        templates.pop(ds_name, None)
+        if not templates:
+            del self._image_templates[image_id]
+
+    def get_image_template(self, image_id, ds_name):
+        """Return the known image-template VM moref or None."""
+        templates = self._image_templates.get(image_id)
+        if templates is None:
+            return None
+        return templates.get(ds_name)
+
+    def get_image_template_datastores(self, image_id):
+        """Return a dict of datastore name to image-template VM moref."""
+        return dict(self._image_templates.get(image_id, {}))
+
+    def set_image_templates(self, templates):
+        """Replace all known image-template VMs.
+
+        :param templates: iterable of (image_id, ds_name, templ_vm_ref)
+        """
+        image_templates = collections.defaultdict(dict)
+        for image_id, ds_name, templ_vm_ref in templates:
+            image_templates[image_id][ds_name] = templ_vm_ref
+        self._image_templates = image_templates
+        self._image_templates_populated = True
+
+    @property
+    def image_templates_populated(self):
+        return self._image_templates_populated
+
+    def record_image_boot(self, image_id, boot_info):
+        """Count a boot of the image from an image-template VM.
+
+        :param boot_info: the ImageBootInfo needed to create the
+                          image-template VM again later
+        """
+        self._image_boots[image_id] += 1
+        self._image_boot_infos[image_id] = boot_info
+
+    def get_hot_images(self, count):
+        """Return the ImageBootInfos of the `count` most booted images.
+
+        The boot counts are halved with every call, so images not booted
+        anymore drop out of the list over time.
+        """
+        hot_images = [self._image_boot_infos[image_id]
+                      for image_id, _ in self._image_boots.most_common(count)]
+        for image_id in list(self._image_boots):
+            self._image_boots[image_id] //= 2
+            if not self._image_boots[image_id]:
+                del self._image_boots[image_id]
+                del self._image_boot_infos[image_id]
+        return hot_images
 
     def _folder_delete(self, ds_path, dc_ref):
         try:
@@ -17,9 +17,11 @@
 Utility functions for Image transfer and manipulation.
 """
 
+import eventlet.queue
 from lxml import etree
 import os
 import tarfile
+import time
 
 from oslo_config import cfg
 from oslo_log import log as logging
@@ -36,6 +38,7 @@ from nova import exception
 from nova.i18n import _
 from nova.image import glance
 from nova.objects import fields
+from nova import utils
 from nova.virt.vmwareapi import constants
 from nova.virt.vmwareapi import vm_util
 
@@ -51,7 +54,7 @@ IMAGE_API = glance.API()
 
 QUEUE_BUFFER_SIZE = 10
 NFC_LEASE_UPDATE_PERIOD = 60  # update NFC lease every 60sec.
-CHUNK_SIZE = 64 * units.Ki  # default chunk size for image transfer
+IMAGE_TRANSFER_PROGRESS_INTERVAL = 30  # log transfer progress every 30sec.
 
 # VMDK images having this size are considered invalid/incomplete downloads
 INVALID_VMDK_SIZE = 4096000
@@ -214,19 +217,105 @@ def get_vsphere_location(context, image_id):
     return None
 
 
-def image_transfer(read_handle, write_handle):
+class _TransferProgress(object):
+    """Keeps track of the progress of an image transfer and logs it"""
+
+    def __init__(self, file_size=None):
+        self.file_size = file_size
+        self.bytes_transferred = 0
+        self._start = time.monotonic()
+        self._last_report = self._start
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self._start
+
+    @property
+    def throughput(self):
+        """Return the average throughput in bytes per second"""
+        elapsed = self.elapsed
+        if not elapsed:
+            return 0
+        return self.bytes_transferred / elapsed
+
+    def add(self, size):
+        self.bytes_transferred += size
+        now = time.monotonic()
+        if now - self._last_report >= IMAGE_TRANSFER_PROGRESS_INTERVAL:
+            self._last_report = now
+            self.report()
+
+    def report(self, done=False):
+        if done:
+            msg = "Transferred %(transferred)d bytes in %(elapsed).1fs"
+        else:
+            msg = "Transferred %(transferred)d bytes so far"
+        if self.file_size:
+            msg += " (%(percent)d%% of %(size)d bytes)"
+        msg += ", %(throughput).2f MiB/s"
+        LOG.debug(msg, {
+            'transferred': self.bytes_transferred,
+            'elapsed': self.elapsed,
+            'size': self.file_size,
+            'percent': self.bytes_transferred * 100 // (self.file_size or 1),
+            'throughput': self.throughput / units.Mi})
+
+
+def _read_ahead(read_handle, buffers, chunk_size):
+    """Read chunks from the handle into the buffer queue
+
+    Blocks if all buffers are full, so the reader can only get ahead of the
+    writer by the number of buffers. The end of the data is signalled by
+    putting an empty chunk and errors are passed on to the writer.
+    """
+    try:
+        while True:
+            data = read_handle.read(chunk_size)
+            buffers.put(data)
+            if not data:
+                break
+    except Exception as e:
+        buffers.put(e)
+
+
+def image_transfer(read_handle, write_handle, file_size=None):
+    """Transfer all data from the read handle to the write handle
+
+    If [vmware]image_transfer_read_ahead_buffers is set, reading happens in a
+    separate green thread, so reading from the source and writing to the
+    destination overlap. The reader is at most that many chunks ahead.
+    """
     # write_handle could be an NFC lease, so we need to periodically
     # update its progress
     update_cb = getattr(write_handle, 'update_progress', lambda: None)
     updater = loopingcall.FixedIntervalLoopingCall(update_cb)
+    chunk_size = CONF.vmware.image_transfer_chunk_size_kb * units.Ki
+    buffer_count = CONF.vmware.image_transfer_read_ahead_buffers
+    progress = _TransferProgress(file_size)
+    reader = None
     try:
         updater.start(interval=NFC_LEASE_UPDATE_PERIOD)
+        if buffer_count:
+            buffers = eventlet.queue.LightQueue(maxsize=buffer_count)
+            reader = utils.spawn(_read_ahead, read_handle, buffers,
+                                 chunk_size)
+            read = buffers.get
+        else:
+            def read():
+                return read_handle.read(chunk_size)
+
         while True:
-            data = read_handle.read(CHUNK_SIZE)
+            data = read()
+            if isinstance(data, Exception):
+                raise data
             if not data:
                 break
             write_handle.write(data)
+            progress.add(len(data))
+        progress.report(done=True)
     finally:
+        if reader is not None:
+            reader.kill()
         updater.stop()
         read_handle.close()
         write_handle.close()
@@ -274,7 +363,7 @@ def fetch_image(context, instance, host, port, dc_name, ds_name, file_path,
     read_file_handle = rw_handles.ImageReadHandle(read_iter)
     write_file_handle = rw_handles.FileWriteHandle(
         host, port, dc_name, ds_name, cookies, file_path, file_size)
-    image_transfer(read_file_handle, write_file_handle)
+    image_transfer(read_file_handle, write_file_handle, file_size=file_size)
     LOG.debug("Downloaded image file data %(image_ref)s to "
               "%(upload_name)s on the data store "
               "%(data_store_name)s",
@@ -426,7 +515,7 @@ def _import_image(session, read_handle, vm_import_spec, vm_name, vm_folder_ref,
                                                       vm_folder_ref,
                                                       vm_import_spec,
                                                       file_size)
-            image_transfer(read_handle, write_handle)
+            image_transfer(read_handle, write_handle, file_size=file_size)
             imported_vm_ref = write_handle.get_imported_vm()
 
             break
@@ -0,0 +1,175 @@
+# Copyright (c) 2026 SAP SE
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+A local model of a vCenter cluster answering placement questions in memory
+instead of asking vCenter/DRS for every decision.
+"""
+from oslo_log import log as logging
+from oslo_vmware import vim_util as vutil
+
+from nova.virt.vmwareapi import cluster_util
+
+LOG = logging.getLogger(__name__)
+
+
+class ClusterPlacementModel(object):
+    """Models the hosts of a cluster with their free memory and the
+    mandatory VM-host rules applying to them.
+
+    The model is built from the per-host stats as returned by
+    vm_util.get_stats_from_cluster_per_host() and optionally the host groups
+    and rules of the cluster as returned by cluster_util.fetch_cluster_groups()
+    and cluster_util.fetch_cluster_rules(). It does not talk to the vCenter
+    by itself, so the caller decides how current its inputs need to be.
+    """
+
+    def __init__(self, host_stats, host_groups=None, rules=None):
+        self._hosts = {}
+        for host_ref_value, info in host_stats.items():
+            self._hosts[host_ref_value] = {
+                'name': info['name'],
+                'available': info['available'],
+                # memory_mb_reserved is not taken into account, as the
+                # reservations are for VMs we still have to place.
+                'memory_mb_free': info['memory_mb'] - info['memory_mb_used'],
+            }
+
+        self._host_groups = {
+            name: set(vutil.get_moref_value(h)
+                      for h in getattr(group, 'host', None) or [])
+            for name, group in (host_groups or {}).items()}
+
+        # only enabled, mandatory VM-host rules restrict the placement. DRS
+        # may violate the other ones.
+        self._vm_host_rules = {}
+        for rule in (rules or {}).values():
+            vm_group_name = getattr(rule, 'vmGroupName', None)
+            if not vm_group_name:
+                continue
+            if not (getattr(rule, 'enabled', False) and
+                    getattr(rule, 'mandatory', False)):
+                continue
+            affine = getattr(rule, 'affineHostGroupName', None)
+            anti_affine = getattr(rule, 'antiAffineHostGroupName', None)
+            if affine:
+                self._vm_host_rules.setdefault(vm_group_name, []).append(
+                    (affine, True))
+            if anti_affine:
+                self._vm_host_rules.setdefault(vm_group_name, []).append(
+                    (anti_affine, False))
+
+    @classmethod
+    def from_cluster_config(cls, session, host_stats, cluster_config):
+        """Build the model from the given per-host stats and the host groups
+        and rules in the given configurationEx of the cluster
+        """
+        host_groups = cluster_util.fetch_cluster_groups(
+            session, cluster_config=cluster_config, group_type='host')
+        rules = cluster_util.fetch_cluster_rules(
+            session, cluster_config=cluster_config)
+        return cls(host_stats, host_groups=host_groups, rules=rules)
+
+    def get_memory_mb_free(self, host_ref_value):
+        return self._hosts[host_ref_value]['memory_mb_free']
+
+    def _is_allowed(self, host_ref_value, vm_group_name):
+        for host_group_name, affine in self._vm_host_rules.get(
+                vm_group_name, []):
+            in_group = host_ref_value in self._host_groups.get(
+                host_group_name, set())
+            if in_group != affine:
+                return False
+        return True
+
+    def fits(self, host_ref_value, memory_mb, vm_group_name=None):
+        """Return if a VM with the given memory can run on the given host
+
+        The host has to be available, have enough free memory and must not
+        be excluded by a mandatory rule for the given VM group.
+        """
+        host = self._hosts.get(host_ref_value)
+        if host is None or not host['available']:
+            return False
+        if host['memory_mb_free'] < memory_mb:
+            return False
+        return self._is_allowed(host_ref_value, vm_group_name)
+
+    def get_candidate_hosts(self, memory_mb, vm_group_name=None):
+        """Return the moref values of all hosts the VM fits onto"""
+        return [h for h in self._hosts
+                if self.fits(h, memory_mb, vm_group_name=vm_group_name)]
+
+    def select_host(self, memory_mb, vm_group_name=None, stack=False):
+        """Return the moref value of the host a VM would land on or None
+
+        With stack=True, the fullest host still fitting the VM is chosen.
+        Otherwise, we choose the host with the most free memory like DRS
+        does on initial placement in an otherwise balanced cluster. Hosts
+        with the same amount of free memory are chosen in the order they
+        were given to the model.
+        """
+        candidates = self.get_candidate_hosts(memory_mb,
+                                              vm_group_name=vm_group_name)
+        if not candidates:
+            LOG.debug("No host fits a VM with %(memory_mb)s MiB. Free memory "
+                      "per host: %(hosts)s",
+                      {'memory_mb': memory_mb,
+                       'hosts': [(h['name'], h['memory_mb_free'])
+                                 for h in self._hosts.values()
+                                 if h['available']]})
+            return None
+
+        if stack:
+            return min(candidates, key=self.get_memory_mb_free)
+        return max(candidates, key=self.get_memory_mb_free)
+
+    def add_vm(self, host_ref_value, memory_mb):
+        """Account for a VM placed onto the given host
+
+        Subsequent decisions of the model take the consumed memory into
+        account. Hosts unknown to the model are ignored.
+        """
+        host = self._hosts.get(host_ref_value)
+        if host is not None:
+            host['memory_mb_free'] -= memory_mb
+
+
+def compare_with_recommendations(model, recorded, stack=False):
+    """Compare the decisions of the model with recorded DRS recommendations
+
+    `recorded` is an iterable of dicts with the `memory_mb` of a VM, the
+    optional `vm_group_name` and the moref value of the `host` DRS
+    recommended or None, if DRS did not find a host. The VMs are placed in
+    order, so every VM consumes the memory on the host DRS recommended.
+
+    Returns a dict with the number of `total` and `matched` decisions and a
+    list of `mismatches` as (recorded entry, host chosen by the model).
+    """
+    result = {'total': 0, 'matched': 0, 'mismatches': []}
+    for entry in recorded:
+        host = model.select_host(entry['memory_mb'],
+                                 vm_group_name=entry.get('vm_group_name'),
+                                 stack=stack)
+        result['total'] += 1
+        if host == entry['host']:
+            result['matched'] += 1
+        else:
+            result['mismatches'].append((entry, host))
+
+        if entry['host'] is not None:
+            model.add_vm(entry['host'], entry['memory_mb'])
+
+    return result
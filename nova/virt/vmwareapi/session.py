@@ -16,17 +16,24 @@
 #    under the License.
 
 import abc
+import contextlib
 import itertools
-import six
+import threading
+import time
 
+from eventlet import event
+from eventlet import semaphore
 from oslo_log import log as logging
 from oslo_utils import excutils
 from oslo_vmware import api
 from oslo_vmware import exceptions as vexc
 from oslo_vmware import vim
+from oslo_vmware import vim_util as vutil
 from oslo_vmware.vim_util import get_moref_value
+import six
 
 import nova.conf
+from nova import utils
 
 CONF = nova.conf.CONF
 LOG = logging.getLogger(__name__)
@@ -83,10 +90,258 @@ class MoRef(StableMoRefProxy):
         return "MoRef({!r})".format(self.moref)
 
 
+class _PendingTask(object):
+    """A task somebody waits for through the TaskWaiter"""
+    def __init__(self, task):
+        self.task = task
+        self.filter = None
+        self.event = event.Event()
+
+
+class TaskWaiter(object):
+    """Waits for vCenter tasks through a single property collector
+
+    Instead of polling the info of each task separately, all tasks waited
+    for get registered with a shared property collector. One green thread
+    waits for updates of all of them and wakes up the waiting thread as soon
+    as its task is done.
+
+    :meth:`wait` returns None if the task cannot be waited for this way, so
+    the caller can fall back to polling the task.
+    """
+    DONE_STATES = ('success', 'error')
+
+    def __init__(self, session):
+        self._session = session
+        self._collector = None
+        self._version = ''
+        self._pending = {}
+        self._thread = None
+
+    def wait(self, task):
+        """Return the info of the finished task
+
+        Raises the translated fault, if the task failed, and returns None, if
+        the caller needs to poll the task instead.
+        """
+        try:
+            pending = self._register(task)
+        except Exception as e:
+            LOG.debug("Cannot wait for task %s through the property "
+                      "collector, polling it instead: %s",
+                      get_moref_value(task), e)
+            return None
+
+        try:
+            task_info = self._wait_for_pending(pending)
+        finally:
+            self._unregister(pending)
+
+        if task_info is None:
+            return None
+        if task_info.state == 'success':
+            LOG.debug("Task: %s completed successfully.",
+                      get_moref_value(task))
+            return task_info
+        raise vexc.translate_fault(task_info.error)
+
+    def _wait_for_pending(self, pending):
+        # we should never miss an update, but as the property collector lives
+        # and dies with the session, we'd rather check the task ourselves
+        # once in a while than waiting forever
+        timeout = 2 * CONF.vmware.property_collector_max_wait_seconds
+        while True:
+            task_info = pending.event.wait(timeout)
+            if task_info is not None:
+                return task_info
+            if pending.event.ready():
+                # the collector gave up on us
+                return None
+            task_info = self._session._call_method(
+                vutil, "get_object_property", pending.task, "info")
+            if task_info.state in self.DONE_STATES:
+                return task_info
+
+    def _register(self, task):
+        if self._collector is None:
+            vim = self._session.vim
+            self._collector = self._session._call_method(
+                vim, "CreatePropertyCollector",
+                vim.service_content.propertyCollector)
+            self._version = ''
+
+        collector = self._collector
+        pending = _PendingTask(task)
+        self._pending[get_moref_value(task)] = pending
+        try:
+            client_factory = self._session.vim.client.factory
+            property_spec = vutil.build_property_spec(
+                client_factory, type_='Task', properties_to_collect=['info'])
+            object_spec = vutil.build_object_spec(client_factory, task, [])
+            filter_spec = vutil.build_property_filter_spec(
+                client_factory, [property_spec], [object_spec])
+            pending.filter = self._session._call_method(
+                self._session.vim, "CreateFilter", collector,
+                spec=filter_spec, partialUpdates=False)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                self._pending.pop(get_moref_value(task), None)
+
+        if self._thread is None:
+            self._thread = utils.spawn(self._wait_for_updates)
+        return pending
+
+    def _unregister(self, pending):
+        key = get_moref_value(pending.task)
+        if self._pending.get(key) is pending:
+            del self._pending[key]
+        if pending.filter is None:
+            return
+        try:
+            self._session._call_method(self._session.vim,
+                                       "DestroyPropertyFilter", pending.filter)
+        except Exception as e:
+            # the filter is gone with the collector or session it belonged to
+            LOG.debug("Could not destroy property filter %s: %s",
+                      get_moref_value(pending.filter), e)
+
+    def _wait_for_updates(self):
+        vim = self._session.vim
+        options = vim.client.factory.create("ns0:WaitOptions")
+        options.maxWaitSeconds = \
+            CONF.vmware.property_collector_max_wait_seconds
+        try:
+            while self._pending:
+                update_set = self._session._call_method(
+                    vim, "WaitForUpdatesEx", self._collector,
+                    version=self._version, options=options)
+                if not update_set:
+                    continue
+                self._version = update_set.version
+                for filter_set in update_set.filterSet or []:
+                    for object_update in filter_set.objectSet or []:
+                        self._apply_object_update(object_update)
+        except Exception as e:
+            LOG.warning("Waiting for task updates failed, falling back to "
+                        "polling: %s", e)
+            # a new waiter may start a new thread while we clean up
+            self._thread = None
+            self._reset()
+        else:
+            self._thread = None
+
+    def _apply_object_update(self, object_update):
+        pending = self._pending.get(get_moref_value(object_update.obj))
+        if pending is None or pending.event.ready():
+            return
+        for change in object_update.changeSet or []:
+            if change.name != 'info':
+                continue
+            task_info = getattr(change, 'val', None)
+            if task_info is not None and task_info.state in self.DONE_STATES:
+                del self._pending[get_moref_value(object_update.obj)]
+                pending.event.send(task_info)
+
+    def _reset(self):
+        """Forget the collector and let all waiters poll their tasks"""
+        collector = self._collector
+        pending_tasks = list(self._pending.values())
+        self._collector = None
+        self._version = ''
+        self._pending = {}
+        for pending in pending_tasks:
+            # the filters die with the collector
+            pending.filter = None
+            if not pending.event.ready():
+                pending.event.send(None)
+
+        if collector is None:
+            return
+        try:
+            self._session._call_method(self._session.vim,
+                                       "DestroyPropertyCollector", collector)
+        except Exception as e:
+            LOG.debug("Could not destroy property collector %s: %s",
+                      get_moref_value(collector), e)
+
+
+class SessionLane(object):
+    """Limits the number of concurrent API calls of one class of operations
+
+    Waiting callers and call durations are counted, so the queue-depth of
+    each lane can be reported by :meth:`VMwareAPISession.get_lane_stats`.
+    A concurrency of 0 means unlimited.
+    """
+    def __init__(self, name, concurrency):
+        self.name = name
+        self.concurrency = concurrency
+        self._semaphore = (semaphore.Semaphore(concurrency)
+                           if concurrency else None)
+        self.active = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.calls = 0
+        self.wait_time = 0.0
+
+    @contextlib.contextmanager
+    def acquire(self, method):
+        if self._semaphore is not None and self._semaphore.locked():
+            self.waiting += 1
+            self.max_waiting = max(self.max_waiting, self.waiting)
+            LOG.debug("Call to %(method)s waits in %(lane)s lane with "
+                      "%(waiting)d other calls waiting",
+                      {'method': method, 'lane': self.name,
+                       'waiting': self.waiting - 1})
+            start = time.monotonic()
+            try:
+                self._semaphore.acquire()
+            finally:
+                self.waiting -= 1
+                self.wait_time += time.monotonic() - start
+        elif self._semaphore is not None:
+            self._semaphore.acquire()
+
+        self.active += 1
+        self.calls += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            if self._semaphore is not None:
+                self._semaphore.release()
+
+    def get_stats(self):
+        return {'concurrency': self.concurrency,
+                'active': self.active,
+                'waiting': self.waiting,
+                'max_waiting': self.max_waiting,
+                'calls': self.calls,
+                'wait_time': self.wait_time}
+
+
 class VMwareAPISession(api.VMwareAPISession):
     """Sets up a session with the VC/ESX host and handles all
     the calls made to the host.
+
+    API calls are sorted into lanes by the kind of operation, each with its
+    own concurrency limit, so heavy operations like clones or imports cannot
+    use up all connections needed for cheap reads of properties.
     """
+    LANE_READ = 'read'
+    LANE_RECONFIGURE = 'reconfigure'
+    LANE_TRANSFER = 'transfer'
+    LANE_POLL = 'poll'
+
+    # operations keeping the vCenter busy moving data around. All other tasks
+    # are "reconfigure" operations and everything else is a "read".
+    TRANSFER_METHODS = frozenset(['CloneVM_Task', 'RelocateVM_Task',
+                                  'MigrateVM_Task', 'InstantClone_Task',
+                                  'ImportVApp', 'ExportVm'])
+    # long polls waiting for property-collector updates, e.g. of the task
+    # waiter or the VM cache. They would hold a read slot for their whole
+    # timeout, so they get their own lane without a limit.
+    POLL_METHODS = frozenset(['WaitForUpdatesEx', 'WaitForUpdates'])
+
     def __init__(self, host_ip=CONF.vmware.host_ip,
                  host_port=CONF.vmware.host_port,
                  username=CONF.vmware.host_username,
@@ -96,6 +351,18 @@ class VMwareAPISession(api.VMwareAPISession):
                  cacert=CONF.vmware.ca_file,
                  insecure=CONF.vmware.insecure,
                  pool_size=CONF.vmware.connection_pool_size):
+        self._task_waiter = TaskWaiter(self)
+        self._lane_local = threading.local()
+        self._lanes = {
+            self.LANE_READ: SessionLane(
+                self.LANE_READ, CONF.vmware.session_read_concurrency),
+            self.LANE_RECONFIGURE: SessionLane(
+                self.LANE_RECONFIGURE,
+                CONF.vmware.session_reconfigure_concurrency),
+            self.LANE_TRANSFER: SessionLane(
+                self.LANE_TRANSFER, CONF.vmware.session_transfer_concurrency),
+            self.LANE_POLL: SessionLane(self.LANE_POLL, 0),
+        }
         super(VMwareAPISession, self).__init__(
                 host=host_ip,
                 port=host_port,
@@ -114,10 +381,39 @@ class VMwareAPISession(api.VMwareAPISession):
         """Check if the module is a VIM Object instance."""
         return isinstance(module, vim.Vim)
 
+    @classmethod
+    def _get_lane_name(cls, method):
+        if method in cls.TRANSFER_METHODS:
+            return cls.LANE_TRANSFER
+        if method in cls.POLL_METHODS:
+            return cls.LANE_POLL
+        if str(method).endswith('_Task'):
+            return cls.LANE_RECONFIGURE
+        return cls.LANE_READ
+
+    def get_lane_stats(self):
+        """Return the concurrency and queue-depth statistics per lane"""
+        return {name: lane.get_stats() for name, lane in self._lanes.items()}
+
     def _call_method(self, module, method, *args, **kwargs):
         """Calls a method within the module specified with
         args provided.
         """
+        if getattr(self._lane_local, 'lane', None) is not None:
+            # nested calls, e.g. for recovering a moref, must not wait for
+            # another slot while holding one already
+            return self._call_method_in_lane(module, method, *args, **kwargs)
+
+        lane = self._lanes[self._get_lane_name(method)]
+        with lane.acquire(method):
+            self._lane_local.lane = lane.name
+            try:
+                return self._call_method_in_lane(module, method, *args,
+                                                 **kwargs)
+            finally:
+                self._lane_local.lane = None
+
+    def _call_method_in_lane(self, module, method, *args, **kwargs):
         try:
             if not self._is_vim_object(module):
                 return self.invoke_api(module, method, self.vim, *args,
@@ -149,7 +445,19 @@ class VMwareAPISession(api.VMwareAPISession):
         # We only end up here when we have recovered a moref by changing
         # the stored value of an argument to a different value,
         # so let's try again (and recover again if it happens more than once)
-        return self._call_method(module, method, *args, **kwargs)
+        return self._call_method_in_lane(module, method, *args, **kwargs)
+
+    def wait_for_task(self, task):
+        """Waits for the given task to complete and returns the result.
+
+        With `use_property_collector_for_tasks`, all tasks get waited for
+        through a single property collector and only polled, if that fails.
+        """
+        if CONF.vmware.use_property_collector_for_tasks:
+            task_info = self._task_waiter.wait(task)
+            if task_info is not None:
+                return task_info
+        return super(VMwareAPISession, self).wait_for_task(task)
 
     def _wait_for_task(self, task_ref):
         """Return a Deferred that will give the result of the given task.
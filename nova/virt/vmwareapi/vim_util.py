@@ -16,6 +16,7 @@
 """
 The VMware API utility module.
 """
+import eventlet
 from oslo_utils import excutils
 from oslo_vmware import exceptions as vexc
 from oslo_vmware import vim_util as vutil
@@ -85,6 +86,45 @@ def get_inner_objects(vim, base_obj, path, inner_type,
             specSet=[property_filter_spec], options=options)
 
 
+def build_traversal_spec_from(client_factory, obj, path):
+    """Builds a TraversalSpec following the given path of the object"""
+    return vutil.build_traversal_spec(client_factory, 'to_' + path,
+                                      vutil.get_moref_type(obj), path,
+                                      False, [])
+
+
+def get_cluster_inventory(vim, cluster, cluster_properties,
+                          host_properties, datastore_properties):
+    """Gets the properties of a cluster, its hosts and its datastores
+
+    All of them are retrieved in a single call by traversing from the cluster
+    to its hosts and datastores.
+    """
+    client_factory = vim.client.factory
+    traversal_specs = [
+        build_traversal_spec_from(client_factory, cluster, 'host'),
+        build_traversal_spec_from(client_factory, cluster, 'datastore'),
+    ]
+    object_spec = vutil.build_object_spec(client_factory, cluster,
+                                          traversal_specs)
+    property_specs = [
+        vutil.build_property_spec(client_factory,
+                                  vutil.get_moref_type(cluster),
+                                  cluster_properties),
+        vutil.build_property_spec(client_factory, 'HostSystem',
+                                  host_properties),
+        vutil.build_property_spec(client_factory, 'Datastore',
+                                  datastore_properties),
+    ]
+    property_filter_spec = vutil.build_property_filter_spec(client_factory,
+                                property_specs, [object_spec])
+    options = client_factory.create('ns0:RetrieveOptions')
+    options.maxObjects = CONF.vmware.maximum_objects
+    return vim.RetrievePropertiesEx(
+            vim.service_content.propertyCollector,
+            specSet=[property_filter_spec], options=options)
+
+
 def get_prop_spec(client_factory, spec_type, properties):
     """Builds the Property Spec Object."""
     prop_spec = client_factory.create('ns0:PropertySpec')
@@ -158,17 +198,34 @@ def get_object_property(session, mo_ref, property):
 
 
 class CustomField:
-    def __init__(self, session):
+    def __init__(self, session, cache_fields=False):
+        """If cache_fields is True, the list of CustomFieldDef is only
+        retrieved once and kept up to date with our own changes afterwards,
+        until invalidate() is called.
+        """
         self._session = session
         self._mgr = session.vim.service_content.customFieldsManager
+        self._cache_fields = cache_fields
+        self._fields = None
+
+    def invalidate(self):
+        """Drop the cached list of CustomFieldDef"""
+        self._fields = None
 
     def get_all(self):
         """Retrieve the list of CustomFieldDef"""
+        if self._fields is not None:
+            return self._fields
+
         fields = get_object_property(self._session, self._mgr, 'field')
         if not hasattr(fields, 'CustomFieldDef'):
-            return []
+            fields = []
+        else:
+            fields = fields.CustomFieldDef
 
-        return fields.CustomFieldDef
+        if self._cache_fields:
+            self._fields = list(fields)
+        return fields
 
     def get_by_obj_type(self, obj_type):
         """Retrieve the list of CustomFieldDef applicable to the given obj_type
@@ -195,7 +252,11 @@ class CustomField:
         try:
             field = self._session._call_method(self._session.vim,
                 "AddCustomFieldDef", self._mgr, name=name, moType=obj_type)
+            if self._fields is not None:
+                self._fields.append(field)
         except vexc.DuplicateName:
+            # someone else created it, so our cache is outdated
+            self.invalidate()
             field = self.get_by_name(name, obj_type=obj_type)
             if field is None:
                 # We raise an exception here instead of returning None, because
@@ -222,6 +283,9 @@ class CustomField:
                 if 'InvalidArgument' in e.fault_list:
                     ctx.reraise = False
 
+        if self._fields is not None:
+            self._fields = [f for f in self._fields if f.key != field.key]
+
     def get_values(self, moref):
         """Fetch a list of CustomFieldDef values for the given object
 
@@ -244,3 +308,17 @@ class CustomField:
         """
         self._session._call_method(self._session.vim, "SetField", self._mgr,
                                    entity=moref, key=key, value=value)
+
+    def set_values(self, moref, values, concurrency=1):
+        """Set the values for several CustomFieldDef of the given object
+
+        values maps the `key` attributes of existing CustomFieldDef to their
+        new value. At most concurrency values are set in parallel. The first
+        error is raised after all values have been tried.
+        """
+        pool = eventlet.GreenPool(concurrency)
+        threads = [pool.spawn(self.set_value, moref, key, value)
+                   for key, value in values.items()]
+        pool.waitall()
+        for thread in threads:
+            thread.wait()
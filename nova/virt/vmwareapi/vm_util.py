@@ -19,14 +19,19 @@ The VMware API VM utility module to build SOAP object specs.
 """
 
 import collections
+import contextlib
 import copy
 import hashlib
 import operator
+import os
 import socket
 import ssl
+import threading
+import time
 
 import six
 
+from oslo_concurrency import lockutils
 from oslo_log import log as logging
 from oslo_serialization import jsonutils
 from oslo_service import loopingcall
@@ -74,7 +79,28 @@ _FOLDER_PATH_REF_MAPPING = {}
 _VM_REFS_CACHE = {}
 _VM_VALUE_CACHE = collections.defaultdict(dict)
 
+# A callable re-resolving the references of all VMs in the cluster at once,
+# registered by the VMwareVMOps. If the references go stale, e.g. after a
+# restart of the vCenter, they most likely do so all at once and we rather
+# list the cluster once than search for each VM separately.
+_VM_REFS_CACHE_REFRESHER = None
+_VM_REFS_CACHE_LAST_REFRESH = None
+# minimum amount of seconds between two refreshes of the whole cache, so a
+# single VM vanishing doesn't trigger listing the cluster over and over
+_VM_REFS_CACHE_REFRESH_SPACING = 60
+
 _HOST_RESERVATIONS_DEFAULT_KEY = '__default__'
+# Maps the path of the reservations file to its modification time and its
+# parsed content
+_HOST_RESERVATIONS_FILE_CACHE = {}
+
+# Host properties needed for the resource stats, which change frequently
+_HOST_STATS_PROPERTIES = ["name", "summary.hardware", "summary.runtime",
+                          "summary.quickStats", "summary.config.product"]
+# Host properties needed for the cpu_info, which are expensive to transfer
+# and only change with a reboot or an upgrade of the host
+_HOST_CPU_INFO_PROPERTIES = ["hardware.cpuPkg", "hardware.cpuInfo",
+                             "config.featureCapability"]
 
 
 class Limits(object):
@@ -151,7 +177,49 @@ class ExtraSpecs(object):
         return evc_modes[self.evc_mode_key]
 
 
+def create_task_filter_spec(client_factory, entity=None, recursion="self",
+                            begin_time=None, end_time=None,
+                            time_type="queuedTime"):
+    """Build a TaskFilterSpec letting the vCenter filter the task history
+
+    Only the given filters are set, so the vCenter doesn't return tasks we
+    would throw away anyways.
+    """
+    task_filter_spec = client_factory.create('ns0:TaskFilterSpec')
+    if entity is not None:
+        task_filter_spec.entity = client_factory.create(
+            'ns0:TaskFilterSpecByEntity')
+        task_filter_spec.entity.entity = entity
+        task_filter_spec.entity.recursion = recursion
+    if begin_time is not None or end_time is not None:
+        task_filter_spec.time = client_factory.create(
+            'ns0:TaskFilterSpecByTime')
+        task_filter_spec.time.timeType = time_type
+        if begin_time is not None:
+            task_filter_spec.time.beginTime = begin_time
+        if end_time is not None:
+            task_filter_spec.time.endTime = end_time
+    return task_filter_spec
+
+
+def _destroy_history_collector(session, history_collector):
+    try:
+        session._call_method(session.vim, "DestroyCollector",
+                             history_collector)
+    except vexc.VimException as e:
+        # the collector might be gone with the session it belonged to
+        LOG.debug("Failed to destroy history collector %(ref)s: %(error)s",
+                  {'ref': vutil.get_moref_value(history_collector),
+                   'error': e})
+
+
 class HistoryCollectorItems(six.Iterator):
+    """Iterate over the items of a vCenter history collector
+
+    The pages are read lazily, i.e. only after the caller consumed the items
+    of the previous one, so a caller stopping early doesn't load the whole
+    history. Use it as a context manager to destroy the collector at the end.
+    """
 
     def __init__(self, session, history_collector, read_page_method,
                  reverse_page_order=False, max_page_size=10,
@@ -163,6 +231,12 @@ class HistoryCollectorItems(six.Iterator):
         self.max_page_size = max_page_size
         self.page_sort_key_func = page_sort_key_func
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def __iter__(self):
         self._latest_page_read = False
         self._page_items = None
@@ -187,6 +261,17 @@ class HistoryCollectorItems(six.Iterator):
         else:
             return self._page_items.pop(0)
 
+    def items(self, stop_when=None):
+        """Yield the items of the history lazily
+
+        If given, `stop_when` is called after the caller processed an item and
+        reading the history stops as soon as it returns True.
+        """
+        for item in self:
+            yield item
+            if stop_when is not None and stop_when(item):
+                return
+
     def _load_page(self):
         if self.reverse_page_order and not self._latest_page_read:
             self._load_latest_page()
@@ -208,11 +293,12 @@ class HistoryCollectorItems(six.Iterator):
 
         self._page_items = vim_util.get_array_items(latest_page)
 
-    def destroy_collector(self):
-        if self.history_collector:
-            self.session._call_method(self.session.vim,
-                                      "DestroyCollector",
-                                      self.history_collector)
+    def close(self):
+        """Destroy the collector"""
+        history_collector, self.history_collector = \
+            self.history_collector, None
+        if history_collector:
+            _destroy_history_collector(self.session, history_collector)
 
 
 class TaskHistoryCollectorItems(HistoryCollectorItems):
@@ -233,9 +319,6 @@ class TaskHistoryCollectorItems(HistoryCollectorItems):
                                                         max_page_size,
                                                         page_sort_key_func)
 
-    def __del__(self):
-        self.destroy_collector()
-
 
 class EventHistoryCollectorItems(HistoryCollectorItems):
     def __init__(self, session, event_filter_spec, reverse_page_order=False,
@@ -255,13 +338,10 @@ class EventHistoryCollectorItems(HistoryCollectorItems):
                                                          max_page_size,
                                                          page_sort_key_func)
 
-    def __del__(self):
-        self.destroy_collector()
-
 
 def vm_value_cache_reset():
     global _VM_VALUE_CACHE
-    _VM_VALUE_CACHE = {}
+    _VM_VALUE_CACHE = collections.defaultdict(dict)
 
 
 def vm_value_cache_delete(id):
@@ -278,7 +358,50 @@ def vm_value_cache_get(id):
 
 def vm_refs_cache_reset():
     global _VM_REFS_CACHE
+    global _VM_REFS_CACHE_REFRESHER
+    global _VM_REFS_CACHE_LAST_REFRESH
     _VM_REFS_CACHE = {}
+    _VM_REFS_CACHE_REFRESHER = None
+    _VM_REFS_CACHE_LAST_REFRESH = None
+
+
+def vm_refs_cache_set_refresher(refresher):
+    """Set the callable re-resolving all VM references in bulk
+
+    The refresher is called without arguments and is expected to update the
+    cache via vm_ref_cache_update().
+    """
+    global _VM_REFS_CACHE_REFRESHER
+    _VM_REFS_CACHE_REFRESHER = refresher
+
+
+def vm_refs_cache_refresh():
+    """Re-resolve all cached VM references with a single query
+
+    Concurrent callers wait for a running refresh instead of starting their
+    own. Returns False, if no refresh was done, because there's no refresher
+    or the last refresh is too recent.
+    """
+    global _VM_REFS_CACHE_LAST_REFRESH
+    if _VM_REFS_CACHE_REFRESHER is None:
+        return False
+
+    with lockutils.lock('vmware-vm-refs-cache-refresh'):
+        last_refresh = _VM_REFS_CACHE_LAST_REFRESH
+        if (last_refresh is not None and
+                time.monotonic() - last_refresh <
+                _VM_REFS_CACHE_REFRESH_SPACING):
+            return False
+
+        LOG.debug("Refreshing all cached VM references")
+        try:
+            _VM_REFS_CACHE_REFRESHER()
+        except Exception as e:
+            LOG.warning("Refreshing all cached VM references failed: %s", e)
+            return False
+        finally:
+            _VM_REFS_CACHE_LAST_REFRESH = time.monotonic()
+        return True
 
 
 def vm_ref_cache_delete(id_):
@@ -295,6 +418,8 @@ def vm_ref_cache_get(id_):
 
 # the config key which stores the VNC port
 VNC_CONFIG_KEY = 'config.extraConfig["RemoteDisplay.vnc.port"]'
+# Seconds a VNC port we handed out is kept as taken, if no VM shows up with it
+VNC_PORT_RESERVATION_TIMEOUT = 600
 
 VmdkInfo = collections.namedtuple('VmdkInfo', ['path', 'adapter_type',
                                                'disk_type',
@@ -953,12 +1078,116 @@ def _get_device_disk_type(device):
             return constants.DEFAULT_DISK_TYPE
 
 
+# The device snapshots of the current request. Within device_snapshot(), this
+# holds {vm moref value: {name: value}} with the properties of VMs already
+# read in the request. Being thread-local, other requests don't see them.
+_DEVICE_SNAPSHOTS = threading.local()
+
+
+@contextlib.contextmanager
+def device_snapshot():
+    """Serve repeated device lookups of a VM within a request from a snapshot
+
+    Operations like resize or rescue look up the hardware devices of the VM
+    several times. Within this context, the devices are only read once from
+    the vCenter and kept indexed by type, key, controller and backing uuid.
+    Reconfiguring the VM through reconfigure_vm() invalidates its snapshot.
+    Can be used as a decorator, too.
+    """
+    if getattr(_DEVICE_SNAPSHOTS, 'vms', None) is not None:
+        # nested, the outermost context owns the snapshots
+        yield
+        return
+
+    _DEVICE_SNAPSHOTS.vms = {}
+    try:
+        yield
+    finally:
+        _DEVICE_SNAPSHOTS.vms = None
+
+
+def _get_device_snapshot(vm_ref):
+    vms = getattr(_DEVICE_SNAPSHOTS, 'vms', None)
+    if vms is None:
+        return None
+    return vms.setdefault(vutil.get_moref_value(vm_ref), {})
+
+
+def invalidate_device_snapshot(vm_ref):
+    """Forget the device snapshot of a VM after changing its devices"""
+    vms = getattr(_DEVICE_SNAPSHOTS, 'vms', None)
+    if vms is not None:
+        vms.pop(vutil.get_moref_value(vm_ref), None)
+
+
+def _get_vm_property(session, vm_ref, property_name):
+    snapshot = _get_device_snapshot(vm_ref)
+    if snapshot is not None and property_name in snapshot:
+        return snapshot[property_name]
+
+    value = session._call_method(vutil, "get_object_property", vm_ref,
+                                 property_name)
+    if snapshot is not None:
+        snapshot[property_name] = value
+    return value
+
+
+class HardwareDeviceIndex(object):
+    """The hardware devices of a VM, indexed for lookups"""
+
+    def __init__(self, devices):
+        self.devices = devices
+        self.by_type = collections.defaultdict(list)
+        self.by_key = {}
+        self.by_backing_uuid = {}
+        for device in devices:
+            self.by_type[device.__class__.__name__].append(device)
+            self.by_key[device.key] = device
+            uuid = getattr(getattr(device, 'backing', None), 'uuid', None)
+            if uuid:
+                self.by_backing_uuid.setdefault(uuid, device)
+
+    def get_flat_disks(self):
+        return [device for device in self.by_type['VirtualDisk']
+                if device.backing.__class__.__name__ ==
+                    "VirtualDiskFlatVer2BackingInfo"]
+
+    def get_vmdk_backed_disk(self, uuid):
+        """Return the flat VirtualDisk with the given backing uuid or None"""
+        device = self.by_backing_uuid.get(uuid)
+        if (device is not None and
+                device.__class__.__name__ == "VirtualDisk" and
+                device.backing.__class__.__name__ ==
+                    "VirtualDiskFlatVer2BackingInfo"):
+            return device
+
+    def get_adapter_type(self, device):
+        """Return the adapter type of the controller the device is on"""
+        controller = self.by_key.get(getattr(device, 'controllerKey', None))
+        if controller is None:
+            return None
+        return CONTROLLER_TO_ADAPTER_TYPE.get(controller.__class__.__name__)
+
+
 def get_hardware_devices(session, vm_ref):
-    hardware_devices = session._call_method(vutil,
-                                            "get_object_property",
-                                            vm_ref,
-                                            "config.hardware.device")
-    return vim_util.get_array_items(hardware_devices)
+    hardware_devices = vim_util.get_array_items(
+        _get_vm_property(session, vm_ref, "config.hardware.device"))
+    if hardware_devices and _get_device_snapshot(vm_ref) is not None:
+        # callers may modify the list, but not the snapshot
+        hardware_devices = list(hardware_devices)
+    return hardware_devices
+
+
+def get_hardware_device_index(session, vm_ref):
+    """Return the HardwareDeviceIndex of the VM"""
+    snapshot = _get_device_snapshot(vm_ref)
+    if snapshot is not None and 'index' in snapshot:
+        return snapshot['index']
+
+    index = HardwareDeviceIndex(get_hardware_devices(session, vm_ref))
+    if snapshot is not None:
+        snapshot['index'] = index
+    return index
 
 
 def _in_boot_order(disk1, disk2):
@@ -1025,33 +1254,23 @@ def get_hardware_devices_by_type(session, vm_ref):
 
 def get_vmdk_info(session, vm_ref):
     """Returns information for the first VMDK attached to the given VM."""
-    hardware_devices = get_hardware_devices(session, vm_ref)
+    index = get_hardware_device_index(session, vm_ref)
     vmdk_file_path = None
-    vmdk_controller_key = None
     disk_type = None
     capacity_in_bytes = 0
 
     first_device = None
 
-    adapter_type_dict = {}
-    for device in hardware_devices:
-        if device.__class__.__name__ == "VirtualDisk":
-            if device.backing.__class__.__name__ == \
-                    "VirtualDiskFlatVer2BackingInfo":
-                if first_device is None or not _in_boot_order(first_device,
-                                                              device):
-                    first_device = device
-        elif device.__class__.__name__ in CONTROLLER_TO_ADAPTER_TYPE:
-            adapter_type_dict[device.key] = CONTROLLER_TO_ADAPTER_TYPE[
-                device.__class__.__name__]
+    for device in index.get_flat_disks():
+        if first_device is None or not _in_boot_order(first_device, device):
+            first_device = device
 
     if first_device:
         vmdk_file_path = first_device.backing.fileName
         capacity_in_bytes = _get_device_capacity(first_device)
-        vmdk_controller_key = first_device.controllerKey
         disk_type = _get_device_disk_type(first_device)
 
-    adapter_type = adapter_type_dict.get(vmdk_controller_key)
+    adapter_type = index.get_adapter_type(first_device)
     return VmdkInfo(vmdk_file_path, adapter_type, disk_type,
                     capacity_in_bytes, first_device)
 
@@ -1116,6 +1335,11 @@ def _get_bus_number_for_scsi_controller(devices):
     """Return usable bus number when create new SCSI controller."""
     # Every SCSI controller will take a unique bus number
     taken = [dev.busNumber for dev in devices if _is_scsi_controller(dev)]
+    return _get_free_scsi_bus_number(taken)
+
+
+def _get_free_scsi_bus_number(taken):
+    """Return the first bus number not contained in taken."""
     # The max bus number for SCSI controllers is 3
     for i in range(constants.SCSI_MAX_CONTROLLER_NUMBER):
         if i not in taken:
@@ -1156,6 +1380,60 @@ def allocate_controller_key_and_unit_number(client_factory, devices,
     return controller_key, 0, controller_spec
 
 
+def allocate_controller_keys_and_unit_numbers(client_factory, devices,
+                                              adapter_types):
+    """Allocate a controller_key and unit_number for every adapter type in
+    adapter_types in a single pass over the current set of hardware devices.
+
+    Slots handed out earlier in the same call count as taken, so the result
+    can be used to attach several virtual disks with one reconfigure. Works
+    like allocate_controller_key_and_unit_number otherwise.
+
+    Returns a list of (controller_key, unit_number) tuples in the order of
+    adapter_types and the list of specs of the controllers, which have to be
+    created along with the disks.
+    """
+    taken = _find_allocated_slots(devices)
+    ide_keys = [dev.key for dev in devices if _is_ide_controller(dev)]
+    scsi_keys = [dev.key for dev in devices if _is_scsi_controller(dev)]
+    scsi_buses = [dev.busNumber for dev in devices
+                  if _is_scsi_controller(dev)]
+
+    slots = []
+    controller_specs = []
+    for adapter_type in adapter_types:
+        controller_keys = []
+        ret = None
+        if adapter_type == constants.ADAPTER_TYPE_IDE:
+            controller_keys = ide_keys
+            ret = _find_controller_slot(controller_keys, taken, 2)
+        elif adapter_type in constants.SCSI_ADAPTER_TYPES:
+            controller_keys = scsi_keys
+            ret = _find_controller_slot(controller_keys, taken, 16)
+
+        if not ret:
+            # create new controller with the specified type, every new
+            # controller needs its own temporary key
+            controller_key = -101 - len(controller_specs)
+            bus_number = 0
+            if adapter_type in constants.SCSI_ADAPTER_TYPES:
+                bus_number = _get_free_scsi_bus_number(scsi_buses)
+                scsi_buses.append(bus_number)
+                # the SCSI controller sits on its own bus
+                taken[controller_key] = [
+                    constants.SCSI_CONTROLLER_UNIT_NUMBER]
+            controller_specs.append(
+                create_controller_spec(client_factory, controller_key,
+                                       adapter_type, bus_number))
+            controller_keys.append(controller_key)
+            ret = (controller_key, 0)
+
+        taken.setdefault(ret[0], []).append(ret[1])
+        slots.append(ret)
+
+    return slots, controller_specs
+
+
 def get_rdm_disk(hardware_devices, uuid):
     """Gets the RDM disk key."""
     for device in hardware_devices:
@@ -1373,24 +1651,171 @@ def get_vnc_config_spec(client_factory, port):
     return virtual_machine_config_spec
 
 
+class VncPortAllocator(object):
+    """Hand out VNC ports without reading the ports of all VMs each time
+
+    A property collector with a filter on the VNC port of all VMs in the
+    vCenter tells us which ports got taken or freed since the last
+    allocation. Thus, finding a free port only costs a single
+    WaitForUpdatesEx call, which returns nothing if nothing changed. This
+    includes the VMs of other compute-nodes using the same vCenter.
+
+    Ports we handed out are kept as taken until a VM shows up with them, or
+    for VNC_PORT_RESERVATION_TIMEOUT seconds, if that never happens.
+
+    Without CONF.vmware.use_property_collector or if the property collector
+    fails, the ports of all VMs are read on every allocation instead.
+    """
+
+    def __init__(self):
+        self._collector = None
+        self._version = ''
+        self._ports_by_vm = {}
+        self._reserved = {}
+        self._next_index = 0
+
+    def reset(self, session=None):
+        """Forget everything, so the next update does a full resync"""
+        collector = self._collector
+        self._collector = None
+        self._version = ''
+        self._ports_by_vm = {}
+        self._reserved = {}
+        self._next_index = 0
+
+        if collector is None or session is None:
+            return
+
+        try:
+            session._call_method(session.vim, "DestroyPropertyCollector",
+                                 collector)
+        except Exception as e:
+            LOG.debug("Could not destroy VNC port property collector %s: %s",
+                      vutil.get_moref_value(collector), e)
+
+    def _create_collector(self, session):
+        vim = session.vim
+        client_factory = vim.client.factory
+        self._collector = session._call_method(
+            vim, "CreatePropertyCollector",
+            vim.service_content.propertyCollector)
+        self._version = ''
+        self._ports_by_vm = {}
+
+        traversal_spec = vutil.build_recursive_traversal_spec(client_factory)
+        object_spec = vutil.build_object_spec(client_factory,
+                                              vim.service_content.rootFolder,
+                                              [traversal_spec])
+        property_spec = vutil.build_property_spec(client_factory,
+                                                  "VirtualMachine",
+                                                  [VNC_CONFIG_KEY])
+        filter_spec = vutil.build_property_filter_spec(client_factory,
+                                                       [property_spec],
+                                                       [object_spec])
+        session._call_method(vim, "CreateFilter", self._collector,
+                             spec=filter_spec, partialUpdates=False)
+
+    def _update(self, session):
+        if self._collector is None:
+            self._create_collector(session)
+
+        vim = session.vim
+        options = vim.client.factory.create("ns0:WaitOptions")
+        options.maxWaitSeconds = 0
+        while True:
+            update_set = session._call_method(vim, "WaitForUpdatesEx",
+                                              self._collector,
+                                              version=self._version,
+                                              options=options)
+            if not update_set:
+                break
+
+            self._version = update_set.version
+            for filter_update in update_set.filterSet or []:
+                for update in filter_update.objectSet or []:
+                    self._apply_object_update(update)
+
+    def _apply_object_update(self, update):
+        key = vutil.get_moref_value(update.obj)
+        if update.kind == "leave":
+            self._ports_by_vm.pop(key, None)
+            return
+
+        for change in getattr(update, "changeSet", None) or []:
+            option_value = getattr(change, "val", None)
+            if (change.op in ("remove", "indirectRemove") or
+                    getattr(option_value, "value", None) is None):
+                self._ports_by_vm.pop(key, None)
+            else:
+                self._ports_by_vm[key] = int(option_value.value)
+
+    def _get_used_ports(self, session):
+        if CONF.vmware.use_property_collector:
+            try:
+                try:
+                    self._update(session)
+                except vexc.ManagedObjectNotFoundException:
+                    # the property collector lives in the session, so it's
+                    # gone after a re-login
+                    LOG.debug("VNC port property collector vanished. Doing "
+                              "a full resync.")
+                    self.reset(session)
+                    self._update(session)
+                return set(self._ports_by_vm.values())
+            except Exception as e:
+                LOG.warning("Could not use the VNC port property collector, "
+                            "reading the ports of all VMs: %s", e)
+                self.reset(session)
+
+        return set(_get_vnc_ports_by_vm(session).values())
+
+    def allocate(self, session):
+        min_port = CONF.vmware.vnc_port
+        port_total = CONF.vmware.vnc_port_total
+        with lockutils.lock('vmware-vnc-port-allocator'):
+            used = self._get_used_ports(session)
+
+            # our own allocations are only kept until a VM has the port
+            now = time.monotonic()
+            self._reserved = {
+                port: reserved_at
+                for port, reserved_at in self._reserved.items()
+                if (port not in used and
+                    now - reserved_at < VNC_PORT_RESERVATION_TIMEOUT)}
+            used.update(self._reserved)
+
+            for offset in range(port_total):
+                index = (self._next_index + offset) % port_total
+                port = min_port + index
+                if port in used:
+                    continue
+                self._reserved[port] = now
+                # continue after the allocated port, so a port isn't reused
+                # right after it got freed
+                self._next_index = (index + 1) % port_total
+                return port
+
+            raise exception.ConsolePortRangeExhausted(
+                min_port=min_port, max_port=min_port + port_total)
+
+
+_VNC_PORT_ALLOCATOR = VncPortAllocator()
+
+
+def vnc_port_allocator_reset():
+    _VNC_PORT_ALLOCATOR.reset()
+
+
 def get_vnc_port(session):
     """Return VNC port for an VM or None if there is no available port."""
-    min_port = CONF.vmware.vnc_port
-    port_total = CONF.vmware.vnc_port_total
-    allocated_ports = _get_allocated_vnc_ports(session)
-    max_port = min_port + port_total
-    for port in range(min_port, max_port):
-        if port not in allocated_ports:
-            return port
-    raise exception.ConsolePortRangeExhausted(min_port=min_port,
-                                              max_port=max_port)
-
-
-def _get_allocated_vnc_ports(session):
-    """Return an integer set of all allocated VNC ports."""
+    return _VNC_PORT_ALLOCATOR.allocate(session)
+
+
+def _get_vnc_ports_by_vm(session):
+    """Return a dict of VM moref value to its allocated VNC port."""
     # TODO(rgerganov): bug #1256944
     # The VNC port should be unique per host, not per vCenter
-    vnc_ports = set()
+    vnc_ports = {}
     result = session._call_method(vim_util, "get_objects",
                                   "VirtualMachine", [VNC_CONFIG_KEY])
     with vutil.WithRetrieval(session.vim, result) as objects:
@@ -1400,7 +1825,7 @@ def _get_allocated_vnc_ports(session):
             dynamic_prop = obj.propSet[0]
             option_value = dynamic_prop.val
             vnc_port = option_value.value
-            vnc_ports.add(int(vnc_port))
+            vnc_ports[vutil.get_moref_value(obj.obj)] = int(vnc_port)
     return vnc_ports
 
 
@@ -1486,11 +1911,31 @@ class VmMoRefProxy(StableMoRefProxy):
         self._uuid = uuid
 
     def fetch_moref(self, session):
-        vm_value_cache_delete(self._uuid)
-        self.moref = search_vm_ref_by_identifier(session, self._uuid)
-        if not self.moref:
-            raise exception.InstanceNotFound(instance_id=self._uuid)
-        vm_ref_cache_update(self._uuid, self.moref)
+        stale_moref = self.moref
+        # single-flight the search for the same VM, so concurrent callers
+        # take the result of the first one from the cache
+        with lockutils.lock('vmware-vm-ref-{}'.format(self._uuid)):
+            vm_value_cache_delete(self._uuid)
+            moref = vm_ref_cache_get(self._uuid)
+            if stale_moref is not None and _is_same_moref(moref, stale_moref):
+                # our reference went stale, so probably all of them did
+                if vm_refs_cache_refresh():
+                    moref = vm_ref_cache_get(self._uuid)
+                if _is_same_moref(moref, stale_moref):
+                    moref = None
+
+            if not moref:
+                moref = search_vm_ref_by_identifier(session, self._uuid)
+            self.moref = moref
+            if not self.moref:
+                raise exception.InstanceNotFound(instance_id=self._uuid)
+            vm_ref_cache_update(self._uuid, self.moref)
+
+
+def _is_same_moref(moref, other_moref):
+    if moref is None or other_moref is None:
+        return moref is other_moref
+    return vutil.get_moref_value(moref) == vutil.get_moref_value(other_moref)
 
 
 def get_vm_ref(session, instance):
@@ -1555,7 +2000,9 @@ def _set_host_reservations(stats, host_reservations_map, host_moref):
     stats["memory_mb_reserved"] = 0
 
     default_key = _HOST_RESERVATIONS_DEFAULT_KEY
-    host_reservations = host_reservations_map.get(default_key, {})
+    # Copy the defaults, so the group reservations of one host don't end up
+    # in the defaults of the next
+    host_reservations = dict(host_reservations_map.get(default_key, {}))
     group_reservations = host_reservations_map.get(host_moref.value, {})
     for key in ['vcpus', 'vcpus_percent', 'memory_mb', 'memory_percent']:
         if key in group_reservations:
@@ -1597,8 +2044,8 @@ def _get_host_reservations_map(groups=None):
     if not CONF.vmware.hostgroup_reservations_json_file:
         return {}
 
-    with open(CONF.vmware.hostgroup_reservations_json_file, 'rb') as f:
-        reservations = jsonutils.load(f)
+    reservations = _load_host_reservations(
+        CONF.vmware.hostgroup_reservations_json_file)
 
     hrm = {}
 
@@ -1619,6 +2066,30 @@ def _get_host_reservations_map(groups=None):
     return hrm
 
 
+def _load_host_reservations(path):
+    """Return the parsed content of the reservations file
+
+    The file only gets read and parsed again, if its modification time
+    changed since the last call.
+    """
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        mtime = None
+
+    cached = _HOST_RESERVATIONS_FILE_CACHE.get(path)
+    if mtime is not None and cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    with open(path, 'rb') as f:
+        reservations = jsonutils.load(f)
+
+    _HOST_RESERVATIONS_FILE_CACHE.clear()
+    if mtime is not None:
+        _HOST_RESERVATIONS_FILE_CACHE[path] = (mtime, reservations)
+    return reservations
+
+
 # Only for satisfying the tests, and to ensure it is producing the same results
 def get_stats_from_cluster(session, cluster):
     return aggregate_stats_from_cluster(
@@ -1754,8 +2225,21 @@ def _set_hypervisor_type_and_version(stats, host_props):
     stats["hypervisor_version"] = convert_version_to_int(product.version)
 
 
-def _process_host_stats(obj, host_reservations_map):
-    host_props = propset_dict(obj.propSet)
+def _get_host_cpu_info_fingerprint(host_props):
+    """Return a value which changes, when the cpu_info of the host may have
+    changed.
+    """
+    runtime_summary = host_props.get("summary.runtime")
+    product = host_props.get("summary.config.product")
+    return (getattr(runtime_summary, "connectionState", None),
+            getattr(runtime_summary, "bootTime", None),
+            getattr(product, "build", None))
+
+
+def _process_host_stats(host_ref, host_props, host_reservations_map,
+                        cpu_info=None):
+    if cpu_info is None:
+        cpu_info = _host_props_to_cpu_info(host_props)
     runtime_summary = host_props["summary.runtime"]
     hardware_summary = host_props.get("summary.hardware")
     stats_summary = host_props.get("summary.quickStats")
@@ -1774,16 +2258,28 @@ def _process_host_stats(obj, host_reservations_map):
         "vcpus_used": 0,
         "memory_mb": mem_mb,
         "memory_mb_used": getattr(stats_summary, "overallMemoryUsage", 0),
-        "cpu_info": _host_props_to_cpu_info(host_props),
+        "cpu_info": cpu_info,
         "cpu_mhz": getattr(hardware_summary, "cpuMhz", 0) * vcpu_ratio,
     }
 
     _set_hypervisor_type_and_version(stats, host_props)
-    _set_host_reservations(stats, host_reservations_map, obj.obj)
-    return vutil.get_moref_value(obj.obj), stats
+    _set_host_reservations(stats, host_reservations_map, host_ref)
+    return vutil.get_moref_value(host_ref), stats
 
 
-def get_stats_from_cluster_per_host(session, cluster):
+def _get_host_props(session, host_mors, properties):
+    """Return a list of (host_ref, property dict) of the given hosts
+    retrieved with a single property collector call.
+    """
+    result = session._call_method(vim_util,
+                    "get_properties_for_a_collection_of_objects",
+                    "HostSystem", host_mors, properties)
+    with vutil.WithRetrieval(session.vim, result) as objects:
+        return [(obj.obj, propset_dict(obj.propSet))
+                for obj in objects if hasattr(obj, "propSet")]
+
+
+def get_stats_from_cluster_per_host(session, cluster, cpu_info_cache=None):
     """Get the hosts with the underlying resource stats.
 
     Returns a dict containing the host mo-ref value as key, and the
@@ -1794,6 +2290,11 @@ def get_stats_from_cluster_per_host(session, cluster):
         'memory_mb': 2048,
       }
     }
+
+    If a dict is passed as cpu_info_cache, the cpu_info of the hosts is
+    kept in there between calls and the expensive properties it is built
+    from are only retrieved for new hosts or hosts, which were rebooted,
+    upgraded or reconnected in the meantime.
     """
     host_mors, host_reservations_map = \
         get_hosts_and_reservations_for_cluster(session, cluster)
@@ -1801,17 +2302,50 @@ def get_stats_from_cluster_per_host(session, cluster):
     if not host_mors:
         return {}
 
-    result = session._call_method(vim_util,
-                    "get_properties_for_a_collection_of_objects",
-                    "HostSystem", host_mors,
-                    ["name", "summary.hardware", "summary.runtime",
-                     "summary.quickStats", "summary.config.product",
-                     "hardware.cpuPkg", "hardware.cpuInfo",
-                     "config.featureCapability",
-                    ])
-    with vutil.WithRetrieval(session.vim, result) as objects:
-        return dict(_process_host_stats(obj, host_reservations_map)
-                    for obj in objects if hasattr(obj, "propSet"))
+    if cpu_info_cache is None:
+        hosts = _get_host_props(session, host_mors,
+                                _HOST_STATS_PROPERTIES +
+                                _HOST_CPU_INFO_PROPERTIES)
+        return dict(_process_host_stats(host_ref, host_props,
+                                        host_reservations_map)
+                    for host_ref, host_props in hosts)
+
+    hosts = _get_host_props(session, host_mors, _HOST_STATS_PROPERTIES)
+    fingerprints = {}
+    stale_host_mors = []
+    for host_ref, host_props in hosts:
+        value = vutil.get_moref_value(host_ref)
+        fingerprint = _get_host_cpu_info_fingerprint(host_props)
+        fingerprints[value] = fingerprint
+        cached = cpu_info_cache.get(value)
+        if cached is None or cached[0] != fingerprint:
+            stale_host_mors.append(host_ref)
+
+    # Forget about hosts, which left the cluster
+    for value in set(cpu_info_cache) - set(fingerprints):
+        del cpu_info_cache[value]
+
+    cpu_infos = {value: cached[1] for value, cached in cpu_info_cache.items()
+                 if cached[0] == fingerprints[value]}
+    if stale_host_mors:
+        LOG.debug("Retrieving cpu info of hosts %s",
+                  [vutil.get_moref_value(m) for m in stale_host_mors])
+        for host_ref, host_props in _get_host_props(
+                session, stale_host_mors, _HOST_CPU_INFO_PROPERTIES):
+            value = vutil.get_moref_value(host_ref)
+            cpu_info = _host_props_to_cpu_info(host_props)
+            cpu_infos[value] = cpu_info
+            # An incomplete cpu_info would be kept until the host reboots, so
+            # we rather retrieve it again with the next update
+            if all(p in host_props for p in _HOST_CPU_INFO_PROPERTIES):
+                cpu_info_cache[value] = (fingerprints[value], cpu_info)
+            else:
+                cpu_info_cache.pop(value, None)
+
+    return dict(_process_host_stats(
+                    host_ref, host_props, host_reservations_map,
+                    cpu_infos.get(vutil.get_moref_value(host_ref)))
+                for host_ref, host_props in hosts)
 
 
 def get_hosts_and_reservations_for_cluster(session, cluster):
@@ -1883,15 +2417,6 @@ def propset_dict(propset):
     return {prop.name: prop.val for prop in propset}
 
 
-def get_vmdk_backed_disk_device(hardware_devices, uuid):
-    for device in hardware_devices:
-        if (device.__class__.__name__ == "VirtualDisk" and
-                device.backing.__class__.__name__ ==
-                "VirtualDiskFlatVer2BackingInfo" and
-                getattr(device.backing, 'uuid', None) == uuid):
-            return device
-
-
 def get_vmdk_volume_disk(hardware_devices, path=None):
     for device in hardware_devices:
         if (device.__class__.__name__ == "VirtualDisk"):
@@ -2097,10 +2622,13 @@ def copy_virtual_disk(session, dc_ref, source, dest):
 
 def reconfigure_vm(session, vm_ref, config_spec):
     """Reconfigure a VM according to the config spec."""
-    reconfig_task = session._call_method(session.vim,
-                                         "ReconfigVM_Task", vm_ref,
-                                         spec=config_spec)
-    session._wait_for_task(reconfig_task)
+    try:
+        reconfig_task = session._call_method(session.vim,
+                                             "ReconfigVM_Task", vm_ref,
+                                             spec=config_spec)
+        session._wait_for_task(reconfig_task)
+    finally:
+        invalidate_device_snapshot(vm_ref)
 
 
 def power_on_instance(session, instance, vm_ref=None):
@@ -2121,10 +2649,7 @@ def power_on_instance(session, instance, vm_ref=None):
 
 
 def _get_vm_port_indices(session, vm_ref):
-    extra_config = session._call_method(vutil,
-                                        'get_object_property',
-                                        vm_ref,
-                                        'config.extraConfig')
+    extra_config = _get_vm_property(session, vm_ref, 'config.extraConfig')
     ports = []
     if extra_config is not None:
         options = extra_config.OptionValue
@@ -2232,26 +2757,15 @@ def detach_devices_from_vm(session, vm_ref, devices):
 
 
 def get_ephemerals(session, vm_ref):
-    devices = []
-    hardware_devices = get_hardware_devices(session, vm_ref)
-
-    for device in hardware_devices:
-        if device.__class__.__name__ == "VirtualDisk":
-            if (device.backing.__class__.__name__ ==
-                    "VirtualDiskFlatVer2BackingInfo"):
-                if 'ephemeral' in device.backing.fileName:
-                    devices.append(device)
-    return devices
+    index = get_hardware_device_index(session, vm_ref)
+    return [device for device in index.get_flat_disks()
+            if 'ephemeral' in device.backing.fileName]
 
 
 def get_swap(session, vm_ref):
-    hardware_devices = get_hardware_devices(session, vm_ref)
-
-    for device in hardware_devices:
-        if (device.__class__.__name__ == "VirtualDisk" and
-                device.backing.__class__.__name__ ==
-                    "VirtualDiskFlatVer2BackingInfo" and
-                'swap' in device.backing.fileName):
+    index = get_hardware_device_index(session, vm_ref)
+    for device in index.get_flat_disks():
+        if 'swap' in device.backing.fileName:
             return device
 
 
@@ -19,13 +19,16 @@
 Class for VM tasks like spawn, snapshot, suspend, resume etc.
 """
 
+import collections
 import contextlib
 import copy
+import datetime
 import itertools
 import math
 from operator import attrgetter
 from operator import itemgetter
 import os
+import random
 import re
 import shutil
 import sys
@@ -33,6 +36,8 @@ import threading
 import time
 
 import decorator
+import eventlet
+from eventlet import semaphore
 import six
 
 from oslo_concurrency import lockutils
@@ -73,6 +78,7 @@ from nova.virt.vmwareapi import ds_util
 from nova.virt.vmwareapi import error_util
 from nova.virt.vmwareapi import imagecache
 from nova.virt.vmwareapi import images
+from nova.virt.vmwareapi import placement_model
 from nova.virt.vmwareapi.rpc import VmwareRpcApi
 from nova.virt.vmwareapi import special_spawning
 from nova.virt.vmwareapi import vif as vmwarevif
@@ -181,6 +187,19 @@ class VMwareVMOps(object):
         self._vcenter_uuid = vcenter_uuid
         self._property_collector = None
         self._property_collector_version = ''
+        self._property_collector_last_sync = None
+        self._property_collector_watcher = None
+        self._property_collector_watcher_running = False
+        self._property_collector_watcher_stop = False
+        self._server_group_sync_queue = set()
+        self._server_group_sync_queued = threading.Event()
+        self._server_group_sync_worker = None
+        self._server_group_sync_worker_stop = False
+        self._image_template_prewarm_thread = None
+        self._cluster_config = None
+        # VMs stacked onto a host by their instance uuid. See
+        # _stack_vm_to_host_if_needed()
+        self._stacked_vms = {}
         self._root_resource_pool = vm_util.get_res_pool_ref(self._session,
                                                             self._cluster)
         self._datastore_regex = datastore_regex
@@ -204,6 +223,7 @@ class VMwareVMOps(object):
 
         # pre-warm the cache, so we don't have to do extra queries per instance
         self.update_vmref_cache()
+        vm_util.vm_refs_cache_set_refresher(self.update_vmref_cache)
 
     def _get_base_folder(self):
         # Enable more than one compute node to run on the same host
@@ -661,6 +681,15 @@ class VMwareVMOps(object):
         templ_vm_name = '%s (%s)' % (image_id, datastore_name)
         return templ_vm_name
 
+    @staticmethod
+    def _parse_image_template_vm_name(templ_vm_name):
+        """Return (image_id, datastore_name) of an image-template VM name"""
+        m = re.match(r'^(?P<image_id>\S+) \((?P<ds_name>[^)]+)\)$',
+                     templ_vm_name)
+        if not m:
+            return None, None
+        return m.group('image_id'), m.group('ds_name')
+
     def _fetch_image_as_vapp(self, context, vi, image_ds_loc):
         """Download stream optimized image to host as a vApp."""
 
@@ -956,8 +985,13 @@ class VMwareVMOps(object):
 
         return self._datastore_hagroup_regex, hagroup
 
-    def _get_vm_config_info(self, context, instance, image_info, extra_specs):
-        """Captures all relevant information from the spawn parameters."""
+    def _get_vm_config_info(self, context, instance, image_info, extra_specs,
+                            reserve_space=False):
+        """Captures all relevant information from the spawn parameters.
+
+        With `reserve_space`, the disk space of the instance is reserved on
+        the chosen datastore under the instance's uuid.
+        """
 
         boot_from_volume = compute_utils.is_volume_backed_instance(
                                                 instance._context, instance)
@@ -971,13 +1005,21 @@ class VMwareVMOps(object):
             image_info.disk_type)
         hagroup_re, hagroup = self._get_hagroup_info(context, instance,
                                                      is_bfv=boot_from_volume)
+        reservation_key = None
+        reservation_size = 0
+        if reserve_space:
+            reservation_key = instance.uuid
+            reservation_size = self._get_instance_disk_space(
+                instance, image_info, boot_from_volume)
         datastore = ds_util.get_datastore(self._session,
                                           self._cluster,
                                           self._datastore_regex,
                                           extra_specs.storage_policy,
                                           allowed_ds_types,
                                           datastore_hagroup_regex=hagroup_re,
-                                          datastore_hagroup=hagroup)
+                                          datastore_hagroup=hagroup,
+                                          reservation_key=reservation_key,
+                                          reservation_size=reservation_size)
         dc_info = self.get_datacenter_ref_and_name(datastore.ref)
 
         return VirtualMachineInstanceConfigInfo(instance,
@@ -987,6 +1029,19 @@ class VMwareVMOps(object):
                                                 self._imagecache,
                                                 extra_specs)
 
+    @staticmethod
+    def _get_instance_disk_space(instance, image_info, boot_from_volume):
+        """Return the bytes the disks of the instance take on its datastore"""
+        flavor = instance.flavor
+        size = (flavor.ephemeral_gb * units.Gi +
+                flavor.swap * units.Mi)
+        if not boot_from_volume:
+            if flavor.root_gb:
+                size += flavor.root_gb * units.Gi
+            else:
+                size += image_info.file_size
+        return size
+
     def _get_image_callbacks(self, vi):
         disk_type = vi.ii.disk_type
 
@@ -1019,11 +1074,41 @@ class VMwareVMOps(object):
             raise exception.InvalidDiskInfo(reason=reason)
         return image_prepare, image_fetch, image_cache
 
+    def _ensure_image_template_index(self, dc_info):
+        """Fill the image-template index, if it wasn't yet
+
+        Listing all image-template VMs takes a while, so callers should do
+        this before taking the lock of an image.
+        """
+        if self._imagecache.image_templates_populated:
+            return
+        with lockutils.lock('vmware-image-template-index'):
+            if not self._imagecache.image_templates_populated:
+                self._update_image_template_index(dc_info)
+
     def _fetch_image_from_other_datastores(self, vi):
+        self._ensure_image_template_index(vi.dc_info)
+
+        # the index lists all image-template VMs and gets updated whenever we
+        # create or age one, so if it doesn't know any for the image, there
+        # is none to copy.
+        templ_ds_names = self._imagecache.get_image_template_datastores(
+            vi.ii.image_id)
+        if not templ_ds_names:
+            LOG.debug("No image-template VM of image %s in the index.",
+                      vi.ii.image_id, instance=vi.instance)
+            return None
+
+        # the datastores known to hold an image-template VM of the image are
+        # searched first. The index can miss templates created by other nodes
+        # since the last listing, so we still search the others afterwards.
+
         dc_all_datastores = ds_util.get_available_datastores(
             self._session, dc_ref=vi.dc_info.ref)
-        dc_other_datastores = [ds for ds in dc_all_datastores if
-                                dict(ds.ref) != dict(vi.datastore.ref)]
+        dc_other_datastores = sorted(
+            (ds for ds in dc_all_datastores
+             if dict(ds.ref) != dict(vi.datastore.ref)),
+            key=lambda ds: ds.name not in templ_ds_names)
 
         client_factory = self._session.vim.client.factory
         tmp_vi = copy.copy(vi)
@@ -1031,7 +1116,13 @@ class VMwareVMOps(object):
             tmp_vi.datastore = ds
             other_templ_vm_ref = self._find_image_template_vm(tmp_vi)
             if other_templ_vm_ref:
-                vmdk = vm_util.get_vmdk_info(self._session, other_templ_vm_ref)
+                try:
+                    vmdk = vm_util.get_vmdk_info(self._session,
+                                                 other_templ_vm_ref)
+                except vexc.ManagedObjectNotFoundException:
+                    self._imagecache.remove_image_template(vi.ii.image_id,
+                                                           ds.name)
+                    continue
                 if not images.ensure_valid_template_vm(
                         self._session, other_templ_vm_ref,
                         vmdk.capacity_in_bytes):
@@ -1070,6 +1161,8 @@ class VMwareVMOps(object):
                     continue
 
                 templ_vm_ref = task_info.result
+                self._imagecache.add_image_template(
+                    vi.ii.image_id, vi.datastore.name, templ_vm_ref)
                 return templ_vm_ref
 
     def _fetch_image_if_missing(self, context, vi):
@@ -1091,6 +1184,9 @@ class VMwareVMOps(object):
         image_prepare, image_fetch, image_cache = self._get_image_callbacks(vi)
         LOG.debug("Processing image %s", vi.ii.image_id, instance=vi.instance)
 
+        if CONF.vmware.fetch_image_from_other_datastores:
+            self._ensure_image_template_index(vi.dc_info)
+
         with lockutils.lock(str(vi.cache_image_path),
                             lock_file_prefix='nova-vmware-fetch_image'):
             self.check_cache_folder(vi.datastore.name, vi.datastore.ref)
@@ -1277,6 +1373,8 @@ class VMwareVMOps(object):
 
                 vm_util.mark_vm_as_template(self._session,
                                             vi.instance, templ_vm_ref)
+                self._imagecache.add_image_template(
+                    vi.ii.image_id, vi.datastore.name, templ_vm_ref)
 
                 return templ_vm_ref
             except Exception as create_templ_exc:
@@ -1308,19 +1406,49 @@ class VMwareVMOps(object):
         return templ_vm_inventory_path
 
     def _find_image_template_vm(self, vi):
+        templ_vm_ref = self._imagecache.get_image_template(vi.ii.image_id,
+                                                           vi.datastore.name)
+        if templ_vm_ref is not None:
+            if self._is_known_image_template_vm(vi, templ_vm_ref):
+                return templ_vm_ref
+            self._imagecache.remove_image_template(vi.ii.image_id,
+                                                   vi.datastore.name)
+
         templ_vm_inventory_path = self._build_template_vm_inventory_path(vi)
         templ_vm_ref = vm_util.find_by_inventory_path(self._session,
                                                       templ_vm_inventory_path)
+        if templ_vm_ref:
+            self._imagecache.add_image_template(
+                vi.ii.image_id, vi.datastore.name, templ_vm_ref)
 
         return templ_vm_ref
 
+    def _is_known_image_template_vm(self, vi, templ_vm_ref):
+        """Check that an indexed image-template VM still exists
+
+        The index can be outdated, if another node deleted the VM in the
+        meantime. Reading the name of the VM is cheaper than looking it up by
+        its inventory path.
+        """
+        try:
+            name = self._session._call_method(vutil, "get_object_property",
+                                              templ_vm_ref, "name")
+        except vexc.ManagedObjectNotFoundException:
+            return False
+        return name == self._get_image_template_vm_name(vi.ii.image_id,
+                                                        vi.datastore.name)
+
     def _get_vm_template_for_image(self, context, instance,
-                                   image_info, extra_specs):
+                                   image_info, extra_specs, dc_info):
         templ_instance = copy.deepcopy(instance)
         # Use image UUID instead of instance UUID for creating the
         # VM template.
         templ_instance.uuid = templ_instance.image_ref
 
+        if CONF.vmware.fetch_image_from_other_datastores:
+            # so the spawns of the image don't wait for the listing
+            self._ensure_image_template_index(dc_info)
+
         with lockutils.lock(templ_instance.uuid,
                             lock_file_prefix='nova-vmware-image-template'):
 
@@ -1336,6 +1464,14 @@ class VMwareVMOps(object):
                                           templ_instance,
                                           image_info,
                                           extra_specs)
+            self._imagecache.record_image_boot(
+                vi.ii.image_id,
+                imagecache.ImageBootInfo(
+                    image_id=vi.ii.image_id,
+                    owner=vi.ii.owner,
+                    root_gb=vi.root_gb,
+                    disk_type=vi.ii.disk_type,
+                    storage_policy=extra_specs.storage_policy))
 
             self._imagecache.enlist_image(
                     vi.ii.image_id, vi.datastore, vi.dc_info.ref)
@@ -1353,6 +1489,104 @@ class VMwareVMOps(object):
 
             return templ_vm_ref
 
+    def prewarm_image_templates(self):
+        """Create the image-template VMs of the most booted images in advance
+
+        Otherwise, the first spawn of an image on a datastore has to wait for
+        its image-template VM to be cloned there. The templates are cloned
+        from another datastore, so only images having a template somewhere
+        are pre-warmed. They are only cloned to the datastores a spawn would
+        choose, see _get_image_template_prewarm_datastores(). The clones run
+        in a background thread, so they don't block the periodic task calling
+        us.
+        """
+        count = CONF.vmware.image_template_prewarm_count
+        if (not count or not CONF.vmware.image_as_template or
+                not CONF.vmware.fetch_image_from_other_datastores):
+            return
+
+        if (self._image_template_prewarm_thread is not None and
+                not self._image_template_prewarm_thread.dead):
+            LOG.debug("Pre-warming image-template VMs is still running.")
+            return
+
+        hot_images = self._imagecache.get_hot_images(count)
+        if not hot_images:
+            return
+
+        self._image_template_prewarm_thread = utils.spawn(
+            self._prewarm_image_templates, hot_images)
+
+    def _get_image_template_prewarm_datastores(self, boot_info):
+        """Return the datastores a spawn of the image would choose now
+
+        That's the datastore chosen like for the latest boot of the image and,
+        with hagroups configured, the one chosen for each hagroup, so we get
+        at most one clone per hagroup.
+        """
+        hagroups = [None]
+        if self._datastore_hagroup_regex:
+            hagroups.extend(['A', 'B'])
+        allowed_ds_types = ds_util.get_allowed_datastore_types(
+            boot_info.disk_type)
+
+        datastores = {}
+        for hagroup in hagroups:
+            try:
+                ds = ds_util.get_datastore(
+                    self._session, self._cluster, self._datastore_regex,
+                    boot_info.storage_policy, allowed_ds_types,
+                    datastore_hagroup_regex=(self._datastore_hagroup_regex
+                                             if hagroup else None),
+                    datastore_hagroup=hagroup)
+            except exception.DatastoreNotFound as e:
+                LOG.debug("No datastore to pre-warm image %(image_id)s on "
+                          "for hagroup %(hagroup)s: %(error)s",
+                          {'image_id': boot_info.image_id,
+                           'hagroup': hagroup, 'error': e})
+                continue
+            datastores.setdefault(ds.name, ds)
+        return list(datastores.values())
+
+    def _prewarm_image_templates(self, hot_images):
+        pool = eventlet.GreenPool(
+            CONF.vmware.image_template_prewarm_concurrency)
+        for boot_info in hot_images:
+            for ds in self._get_image_template_prewarm_datastores(boot_info):
+                if self._imagecache.get_image_template(boot_info.image_id,
+                                                       ds.name):
+                    continue
+                pool.spawn_n(self._prewarm_image_template, boot_info, ds)
+        pool.waitall()
+
+    def _prewarm_image_template(self, boot_info, ds):
+        # the clone only needs the image and the size of the template's root
+        # disk from the instance
+        templ_instance = objects.Instance(
+            uuid=boot_info.image_id, project_id=boot_info.owner,
+            flavor=objects.Flavor(root_gb=boot_info.root_gb))
+        image_info = images.VMwareImage(image_id=boot_info.image_id,
+                                        owner=boot_info.owner)
+        try:
+            vi = VirtualMachineInstanceConfigInfo(
+                templ_instance, image_info, ds,
+                self.get_datacenter_ref_and_name(ds.ref), self._imagecache)
+            # same lock as _get_vm_template_for_image(), so we don't clone a
+            # template a spawn is currently creating
+            with lockutils.lock(vi.ii.image_id,
+                                lock_file_prefix='nova-vmware-image-template'):
+                if self._find_image_template_vm(vi):
+                    return
+                LOG.debug("Pre-warming image-template VM of image "
+                          "%(image_id)s on datastore %(ds)s",
+                          {'image_id': vi.ii.image_id, 'ds': ds.name})
+                self._fetch_image_from_other_datastores(vi)
+        except Exception as e:
+            LOG.warning("Pre-warming the image-template VM of image "
+                        "%(image_id)s on datastore %(ds)s failed: %(error)s",
+                        {'image_id': boot_info.image_id, 'ds': ds.name,
+                         'error': e})
+
     def _create_instance_from_image_template(self, context, client_factory,
                                              templ_vm_ref, vi,
                                              extra_specs, network_info,
@@ -1419,8 +1653,12 @@ class VMwareVMOps(object):
         if serial_port_spec:
             reconfig_spec.deviceChange.append(serial_port_spec)
 
-    def update_cluster_placement(self, context, instance, remove=False):
-        self.sync_instance_server_group(context, instance)
+    def update_cluster_placement(self, context, instance, remove=False,
+                                 defer_sync=False):
+        if defer_sync:
+            self.queue_instance_server_group_sync(context, instance)
+        else:
+            self.sync_instance_server_group(context, instance)
         self.update_admin_vm_group_membership(instance, remove=remove)
 
     def sync_instance_server_group(self, context, instance):
@@ -1432,6 +1670,21 @@ class VMwareVMOps(object):
         except nova.exception.InstanceGroupNotFound:
             pass
 
+    def queue_instance_server_group_sync(self, context, instance):
+        """Queue the sync of the instance's server-group, if it has one
+
+        Falls back to syncing right away, if the sync worker isn't running.
+        """
+        try:
+            instance_group_object = objects.instance_group.InstanceGroup
+            server_group = instance_group_object.get_by_instance_uuid(
+                context, instance.uuid)
+        except nova.exception.InstanceGroupNotFound:
+            return
+
+        if not self.queue_server_group_sync(server_group.uuid):
+            self.sync_server_group(context, server_group.uuid)
+
     @staticmethod
     def _get_admin_group_name_for_instance(instance):
         vm_group_name = CONF.vmware.special_spawning_vm_group
@@ -1462,6 +1715,19 @@ class VMwareVMOps(object):
 
     def spawn(self, context, instance, image_meta, injected_files,
               admin_password, network_info, block_device_info=None):
+        spawned = False
+        try:
+            self._spawn(context, instance, image_meta, injected_files,
+                        admin_password, network_info, block_device_info)
+            spawned = True
+        finally:
+            # reserved by _get_vm_config_info() for choosing the datastore
+            ds_util.release_datastore_space(instance.uuid)
+            # recorded by _stack_vm_to_host_if_needed() for choosing the host
+            self._finish_stacked_vm(instance, spawned)
+
+    def _spawn(self, context, instance, image_meta, injected_files,
+               admin_password, network_info, block_device_info=None):
 
         client_factory = self._session.vim.client.factory
         image_info = images.VMwareImage.from_image(context,
@@ -1470,7 +1736,7 @@ class VMwareVMOps(object):
         extra_specs = self._get_extra_specs(instance.flavor, image_meta)
 
         vi = self._get_vm_config_info(context, instance, image_info,
-                                      extra_specs)
+                                      extra_specs, reserve_space=True)
 
         boot_from_volume = compute_utils.is_volume_backed_instance(
                                                 instance._context, instance)
@@ -1480,7 +1746,7 @@ class VMwareVMOps(object):
         if CONF.vmware.image_as_template and instance.image_ref \
                 and not boot_from_volume:
             templ_vm_ref = self._get_vm_template_for_image(
-                context, instance, image_info, extra_specs)
+                context, instance, image_info, extra_specs, vi.dc_info)
             vm_ref = self._create_instance_from_image_template(
                 context, client_factory, templ_vm_ref, vi,
                 extra_specs, network_info, host_ref=host_ref)
@@ -1502,81 +1768,85 @@ class VMwareVMOps(object):
         # instance uuid.
         vm_util.vm_ref_cache_update(instance.uuid, vm_ref)
 
-        # Update all DRS related rules
-        self.update_cluster_placement(context, instance)
-
-        # Update the Neutron VNIC index
-        self._update_vnic_index(context, instance, network_info)
-
-        # Set the machine.id parameter of the instance to inject
-        # the NIC configuration inside the VM
-        if CONF.flat_injected:
-            self._set_machine_id(client_factory, instance, network_info,
-                                vm_ref=vm_ref)
-
-        # Set the vnc configuration of the instance, vnc port starts from 5900
-        if CONF.vnc.enabled:
-            self._get_and_set_vnc_config(client_factory, instance, vm_ref)
-
-        block_device_mapping = []
-        if block_device_info is not None:
-            block_device_mapping = driver.block_device_info_get_mapping(
-                block_device_info)
-
-        if instance.image_ref and not CONF.vmware.image_as_template \
-                and not boot_from_volume:
-            self._imagecache.enlist_image(
-                    image_info.image_id, vi.datastore, vi.dc_info.ref)
-            self._fetch_image_if_missing(context, vi)
+        # Update all DRS related rules and the Neutron VNIC index. Neither
+        # touches the VM itself, so we don't have to wait for them before
+        # configuring the VM and its disks.
+        placement_thread = utils.spawn(self._update_placement_and_vnic_index,
+                                       context, instance, network_info)
+        try:
+            # Set the machine.id parameter of the instance to inject the NIC
+            # configuration inside the VM and the vnc configuration of the
+            # instance in a single reconfigure
+            self._set_machine_id_and_vnc_config(client_factory, instance,
+                                                vm_ref, network_info)
+
+            block_device_mapping = []
+            if block_device_info is not None:
+                block_device_mapping = driver.block_device_info_get_mapping(
+                    block_device_info)
+
+            if instance.image_ref and not CONF.vmware.image_as_template \
+                    and not boot_from_volume:
+                self._imagecache.enlist_image(
+                        image_info.image_id, vi.datastore, vi.dc_info.ref)
+                self._fetch_image_if_missing(context, vi)
 
-            if image_info.is_iso:
-                self._use_iso_image(vm_ref, vi)
-            elif image_info.linked_clone:
-                self._use_disk_image_as_linked_clone(vm_ref, vi)
-            else:
-                self._use_disk_image_as_full_clone(vm_ref, vi)
-
-        if block_device_mapping:
-            msg = "Block device information present: %s" % block_device_info
-            # NOTE(mriedem): block_device_info can contain an auth_password
-            # so we have to scrub the message before logging it.
-            LOG.debug(strutils.mask_password(msg), instance=instance)
-
-            # Before attempting to attach any volume, make sure the
-            # block_device_mapping (i.e. disk_bus) is valid
-            self._is_bdm_valid(block_device_mapping)
-
-            for disk in sorted(block_device_mapping,
-                               key=lambda x: x.get('boot_index') != 0):
-                connection_info = disk['connection_info']
-                adapter_type = disk.get('disk_bus') or vi.ii.adapter_type
-
-                # TODO(hartsocks): instance is unnecessary, remove it
-                # we still use instance in many locations for no other purpose
-                # than logging, can we simplify this?
-                if disk.get('boot_index') == 0:
-                    self._volumeops.attach_root_volume(connection_info,
-                        instance, vi.datastore.ref, adapter_type)
+                if image_info.is_iso:
+                    self._use_iso_image(vm_ref, vi)
+                elif image_info.linked_clone:
+                    self._use_disk_image_as_linked_clone(vm_ref, vi)
                 else:
-                    self._volumeops.attach_volume(connection_info,
-                        instance, adapter_type)
-
-        # Create ephemeral disks
-        self._create_ephemeral(block_device_info, instance, vm_ref,
-                               vi.dc_info, vi.datastore, instance.uuid,
-                               vi.ii.adapter_type)
-        self._create_swap(block_device_info, instance, vm_ref, vi.dc_info,
-                          vi.datastore, instance.uuid, vi.ii.adapter_type)
-
-        if configdrive.required_by(instance):
-            self._configure_config_drive(
-                    context, instance, vm_ref, vi.dc_info, vi.datastore,
-                    injected_files, admin_password, network_info)
-
-        # Rename the VM. This is done after the spec is created to ensure
-        # that all of the files for the instance are under the directory
-        # 'uuid' of the instance
-        vm_util.rename_vm(self._session, vm_ref, instance)
+                    self._use_disk_image_as_full_clone(vm_ref, vi)
+
+            if block_device_mapping:
+                msg = ("Block device information present: %s" %
+                       block_device_info)
+                # NOTE(mriedem): block_device_info can contain an auth_password
+                # so we have to scrub the message before logging it.
+                LOG.debug(strutils.mask_password(msg), instance=instance)
+
+                # Before attempting to attach any volume, make sure the
+                # block_device_mapping (i.e. disk_bus) is valid
+                self._is_bdm_valid(block_device_mapping)
+
+                volumes = []
+                for disk in sorted(block_device_mapping,
+                                   key=lambda x: x.get('boot_index') != 0):
+                    connection_info = disk['connection_info']
+                    adapter_type = disk.get('disk_bus') or vi.ii.adapter_type
+
+                    # TODO(hartsocks): instance is unnecessary, remove it
+                    # we still use instance in many locations for no other
+                    # purpose than logging, can we simplify this?
+                    if disk.get('boot_index') == 0:
+                        self._volumeops.attach_root_volume(connection_info,
+                            instance, vi.datastore.ref, adapter_type)
+                    else:
+                        volumes.append((connection_info, adapter_type))
+                # Attach the remaining volumes with a single reconfigure
+                self._volumeops.attach_volumes(volumes, instance)
+
+            # Create ephemeral disks
+            self._create_ephemeral(block_device_info, instance, vm_ref,
+                                   vi.dc_info, vi.datastore, instance.uuid,
+                                   vi.ii.adapter_type)
+            self._create_swap(block_device_info, instance, vm_ref, vi.dc_info,
+                              vi.datastore, instance.uuid, vi.ii.adapter_type)
+
+            if configdrive.required_by(instance):
+                self._configure_config_drive(
+                        context, instance, vm_ref, vi.dc_info, vi.datastore,
+                        injected_files, admin_password, network_info)
+
+            # Rename the VM. This is done after the spec is created to ensure
+            # that all of the files for the instance are under the directory
+            # 'uuid' of the instance
+            vm_util.rename_vm(self._session, vm_ref, instance)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                self._wait_for_thread_ignoring_errors(placement_thread,
+                                                      instance)
+        placement_thread.wait()
 
         # Make sure we don't automatically move around "big" VMs
         self.disable_drs_if_needed(instance)
@@ -1595,6 +1865,23 @@ class VMwareVMOps(object):
         self._clean_up_after_special_spawning(context, instance.memory_mb,
                                               instance.flavor)
 
+    def _update_placement_and_vnic_index(self, context, instance,
+                                         network_info):
+        self.update_cluster_placement(context, instance)
+        self._update_vnic_index(context, instance, network_info)
+
+    @staticmethod
+    def _wait_for_thread_ignoring_errors(thread, instance):
+        """Wait for a helper thread of an already failed operation
+
+        Its own error, if any, is only logged to not hide the original one.
+        """
+        try:
+            thread.wait()
+        except Exception as e:
+            LOG.warning("Concurrent step failed, too: %s", e,
+                        instance=instance)
+
     def disable_drs_if_needed(self, instance):
         if utils.is_big_vm(int(instance.memory_mb), instance.flavor) or \
                 utils.is_large_vm(int(instance.memory_mb), instance.flavor):
@@ -1673,35 +1960,53 @@ class VMwareVMOps(object):
             return None
         LOG.info("DRS is disabled and stacking VMs was enabled.")
 
-        hosts_free = []
-        hosts_full = []
-        for host_ref_value, info in vm_util.get_stats_from_cluster_per_host(
-                self._session, self._cluster).items():
-            if not info['available']:
-                continue
-            memory_mb_free = (info['memory_mb'] -
-                              info['memory_mb_used'])
-            if memory_mb_free < instance.memory_mb:
-                hosts_full.append((info['name'], memory_mb_free))
-            else:
-                hosts_free.append({'host_ref_value': host_ref_value,
-                                   'name': info['name'],
-                                   'memory_mb_free': memory_mb_free})
-
-        if hosts_full:
-            LOG.debug("Placing VM with %(memory_mb)s MiB ignored hosts "
-                      "without enough free memory %(hosts_full)s",
-                      {'memory_mb': instance.memory_mb,
-                       'hosts_full': hosts_full})
-        if not hosts_free:
-            reason = "Didn't find a host with enough memory to fit the VM."
-            raise exception.InstanceUnacceptable(instance_id=instance.uuid,
-                                                 reason=reason)
+        # the VM will become a member of the admin group, so the group's
+        # mandatory rules apply
+        vm_group_name = self._get_admin_group_name_for_instance(instance)
+        with lockutils.lock('vmware-stack-vms'):
+            # the host stats of the last update and the rules of the last
+            # server-group sync are recent enough for choosing a host, as
+            # long as we account for the VMs stacked since then
+            host_stats = self._vc_state.get_per_host_stats()
+            model = placement_model.ClusterPlacementModel.from_cluster_config(
+                self._session, host_stats, self._get_cluster_config())
+            for uuid, stacked in list(self._stacked_vms.items()):
+                host, memory_mb, spawned_stats = stacked
+                if spawned_stats is not None and \
+                        spawned_stats is not host_stats:
+                    # the host stats got updated after the VM was spawned,
+                    # so they contain it already
+                    del self._stacked_vms[uuid]
+                    continue
+                model.add_vm(host, memory_mb)
+
+            host_ref_value = model.select_host(instance.memory_mb,
+                                               vm_group_name=vm_group_name,
+                                               stack=True)
+            if host_ref_value is None:
+                reason = "Didn't find a host with enough memory to fit the VM."
+                raise exception.InstanceUnacceptable(
+                    instance_id=instance.uuid, reason=reason)
+            self._stacked_vms[instance.uuid] = (host_ref_value,
+                                                instance.memory_mb, None)
 
-        info = sorted(hosts_free, key=itemgetter('memory_mb_free'))[0]
         LOG.debug("Stacking instance %(instance)s on host %(host)s.",
-                  {'instance': instance.uuid, 'host': info['name']})
-        return vutil.get_moref(info['host_ref_value'], "HostSystem")
+                  {'instance': instance.uuid, 'host': host_ref_value})
+        return vutil.get_moref(host_ref_value, "HostSystem")
+
+    def _finish_stacked_vm(self, instance, spawned):
+        """Stop accounting for a VM stacked onto a host, if it failed to spawn
+
+        A spawned VM is accounted for until the next update of the host
+        stats, because only then they contain its memory.
+        """
+        with lockutils.lock('vmware-stack-vms'):
+            stacked = self._stacked_vms.pop(instance.uuid, None)
+            if stacked is None or not spawned:
+                return
+            host, memory_mb, _ = stacked
+            self._stacked_vms[instance.uuid] = (
+                host, memory_mb, self._vc_state.get_per_host_stats())
 
     def _is_bdm_valid(self, block_device_mapping):
         """Checks if the block device mapping is valid."""
@@ -2119,6 +2424,22 @@ class VMwareVMOps(object):
         self._destroy_instance(context, instance, destroy_disks=destroy_disks)
         LOG.debug("Instance destroyed", instance=instance)
 
+        # the VM is gone, so its server-group's DRS rule needs an update.
+        # Without a running sync worker, we leave this to the sync-loop.
+        if self._server_group_sync_worker is None:
+            return
+
+        try:
+            instance_group_object = objects.instance_group.InstanceGroup
+            server_group = instance_group_object.get_by_instance_uuid(
+                context, instance.uuid)
+            self.queue_server_group_sync(server_group.uuid)
+        except nova.exception.InstanceGroupNotFound:
+            pass
+        except Exception as e:
+            LOG.warning("Could not queue the server-group sync: %s", e,
+                        instance=instance)
+
     def pause(self, instance):
         msg = _("pause not supported for vmwareapi")
         raise NotImplementedError(msg)
@@ -2166,6 +2487,7 @@ class VMwareVMOps(object):
         return vm_util.find_rescue_device(hardware_devices,
                                           instance)
 
+    @vm_util.device_snapshot()
     def rescue(self, context, instance, network_info, image_meta):
         """Rescue the specified instance.
 
@@ -2223,6 +2545,7 @@ class VMwareVMOps(object):
         vm_util.reconfigure_vm(self._session, vm_ref, boot_spec)
         vm_util.power_on_instance(self._session, instance, vm_ref=vm_ref)
 
+    @vm_util.device_snapshot()
     def unrescue(self, instance, power_on=True):
         """Unrescue the specified instance."""
 
@@ -2361,7 +2684,9 @@ class VMwareVMOps(object):
         if not skip_update:
             self.update_cached_instances()
         vm_ref = vm_util.get_vm_ref(self._session, instance)
-        vm_props = vm_util._VM_VALUE_CACHE.get(vm_ref.value, {})
+        vm_props = {}
+        if self.is_vm_cache_fresh():
+            vm_props = vm_util._VM_VALUE_CACHE.get(vm_ref.value, {})
 
         if set(vm_props.keys()).issuperset(lst_properties):
             return vm_props
@@ -2493,6 +2818,9 @@ class VMwareVMOps(object):
                               str(resized_disk))
             self._extend_virtual_disk(instance, root_disk_in_kb, resized_disk,
                                       dc_info.ref)
+            # extending the disk doesn't reconfigure the VM, so the devices
+            # known from before still have the old capacity
+            vm_util.invalidate_device_snapshot(vm_ref)
             self._volumeops.detach_disk_from_vm(vm_ref, instance, vmdk.device)
             original_disk = str(ds_obj.DatastorePath(datastore, folder,
                                 'original.vmdk'))
@@ -2848,6 +3176,7 @@ class VMwareVMOps(object):
             finally:
                 self._attach_volumes(instance, block_device_info, adapter_type)
 
+    @vm_util.device_snapshot()
     def finish_migration(self, context, migration, instance, disk_info,
                          network_info, image_meta, resize_instance=False,
                          block_device_info=None, power_on=True):
@@ -2908,14 +3237,9 @@ class VMwareVMOps(object):
         # 10. Start VM
         client_factory = self._session.vim.client.factory
         # Set the machine.id parameter of the instance to inject
-        # the NIC configuration inside the VM
-        if CONF.flat_injected:
-            self._set_machine_id(client_factory, instance, network_info,
-                                 vm_ref=vm_ref)
-
-        # Set the vnc configuration of the instance, vnc port starts from 5900
-        if CONF.vnc.enabled:
-            self._get_and_set_vnc_config(client_factory, instance, vm_ref)
+        # the NIC configuration inside the VM and the vnc configuration
+        self._set_machine_id_and_vnc_config(client_factory, instance, vm_ref,
+                                            network_info)
 
         self._update_instance_progress(context, instance,
                                        step=11,
@@ -3245,6 +3569,7 @@ class VMwareVMOps(object):
         reconfig_task = self._session._call_method(self._session.vim,
                                                    "ReconfigVM_Task", vm_ref,
                                                    spec=config_spec)
+        vm_util.invalidate_device_snapshot(vm_ref)
         task_completed = threading.Event()
 
         def set_task_completed(gt):
@@ -3284,28 +3609,25 @@ class VMwareVMOps(object):
         disks = driver.block_device_info_get_mapping(block_device_info)
         # Detach the volumes in reverse order, so if we roll it back
         # that the device order will still be preserved
-        for disk in sorted(disks,
-                           reverse=True,
-                           key=itemgetter('mount_device')):
-            try:
-                self._volumeops.detach_volume(disk['connection_info'],
-                                              instance)
-            except exception.DiskNotFound:
-                LOG.warning(("Cannot find disk {}."
-                             " Assuming it to be removed").format(disk))
+        connection_infos = [disk['connection_info']
+                            for disk in sorted(disks,
+                                               reverse=True,
+                                               key=itemgetter('mount_device'))]
+        self._volumeops.detach_volumes(connection_infos, instance)
 
     def _attach_volumes(self, instance, block_device_info, adapter_type,
                         existing_disks=None):
         disks = driver.block_device_info_get_mapping(block_device_info)
         # make sure the disks are attached by the device_name order
+        volumes = []
         for disk in sorted(disks,
                            key=itemgetter('mount_device')):
             if existing_disks and disk['volume_id'] in existing_disks:
                 continue
 
             adapter_type = disk.get('disk_bus') or adapter_type
-            self._volumeops.attach_volume(disk['connection_info'], instance,
-                                          adapter_type)
+            volumes.append((disk['connection_info'], adapter_type))
+        self._volumeops.attach_volumes(volumes, instance)
 
     def _find_esx_host(self, cluster_ref, ds_ref):
         """Find ESX host in the specified cluster which is also connected to
@@ -3520,6 +3842,32 @@ class VMwareVMOps(object):
         return hardware.InstanceInfo(
             state=constants.POWER_STATES[vm_props[powerstate_property]])
 
+    def get_power_states(self):
+        """Return a dict of instance uuid to power state for all instances
+
+        Uses the property-collector cache if it's fresh and otherwise lists
+        all VMs in the cluster in one go.
+        """
+        powerstate_property = 'runtime.powerState'
+        self.update_cached_instances()
+        if self.is_vm_cache_fresh():
+            vms = [(props["config.instanceUuid"], props)
+                   for props in list(vm_util._VM_VALUE_CACHE.values())
+                   if props.get("config.managedBy") and
+                       "config.instanceUuid" in props]
+        else:
+            vms = self._list_instances_in_cluster([powerstate_property])
+
+        power_states = {}
+        for vm_uuid, props in vms:
+            vm_power_state = props.get(powerstate_property)
+            if vm_power_state is None:
+                continue
+            power_states[vm_uuid] = constants.POWER_STATES[vm_power_state]
+
+        LOG.debug("Got power states of %d instances", len(power_states))
+        return power_states
+
     def _get_diagnostics(self, instance):
         """Return data about VM diagnostics."""
         lst_properties = ["summary.config",
@@ -3618,12 +3966,46 @@ class VMwareVMOps(object):
         LOG.debug("Reconfigured VM instance to set the machine id",
                   instance=instance)
 
+    def _set_machine_id_and_vnc_config(self, client_factory, instance,
+                                       vm_ref, network_info):
+        """Set the machine id and the vnc configuration of a new VM
+
+        Both only add extraConfig options, so they're applied in a single
+        reconfigure of the VM.
+        """
+        extra_config = []
+        if CONF.flat_injected:
+            machine_id_change_spec = vm_util.get_machine_id_change_spec(
+                client_factory, self._get_machine_id_str(network_info))
+            extra_config.extend(machine_id_change_spec.extraConfig)
+
+        # vnc port starts from 5900
+        if CONF.vnc.enabled:
+            self._get_and_set_vnc_config(client_factory, instance, vm_ref,
+                                         extra_config=extra_config)
+        elif extra_config:
+            config_spec = client_factory.create(
+                'ns0:VirtualMachineConfigSpec')
+            config_spec.extraConfig = extra_config
+            LOG.debug("Reconfiguring VM instance to set the machine id",
+                      instance=instance)
+            vm_util.reconfigure_vm(self._session, vm_ref, config_spec)
+            LOG.debug("Reconfigured VM instance to set the machine id",
+                      instance=instance)
+
     @utils.synchronized('vmware.get_and_set_vnc_port')
-    def _get_and_set_vnc_config(self, client_factory, instance, vm_ref):
-        """Set the vnc configuration of the VM."""
+    def _get_and_set_vnc_config(self, client_factory, instance, vm_ref,
+                                extra_config=None):
+        """Set the vnc configuration of the VM.
+
+        Other `extra_config` options get applied in the same reconfigure.
+        """
         port = vm_util.get_vnc_port(self._session)
         vnc_config_spec = vm_util.get_vnc_config_spec(
                                       client_factory, port)
+        if extra_config:
+            vnc_config_spec.extraConfig = (list(extra_config) +
+                                           vnc_config_spec.extraConfig)
 
         LOG.debug("Reconfiguring VM instance to enable vnc on "
                   "port - %(port)s", {'port': port},
@@ -3699,9 +4081,30 @@ class VMwareVMOps(object):
         self._age_cached_image_templates(dc_info)
 
     def _age_cached_image_templates(self, dc_info):
-        images_folders = self._get_all_images_folders(dc_info)
-        for folder_ref in images_folders:
-            self._destroy_expired_image_templates(folder_ref)
+        folders_templ_vms = [(folder_ref,
+                              self._get_image_template_vms(folder_ref) or [])
+                             for folder_ref in
+                             self._get_all_images_folders(dc_info)]
+        self._set_image_template_index(
+            templ_vm for _, templ_vms in folders_templ_vms
+            for templ_vm in templ_vms)
+        self._destroy_expired_image_templates(folders_templ_vms)
+
+    def _update_image_template_index(self, dc_info):
+        """Fill the image cache index with all image-template VMs"""
+        templ_vms = []
+        for folder_ref in self._get_all_images_folders(dc_info):
+            templ_vms.extend(self._get_image_template_vms(folder_ref) or [])
+        self._set_image_template_index(templ_vms)
+
+    def _set_image_template_index(self, templ_vms):
+        templates = []
+        for templ_vm_ref, templ_vm_name in templ_vms:
+            image_id, ds_name = self._parse_image_template_vm_name(
+                templ_vm_name)
+            if image_id:
+                templates.append((image_id, ds_name, templ_vm_ref))
+        self._imagecache.set_image_templates(templates)
 
     def _get_all_images_folders(self, dc_info):
         """Return all Folder morefs containing image templates
@@ -3776,36 +4179,69 @@ class VMwareVMOps(object):
                 else:
                     raise
 
-    def _destroy_expired_image_templates(self, templ_vm_folder_ref):
-        templ_vms = self._get_image_template_vms(templ_vm_folder_ref)
-        if not templ_vms:
+    def _get_used_image_templates(self, templ_vm_folder_ref, templ_vms,
+                                  min_age):
+        """Return the moref values of the `templ_vms` used recently
+
+        A template counts as used, if it was created or cloned from within
+        the last `min_age` seconds. The task history is filtered by the
+        folder and the time in the vCenter, so it only returns the recent
+        tasks of this folder's templates.
+        """
+        unused_templ_vms = set(moref.value for moref, _ in templ_vms)
+        client_factory = self._session.vim.client.factory
+        task_filter_spec = vm_util.create_task_filter_spec(
+            client_factory, entity=templ_vm_folder_ref, recursion="children",
+            begin_time=(timeutils.utcnow() -
+                        datetime.timedelta(seconds=min_age)))
+
+        used_templ_vms = set()
+        with vm_util.TaskHistoryCollectorItems(
+                self._session, task_filter_spec,
+                max_page_size=100) as templ_tasks:
+            for ti in templ_tasks.items(
+                    stop_when=lambda ti: not unused_templ_vms):
+                # Look for template creation or clone from template. The
+                # TaskFilterSpec cannot filter by descriptionId.
+                if ti.descriptionId not in ["ResourcePool.ImportVAppLRO",
+                                            "VirtualMachine.clone"]:
+                    continue
+                # the vCenter already filters by time, but we don't want to
+                # keep a template because of a clock skew between us and the
+                # vCenter
+                if timeutils.is_older_than(ti.queueTime, min_age):
+                    continue
+                used_templ_vms.add(ti.entity.value)
+                unused_templ_vms.discard(ti.entity.value)
+        return used_templ_vms
+
+    def _destroy_expired_image_templates(self, folders_templ_vms):
+        """Destroy the image-template VMs not used for a while
+
+        `folders_templ_vms` is a list of (folder_ref, templ_vms) tuples. The
+        task history of the folders is queried concurrently, one collector
+        per folder limited to the minimum age of an unused image. The expired
+        templates get destroyed concurrently, too, both limited by
+        `CONF.vmware.image_template_cleanup_concurrency`.
+        """
+        folders_templ_vms = [(folder_ref, templ_vms)
+                             for folder_ref, templ_vms in folders_templ_vms
+                             if templ_vms]
+        if not folders_templ_vms:
             return
         expired_templ_vms = {moref.value: (moref, name)
+                             for _, templ_vms in folders_templ_vms
                              for moref, name in templ_vms}
+        min_age = CONF.image_cache.remove_unused_original_minimum_age_seconds
 
-        client_factory = self._session.vim.client.factory
-        task_filter_spec = client_factory.create('ns0:TaskFilterSpec')
-        task_filter_spec.entity = client_factory.create(
-                                        'ns0:TaskFilterSpecByEntity')
-        task_filter_spec.entity.entity = templ_vm_folder_ref
-        task_filter_spec.entity.recursion = "children"
-
-        templ_tasks = vm_util.TaskHistoryCollectorItems(
-            self._session, task_filter_spec, reverse_page_order=True)
-
-        for ti in templ_tasks:
-            # Look for template creation or clone from template
-            if ti.descriptionId in ["ResourcePool.ImportVAppLRO",
-                                    "VirtualMachine.clone"]:
-                templ_vm_ref = ti.entity
-                if timeutils.is_older_than(ti.queueTime,
-                    CONF.image_cache.
-                        remove_unused_original_minimum_age_seconds):
-                    break
-                else:
-                    expired_templ_vms.pop(templ_vm_ref.value, None)
-                    if not expired_templ_vms:
-                        break
+        pool = eventlet.GreenPool(
+            CONF.vmware.image_template_cleanup_concurrency)
+        for used_templ_vms in pool.starmap(
+                self._get_used_image_templates,
+                [(folder_ref, templ_vms, min_age)
+                 for folder_ref, templ_vms in folders_templ_vms]):
+            for templ_vm_value in used_templ_vms:
+                expired_templ_vms.pop(templ_vm_value, None)
 
         if not expired_templ_vms:
             return
@@ -3857,20 +4293,27 @@ class VMwareVMOps(object):
             expired_templ_vms[key] = (templ_vm_ref, templ_vm_name, 'unknown')
 
         for templ_vm_ref, templ_vm_name, ds_name in expired_templ_vms.values():
-            # we take the lock here on a best-effort basis to guard against us
-            # deleting an image-cache VM while it's disk is currently getting
-            # copied into the image-cache
-            # name looks like "$UUID ($ds)"
-            templ_vm_image_uuid = templ_vm_name.split(' ')[0]
-            cache_image_file_name = "{}.vmdk".format(templ_vm_image_uuid)
-            cache_image_path = ds_obj.DatastorePath(ds_name,
-                                                    self._base_folder,
-                                                    templ_vm_image_uuid,
-                                                    cache_image_file_name)
-            with lockutils.lock(str(cache_image_path),
-                                lock_file_prefix='nova-vmware-fetch_image'):
-                msg = "Destroying expired image-template VM {}"
-                LOG.debug(msg.format(templ_vm_name))
+            pool.spawn_n(self._destroy_expired_image_template,
+                         templ_vm_ref, templ_vm_name, ds_name)
+        pool.waitall()
+
+    def _destroy_expired_image_template(self, templ_vm_ref, templ_vm_name,
+                                        ds_name):
+        # we take the lock here on a best-effort basis to guard against us
+        # deleting an image-cache VM while it's disk is currently getting
+        # copied into the image-cache
+        # name looks like "$UUID ($ds)"
+        templ_vm_image_uuid = templ_vm_name.split(' ')[0]
+        cache_image_file_name = "{}.vmdk".format(templ_vm_image_uuid)
+        cache_image_path = ds_obj.DatastorePath(ds_name,
+                                                self._base_folder,
+                                                templ_vm_image_uuid,
+                                                cache_image_file_name)
+        with lockutils.lock(str(cache_image_path),
+                            lock_file_prefix='nova-vmware-fetch_image'):
+            msg = "Destroying expired image-template VM {}"
+            LOG.debug(msg.format(templ_vm_name))
+            try:
                 try:
                     vm_util.destroy_vm(self._session, None, templ_vm_ref)
                 except vexc.VimFaultException as e:
@@ -3883,6 +4326,16 @@ class VMwareVMOps(object):
                             # we unregister instead of destroying then, because
                             # we can't use it anymore anyways.
                             self._unregister_template_vm(templ_vm_ref)
+            except Exception:
+                # one failing template shouldn't stop the others from being
+                # cleaned up. we retry in the next aging run.
+                LOG.exception("Failed to destroy expired image-template VM %s",
+                              templ_vm_name)
+                return
+            templ_vm_image_id, templ_vm_ds_name = \
+                self._parse_image_template_vm_name(templ_vm_name)
+            self._imagecache.remove_image_template(templ_vm_image_id,
+                                                   templ_vm_ds_name)
 
     def _get_valid_vms_from_retrieve_result(self, retrieve_result,
                                             return_properties=False,
@@ -3934,6 +4387,7 @@ class VMwareVMOps(object):
         except exception.InstanceNotFound:
             return False
 
+    @vm_util.device_snapshot()
     def attach_interface(self, context, instance, image_meta, vif):
         """Attach an interface to the instance."""
         vif_model = image_meta.properties.get('hw_vif_model',
@@ -3968,6 +4422,7 @@ class VMwareVMOps(object):
 
         LOG.debug("Reconfigured VM to attach interface", instance=instance)
 
+    @vm_util.device_snapshot()
     def detach_interface(self, context, instance, vif):
         """Detach an interface from the instance."""
         vm_ref = vm_util.get_vm_ref(self._session, instance)
@@ -4142,14 +4597,26 @@ class VMwareVMOps(object):
         return ds_util.get_dc_info(self._session, ds_ref)
 
     def list_instances(self):
-        if not CONF.vmware.use_property_collector:
-            lst_vm_names = self._list_instances_in_cluster()
-        else:
+        """Return the uuids of the instances in the cluster
+
+        They are served from the VM cache if it's fresh. Otherwise, we fall
+        back to reading all VMs of the cluster from the vCenter.
+        """
+        lst_vm_names = None
+        if CONF.vmware.use_property_collector:
             self.update_cached_instances()
-            lst_vm_names = [item["config.instanceUuid"]
-                            for item in vm_util._VM_VALUE_CACHE.values()
-                            if "config.instanceUuid" in item and
-                                item.get("config.managedBy")]
+            if self.is_vm_cache_fresh():
+                lst_vm_names = [item["config.instanceUuid"]
+                                for item in list(
+                                    vm_util._VM_VALUE_CACHE.values())
+                                if "config.instanceUuid" in item and
+                                    item.get("config.managedBy")]
+            else:
+                LOG.debug("VM cache is not fresh (%s). Listing instances "
+                          "from the vCenter.", self.get_vm_cache_info())
+
+        if lst_vm_names is None:
+            lst_vm_names = self._list_instances_in_cluster()
 
         LOG.debug("Got total of %s instances", str(len(lst_vm_names)))
 
@@ -4218,75 +4685,243 @@ class VMwareVMOps(object):
             else:
                 yield change.name, val
 
-    @utils.synchronized("vmware.update_cache")
     def update_cached_instances(self):
+        """Bring the property-collector cache up-to-date
+
+        If the background watcher is running, it keeps the cache current and
+        we must not interfere with its pending WaitForUpdatesEx call.
+        Otherwise, we drain all pending updates from the vCenter.
+        """
         if not CONF.vmware.use_property_collector:
             return
 
+        if self._property_collector_watcher_running:
+            return
+
+        self._drain_property_collector()
+
+    @utils.synchronized("vmware.update_cache")
+    def _drain_property_collector(self):
+        # the watcher might have been started while we waited for the lock
+        if self._property_collector_watcher_running:
+            return
+
+        try:
+            self._wait_for_property_collector_updates(0)
+        except vexc.ManagedObjectNotFoundException:
+            # the property collector lives in the session, so it's gone after
+            # a re-login
+            LOG.info("Property collector vanished. Probably the session got "
+                     "lost. Doing a full resync.")
+            self._reset_property_collector()
+            self._wait_for_property_collector_updates(0)
+
+    def _create_property_collector(self):
+        vim = self._session.vim
+        pc = vim.service_content.propertyCollector
+        self._property_collector = self._session._call_method(
+            vim, "CreatePropertyCollector", pc)
+        self._property_collector_version = ''
+        vim.CreateFilter(self._property_collector,
+            spec=self._get_vm_monitor_spec(vim),
+            partialUpdates=False)
+
+    def _reset_property_collector(self):
+        """Forget the property collector and everything it told us
+
+        The next update will create a new property collector, which starts
+        with a full update of all VMs in the cluster.
+        """
+        pc = self._property_collector
+        self._property_collector = None
+        self._property_collector_version = ''
+        self._property_collector_last_sync = None
+        vm_util.vm_value_cache_reset()
+
+        if pc is None:
+            return
+
+        try:
+            self._session._call_method(self._session.vim,
+                                       "DestroyPropertyCollector", pc)
+        except Exception as e:
+            # the collector is gone with the session it was created in
+            LOG.debug("Could not destroy property collector %s: %s",
+                      vutil.get_moref_value(pc), e)
+
+    def _wait_for_property_collector_updates(self, max_wait_seconds):
+        """Apply all updates the vCenter has for our property collector
+
+        Blocks up to `max_wait_seconds` for the first update to arrive and
+        returns as soon as no more updates are pending.
+        """
         vim = self._session.vim
-        options = self._session.vim.client.factory.create("ns0:WaitOptions")
-        options.maxWaitSeconds = 0
+        options = vim.client.factory.create("ns0:WaitOptions")
+        options.maxWaitSeconds = max_wait_seconds
 
         if self._property_collector is None:
-            pc = vim.service_content.propertyCollector
-            self._property_collector = self._session._call_method(
-                self._session.vim,
-                "CreatePropertyCollector", pc)
-            vim.CreateFilter(self._property_collector,
-                spec=self._get_vm_monitor_spec(vim),
-                partialUpdates=False)
+            self._create_property_collector()
 
-        update_set = vim.WaitForUpdatesEx(self._property_collector,
-            version=self._property_collector_version,
-            options=options)
+        while True:
+            update_set = self._session._call_method(vim, "WaitForUpdatesEx",
+                self._property_collector,
+                version=self._property_collector_version,
+                options=options)
+            if not update_set:
+                break
 
-        while update_set:
             self._property_collector_version = update_set.version
-            if update_set.filterSet and update_set.filterSet[0].objectSet:
-                for update in update_set.filterSet[0].objectSet:
-                    vm_ref = update.obj
-                    if vm_ref["_type"] != "VirtualMachine":
+            self._apply_property_collector_update_set(update_set)
+
+            # a truncated update set means there are more updates pending
+            # right away and we're not in sync with the vCenter yet
+            if not getattr(update_set, "truncated", False):
+                self._property_collector_last_sync = time.monotonic()
+            options.maxWaitSeconds = 0
+
+        self._property_collector_last_sync = time.monotonic()
+
+    def _apply_property_collector_update_set(self, update_set):
+        if not (update_set.filterSet and update_set.filterSet[0].objectSet):
+            return
+
+        for update in update_set.filterSet[0].objectSet:
+            vm_ref = update.obj
+            if vutil.get_moref_type(vm_ref) != "VirtualMachine":
+                continue
+            values = vm_util._VM_VALUE_CACHE[vm_ref.value]
+
+            if update.kind == "leave":
+                instance_uuid = values.get("config.instanceUuid")
+                vm_util.vm_ref_cache_delete(instance_uuid)
+                vm_util.vm_value_cache_delete(vm_ref.value)
+                LOG.debug("Removed instance %s (%s) from cache...",
+                          instance_uuid, vm_ref.value)
+                continue
+
+            changes = dict(self._parse_change_set(update.changeSet))
+            LOG.debug("VirtualMachine.%s.%s: %s", update.kind,
+                      vm_ref.value, changes)
+            if not (changes.get("config.managedBy") or
+                    values.get("config.managedBy")):
+                LOG.debug("%s Not managed by nova", vm_ref.value)
+                continue
+
+            instance_uuid = changes.get("config.instanceUuid")
+
+            if update.kind == "enter":
+                vm_util.vm_ref_cache_update(instance_uuid, vm_ref)
+            elif (update.kind == "modify" and
+                    "config.instanceUuid" in changes):
+                old_instance_uuid = values.get("config.instanceUuid")
+                new_instance_uuid = changes.get("config.instanceUuid")
+
+                if old_instance_uuid != new_instance_uuid:
+                    vm_util.vm_ref_cache_delete(old_instance_uuid)
+                    vm_util.vm_ref_cache_update(instance_uuid, vm_ref)
+
+            values.update(changes)
+            LOG.debug("VirtualMachine.%s.%s -> %s", update.kind,
+                      vm_ref.value, values)
+
+    def start_property_collector_watcher(self):
+        """Keep the VM cache up-to-date from a background thread"""
+        if not CONF.vmware.use_property_collector:
+            return
+
+        if self._property_collector_watcher is not None:
+            return
+
+        LOG.debug("Starting green property-collector watcher thread")
+        self._property_collector_watcher_stop = False
+        self._property_collector_watcher = utils.spawn(
+            self._property_collector_watcher_loop)
+
+    def stop_property_collector_watcher(self):
+        self._property_collector_watcher_stop = True
+
+    def _property_collector_watcher_loop(self):
+        # do the initial (potentially big) sync under the lock, so we do not
+        # race with a caller draining the property collector
+        while not self._property_collector_watcher_stop:
+            try:
+                self._drain_property_collector()
+                break
+            except Exception:
+                LOG.exception("Initial property-collector sync failed. "
+                              "Retrying.")
+                self._reset_property_collector()
+                time.sleep(CONF.vmware.task_poll_interval)
+
+        self._property_collector_watcher_running = True
+        try:
+            while not self._property_collector_watcher_stop:
+                try:
+                    self._wait_for_property_collector_updates(
+                        CONF.vmware.property_collector_max_wait_seconds)
+                except vexc.ManagedObjectNotFoundException:
+                    # the property collector lives in the session, so it's
+                    # gone after a re-login
+                    LOG.info("Property collector vanished. Probably the "
+                             "session got lost. Doing a full resync.")
+                    self._reset_property_collector()
+                except vexc.VimFaultException as e:
+                    if 'RequestCanceled' in e.fault_list:
+                        # someone else called WaitForUpdatesEx concurrently.
+                        # We're still in sync up to our version.
                         continue
-                    values = vm_util._VM_VALUE_CACHE[vm_ref.value]
-
-                    if update.kind == "leave":
-                        instance_uuid = values.get("config.instanceUuid")
-                        vm_util.vm_ref_cache_delete(instance_uuid)
-                        vm_util.vm_value_cache_delete(vm_ref)
-                        LOG.debug("Removed instance %s (%s) from cache...",
-                                  instance_uuid, vm_ref.value)
+                    if 'InvalidCollectorVersion' in e.fault_list:
+                        LOG.info("Property collector version %s became "
+                                 "invalid. Doing a full resync.",
+                                 self._property_collector_version)
                     else:
-                        changes = dict(
-                            self._parse_change_set(update.changeSet))
-                        LOG.debug("%s.%s.%s: %s", vm_ref["_type"], update.kind,
-                                  vm_ref.value, changes)
-                        if not (changes.get("config.managedBy") or
-                                values.get("config.managedBy")):
-                            LOG.debug("%s Not managed by nova", vm_ref.value)
-                            continue
-
-                        instance_uuid = changes.get("config.instanceUuid")
-
-                        if update.kind == "enter":
-                            vm_util.vm_ref_cache_update(instance_uuid, vm_ref)
-                        elif update.kind == "modify":
-                            old_instance_uuid = values.get(
-                                "config.instanceUuid")
-                            new_instance_uuid = changes.get(
-                                "config.instanceUuid")
-
-                            if old_instance_uuid != new_instance_uuid:
-                                vm_util.vm_ref_cache_delete(old_instance_uuid)
-                                vm_util.vm_ref_cache_update(instance_uuid,
-                                                            vm_ref)
+                        LOG.exception("Waiting for property-collector "
+                                      "updates failed. Doing a full resync.")
+                    self._reset_property_collector()
+                except Exception:
+                    LOG.exception("Waiting for property-collector updates "
+                                  "failed. Doing a full resync.")
+                    self._reset_property_collector()
+                    time.sleep(CONF.vmware.task_poll_interval)
+        finally:
+            self._property_collector_watcher_running = False
+            self._property_collector_watcher = None
+            self._reset_property_collector()
 
-                        values.update(changes)
-                        LOG.debug("%s.%s.%s -> %s", vm_ref["_type"],
-                                  update.kind, vm_ref.value, values)
+    def get_vm_cache_age(self):
+        """Return the seconds since the VM cache was last in sync or None
 
-            update_set = vim.WaitForUpdatesEx(self._property_collector,
-                version=self._property_collector_version,
-                options=options)
+        None means, the cache was never (or not since the last resync)
+        confirmed to be in sync with the vCenter.
+        """
+        if self._property_collector_last_sync is None:
+            return None
+        return time.monotonic() - self._property_collector_last_sync
+
+    def is_vm_cache_fresh(self, max_age=None):
+        """Return if the VM cache is recent enough to be trusted
+
+        :param max_age: the maximum age in seconds, defaults to
+                        CONF.vmware.property_collector_max_cache_age
+        """
+        if not CONF.vmware.use_property_collector:
+            return False
+
+        if max_age is None:
+            max_age = CONF.vmware.property_collector_max_cache_age
+
+        age = self.get_vm_cache_age()
+        return age is not None and age <= max_age
+
+    def get_vm_cache_info(self):
+        """Return the state of the VM cache for diagnostics"""
+        return {
+            'version': self._property_collector_version,
+            'age': self.get_vm_cache_age(),
+            'fresh': self.is_vm_cache_fresh(),
+            'watcher_running': self._property_collector_watcher_running,
+            'vms': len(vm_util._VM_VALUE_CACHE),
+        }
 
     def _get_vm_monitor_spec(self, vim):
         client_factory = vim.client.factory
@@ -4344,6 +4979,215 @@ class VMwareVMOps(object):
     def sync_server_group(self, context, sg_uuid):
         """Sync a server group by its uuid for the current host/cluster
         """
+        LOG.debug('Starting sync for server-group %s', sg_uuid)
+
+        @utils.synchronized(self._get_server_group_lock_name(sg_uuid))
+        def _sync_sync_server_group(context, sg_uuid):
+            cluster_rules = self._fetch_cluster_rule_list()
+            rule_specs = self._get_server_group_rule_specs(context, sg_uuid,
+                                                           cluster_rules)
+            self._reconfigure_cluster_rules(rule_specs)
+            LOG.debug('Sync for server-group %s done', sg_uuid)
+
+        _sync_sync_server_group(context, sg_uuid)
+
+    def start_server_group_sync_worker(self):
+        """Sync the server-groups queued by queue_server_group_sync()"""
+        if CONF.vmware.server_group_sync_queue_delay < 0:
+            return
+
+        if self._server_group_sync_worker is not None:
+            return
+
+        LOG.debug("Starting green server-group sync worker thread")
+        self._server_group_sync_worker_stop = False
+        self._server_group_sync_worker = utils.spawn(
+            self._server_group_sync_worker_loop)
+
+    def stop_server_group_sync_worker(self):
+        self._server_group_sync_worker_stop = True
+        self._server_group_sync_queued.set()
+
+    def queue_server_group_sync(self, sg_uuid):
+        """Queue a server-group to have its DRS rules synced by the worker
+
+        Returns False if the worker isn't running and thus the caller has to
+        take care of syncing the server-group itself.
+        """
+        if self._server_group_sync_worker is None:
+            return False
+
+        LOG.debug('Queuing sync for server-group %s', sg_uuid)
+        self._server_group_sync_queue.add(sg_uuid)
+        self._server_group_sync_queued.set()
+        return True
+
+    def _server_group_sync_worker_loop(self):
+        context = nova_context.get_admin_context()
+        try:
+            while not self._server_group_sync_worker_stop:
+                self._server_group_sync_queued.wait()
+                if self._server_group_sync_worker_stop:
+                    break
+
+                # give changes coming in together, e.g. from a multi-create or
+                # an evacuation, the chance to end up in the same sync
+                time.sleep(CONF.vmware.server_group_sync_queue_delay)
+
+                self._server_group_sync_queued.clear()
+                sg_uuids = self._server_group_sync_queue
+                self._server_group_sync_queue = set()
+                self._sync_queued_server_groups(context, sg_uuids)
+        finally:
+            self._server_group_sync_worker = None
+
+    def _sync_queued_server_groups(self, context, sg_uuids):
+        if not sg_uuids:
+            return
+
+        try:
+            self.sync_server_groups(context, sg_uuids)
+        except Exception as e:
+            LOG.exception('Failed to sync queued server-groups: %s', e)
+
+        try:
+            self.update_server_groups_hagroup_disk_placement(
+                context, sorted(sg_uuids))
+        except Exception as e:
+            LOG.exception('Failed to update disk placement of '
+                          'server-groups %s: %s', sorted(sg_uuids), e)
+
+    def sync_server_groups(self, context, sg_uuids):
+        """Sync multiple server groups for the current host/cluster
+
+        Contrary to calling sync_server_group() for each of them, this reads
+        the cluster's configuration only once and applies all necessary
+        changes to the DRS rules in a single reconfiguration of the cluster.
+        Failing to sync one server-group doesn't keep the others from being
+        synced. A server-group whose rules get changed concurrently is synced
+        again afterwards.
+        """
+        sg_uuids = sorted(set(sg_uuids))
+        if not sg_uuids:
+            return
+        LOG.debug('Starting sync for %d server-groups', len(sg_uuids))
+
+        cluster_rules = self._fetch_cluster_rule_list()
+        rule_states = {
+            sg_uuid: self._get_server_group_rule_state(cluster_rules, sg_uuid)
+            for sg_uuid in sg_uuids}
+        rule_specs_by_sg_uuid = {}
+        for sg_uuid in sg_uuids:
+            # we only hold the lock of a server-group while reading its state,
+            # so spawns and migrations of its members are not blocked by the
+            # DB queries of all other server-groups.
+            try:
+                with lockutils.lock(self._get_server_group_lock_name(sg_uuid),
+                                    lock_file_prefix='nova-'):
+                    specs = self._get_server_group_rule_specs(
+                        context, sg_uuid, cluster_rules)
+            except Exception as e:
+                LOG.exception('Failed to sync server-group %s: %s',
+                              sg_uuid, e)
+                continue
+            if specs:
+                rule_specs_by_sg_uuid[sg_uuid] = specs
+
+        resync_sg_uuids = []
+        with contextlib.ExitStack() as stack:
+            # A sync of a single server-group, e.g. by a spawn, might have
+            # changed its rules since we read them. We hold the locks of all
+            # server-groups we change until the reconfiguration is done and
+            # check their rules again, so our specs cannot overwrite such a
+            # change. Server-groups with changed rules get synced again. The
+            # locks are taken in order, so overlapping syncs cannot deadlock.
+            for sg_uuid in sorted(rule_specs_by_sg_uuid):
+                stack.enter_context(lockutils.lock(
+                    self._get_server_group_lock_name(sg_uuid),
+                    lock_file_prefix='nova-'))
+            if rule_specs_by_sg_uuid:
+                cluster_rules = self._fetch_cluster_rule_list()
+            for sg_uuid in sorted(rule_specs_by_sg_uuid):
+                rule_state = self._get_server_group_rule_state(cluster_rules,
+                                                               sg_uuid)
+                if rule_state != rule_states[sg_uuid]:
+                    LOG.debug('DRS rules of server-group %s changed during '
+                              'the sync', sg_uuid)
+                    del rule_specs_by_sg_uuid[sg_uuid]
+                    resync_sg_uuids.append(sg_uuid)
+
+            rule_specs = [rule_spec
+                          for specs in rule_specs_by_sg_uuid.values()
+                          for rule_spec in specs]
+            try:
+                self._reconfigure_cluster_rules(rule_specs)
+            except vexc.VimException as e:
+                # a single broken rule shouldn't keep all other server-groups
+                # from being synced
+                LOG.warning('Updating DRS rules of %d server-groups at once '
+                            'failed, retrying per server-group: %s',
+                            len(rule_specs_by_sg_uuid), e)
+                for sg_uuid, specs in rule_specs_by_sg_uuid.items():
+                    try:
+                        self._reconfigure_cluster_rules(specs)
+                    except vexc.VimException as e:
+                        LOG.exception('Failed to sync server-group %s: %s',
+                                      sg_uuid, e)
+
+        for sg_uuid in resync_sg_uuids:
+            if not self.queue_server_group_sync(sg_uuid):
+                self.sync_server_group(context, sg_uuid)
+
+        LOG.debug('Sync for %d server-groups done', len(sg_uuids))
+
+    @staticmethod
+    def _get_server_group_rule_state(cluster_rules, sg_uuid):
+        """Return a comparable state of all DRS rules of a server-group"""
+        rule_prefix = '{}{}'.format(constants.DRS_PREFIX, sg_uuid)
+        return sorted(
+            (rule.key, rule.name, getattr(rule, 'enabled', None),
+             sorted(vutil.get_moref_value(m) for m in getattr(rule, 'vm', [])))
+            for rule in cluster_rules if rule.name.startswith(rule_prefix))
+
+    @staticmethod
+    def _get_server_group_lock_name(sg_uuid):
+        return 'vmware-server-group-{}'.format(sg_uuid)
+
+    def _get_cluster_config(self, refresh=False):
+        """Return the configurationEx of the cluster
+
+        The configuration is kept until the next refresh, which happens with
+        every server-group sync.
+        """
+        if refresh or self._cluster_config is None:
+            self._cluster_config = self._session._call_method(
+                vutil, "get_object_property", self._cluster, "configurationEx")
+        return self._cluster_config
+
+    def _fetch_cluster_rule_list(self):
+        cluster_config = self._get_cluster_config(refresh=True)
+        return list(getattr(cluster_config, 'rule', []))
+
+    def _reconfigure_cluster_rules(self, rule_specs):
+        """Apply all given ClusterRuleSpec in a single reconfiguration"""
+        if not rule_specs:
+            return
+        client_factory = self._session.vim.client.factory
+        config_spec = client_factory.create('ns0:ClusterConfigSpecEx')
+        config_spec.rulesSpec = rule_specs
+        LOG.debug('Applying %d DRS rule changes', len(rule_specs))
+        cluster_util.reconfigure_cluster(self._session, self._cluster,
+                                         config_spec)
+        for rule_spec in rule_specs:
+            LOG.info('Applied DRS rule change: %s of rule %s',
+                     rule_spec.operation, rule_spec.info.name)
+
+    def _get_server_group_rule_specs(self, context, sg_uuid, cluster_rules):
+        """Return the ClusterRuleSpec necessary to sync the server-group
+
+        `cluster_rules` is the list of all DRS rules of the cluster. Its
+        rules get updated in place to reflect the changes returned.
+        """
         # we have to ignore instances currently in a volatitle state, where
         # either VMware cannot support them being in a DRS rule or we expect
         # them to go away during the syncing process, which could lead to
@@ -4356,234 +5200,214 @@ class VMwareVMOps(object):
             task_states.REBUILDING,
             task_states.REBUILD_BLOCK_DEVICE_MAPPING,
         ]
-        LOG.debug('Starting sync for server-group %s', sg_uuid)
-
-        @utils.synchronized('vmware-server-group-{}'.format(sg_uuid))
-        def _sync_sync_server_group(context, sg_uuid):
-            rule_prefix = '{}{}'.format(constants.DRS_PREFIX, sg_uuid)
-
-            # retrieve the server-group with its members
-            try:
-                sg = objects.instance_group.InstanceGroup.get_by_uuid(context,
-                                                                      sg_uuid)
-            except exception.InstanceGroupNotFound:
-                LOG.info('Server-group %s cannot be found in DB', sg_uuid)
-                # check if we have it in the vCenter. if yes, it's an orphan
-                # and needs deletion
-                rules = cluster_util.get_rules_by_prefix(
-                    self._session, self._cluster, rule_prefix)
-                for rule in rules:
-                    LOG.debug('Deleting DRS rule %s as orphan', rule.name)
-                    cluster_util.delete_rule(
-                        self._session, self._cluster, rule)
-                    LOG.info('Deleted rule %s as orphan', rule.name)
-                LOG.debug('Sync for server-group %s done', sg_uuid)
-                return
-
-            # First we check for all instances, which have ongoing migrations
-            # on the given host, either as source or destination
-
-            # Decision matrix for migrations:
-            # Mig-Status Action/Host
-            #            Source  Dest
-            # Preparing  Remove  N/A
-            # Running    Remove  Add
-            # (Other states are consistent with default behaviour)
-            #
-            # So the Instance.host will always be the source of the migration,
-            # and we want to remove the rules.
-            # We only need to handle specially the case a running migration
-            # on the destination host, and add it
-
-            MigrationList = objects.migration.MigrationList
-            filters = {
-                "host": self._compute_host,
-                "instance_uuid": sg.members,
-                "status": ["preparing", "running"],
-            }
-
-            expected_members = {}
-
-            migrations_by_instance_uuid = {}
-            for migration in MigrationList.get_by_filters(context, filters):
-                instance_uuid = migration.instance_uuid
-                if migration.source_compute == self._compute_host:
-                    # The host is the source of a migration
-                    # That means the instance will be part of the instance list
-                    # So we have to remember that instance to be removed from
-                    # the DRS rule-set
-                    migrations_by_instance_uuid[instance_uuid] = \
-                        migration
-                else:
-                    # We now handle the destination side
-                    if migration.status == "preparing":
-                        # Not even started, we can ignore that one
-                        continue
-
-                    # Polling the cache, as vm_util.get_vm_ref is very slow
-                    # for the negative search.
-                    # We just have to ensure, that the cache holds a value
-                    # before syncing the server group on the destination host
-                    # Race conditions are averted by this functions lock
-                    moref = vm_util.vm_ref_cache_get(instance_uuid)
-                    if moref:
-                        expected_members[instance_uuid] = moref
-
-            # retrieve the instances, because sg.members contains all members
-            # and we need to filter them for our host
-            InstanceList = objects.instance.InstanceList
-            filters = {'host': self._compute_host, 'uuid': sg.members,
-                       'deleted': False}
-            instances = InstanceList.get_by_filters(context, filters,
-                                                    expected_attrs=[])
-
-            for instance in instances:
-                task_state = instance.task_state
-                if task_state in STATES_EXCLUDING_MEMBERS_FROM_DRS_RULES:
-                    LOG.debug("Excluding member %s of server-group %s, "
-                              "because it's in task_state %s.",
-                              instance.uuid, sg.uuid, task_state)
-                    continue
-
-                migration = migrations_by_instance_uuid.get(instance.uuid)
-                if migration:
-                    LOG.debug("Excluding member %s of server-group %s, "
-                              "due to being on the source side of "
-                              "ongoing migration %s.",
-                              instance.uuid, sg.uuid, migration.uuid)
-                    continue
+        client_factory = self._session.vim.client.factory
+        rule_prefix = '{}{}'.format(constants.DRS_PREFIX, sg_uuid)
 
-                try:
-                    moref = vm_util.get_vm_ref(self._session, instance)
-                except exception.InstanceNotFound:
-                    LOG.warning('Could not find moref for instance %s. '
-                                'Ignoring member of server-group %s',
-                                instance.uuid, sg.uuid)
-                    continue
-                expected_members[instance.uuid] = moref
-
-            rule_members_by_name = {}
-            if sg.policy == 'soft-anti-affinity':
-                # we chunk by available hosts - 1, because we can spawn only as
-                # many VMs as there are hosts as VMWare doesn't provide any
-                # "soft" anti-affinity except for VM-Host relations, while we
-                # still allow 1 host to go into maintenance mode.
-                # Only hosts have an 'available' field - the cluster doesn't.
-                # Therefore, we don't have to filter out the aggregated cluster
-                # stats explicitly.
-                member_chunk_size = len(
-                    [stat for stat in self._vc_state.get_host_stats().values()
-                     if stat.get('available', False)])
-                member_chunk_size = max(member_chunk_size - 1, 1)
-
-                # to generate stable chunks we have to sort the expected
-                # members. we also need a list to be able to access parts of
-                # them.
-                expected_members = sorted(expected_members.items())
-
-                # generate chunks of the expected members with rules having a
-                # postfix counting up for the soft-anti-affinity policy
-                for i, j in enumerate(range(0, len(expected_members),
-                                            member_chunk_size)):
-                    rule_name = '{}-{}-{}'.format(rule_prefix, sg.policy, i)
-                    rule_members = expected_members[j:j + member_chunk_size]
-                    rule_members_by_name[rule_name] = rule_members
-
-                # we need to add in the existing rules with the same prefix,
-                # because there might be 1) old rules from before the chunking
-                # and 2) rules we don't reach anymore because the number of
-                # members of the sg is much lower now
-                existing_rule_names = [
-                    rule['name'] for rule in cluster_util.get_rules_by_prefix(
-                        self._session, self._cluster, rule_prefix)]
-
-                rule_names = \
-                    set(existing_rule_names) | set(rule_members_by_name)
-                for rule_name in rule_names:
-                    rule_members = rule_members_by_name.get(rule_name, [])
-                    _update_rule(rule_name, dict(rule_members), sg)
+        # retrieve the server-group with its members
+        try:
+            sg = objects.instance_group.InstanceGroup.get_by_uuid(context,
+                                                                  sg_uuid)
+        except exception.InstanceGroupNotFound:
+            LOG.info('Server-group %s cannot be found in DB', sg_uuid)
+            # check if we have it in the vCenter. if yes, it's an orphan
+            # and needs deletion
+            rule_specs = []
+            for rule in [r for r in cluster_rules
+                         if r.name.startswith(rule_prefix)]:
+                LOG.debug('Deleting DRS rule %s as orphan', rule.name)
+                rule_specs.append(cluster_util.create_rule_spec(
+                    client_factory, rule, 'remove'))
+                cluster_rules.remove(rule)
+            return rule_specs
+
+        # First we check for all instances, which have ongoing migrations
+        # on the given host, either as source or destination
+
+        # Decision matrix for migrations:
+        # Mig-Status Action/Host
+        #            Source  Dest
+        # Preparing  Remove  N/A
+        # Running    Remove  Add
+        # (Other states are consistent with default behaviour)
+        #
+        # So the Instance.host will always be the source of the migration,
+        # and we want to remove the rules.
+        # We only need to handle specially the case a running migration
+        # on the destination host, and add it
+
+        MigrationList = objects.migration.MigrationList
+        filters = {
+            "host": self._compute_host,
+            "instance_uuid": sg.members,
+            "status": ["preparing", "running"],
+        }
+
+        expected_members = {}
+
+        migrations_by_instance_uuid = {}
+        for migration in MigrationList.get_by_filters(context, filters):
+            instance_uuid = migration.instance_uuid
+            if migration.source_compute == self._compute_host:
+                # The host is the source of a migration
+                # That means the instance will be part of the instance list
+                # So we have to remember that instance to be removed from
+                # the DRS rule-set
+                migrations_by_instance_uuid[instance_uuid] = \
+                    migration
             else:
-                # no chunking necessary - just update the rule
-                rule_name = '{}-{}'.format(rule_prefix, sg.policy)
-                _update_rule(rule_name, expected_members, sg)
+                # We now handle the destination side
+                if migration.status == "preparing":
+                    # Not even started, we can ignore that one
+                    continue
 
-            LOG.debug('Sync for server-group %s done', sg_uuid)
+                # Polling the cache, as vm_util.get_vm_ref is very slow
+                # for the negative search.
+                # We just have to ensure, that the cache holds a value
+                # before syncing the server group on the destination host
+                # Race conditions are averted by this functions lock
+                moref = vm_util.vm_ref_cache_get(instance_uuid)
+                if moref:
+                    expected_members[instance_uuid] = moref
+
+        # retrieve the instances, because sg.members contains all members
+        # and we need to filter them for our host
+        InstanceList = objects.instance.InstanceList
+        filters = {'host': self._compute_host, 'uuid': sg.members,
+                   'deleted': False}
+        instances = InstanceList.get_by_filters(context, filters,
+                                                expected_attrs=[])
 
-        def _update_rule(rule_name, expected_members, sg):
-            # we need to get by "prefix", to get all rules matching our name,
-            # as there can be duplication happening with automatically
-            # vSphere-created rules during vMotion
-            rules = [r for r in cluster_util.get_rules_by_prefix(
-                        self._session, self._cluster, rule_name)
-                     if r.name == rule_name]
-
-            rule = rules[0] if rules else None
-
-            # if we have duplicates (with the same name), delete them
-            for dupl_rule in rules[1:]:
-                LOG.debug('Deleting DRS rule %s with key %s as duplicate',
-                          dupl_rule.name, dupl_rule.key)
-                cluster_util.delete_rule(
-                    self._session, self._cluster, dupl_rule)
-                LOG.info('Deleted rule %s with key %s as duplicate',
-                         dupl_rule.name, dupl_rule.key)
-
-            if not rule:
-                if len(expected_members) < 2 or sg.policy == 'soft-affinity':
-                    return
-                # we have to create a new rule
-                LOG.debug('Creating missing DRS rule %s with members %s',
-                          rule_name, ', '.join(expected_members))
-                client_factory = self._session.vim.client.factory
-                rule = cluster_util.create_vm_rule(
-                    client_factory, rule_name, list(expected_members.values()),
-                    policy=sg.policy)
-                cluster_util.add_rule(
-                    self._session, self._cluster, rule)
-                LOG.info('Created missing DRS rule %s with members %s',
-                         rule_name, ', '.join(expected_members))
-                return
+        for instance in instances:
+            task_state = instance.task_state
+            if task_state in STATES_EXCLUDING_MEMBERS_FROM_DRS_RULES:
+                LOG.debug("Excluding member %s of server-group %s, "
+                          "because it's in task_state %s.",
+                          instance.uuid, sg.uuid, task_state)
+                continue
 
-            if sg.policy == 'soft-affinity':
-                LOG.debug('Deleting DRS rule %s with policy soft-affinity',
-                          rule_name)
-                cluster_util.delete_rule(
-                    self._session, self._cluster, rule)
-                LOG.info('Deleted DRS rule %s with policy soft-affinity.',
-                          rule_name)
-                return
+            migration = migrations_by_instance_uuid.get(instance.uuid)
+            if migration:
+                LOG.debug("Excluding member %s of server-group %s, "
+                          "due to being on the source side of "
+                          "ongoing migration %s.",
+                          instance.uuid, sg.uuid, migration.uuid)
+                continue
 
-            if len(expected_members) < 2:
-                # we have to delete the rule
-                LOG.debug('Deleting DRS rule %s with < 2 members.', rule_name)
-                cluster_util.delete_rule(
-                    self._session, self._cluster, rule)
-                LOG.info('Deleted DRS rule %s with < 2 members.', rule_name)
-                return
+            try:
+                moref = vm_util.get_vm_ref(self._session, instance)
+            except exception.InstanceNotFound:
+                LOG.warning('Could not find moref for instance %s. '
+                            'Ignoring member of server-group %s',
+                            instance.uuid, sg.uuid)
+                continue
+            expected_members[instance.uuid] = moref
+
+        rule_specs = []
+        rule_members_by_name = {}
+        if sg.policy == 'soft-anti-affinity':
+            # we chunk by available hosts - 1, because we can spawn only as
+            # many VMs as there are hosts as VMWare doesn't provide any
+            # "soft" anti-affinity except for VM-Host relations, while we
+            # still allow 1 host to go into maintenance mode.
+            # Only hosts have an 'available' field - the cluster doesn't.
+            # Therefore, we don't have to filter out the aggregated cluster
+            # stats explicitly.
+            member_chunk_size = len(
+                [stat for stat in self._vc_state.get_host_stats().values()
+                 if stat.get('available', False)])
+            member_chunk_size = max(member_chunk_size - 1, 1)
+
+            # to generate stable chunks we have to sort the expected
+            # members. we also need a list to be able to access parts of
+            # them.
+            expected_members = sorted(expected_members.items())
+
+            # generate chunks of the expected members with rules having a
+            # postfix counting up for the soft-anti-affinity policy
+            for i, j in enumerate(range(0, len(expected_members),
+                                        member_chunk_size)):
+                rule_name = '{}-{}-{}'.format(rule_prefix, sg.policy, i)
+                rule_members = expected_members[j:j + member_chunk_size]
+                rule_members_by_name[rule_name] = rule_members
+
+            # we need to add in the existing rules with the same prefix,
+            # because there might be 1) old rules from before the chunking
+            # and 2) rules we don't reach anymore because the number of
+            # members of the sg is much lower now
+            existing_rule_names = [rule.name for rule in cluster_rules
+                                   if rule.name.startswith(rule_prefix)]
+
+            rule_names = \
+                set(existing_rule_names) | set(rule_members_by_name)
+            for rule_name in sorted(rule_names):
+                rule_members = rule_members_by_name.get(rule_name, [])
+                rule_specs.extend(self._get_server_group_rule_spec(
+                    rule_name, dict(rule_members), sg, cluster_rules))
+        else:
+            # no chunking necessary - just update the rule
+            rule_name = '{}-{}'.format(rule_prefix, sg.policy)
+            rule_specs.extend(self._get_server_group_rule_spec(
+                rule_name, expected_members, sg, cluster_rules))
 
-            if not rule.enabled:
-                LOG.debug('Enabling DRS rule %s.', rule_name)
-                rule.enabled = True
-                cluster_util.update_rule(
-                    self._session, self._cluster, rule)
-                LOG.info('Enabled DRS rule %s.', rule_name)
-
-            expected_moref_values = set(vutil.get_moref_value(m)
-                                        for m in expected_members.values())
-            existing_moref_values = set(vutil.get_moref_value(m)
-                                        for m in rule.vm)
-            if expected_moref_values == existing_moref_values:
-                return
+        return rule_specs
 
-            # we have to update the DRS rule to contain the right members
-            rule.vm = list(expected_members.values())
-            LOG.debug('Updating DRS rule %s with members %s',
+    def _get_server_group_rule_spec(self, rule_name, expected_members, sg,
+                                    cluster_rules):
+        """Return the ClusterRuleSpec to bring a rule to the expected state"""
+        client_factory = self._session.vim.client.factory
+        # we need to match all rules by name, as there can be duplication
+        # happening with automatically vSphere-created rules during vMotion
+        rules = [r for r in cluster_rules if r.name == rule_name]
+
+        rule = rules[0] if rules else None
+
+        rule_specs = []
+        # if we have duplicates (with the same name), delete them
+        for dupl_rule in rules[1:]:
+            LOG.debug('Deleting DRS rule %s with key %s as duplicate',
+                      dupl_rule.name, dupl_rule.key)
+            rule_specs.append(cluster_util.create_rule_spec(
+                client_factory, dupl_rule, 'remove'))
+            cluster_rules.remove(dupl_rule)
+
+        if not rule:
+            if len(expected_members) < 2 or sg.policy == 'soft-affinity':
+                return rule_specs
+            # we have to create a new rule
+            LOG.debug('Creating missing DRS rule %s with members %s',
                       rule_name, ', '.join(expected_members))
-            cluster_util.update_rule(self._session, self._cluster, rule)
-            LOG.info('Updated DRS rule %s with members %s',
-                     rule_name, ', '.join(expected_members))
-
-        _sync_sync_server_group(context, sg_uuid)
+            rule = cluster_util.create_vm_rule(
+                client_factory, rule_name, list(expected_members.values()),
+                policy=sg.policy)
+            rule_specs.append(cluster_util.create_rule_spec(
+                client_factory, rule, 'add'))
+            cluster_rules.append(rule)
+            return rule_specs
+
+        if sg.policy == 'soft-affinity' or len(expected_members) < 2:
+            LOG.debug('Deleting DRS rule %s with policy %s and %d members',
+                      rule_name, sg.policy, len(expected_members))
+            rule_specs.append(cluster_util.create_rule_spec(
+                client_factory, rule, 'remove'))
+            cluster_rules.remove(rule)
+            return rule_specs
+
+        expected_moref_values = set(vutil.get_moref_value(m)
+                                    for m in expected_members.values())
+        existing_moref_values = set(vutil.get_moref_value(m)
+                                    for m in getattr(rule, 'vm', []))
+        if rule.enabled and expected_moref_values == existing_moref_values:
+            return rule_specs
+
+        # we have to enable the DRS rule and update it to contain the right
+        # members
+        rule.enabled = True
+        rule.vm = list(expected_members.values())
+        LOG.debug('Updating DRS rule %s with members %s',
+                  rule_name, ', '.join(expected_members))
+        rule_specs.append(cluster_util.create_rule_spec(
+            client_factory, rule, 'edit'))
+        return rule_specs
 
     def place_vm(self, context, instance, host_ref=None):
         # We currently only fill the bare-minimum to get a placement.
@@ -4746,10 +5570,61 @@ class VMwareVMOps(object):
         A and B respectively. This action is done by the host/cluster
         responsible for these VMs.
         """
+        self.update_server_groups_hagroup_disk_placement(context, [sg_uuid])
+
+    def update_server_groups_hagroup_disk_placement(self, context, sg_uuids,
+                                                    max_spacing=None):
+        """Checks and remedies the root disk placement of multiple
+        server-groups
+
+        Contrary to calling update_server_group_hagroup_disk_placement() for
+        each of them, this plans the relocations of all server-groups up front
+        and runs them in parallel. See _run_hagroup_relocations() for the
+        limits.
+
+        If max_spacing is given, we sleep a random time of up to max_spacing
+        seconds before checking each server-group to spread the load on the
+        vCenter.
+
+        Errors in planning a single server-group are logged and do not stop
+        the others from being handled.
+        """
         # this feature is disabled as we have no way to find hagroups
         if not self._datastore_hagroup_regex:
             return
 
+        ephemeral_datastores = None
+        relocations = []
+        for sg_uuid in sg_uuids:
+            if max_spacing is not None:
+                time.sleep(random.uniform(0.5, max_spacing))
+            try:
+                if ephemeral_datastores is None:
+                    ephemeral_datastores = {
+                        vutil.get_moref_value(ds.ref): ds for ds in
+                        ds_util.get_available_datastores(
+                            self._session, self._cluster,
+                            self._datastore_regex)}
+                relocations.extend(self._plan_hagroup_relocations(
+                    context, sg_uuid, ephemeral_datastores))
+            except Exception as e:
+                LOG.exception('Failed to plan disk placement of '
+                              'server-group %s: %s', sg_uuid, e)
+
+        self._run_hagroup_relocations(context, relocations)
+
+    def _plan_hagroup_relocations(self, context, sg_uuid,
+                                  ephemeral_datastores):
+        """Return the relocations necessary to fix the hagroup placement of a
+        server-group
+
+        Returns a list of (sg_uuid, instance, hagroup, datastore) for every
+        instance that has to move its config and ephemeral disks to the
+        datastore. The expected disk space is reserved on the chosen datastore
+        under _get_relocation_reservation_key(), so following choices take it
+        into account.
+        If planning fails, the space reserved so far is released again.
+        """
         # try to find the server-group
         try:
             sg = objects.instance_group.InstanceGroup.get_by_uuid(context,
@@ -4757,18 +5632,18 @@ class VMwareVMOps(object):
         except nova.exception.InstanceGroupNotFound:
             LOG.warning("Cannot update hagroup placement for server-group %s: "
                         "InstanceGroup not found.", sg_uuid)
-            return
+            return []
 
         # we explicitly only handle anti-affinity
         if 'anti-affinity' not in sg.policy:
-            return
+            return []
 
         # get the relevant instances for this server-group
         sg_members = self._get_server_group_members_for_hagroup(context, sg)
 
         # nothing we can do if there aren't even 2 members to take care of
         if len(sg_members) < 2:
-            return
+            return []
 
         # check if member #1 or #2 belong to us
         InstanceList = objects.instance.InstanceList
@@ -4778,73 +5653,154 @@ class VMwareVMOps(object):
         instances = InstanceList.get_by_filters(context, filters,
                                                 expected_attrs=[])
         if not instances:
-            return
+            return []
 
-        for instance in instances:
-            hagroup = 'a' if sg_members[0] == instance.uuid else 'b'
-            LOG.debug("Checking hagroup %s disk placement of instance %s in "
-                      "server-group %s",
-                      hagroup, instance.uuid, sg_uuid)
-
-            # retrieve the currently used ephemeral datastores
-            # TODO(jkulik) implement something that checks against the
-            # swap-file, too
-            vm_ref = vm_util.get_vm_ref(self._session, instance)
-            properties = ["datastore"]
-            vm_props = self._session._call_method(vutil,
-                                                  "get_object_properties_dict",
-                                                  vm_ref,
-                                                  properties)
-            ephemeral_datastores = {
-                vutil.get_moref_value(ds.ref): ds for ds in
-                ds_util.get_available_datastores(self._session,
-                                                 self._cluster,
-                                                 self._datastore_regex)}
-
-            datastores = vim_util.get_array_items(vm_props['datastore'])
-            used_datastores = [vutil.get_moref_value(ds_ref)
-                               for ds_ref in datastores]
-
-            used_ephemeral_datastores = [
-                ephemeral_datastores[ds_ref_value]
-                for ds_ref_value in used_datastores
-                if ds_ref_value in ephemeral_datastores]
-
-            # get hagroup for the datastores and check if it matches
-            # expectations
-            for ds in used_ephemeral_datastores:
-                m = self._datastore_hagroup_regex.match(ds.name)
-                current_hagroup = '<unknown>'
-                if not m:
-                    break
-                current_hagroup = m.group('hagroup').lower()
-                if current_hagroup != hagroup:
-                    break
-            else:
+        relocations = []
+        try:
+            for instance in instances:
+                hagroup = 'a' if sg_members[0] == instance.uuid else 'b'
                 LOG.debug("Checking hagroup %s disk placement of instance %s "
-                          "in server-group %s finished: no action necessary.",
+                          "in server-group %s",
                           hagroup, instance.uuid, sg_uuid)
-                continue
 
-            # parts of the VM are on the wrong hagroup. we have to move it to a
-            # new datastore
-            LOG.debug("Instance %s in server-group %s resides on hagroup %s "
-                      "but should be on %s. Trying to remedy.",
-                      instance.uuid, sg_uuid, current_hagroup, hagroup)
-            storage_policy = self._get_storage_policy(instance.flavor)
-            allowed_ds_types = ds_util.get_allowed_datastore_types(
-                instance.image_meta.properties.hw_disk_type)
-            datastore = ds_util.get_datastore(self._session, self._cluster,
-                                              self._datastore_regex,
-                                              storage_policy,
-                                              allowed_ds_types,
-                                              datastore_hagroup_regex=
-                                                self._datastore_hagroup_regex,
-                                              datastore_hagroup=hagroup)
-            self.relocate_vm_config_and_ephemeral_disk(context, instance,
-                                                       datastore.ref)
-            LOG.debug("Moved instance %s in server-group %s to hagroup %s.",
-                      instance.uuid, sg_uuid, hagroup)
+                # retrieve the currently used ephemeral datastores
+                # TODO(jkulik) implement something that checks against the
+                # swap-file, too
+                vm_ref = vm_util.get_vm_ref(self._session, instance)
+                properties = ["datastore"]
+                vm_props = self._session._call_method(
+                    vutil, "get_object_properties_dict", vm_ref, properties)
+
+                datastores = vim_util.get_array_items(vm_props['datastore'])
+                used_datastores = [vutil.get_moref_value(ds_ref)
+                                   for ds_ref in datastores]
+
+                used_ephemeral_datastores = [
+                    ephemeral_datastores[ds_ref_value]
+                    for ds_ref_value in used_datastores
+                    if ds_ref_value in ephemeral_datastores]
+
+                # get hagroup for the datastores and check if it matches
+                # expectations
+                for ds in used_ephemeral_datastores:
+                    m = self._datastore_hagroup_regex.match(ds.name)
+                    current_hagroup = '<unknown>'
+                    if not m:
+                        break
+                    current_hagroup = m.group('hagroup').lower()
+                    if current_hagroup != hagroup:
+                        break
+                else:
+                    LOG.debug("Checking hagroup %s disk placement of instance "
+                              "%s in server-group %s finished: no action "
+                              "necessary.",
+                              hagroup, instance.uuid, sg_uuid)
+                    continue
+
+                # parts of the VM are on the wrong hagroup. we have to move it
+                # to a new datastore
+                LOG.debug("Instance %s in server-group %s resides on hagroup "
+                          "%s but should be on %s. Planning to remedy.",
+                          instance.uuid, sg_uuid, current_hagroup, hagroup)
+                storage_policy = self._get_storage_policy(instance.flavor)
+                allowed_ds_types = ds_util.get_allowed_datastore_types(
+                    instance.image_meta.properties.hw_disk_type)
+                # NOTE: root_gb is 0 for volume-backed instances, which do
+                # not move their root disk anyways. For image-backed instances
+                # without root_gb we underestimate, which is good enough to
+                # spread the relocations.
+                flavor = instance.flavor
+                reservation_size = ((flavor.root_gb + flavor.ephemeral_gb) *
+                                    units.Gi + flavor.swap * units.Mi)
+                datastore = ds_util.get_datastore(
+                    self._session, self._cluster, self._datastore_regex,
+                    storage_policy, allowed_ds_types,
+                    datastore_hagroup_regex=self._datastore_hagroup_regex,
+                    datastore_hagroup=hagroup,
+                    reservation_key=self._get_relocation_reservation_key(
+                        instance),
+                    reservation_size=reservation_size)
+                relocations.append((sg_uuid, instance, hagroup, datastore))
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                # nobody runs the relocations planned so far, so we have to
+                # give back the space reserved for them
+                for relocation in relocations:
+                    ds_util.release_datastore_space(
+                        self._get_relocation_reservation_key(relocation[1]))
+
+        return relocations
+
+    @staticmethod
+    def _get_relocation_reservation_key(instance):
+        """Return the key of the datastore space reserved for relocating the
+        instance
+
+        It differs from the instance's uuid used by spawn, so releasing one
+        doesn't release the other.
+        """
+        return '%s-relocate' % instance.uuid
+
+    def _run_hagroup_relocations(self, context, relocations):
+        """Run the relocations planned by _plan_hagroup_relocations()
+
+        At most ``hagroup_relocation_concurrency`` relocations run in
+        parallel and at most ``hagroup_relocation_concurrency_per_datastore``
+        of them target the same datastore, as the Storage vMotions of a
+        datastore share its throughput. The first error is raised after all
+        relocations have been tried.
+        """
+        if not relocations:
+            return
+
+        total = len(relocations)
+        ds_semaphores = collections.defaultdict(
+            lambda: semaphore.Semaphore(
+                CONF.vmware.hagroup_relocation_concurrency_per_datastore))
+        # the datastore's semaphore is taken before a slot, so a relocation
+        # waiting for its datastore doesn't block one to another datastore
+        slots = semaphore.Semaphore(
+            CONF.vmware.hagroup_relocation_concurrency)
+        done = []
+
+        def _relocate(sg_uuid, instance, hagroup, datastore):
+            try:
+                with ds_semaphores[vutil.get_moref_value(datastore.ref)]:
+                    with slots:
+                        self.relocate_vm_config_and_ephemeral_disk(
+                            context, instance, datastore.ref)
+            finally:
+                ds_util.release_datastore_space(
+                    self._get_relocation_reservation_key(instance))
+            done.append(instance.uuid)
+            LOG.info("Moved instance %(instance)s in server-group %(sg)s to "
+                     "hagroup %(hagroup)s (%(done)d of %(total)d "
+                     "relocations).",
+                     {'instance': instance.uuid, 'sg': sg_uuid,
+                      'hagroup': hagroup, 'done': len(done),
+                      'total': total})
+
+        threads = [utils.spawn(_relocate, *relocation)
+                   for relocation in relocations]
+
+        errors = []
+        for (sg_uuid, instance, hagroup, datastore), thread in zip(relocations,
+                                                                   threads):
+            try:
+                thread.wait()
+            except Exception as e:
+                errors.append(e)
+                LOG.error("Failed to move instance %(instance)s in "
+                          "server-group %(sg)s to hagroup %(hagroup)s: "
+                          "%(error)s",
+                          {'instance': instance.uuid, 'sg': sg_uuid,
+                           'hagroup': hagroup, 'error': e})
+        if errors:
+            LOG.warning("Finished %(done)d of %(total)d hagroup relocations, "
+                        "%(errors)d failed.",
+                        {'done': len(done), 'total': total,
+                         'errors': len(errors)})
+            raise errors[0]
 
     def _get_instance_config_info(self, context, instance, image_meta=None):
         """Returns VirtualMachineInstanceConfigInfo based on instance."""
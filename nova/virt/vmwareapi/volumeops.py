@@ -109,11 +109,86 @@ class VMwareVolumeOps(object):
                    'device_name': device_name, 'disk_type': disk_type},
                   instance=instance)
 
+    def attach_disks_to_vm(self, vm_ref, instance, disks,
+                           create_controllers_first=False):
+        """Attach several disks to VM by a single reconfiguration.
+
+        Every entry of disks is a dict holding adapter_type, disk_type and
+        vmdk_path of a disk and optionally the volume_uuid, backing_uuid and
+        profile_id as passed to attach_disk_to_vm. The controller slots of
+        all disks are allocated in one pass, missing controllers are created
+        in the same reconfigure request. With create_controllers_first, they
+        are created by a reconfigure of their own before, like _attach_fcd
+        does.
+        """
+        if not disks:
+            return
+
+        client_factory = self._session.vim.client.factory
+        adapter_types = [disk['adapter_type'] for disk in disks]
+        devices = vm_util.get_hardware_devices(self._session, vm_ref)
+        slots, controller_specs = \
+            vm_util.allocate_controller_keys_and_unit_numbers(
+                client_factory, devices, adapter_types)
+
+        if controller_specs and create_controllers_first:
+            config_spec = client_factory.create(
+                'ns0:VirtualMachineConfigSpec')
+            config_spec.deviceChange = list(controller_specs)
+            vm_util.reconfigure_vm(self._session, vm_ref, config_spec)
+            # The disks need the keys the vCenter gave the new controllers
+            devices = vm_util.get_hardware_devices(self._session, vm_ref)
+            slots, controller_specs = \
+                vm_util.allocate_controller_keys_and_unit_numbers(
+                    client_factory, devices, adapter_types)
+
+        config_spec = client_factory.create('ns0:VirtualMachineConfigSpec')
+        config_spec.deviceChange = list(controller_specs)
+        # The new disks need temporary keys distinct from each other and
+        # from the ones of the new controllers
+        disk_key = -101 - len(controller_specs)
+        volume_details = {}
+        for disk, (controller_key, unit_number) in zip(disks, slots):
+            disk_spec = vm_util._create_virtual_disk_spec(
+                client_factory, controller_key, disk['disk_type'],
+                disk['vmdk_path'], unit_number=unit_number,
+                profile_id=disk.get('profile_id'))
+            disk_spec.device.key = disk_key
+            disk_key -= 1
+            config_spec.deviceChange.append(disk_spec)
+
+            if disk.get('volume_uuid') and disk.get('backing_uuid'):
+                volume_details[disk['volume_uuid']] = disk['backing_uuid']
+
+        if volume_details:
+            self._add_volumes_details_to_config_spec(config_spec,
+                                                     volume_details)
+
+        vmdk_paths = [disk['vmdk_path'] for disk in disks]
+        LOG.debug("Reconfiguring VM instance %(vm_ref)s to attach "
+                  "disks %(vmdk_paths)s",
+                  {'vm_ref': vm_ref.value, 'vmdk_paths': vmdk_paths},
+                  instance=instance)
+        vm_util.reconfigure_vm(self._session, vm_ref, config_spec)
+        LOG.debug("Reconfigured VM instance %(vm_ref)s to attach "
+                  "disks %(vmdk_paths)s",
+                  {'vm_ref': vm_ref.value, 'vmdk_paths': vmdk_paths},
+                  instance=instance)
+
     def _add_volume_details_to_config_spec(self, config_spec, volume_uuid,
                                            device_uuid):
         """Store the UUID of the volume's device in extraConfig"""
-        volume_option = 'volume-%s' % volume_uuid
-        extra_opts = {volume_option: device_uuid}
+        self._add_volumes_details_to_config_spec(config_spec,
+                                                 {volume_uuid: device_uuid})
+
+    def _add_volumes_details_to_config_spec(self, config_spec,
+                                            volume_details):
+        """Store the UUIDs of the volumes' devices in extraConfig
+
+        volume_details maps the volume UUIDs to the UUIDs of their devices.
+        """
+        extra_opts = {'volume-%s' % volume_uuid: device_uuid
+                      for volume_uuid, device_uuid in volume_details.items()}
 
         client_factory = self._session.vim.client.factory
         config_spec.extraConfig = vm_util.create_extra_config(client_factory,
@@ -157,6 +232,40 @@ class VMwareVolumeOps(object):
                   {'vm_ref': vm_ref.value, 'disk_key': disk_key},
                   instance=instance)
 
+    def detach_disks_from_vm(self, vm_ref, instance, disks):
+        """Detach several disks from VM by a single reconfiguration.
+
+        disks is a list of (device, volume_uuid) tuples. If volume_uuid is not
+        None, the key-value pair <volume_id, vmdk_uuid> is removed from the
+        instance's extraConfig in the same reconfigure request.
+        """
+        if not disks:
+            return
+
+        client_factory = self._session.vim.client.factory
+        config_spec = client_factory.create('ns0:VirtualMachineConfigSpec')
+        config_spec.deviceChange = [
+            vm_util.detach_virtual_disk_spec(client_factory, device)
+            for device, _volume_uuid in disks]
+
+        volume_details = {volume_uuid: ''
+                          for _device, volume_uuid in disks
+                          if volume_uuid is not None}
+        if volume_details:
+            self._add_volumes_details_to_config_spec(config_spec,
+                                                     volume_details)
+
+        disk_keys = [device.key for device, _volume_uuid in disks]
+        LOG.debug("Reconfiguring VM instance %(vm_ref)s to detach "
+                  "disks %(disk_keys)s",
+                  {'vm_ref': vm_ref.value, 'disk_keys': disk_keys},
+                  instance=instance)
+        vm_util.reconfigure_vm(self._session, vm_ref, config_spec)
+        LOG.debug("Reconfigured VM instance %(vm_ref)s to detach "
+                  "disks %(disk_keys)s",
+                  {'vm_ref': vm_ref.value, 'disk_keys': disk_keys},
+                  instance=instance)
+
     def _iscsi_get_target(self, data):
         """Return the iSCSI Target given a volume info."""
         target_portal = data['target_portal']
@@ -447,6 +556,16 @@ class VMwareVolumeOps(object):
             vm_util.reconfigure_vm(self._session, vm_ref, config_spec)
             (_, _, controller_spec) = self._get_controller_key_and_unit(
                 vm_ref, adapter_type)
+        disk_info = self._get_fcd_disk_info(fcd_id, ds_ref_val)
+        self.attach_disk_to_vm(vm_ref, instance, adapter_type,
+                               disk_info['disk_type'],
+                               vmdk_path=disk_info['vmdk_path'],
+                               volume_uuid=disk_info['volume_uuid'],
+                               backing_uuid=disk_info['backing_uuid'],
+                               profile_id=profile_id)
+
+    def _get_fcd_disk_info(self, fcd_id, ds_ref_val):
+        """Look up the details needed to attach the disk of the fcd"""
         vstorage_mgr = self._session.vim.service_content.vStorageObjectManager
         virtual_dmgr = self._session.vim.service_content.virtualDiskManager
         cf = self._session.vim.client.factory
@@ -470,11 +589,10 @@ class VMwareVolumeOps(object):
         volume_uuid = fcd_obj.config.name.replace('volume-', '')
         disk_type = fcd_obj.config.backing.provisioningType
 
-        self.attach_disk_to_vm(vm_ref, instance, adapter_type, disk_type,
-                               vmdk_path=vmdk_path,
-                               volume_uuid=volume_uuid,
-                               backing_uuid=backing_uuid,
-                               profile_id=profile_id)
+        return {'disk_type': disk_type,
+                'vmdk_path': vmdk_path,
+                'volume_uuid': volume_uuid,
+                'backing_uuid': backing_uuid}
 
     def _attach_volume_fcd(self, connection_info, instance):
         """Attach fcd volume storage to VM instance."""
@@ -507,6 +625,82 @@ class VMwareVolumeOps(object):
         else:
             raise exception.VolumeDriverNotFound(driver_type=driver_type)
 
+    def _check_disk_hotplug(self, instance, adapter_type, vm_states):
+        """Raise if the adapter type does not support hotplug on the VM
+
+        vm_states is used to cache the power state of the instance over
+        several calls.
+        """
+        if adapter_type != constants.ADAPTER_TYPE_IDE:
+            return
+        if 'state' not in vm_states:
+            vm_states['state'] = vm_util.get_vm_state(self._session, instance)
+        if vm_states['state'] != power_state.SHUTDOWN:
+            raise exception.Invalid(_('%s does not support disk '
+                                      'hotplug.') % adapter_type)
+
+    def _get_volume_attach_disk_info(self, connection_info, instance, vm_ref,
+                                     adapter_type, vm_states):
+        """Return the attach_disks_to_vm entry of a vmdk or fcd volume"""
+        driver_type = connection_info['driver_volume_type']
+        data = connection_info['data']
+        if driver_type == constants.DISK_FORMAT_FCD:
+            adapter_type = data['adapter_type']
+            self._check_disk_hotplug(instance, adapter_type, vm_states)
+            disk_info = self._get_fcd_disk_info(data['id'],
+                                                data['ds_ref_val'])
+            disk_info['profile_id'] = data.get('profile_id')
+        else:
+            volume_ref = self._get_volume_ref(data)
+            vmdk = vm_util.get_vmdk_info(self._session, volume_ref)
+            if not adapter_type:
+                adapter_type = vm_util.get_vmdk_info(self._session,
+                                                     vm_ref).adapter_type
+            self._check_disk_hotplug(instance, adapter_type, vm_states)
+            disk_info = {'disk_type': vmdk.disk_type,
+                         'vmdk_path': vmdk.path,
+                         'volume_uuid': data['volume_id'],
+                         'backing_uuid': vmdk.device.backing.uuid,
+                         'profile_id': data['profile_id']}
+        disk_info['adapter_type'] = adapter_type
+        return disk_info
+
+    @vm_util.device_snapshot()
+    def attach_volumes(self, volumes, instance):
+        """Attach several volumes to VM instance.
+
+        volumes is a list of (connection_info, adapter_type) tuples. The disks
+        of all vmdk and fcd volumes get attached by a single reconfiguration
+        of the VM in the given order, other volume types are attached one by
+        one afterwards.
+        """
+        if not volumes:
+            return
+
+        vm_ref = vm_util.get_vm_ref(self._session, instance)
+        vm_states = {}
+        disks = []
+        other_volumes = []
+        has_fcd = False
+        for connection_info, adapter_type in volumes:
+            driver_type = connection_info['driver_volume_type']
+            if driver_type not in (constants.DISK_FORMAT_VMDK,
+                                   constants.DISK_FORMAT_FCD):
+                other_volumes.append((connection_info, adapter_type))
+                continue
+            has_fcd |= driver_type == constants.DISK_FORMAT_FCD
+            disks.append(self._get_volume_attach_disk_info(
+                connection_info, instance, vm_ref, adapter_type, vm_states))
+
+        LOG.debug("Volumes attach. Attaching %(count)d disks in one batch.",
+                  {'count': len(disks)}, instance=instance)
+        # fcds get attached to existing controllers only, see _attach_fcd()
+        self.attach_disks_to_vm(vm_ref, instance, disks,
+                                create_controllers_first=has_fcd)
+
+        for connection_info, adapter_type in other_volumes:
+            self.attach_volume(connection_info, instance, adapter_type)
+
     def _get_host_of_vm(self, vm_ref):
         """Get the ESX host of given VM."""
         return self._session._call_method(vutil, 'get_object_property',
@@ -614,21 +808,21 @@ class VMwareVolumeOps(object):
                                vmdk_path=current_device_path,
                                profile_id=profile_id)
 
-    def _get_vmdk_backed_disk_device(self, vm_ref, connection_info_data):
+    def _get_vmdk_backed_disk_device(self, vm_ref, connection_info_data,
+                                     index=None):
         # Get the vmdk file name that the VM is pointing to
-        hardware_devices = vm_util.get_hardware_devices(self._session, vm_ref)
+        if index is None:
+            index = vm_util.get_hardware_device_index(self._session, vm_ref)
         volume_uuid = connection_info_data['volume_id']
 
         # Try first the direct mapping
-        device = vm_util.get_vmdk_backed_disk_device(hardware_devices,
-                                                     volume_uuid)
+        device = index.get_vmdk_backed_disk(volume_uuid)
         if device:
             return device
 
         # Fall back to the indirect mapping
         disk_uuid = self._get_volume_uuid(vm_ref, volume_uuid)
-        device = vm_util.get_vmdk_backed_disk_device(hardware_devices,
-                                                     disk_uuid)
+        device = index.get_vmdk_backed_disk(disk_uuid)
         if not device:
             raise exception.DiskNotFound(message=_("Unable to find volume"))
         return device
@@ -642,15 +836,9 @@ class VMwareVolumeOps(object):
         data = connection_info['data']
         volume_ref = self._get_volume_ref(data)
 
-        device = self._get_vmdk_backed_disk_device(vm_ref, data)
-
-        hardware_devices = vm_util.get_hardware_devices(self._session, vm_ref)
-        adapter_type = None
-        for hw_device in hardware_devices:
-            if hw_device.key == device.controllerKey:
-                adapter_type = vm_util.CONTROLLER_TO_ADAPTER_TYPE.get(
-                    hw_device.__class__.__name__)
-                break
+        index = vm_util.get_hardware_device_index(self._session, vm_ref)
+        device = self._get_vmdk_backed_disk_device(vm_ref, data, index=index)
+        adapter_type = index.get_adapter_type(device)
 
         # IDE does not support disk hotplug
         if adapter_type == constants.ADAPTER_TYPE_IDE:
@@ -725,6 +913,68 @@ class VMwareVolumeOps(object):
         else:
             raise exception.VolumeDriverNotFound(driver_type=driver_type)
 
+    def _get_volume_detach_disk(self, connection_info, instance, vm_ref,
+                                vm_states):
+        """Return the device of a vmdk or fcd volume attached to the VM
+
+        For vmdk volumes, this consolidates the volume's backing first.
+        """
+        driver_type = connection_info['driver_volume_type']
+        data = connection_info['data']
+        if driver_type == constants.DISK_FORMAT_FCD:
+            self._check_disk_hotplug(instance, data['adapter_type'],
+                                     vm_states)
+            # Copy the volume_id to data, as we need this for device search
+            data['volume_id'] = block_device.get_volume_id(connection_info)
+            return self._get_vmdk_backed_disk_device(vm_ref, data)
+
+        volume_ref = self._get_volume_ref(data)
+        index = vm_util.get_hardware_device_index(self._session, vm_ref)
+        device = self._get_vmdk_backed_disk_device(vm_ref, data, index=index)
+        adapter_type = index.get_adapter_type(device)
+        self._check_disk_hotplug(instance, adapter_type, vm_states)
+
+        self._consolidate_vmdk_volume(instance, vm_ref, device, volume_ref,
+                                      adapter_type=adapter_type,
+                                      disk_type=vm_util._get_device_disk_type(
+                                          device),
+                                      profile_id=data.get('profile_id'))
+        return device
+
+    @vm_util.device_snapshot()
+    def detach_volumes(self, connection_infos, instance):
+        """Detach several volumes from VM instance.
+
+        The disks of all vmdk and fcd volumes get detached by a single
+        reconfiguration of the VM, other volume types are detached one by
+        one. Volumes without a disk attached to the VM are skipped.
+        """
+        if not connection_infos:
+            return
+
+        vm_ref = vm_util.get_vm_ref(self._session, instance)
+        vm_states = {}
+        disks = []
+        for connection_info in connection_infos:
+            driver_type = connection_info['driver_volume_type']
+            try:
+                if driver_type not in (constants.DISK_FORMAT_VMDK,
+                                       constants.DISK_FORMAT_FCD):
+                    self.detach_volume(connection_info, instance)
+                    continue
+                device = self._get_volume_detach_disk(
+                    connection_info, instance, vm_ref, vm_states)
+            except exception.DiskNotFound:
+                LOG.warning("Cannot find the disk of %s. Assuming it to be "
+                            "detached.", connection_info.get('serial'),
+                            instance=instance)
+                continue
+            disks.append((device, connection_info['data']['volume_id']))
+
+        LOG.debug("Volumes detach. Detaching %(count)d disks in one batch.",
+                  {'count': len(disks)}, instance=instance)
+        self.detach_disks_from_vm(vm_ref, instance, disks)
+
     def attach_root_volume(self, connection_info, instance,
                            datastore, adapter_type=None):
         """Attach a root volume to the VM instance."""
@@ -764,6 +1014,9 @@ class VMwareVolumeOps(object):
         # Cinder can delete the old shadow-vm, as soon as the attachment
         # for the vm prior the vmotion gets deleted
         vm_ref = vm_util.get_vm_ref(self._session, instance)
+        # Every shadow-vm gets reconfigured only once and all reconfigure
+        # tasks are started before waiting for any of them
+        tasks = []
         for device in vm_util.get_hardware_devices(self._session, vm_ref):
             class_name = device.__class__.__name__
 
@@ -775,37 +1028,71 @@ class VMwareVolumeOps(object):
                 continue
 
             try:
-                current_device_path = device.backing.fileName
-                volume = data["volume"]
-                volume_ref = vutil.get_moref(volume, "VirtualMachine")
-                original_device = self._get_vmdk_base_volume_device(volume_ref)
-                if original_device:
-                    original_device_path = original_device.backing.fileName
-                    if original_device_path == current_device_path:
-                        # Already attached
-                        continue
-
-                    # That should not happen
-                    LOG.warning("Shadow-vm %s already has a disk"
-                        " attached at %s replacing it with %s",
-                        volume, original_device_path, current_device_path,
-                        instance=instance
-                        )
-                    self.detach_disk_from_vm(volume_ref, instance,
-                        original_device, destroy_disk=True)
-
-                disk_type = vm_util._get_device_disk_type(device)
-                self.attach_disk_to_vm(volume_ref,
-                    instance,
-                    constants.DEFAULT_ADAPTER_TYPE,
-                    disk_type,
-                    current_device_path,
-                    profile_id=data.get("profile_id")
-                    )
+                volume_ref = vutil.get_moref(data["volume"], "VirtualMachine")
+                config_spec = self._get_shadow_vm_fixup_spec(
+                    instance, volume_ref, device, data)
+                if config_spec is None:
+                    continue
+                task = self._session._call_method(self._session.vim,
+                                                  "ReconfigVM_Task",
+                                                  volume_ref,
+                                                  spec=config_spec)
+                tasks.append((task, volume_ref, device, data))
+            except Exception:
+                LOG.exception("Failed to attach volume {}. Device {}".format(
+                    data["volume_id"],
+                    device.key), instance=instance)
+
+        for task, volume_ref, device, data in tasks:
+            try:
+                self._session._wait_for_task(task)
             except Exception:
                 LOG.exception("Failed to attach volume {}. Device {}".format(
                     data["volume_id"],
                     device.key), instance=instance)
+            finally:
+                vm_util.invalidate_device_snapshot(volume_ref)
+
+    def _get_shadow_vm_fixup_spec(self, instance, volume_ref, device, data):
+        """Build the spec attaching the disk device to the shadow-vm
+
+        A disk already attached to the shadow-vm is removed in the same spec.
+        Returns None, if the disk is already attached.
+        """
+        current_device_path = device.backing.fileName
+        hardware_devices = vm_util.get_hardware_devices(self._session,
+                                                        volume_ref)
+        original_device = vm_util.get_vmdk_volume_disk(hardware_devices)
+        client_factory = self._session.vim.client.factory
+        device_change = []
+        if original_device:
+            original_device_path = original_device.backing.fileName
+            if original_device_path == current_device_path:
+                # Already attached
+                return None
+
+            # That should not happen
+            LOG.warning("Shadow-vm %s already has a disk"
+                " attached at %s replacing it with %s",
+                data["volume"], original_device_path, current_device_path,
+                instance=instance
+                )
+            device_change.append(vm_util.detach_virtual_disk_spec(
+                client_factory, original_device, destroy_disk=True))
+
+        (controller_key, unit_number,
+         controller_spec) = vm_util.allocate_controller_key_and_unit_number(
+                                client_factory,
+                                hardware_devices,
+                                constants.DEFAULT_ADAPTER_TYPE)
+        config_spec = vm_util.get_vmdk_attach_config_spec(
+            client_factory, vm_util._get_device_disk_type(device),
+            current_device_path, controller_key=controller_key,
+            unit_number=unit_number, profile_id=data.get("profile_id"))
+        if controller_spec:
+            config_spec.deviceChange.append(controller_spec)
+        config_spec.deviceChange = device_change + config_spec.deviceChange
+        return config_spec
 
     def delete_shadow_vms(self, block_device_info, instance=None):
         # We need to delete the migrated shadow vms
@@ -850,10 +1137,9 @@ class VMwareVolumeOps(object):
         """
         remapped = {}
         vm_ref = vm_util.get_vm_ref(self._session, instance)
-        # TODO(fwiesel) Create a function
-        #  _get_vmdk_backed_disk_devices (plural)
-        # so we do not have two calls for each device
+        index = vm_util.get_hardware_device_index(self._session, vm_ref)
         for disk_info in disk_infos:
-            device = self._get_vmdk_backed_disk_device(vm_ref, disk_info)
+            device = self._get_vmdk_backed_disk_device(vm_ref, disk_info,
+                                                       index=index)
             remapped[device.key] = disk_info
         return remapped